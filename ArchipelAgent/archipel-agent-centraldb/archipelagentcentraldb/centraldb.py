@@ -23,13 +23,17 @@ import datetime
 import random
 
 from archipelcore.archipelPlugin import TNArchipelPlugin
+from archipelcore import dbentries
+from archipelcore.dbquery import TNDBQuery
 from archipelcore.pubsub import TNPubSubNode
 from archipelcore import xmpp
-from threading import Timer
+from threading import Lock, Timer
 
 # this pubsub is subscribed by all hypervisors and carries the keepalive messages
 # for the central agent
 ARCHIPEL_KEEPALIVE_PUBSUB                = "/archipel/centralagentkeepalive"
+# pubsub#max_items of the keepalive node, as created by archipel-centralagentnode
+ARCHIPEL_KEEPALIVE_PUBSUB_MAX_ITEMS      = 100
 
 ARCHIPEL_NS_CENTRALAGENT                 = "archipel:centralagent"
 
@@ -37,6 +41,10 @@ ARCHIPEL_ERROR_CODE_CENTRALAGENT         = 123
 
 ARCHIPEL_CENTRAL_AGENT_TIMEOUT           = 60
 
+# number of rows asked per page to the central agent, and
+# number of vms sent per get_existing_vms_instances request
+ARCHIPEL_CENTRAL_DB_PAGE_SIZE            = 200
+
 
 class TNTasks(object):
     """Timed jobs tasker"""
@@ -78,6 +86,7 @@ class TNCentralDb (TNArchipelPlugin):
             self.entity.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.hypervisor_hook_xmpp_authenticated)
             self.entity.register_hook("HOOK_HYPERVISOR_WOKE_UP", method=self.push_vms_in_central_db)
             self.entity.register_hook("HOOK_HYPERVISOR_FREE",  method=self.hook_vm_unregistered)
+            self.entity.register_hook("HOOK_HYPERVISOR_BULK_DONE", method=self.hook_bulk_done)
 
 
         if self.entity.__class__.__name__ == "TNArchipelVirtualMachine":
@@ -85,11 +94,14 @@ class TNCentralDb (TNArchipelPlugin):
             self.entity.register_hook("HOOK_VM_DEFINE",     method=self.hook_vm_event)
 
         self.central_agent_jid_val = None
+        self.central_agent_encoding = dbentries.ARCHIPEL_ENTRIES_ENCODING_XML
         self.last_keepalive_heard = None
         self.keepalive_interval = int(ARCHIPEL_CENTRAL_AGENT_TIMEOUT * 2)
         self.hypervisor_timeout_threshold = int(ARCHIPEL_CENTRAL_AGENT_TIMEOUT)
         self.delayed_tasks = TNTasks(self.entity.log)
         self.vms_to_hook = set()
+        self.deferred_entries = {}
+        self.deferred_lock = Lock()
 
         self.xmpp_authenticated    = False
 
@@ -113,16 +125,64 @@ class TNCentralDb (TNArchipelPlugin):
             return
 
         xmldesc = self.entity.xmldesc(mask_description=False)
-        vm_info = [{"uuid":self.entity.uuid,"parker":None,"creation_date":None,"domain":xmldesc,"hypervisor":self.entity.hypervisor.jid, 'name':xmldesc.getTag("name").getData()}]
-        self.register_vms(vm_info)
+        vm_info = {"uuid":self.entity.uuid,"parker":None,"creation_date":None,"domain":xmldesc,"hypervisor":self.entity.hypervisor.jid, 'name':xmldesc.getTag("name").getData()}
+        hypervisor_plugin = self.entity.hypervisor.get_plugin("centraldb")
+        if hypervisor_plugin and hypervisor_plugin.defer("registrations", vm_info):
+            return
+        self.register_vms([vm_info])
 
     def hook_vm_unregistered(self, origin=None, user_info=None, arguments=None):
         """
         Called when a VM termination occurs.
         This will advertise undefinition to the central agent.
         """
+        if self.defer("unregistrations", {"uuid":arguments.uuid}):
+            return
         self.unregister_vms([{"uuid":arguments.uuid}], None)
 
+    def hook_bulk_done(self, origin=None, user_info=None, arguments=None):
+        """
+        Called when a bulk operation of the hypervisor is done.
+        Sends the registrations and unregistrations deferred during the operation.
+        @type arguments: L{TNHypervisorBulkOperation}
+        @param arguments: the operation
+        """
+        self.deferred_lock.acquire()
+        entries = self.deferred_entries.pop(arguments.identifier, None)
+        self.deferred_lock.release()
+        if not entries:
+            return
+        if entries["registrations"]:
+            self.register_vms(entries["registrations"])
+        if entries["unregistrations"]:
+            self.unregister_vms(entries["unregistrations"], None)
+
+    def defer(self, kind, entry):
+        """
+        If the virtual machine of the entry is created or freed by a bulk
+        operation of the hypervisor, keep the entry to send it with the
+        others of the same operation when it is done.
+        @type kind: string
+        @param kind: "registrations" or "unregistrations"
+        @type entry: dict
+        @param entry: the entry
+        @rtype: Boolean
+        @return: True if the entry has been deferred
+        """
+        self.deferred_lock.acquire()
+        try:
+            # the operation is removed from the running ones before HOOK_HYPERVISOR_BULK_DONE
+            # is performed, so an entry deferred here is always sent by hook_bulk_done
+            operation = self.entity.get_bulk_operation_of_vm(entry["uuid"])
+            if not operation:
+                return False
+            if not operation.identifier in self.deferred_entries:
+                self.deferred_entries[operation.identifier] = {"registrations": [], "unregistrations": []}
+            self.deferred_entries[operation.identifier][kind].append(entry)
+            return True
+        finally:
+            self.deferred_lock.release()
+
     # Pubsub management
 
     def hypervisor_hook_xmpp_authenticated(self, origin=None, user_info=None, arguments=None):
@@ -137,7 +197,7 @@ class TNCentralDb (TNArchipelPlugin):
         """
 
         self.xmpp_authenticated  = True
-        self.central_keepalive_pubsub = TNPubSubNode(self.entity.xmppclient, self.entity.pubsubserver, ARCHIPEL_KEEPALIVE_PUBSUB)
+        self.central_keepalive_pubsub = TNPubSubNode(self.entity.xmppclient, self.entity.pubsubserver, ARCHIPEL_KEEPALIVE_PUBSUB, max_items=ARCHIPEL_KEEPALIVE_PUBSUB_MAX_ITEMS)
         self.central_keepalive_pubsub.recover()
         self.central_keepalive_pubsub.subscribe(self.entity.jid, self.handle_central_keepalive_event)
         self.entity.log.info("CENTRALDB: entity %s is now subscribed to events from node %s" % (self.entity.jid, ARCHIPEL_KEEPALIVE_PUBSUB))
@@ -175,6 +235,16 @@ class TNCentralDb (TNArchipelPlugin):
             self.entity.log.warning("CENTRALDB: Can't get central-agent presence, using keepalive to check it's availability.")
             return self.central_agent_jid_val
 
+    def entries_encoding(self):
+        """
+        Returns the encoding of entries negotiated with the central agent. In case we are a VM, query hypervisor.
+        @rtype: string
+        @return: the encoding
+        """
+        if self.entity.__class__.__name__ == "TNArchipelVirtualMachine":
+            return self.entity.hypervisor.get_plugin("centraldb").entries_encoding()
+        return self.central_agent_encoding
+
     def handle_central_keepalive_event(self, event):
         """
         Called when the central agent sends a keepalive.
@@ -198,8 +268,9 @@ class TNCentralDb (TNArchipelPlugin):
                 if central_announcement_event.getAttr("hypervisor_timeout_threshold"):
                     self.hypervisor_timeout_threshold = int(central_announcement_event.getAttr("hypervisor_timeout_threshold"))
 
-                self.central_agent_jid_val = keepalive_jid
-                self.last_keepalive_heard  = datetime.datetime.now()
+                self.central_agent_jid_val  = keepalive_jid
+                self.central_agent_encoding = dbentries.negotiate_encoding(central_announcement_event.getAttr("encodings"))
+                self.last_keepalive_heard   = datetime.datetime.now()
 
                 self.delayed_tasks.add((self.hypervisor_timeout_threshold - self.keepalive_interval) * 2 / 3, self.push_statistics_to_centraldb, {'central_announcement_event':central_announcement_event})
 
@@ -238,24 +309,28 @@ class TNCentralDb (TNArchipelPlugin):
         vms_from_local_db = self.entity.get_vms_from_local_db()
 
         if len(vms_from_local_db) > 0:
-            dbCommand = xmpp.Node(tag="event", attrs={"jid":self.entity.jid})
+            uuids = [xmpp.JID(vm["string_jid"]).getNode() for vm in vms_from_local_db]
+            existing_vms_entities = []
 
             def _get_existing_vms_instances_callback(conn, packed_vms):
-                existing_vms_entities = self.unpack_entries(packed_vms)
-                self.entity.manage_persistence(vms_from_local_db, existing_vms_entities)
-                if callback:
-                    callback(**kwargs)
-
-            for vm in vms_from_local_db:
-                entryTag = xmpp.Node(tag="entry")
-                uuid     = xmpp.JID(vm["string_jid"]).getNode()
-                entryTag.addChild("item",attrs={"key":"uuid","value": uuid})
-                dbCommand.addChild(node=entryTag)
-
-            iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=keepalive_jid)
-            iq.getTag("query").addChild(name="archipel", attrs={"action":"get_existing_vms_instances"})
-            iq.getTag("query").getTag("archipel").addChild(node=dbCommand)
-            self.entity.xmppclient.SendAndCallForResponse(iq, _get_existing_vms_instances_callback)
+                existing_vms_entities.extend(self.unpack_entries(packed_vms))
+                _ask_next_chunk()
+
+            def _ask_next_chunk():
+                if not uuids:
+                    self.entity.manage_persistence(vms_from_local_db, existing_vms_entities)
+                    if callback:
+                        callback(**kwargs)
+                    return
+                chunk = uuids[:ARCHIPEL_CENTRAL_DB_PAGE_SIZE]
+                del uuids[:ARCHIPEL_CENTRAL_DB_PAGE_SIZE]
+                dbCommand = self.build_event([{"uuid": uuid} for uuid in chunk])
+                iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=keepalive_jid)
+                iq.getTag("query").addChild(name="archipel", attrs={"action":"get_existing_vms_instances"})
+                iq.getTag("query").getTag("archipel").addChild(node=dbCommand)
+                self.entity.xmppclient.SendAndCallForResponse(iq, _get_existing_vms_instances_callback)
+
+            _ask_next_chunk()
 
         else:
             # update status to Online(0)
@@ -285,21 +360,61 @@ class TNCentralDb (TNArchipelPlugin):
     # Database Management
     # read commands
 
-    def read_hypervisors(self, columns, where_statement, callback):
+    def read_hypervisors(self, query, callback, page_callback=None):
         """
-        List vm in database.
-        @type table: list
-        @param table: the list of hypervisors to insert
+        Read hypervisors from central database.
+        @type query: L{TNDBQuery}
+        @param query: the query on the hypervisors table
+        @type callback: func
+        @param callback: called with the list of read hypervisors
+        @type page_callback: func
+        @param page_callback: if given, called with each page of read hypervisors (see read_from_db)
         """
-        self.read_from_db("read_hypervisors", columns, where_statement, callback)
+        self.read_from_db("read_hypervisors", query, callback, page_callback)
 
-    def read_vms(self, columns, where_statement, callback):
+    def read_vms(self, query, callback, page_callback=None):
         """
-        Registers a list of vms into central database.
-        @type table: list
-        @param table: the list of vms to insert
+        Read vms from central database.
+        @type query: L{TNDBQuery}
+        @param query: the query on the vms table
+        @type callback: func
+        @param callback: called with the list of read vms
+        @type page_callback: func
+        @param page_callback: if given, called with each page of read vms (see read_from_db)
         """
-        self.read_from_db("read_vms", columns, where_statement, callback)
+        self.read_from_db("read_vms", query, callback, page_callback)
+
+    def read_vms_by_uuids(self, uuids, callback, columns=None, conditions=()):
+        """
+        Read the vms with the given uuids from central database, with one
+        query per ARCHIPEL_CENTRAL_DB_PAGE_SIZE uuids, as sqlite accepts at
+        most 999 variables in a statement.
+        @type uuids: list
+        @param uuids: the uuids of the vms
+        @type callback: func
+        @param callback: called with the list of read vms, once all the queries are answered
+        @type columns: list
+        @param columns: the columns to return. All if None
+        @type conditions: list
+        @param conditions: names of predefined conditions the vms must match
+        """
+        uuids = list(uuids)
+        entries = []
+
+        def _read_next_chunk(read_entries=None):
+            if read_entries:
+                entries.extend(read_entries)
+            if not uuids:
+                callback(entries)
+                return
+            chunk = uuids[:ARCHIPEL_CENTRAL_DB_PAGE_SIZE]
+            del uuids[:ARCHIPEL_CENTRAL_DB_PAGE_SIZE]
+            query = TNDBQuery("vms", columns).where_in("uuid", chunk)
+            for condition in conditions:
+                query.condition(condition)
+            self.read_vms(query, _read_next_chunk)
+
+        _read_next_chunk()
 
     # write commands
 
@@ -382,13 +497,7 @@ class TNCentralDb (TNArchipelPlugin):
         central_agent_jid = self.central_agent_jid()
 
         if central_agent_jid:
-            dbCommand = xmpp.Node(tag="event", attrs={"jid":self.entity.jid})
-            for entry in table:
-                entryTag = xmpp.Node(tag="entry")
-                for key,value in entry.iteritems():
-                    entryTag.addChild("item",attrs={"key":key,"value":value})
-
-                dbCommand.addChild(node=entryTag)
+            dbCommand = self.build_event(table)
 
             iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=central_agent_jid)
             iq.getTag("query").addChild(name="archipel", attrs={"action":action})
@@ -398,39 +507,76 @@ class TNCentralDb (TNArchipelPlugin):
         else:
             self.entity.log.warning("CENTRALDB: cannot commit to db because we have not detected any central agent")
 
-    def read_from_db(self,action,columns, where_statement, callback):
+    def read_from_db(self, action, query, callback, page_callback=None):
         """
-        Send a select statement to central db.
-        @type command: string
-        @param command: the sql command to execute
-        @type columns: string
-        @param columns: the list of database columns to return
-        @type where_statement: string
-        @param where_statement: for database reads, provides "where" constraint
+        Send a select statement to central db. When the query has no order nor
+        limit of its own, the result is read by pages of ARCHIPEL_CENTRAL_DB_PAGE_SIZE
+        rows, each page being asked with the cursor returned with the previous one.
+        @type action: string
+        @param action: the read action of the central agent
+        @type query: L{TNDBQuery}
+        @param query: the query to run
+        @type callback: func
+        @param callback: called with the list of read entries. If page_callback is
+                         given, called with an empty list once all pages have been read
+        @type page_callback: func
+        @param page_callback: if given, called with the entries of each page as soon as
+                              it is received, and the entries are not kept in memory
         """
+        entries = []
 
         def _read_from_db_callback(conn, resp):
+            if resp.getType() == "error":
+                self.entity.log.error("CENTRALDB: error while reading [%s]: %s" % (action.upper(), resp.getTag("error")))
             unpacked_entries = self.unpack_entries(resp)
             self.entity.log.debug("CENTRALDB: read %s entries from db response" % len(unpacked_entries))
-            callback(unpacked_entries)
-
-        central_agent_jid = self.central_agent_jid()
-
-        if central_agent_jid:
-            dbCommand = xmpp.Node(tag="event", attrs={"jid":self.entity.jid})
-            if where_statement:
-                dbCommand.setAttr("where_statement", where_statement)
-
-            if columns:
-                dbCommand.setAttr("columns", columns)
-
-            self.entity.log.debug("CENTRALDB: Asking central db for [%s] %s %s" % (action.upper(), columns, where_statement))
+            if page_callback:
+                page_callback(unpacked_entries)
+            else:
+                entries.extend(unpacked_entries)
+            # central agents that do not know about pages send everything at once
+            page = resp.getTag("page")
+            if page and page.getAttr("next"):
+                query.cursor = page.getAttr("next")
+                _send_read_request()
+            elif callback:
+                callback(entries)
+
+        def _send_read_request():
+            central_agent_jid = self.central_agent_jid()
+            if not central_agent_jid:
+                self.entity.log.warning("CENTRALDB: cannot read from db because we have not detected any central agent")
+                return
+            dbCommand = self.build_event()
+            query.to_node(dbCommand)
+
+            self.entity.log.debug("CENTRALDB: Asking central db for [%s] %s" % (action.upper(), dbCommand))
             iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=central_agent_jid)
             iq.getTag("query").addChild(name="archipel", attrs={"action":action})
             iq.getTag("query").getTag("archipel").addChild(node=dbCommand)
             self.entity.xmppclient.SendAndCallForResponse(iq, _read_from_db_callback)
-        else:
-            self.entity.log.warning("CENTRALDB: cannot read from db because we have not detected any central agent")
+
+        if not query.page_size and query.is_pageable():
+            query.page(ARCHIPEL_CENTRAL_DB_PAGE_SIZE)
+        _send_read_request()
+
+    def build_event(self, entries=None):
+        """
+        Build the event node sent to the central agent, with the given entries
+        packed in the negotiated encoding.
+        @type entries: list
+        @param entries: the list of dict to send, if any
+        @rtype: xmpp.Node
+        @return: the event node
+        """
+        encoding = self.entries_encoding()
+        event = xmpp.Node(tag="event", attrs={"jid":self.entity.jid})
+        if encoding != dbentries.ARCHIPEL_ENTRIES_ENCODING_XML:
+            event.setAttr("accept_encoding", encoding)
+        if entries:
+            for node in dbentries.pack_entries(entries, encoding):
+                event.addChild(node=node)
+        return event
 
     def unpack_entries(self, iq):
         """
@@ -438,16 +584,7 @@ class TNCentralDb (TNArchipelPlugin):
         @type iq: xmpp.Iq
         @param event: received Iq
         """
-        entries = []
-
-        for entry in iq.getChildren():
-            entry_dict = {}
-            for entry_val in entry.getChildren():
-                if entry_val.getAttr("key"):
-                    entry_dict[entry_val.getAttr("key")] = entry_val.getAttr("value")
-            if entry_dict != {}:
-                entries.append(entry_dict)
-        return entries
+        return dbentries.unpack_entries(iq)
 
     # Plugin information
 
@@ -266,6 +266,11 @@ class TNHypervisorHealth (TNArchipelPlugin):
                     nodes.append(driverversion_node)
                 except Exception as ex:
                     raise Exception("Unable to append driverversion_node node.", ex)
+                try:
+                    domains_node = xmpp.Node("domains", attrs=self.entity.stats_sampler.summary())
+                    nodes.append(domains_node)
+                except Exception as ex:
+                    raise Exception("Unable to append domains stats node.", ex)
                 try:
                     basic_info = xmpp.Node("info", attrs=self.get_basic_info())
                     nodes.append(basic_info)
@@ -43,20 +43,20 @@ class AppNotificator (TNArchipelPlugin):
         for cred in creds.split(",,"):
             self.credentials.append(cred)
         if self.entity.__class__.__name__ == "TNArchipelVirtualMachine":
-            self.entity.register_hook("HOOK_VM_CREATE", method=self.vm_create)
-            self.entity.register_hook("HOOK_VM_SHUTOFF", method=self.vm_shutoff)
-            self.entity.register_hook("HOOK_VM_STOP", method=self.vm_stop)
-            self.entity.register_hook("HOOK_VM_DESTROY", method=self.vm_destroy)
-            self.entity.register_hook("HOOK_VM_SUSPEND", method=self.vm_suspend)
-            self.entity.register_hook("HOOK_VM_RESUME", method=self.vm_resume)
-            self.entity.register_hook("HOOK_VM_UNDEFINE", method=self.vm_undefine)
-            self.entity.register_hook("HOOK_VM_DEFINE", method=self.vm_define)
+            self.entity.register_hook("HOOK_VM_CREATE", method=self.vm_create, asynchronous=True)
+            self.entity.register_hook("HOOK_VM_SHUTOFF", method=self.vm_shutoff, asynchronous=True)
+            self.entity.register_hook("HOOK_VM_STOP", method=self.vm_stop, asynchronous=True)
+            self.entity.register_hook("HOOK_VM_DESTROY", method=self.vm_destroy, asynchronous=True)
+            self.entity.register_hook("HOOK_VM_SUSPEND", method=self.vm_suspend, asynchronous=True)
+            self.entity.register_hook("HOOK_VM_RESUME", method=self.vm_resume, asynchronous=True)
+            self.entity.register_hook("HOOK_VM_UNDEFINE", method=self.vm_undefine, asynchronous=True)
+            self.entity.register_hook("HOOK_VM_DEFINE", method=self.vm_define, asynchronous=True)
         elif self.entity.__class__.__name__ == "TNArchipelHypervisor":
-            self.entity.register_hook("HOOK_HYPERVISOR_ALLOC", method=self.hypervisor_alloc)
-            self.entity.register_hook("HOOK_HYPERVISOR_FREE", method=self.hypervisor_free)
-            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_LEAVE", method=self.hypervisor_migrate_leave)
-            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_ARRIVE", method=self.hypervisor_migrate_arrive)
-            self.entity.register_hook("HOOK_HYPERVISOR_CLONE", method=self.hypervisor_clone)
+            self.entity.register_hook("HOOK_HYPERVISOR_ALLOC", method=self.hypervisor_alloc, asynchronous=True)
+            self.entity.register_hook("HOOK_HYPERVISOR_FREE", method=self.hypervisor_free, asynchronous=True)
+            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_LEAVE", method=self.hypervisor_migrate_leave, asynchronous=True)
+            self.entity.register_hook("HOOK_HYPERVISOR_MIGRATEDVM_ARRIVE", method=self.hypervisor_migrate_arrive, asynchronous=True)
+            self.entity.register_hook("HOOK_HYPERVISOR_CLONE", method=self.hypervisor_clone, asynchronous=True)
 
 
     ### Plugin interface
@@ -39,6 +39,16 @@ ARCHIPEL_ERROR_CODE_SNAPSHOT_REVERT     = -2005
 ARCHIPEL_ERROR_CODE_SNAPSHOT_NO_DRIVE   = -2006
 
 
+# permissions of the plugin
+ARCHIPEL_SNAPSHOTING_PERMISSIONS = [
+    ("snapshot_take", "Authorizes user to get take a snapshot", False),
+    ("snapshot_delete", "Authorizes user to delete a snapshot", False),
+    ("snapshot_get", "Authorizes user to get all snapshots", False),
+    ("snapshot_current", "Authorizes user to get current used snapshot", False),
+    ("snapshot_revert", "Authorizes user to revert to a snapshot", False),
+]
+
+
 class TNSnapshoting (TNArchipelPlugin):
 
     def __init__(self, configuration, entity, entry_point_group):
@@ -53,11 +63,8 @@ class TNSnapshoting (TNArchipelPlugin):
         """
         TNArchipelPlugin.__init__(self, configuration=configuration, entity=entity, entry_point_group=entry_point_group)
         # permissions
-        self.entity.permission_center.create_permission("snapshot_take", "Authorizes user to get take a snapshot", False)
-        self.entity.permission_center.create_permission("snapshot_delete", "Authorizes user to delete a snapshot", False)
-        self.entity.permission_center.create_permission("snapshot_get", "Authorizes user to get all snapshots", False)
-        self.entity.permission_center.create_permission("snapshot_current", "Authorizes user to get current used snapshot", False)
-        self.entity.permission_center.create_permission("snapshot_revert", "Authorizes user to revert to a snapshot", False)
+        for name, description, default in ARCHIPEL_SNAPSHOTING_PERMISSIONS:
+            self.entity.permission_center.create_permission(name, description, default)
 
     ### Plugin interface
 
@@ -88,7 +95,9 @@ class TNSnapshoting (TNArchipelPlugin):
         return {    "common-name"               : plugin_friendly_name,
                     "identifier"                : plugin_identifier,
                     "configuration-section"     : plugin_configuration_section,
-                    "configuration-tokens"      : plugin_configuration_tokens }
+                    "configuration-tokens"      : plugin_configuration_tokens,
+                    "lazy-namespaces"           : [ARCHIPEL_NS_SNAPSHOTING],
+                    "lazy-permissions"          : ARCHIPEL_SNAPSHOTING_PERMISSIONS }
 
 
     ### XMPP Processing
@@ -42,6 +42,18 @@ ARCHIPEL_ERROR_CODE_DRIVES_GETGOLDEN    = -3007
 ARCHIPEL_ERROR_CODE_DRIVES_SETGOLDEN    = -3008
 
 
+# permissions of the plugin
+ARCHIPEL_STORAGE_PERMISSIONS = [
+    ("drives_create", "Authorizes user to get create a drive", False),
+    ("drives_delete", "Authorizes user to delete a drive", False),
+    ("drives_get", "Authorizes user to get all drives", False),
+    ("drives_getiso", "Authorizes user to get existing ISO images", False),
+    ("drives_convert", "Authorizes user to convert a drive", False),
+    ("drives_rename", "Authorizes user to rename a drive", False),
+    ("drives_create_golden", "Authorizes user to create a golden image", False),
+]
+
+
 class TNStorageManagement (TNArchipelPlugin):
     """
     Plugin that manages the storage volumes for virtual machines.
@@ -71,13 +83,8 @@ class TNStorageManagement (TNArchipelPlugin):
         if not os.path.exists(self.golden_drives_dir):
             os.makedirs(self.golden_drives_dir)
         # permissions
-        self.entity.permission_center.create_permission("drives_create", "Authorizes user to get create a drive", False)
-        self.entity.permission_center.create_permission("drives_delete", "Authorizes user to delete a drive", False)
-        self.entity.permission_center.create_permission("drives_get", "Authorizes user to get all drives", False)
-        self.entity.permission_center.create_permission("drives_getiso", "Authorizes user to get existing ISO images", False)
-        self.entity.permission_center.create_permission("drives_convert", "Authorizes user to convert a drive", False)
-        self.entity.permission_center.create_permission("drives_rename", "Authorizes user to rename a drive", False)
-        self.entity.permission_center.create_permission("drives_create_golden", "Authorizes user to create a golden image", False)
+        for name, description, default in ARCHIPEL_STORAGE_PERMISSIONS:
+            self.entity.permission_center.create_permission(name, description, default)
 
 
     ### Plugin interface
@@ -110,7 +117,9 @@ class TNStorageManagement (TNArchipelPlugin):
         return {    "common-name"               : plugin_friendly_name,
                     "identifier"                : plugin_identifier,
                     "configuration-section"     : plugin_configuration_section,
-                    "configuration-tokens"      : plugin_configuration_tokens }
+                    "configuration-tokens"      : plugin_configuration_tokens,
+                    "lazy-namespaces"           : [ARCHIPEL_NS_VM_DISK],
+                    "lazy-permissions"          : ARCHIPEL_STORAGE_PERMISSIONS }
 
 
     ### Utilities
@@ -296,6 +305,7 @@ class TNStorageManagement (TNArchipelPlugin):
             path        = query_node.getTag("archipel").getAttr("path")
             format      = query_node.getTag("archipel").getAttr("format")
             disk_path   = path.replace(path.split(".")[-1], "") + format
+            self.entity.check_not_backing_overlays("convert its drives")
             if os.path.exists(disk_path):
                 raise Exception("The disk with same name and extension already exists.")
             self.entity.change_presence(presence_show="dnd", presence_status="Converting a disk...")
@@ -337,6 +347,7 @@ class TNStorageManagement (TNArchipelPlugin):
             newname = query_node.getTag("archipel").getAttr("newname").replace(" ", "_").replace("/", "_").replace("..", "_")
             extension = path.split(".")[-1]
             newpath = os.path.join(self.entity.folder, "%s.%s" % (newname, extension))
+            self.entity.check_not_backing_overlays("rename its drives")
             if os.path.exists(newpath):
                 raise Exception("The disk with name %s already exists." % newname)
             os.rename(path, newpath)
@@ -363,6 +374,7 @@ class TNStorageManagement (TNArchipelPlugin):
             secure_disk_path    = os.path.join(self.entity.folder, secure_disk_name)
             old_status          = self.entity.xmppstatus
             old_show            = self.entity.xmppstatusshow
+            self.entity.check_not_backing_overlays("delete its drives")
             self.entity.change_presence(presence_show="dnd", presence_status="Deleting a drive...")
             os.unlink(secure_disk_path)
             disk_nodes = []
@@ -203,11 +203,10 @@ class TNArchipelVNC (TNArchipelPlugin):
         @rtype: dict
         @return: dict containing the information about VNC screen
         """
-        xmldesc = self.entity.domain.XMLDesc(0)
-        xmldescnode = xmpp.simplexml.NodeBuilder(data=xmldesc).getDom()
         try:
-            directport = int(xmldescnode.getTag(name="devices").getTag(name="graphics").getAttr("port"))
-            screentype = xmldescnode.getTag(name="devices").getTag(name="graphics").getAttr("type")
+            graphics = self.entity.get_domain_devices()["graphics"][0]
+            directport = graphics["port"]
+            screentype = graphics["type"]
 
             if directport == -1:
                 return {"direct"        : -1,
@@ -28,6 +28,7 @@ import string
 from archipel.archipelHypervisor import TNArchipelHypervisor
 from archipel.archipelVirtualMachine import TNArchipelVirtualMachine
 from archipelcore.archipelPlugin import TNArchipelPlugin
+from archipelcore.dbquery import TNDBQuery
 from archipelcore import xmpp
 
 from archipelcore.utils import build_error_iq, build_error_message
@@ -128,8 +129,7 @@ class TNVMParking (TNArchipelPlugin):
         uuid_strings = []
         for vm in vms:
             uuid_strings.append(vm["uuid"])
-        where_statement = "uuid='" + "' or uuid='".join(uuid_strings) + "' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online'))"
-        self.entity.get_plugin("centraldb").read_vms("*", where_statement, callback)
+        self.entity.get_plugin("centraldb").read_vms_by_uuids(uuid_strings, callback, conditions=["parked"])
 
     def get_vms_from_name(self, name, callback):
         """
@@ -137,8 +137,8 @@ class TNVMParking (TNArchipelPlugin):
         @type name: string
         @param name: The pattern name of vms like vm_
         """
-        where_statement = "name like '%s%' and domain != 'None' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online')) order by name" % name
-        self.entity.get_plugin("centraldb").read_vms("*", where_statement, callback)
+        query = TNDBQuery("vms").where("name", "like", "%s%%" % name).condition("defined").condition("parked").order("name")
+        self.entity.get_plugin("centraldb").read_vms(query, callback)
 
     def get_vms(self, iq, conn):
         """
@@ -170,10 +170,10 @@ class TNVMParking (TNArchipelPlugin):
                 reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
             self.entity.xmppclient.send(reply)
             raise xmpp.protocol.NodeProcessed
-        where_statement = "domain != 'None' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online')) order by name limit %s offset %s" % (vms_per_page, vms_per_page * int(page))
+        query = TNDBQuery("vms").condition("defined").condition("parked").order("name").slice(vms_per_page, vms_per_page * int(page))
         if filter:
-            where_statement = "name like '%%%s%%' and %s" % (filter, where_statement)
-        self.entity.get_plugin("centraldb").read_vms("*", where_statement, _on_centralagent_reply)
+            query.where("name", "like", "%%%s%%" % filter)
+        self.entity.get_plugin("centraldb").read_vms(query, _on_centralagent_reply)
 
     # Plugin information
 
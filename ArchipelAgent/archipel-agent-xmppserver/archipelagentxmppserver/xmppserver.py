@@ -24,6 +24,7 @@ import time
 import re
 
 from archipelcore.archipelPlugin import TNArchipelPlugin
+from archipelcore.dbquery import TNDBQuery
 from archipelcore.utils import build_error_iq
 from archipelcore import xmpp
 
@@ -285,12 +286,14 @@ class TNXMPPServerController (TNArchipelPlugin):
         @type args: dict
         @param args: optional kwards of the callback
         """
-        for vm in self.entity.read_vms('uuid', None):
-            entry = "%s@%s" % (vm.get('uuid'), self.xmpp_server)
-            self.entities_from_central_db['virtualmachines'].add(entry)
+        for vms in self.entity.read_pages(TNDBQuery("vms", ["uuid"])):
+            for vm in vms:
+                entry = "%s@%s" % (vm.get('uuid'), self.xmpp_server)
+                self.entities_from_central_db['virtualmachines'].add(entry)
 
-        for hyp in self.entity.read_hypervisors("jid"):
-            self.entities_from_central_db['hypervisors'].add(hyp.get('jid').split('/')[0])
+        for hyps in self.entity.read_pages(TNDBQuery("hypervisors", ["jid"])):
+            for hyp in hyps:
+                self.entities_from_central_db['hypervisors'].add(hyp.get('jid').split('/')[0])
 
         start_time = time.time()
 
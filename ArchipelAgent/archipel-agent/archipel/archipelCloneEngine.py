@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+#
+# archipelCloneEngine.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNCloneEngine}, that copies the folder of a virtual machine
+into the folder of its clone.
+
+Each file is cloned with the cheapest available method:
+    - overlay: for the disks given as overlays, a qcow2 image backed by
+      the original disk is created. Nothing is copied, but the original
+      disk must not be modified or removed while the clone exists
+    - reflink: the file shares its blocks with the original one, on
+      copy-on-write filesystems (btrfs, xfs with reflink, ...)
+    - copy: only the data segments of the file are copied, with
+      copy_file_range when the kernel provides it, so holes of sparse
+      images stay holes. When the data has to be read, zero filled
+      blocks are not written either.
+
+Files are processed in parallel by a pool of workers, biggest first.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import Queue
+import shutil
+import subprocess
+import time
+from threading import Lock, Thread
+
+
+ARCHIPEL_CLONE_MODE_COPY            = "copy"
+ARCHIPEL_CLONE_MODE_OVERLAY         = "overlay"
+ARCHIPEL_CLONE_MODES                = (ARCHIPEL_CLONE_MODE_COPY, ARCHIPEL_CLONE_MODE_OVERLAY)
+
+ARCHIPEL_CLONE_WORKERS              = 2
+ARCHIPEL_CLONE_CHUNK_SIZE           = 8 * 1024 * 1024
+ARCHIPEL_CLONE_PROGRESS_INTERVAL    = 2.0
+
+# linux/fs.h
+FICLONE     = 0x40049409
+SEEK_DATA   = 3
+SEEK_HOLE   = 4
+
+# errors meaning that a method is not available for this pair of files
+UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS)
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    copy_file_range = libc.copy_file_range
+    copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint]
+    copy_file_range.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    copy_file_range = None
+
+
+def data_segments(fd, size):
+    """
+    List the data segments of a file, skipping its holes.
+    @type fd: integer
+    @param fd: the file descriptor
+    @type size: integer
+    @param size: the size of the file
+    @rtype: list
+    @return: list of (start, end) offsets
+    """
+    segments = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                break
+            if ex.errno == errno.EINVAL and offset == 0:
+                # the filesystem cannot tell where the holes are
+                return [(0, size)]
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        segments.append((start, end))
+        offset = end
+    return segments
+
+
+class TNCloneEngine (object):
+    """
+    Copy the files of a folder into another one, with a pool of workers.
+    """
+
+    def __init__(self, src_path, dst_path, overlays=None, workers=ARCHIPEL_CLONE_WORKERS, qemu_img_bin="qemu-img", log=None, progress_callback=None):
+        """
+        The contructor of the class.
+        @type src_path: string
+        @param src_path: the folder to copy
+        @type dst_path: string
+        @param dst_path: the destination folder
+        @type overlays: dict
+        @param overlays: name of file -> format, for the disks cloned as qcow2 overlays
+        @type workers: integer
+        @param workers: max number of files cloned at the same time
+        @type qemu_img_bin: string
+        @param qemu_img_bin: the qemu-img binary, used to create overlays
+        @type log: logging.Logger
+        @param log: the logger
+        @type progress_callback: function
+        @param progress_callback: called with the percentage of cloned data
+        """
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.overlays = overlays or {}
+        self.workers = max(1, workers)
+        self.qemu_img_bin = qemu_img_bin
+        self.log = log
+        self.progress_callback = progress_callback
+        self.queue = Queue.Queue()
+        self.lock = Lock()
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.last_report_date = 0
+        self.last_reported_percentage = None
+        self.errors = []
+        self.use_reflink = True
+        self.use_copy_file_range = copy_file_range is not None
+
+    ### Progress
+
+    def add_progress(self, count):
+        """
+        Count cloned bytes and report the progress if needed.
+        @type count: integer
+        @param count: number of bytes
+        """
+        with self.lock:
+            self.done_bytes += count
+            now = time.time()
+            if now - self.last_report_date < ARCHIPEL_CLONE_PROGRESS_INTERVAL:
+                return
+            percentage = self.percentage()
+            if percentage == self.last_reported_percentage:
+                return
+            self.last_report_date = now
+            self.last_reported_percentage = percentage
+        self.report(percentage)
+
+    def percentage(self):
+        """
+        @rtype: integer
+        @return: the percentage of cloned data
+        """
+        if not self.total_bytes:
+            return 100
+        return min(100, int(self.done_bytes * 100 / self.total_bytes))
+
+    def report(self, percentage):
+        """
+        Give the progress to the callback.
+        @type percentage: integer
+        @param percentage: the percentage of cloned data
+        """
+        if not self.progress_callback:
+            return
+        try:
+            self.progress_callback(percentage)
+        except Exception as ex:
+            self.log.warning("CLONING: unable to report progress: %s" % str(ex))
+
+    ### Cloning methods
+
+    def create_overlay(self, src, dst, backing_format):
+        """
+        Create a qcow2 image backed by the given disk.
+        @type src: string
+        @param src: the path of the backing disk
+        @type dst: string
+        @param dst: the path of the overlay
+        @type backing_format: string
+        @param backing_format: the format of the backing disk
+        """
+        ret = subprocess.call([self.qemu_img_bin, "create", "-f", "qcow2", "-b", src, "-F", backing_format, dst])
+        if not ret == 0:
+            raise Exception("qemu-img returned %d while creating overlay %s" % (ret, dst))
+
+    def reflink(self, src_fd, dst_fd):
+        """
+        Share the blocks of the source file with the destination one.
+        @rtype: Boolean
+        @return: False if the filesystem does not support it
+        """
+        if not self.use_reflink:
+            return False
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return True
+        except IOError as ex:
+            if ex.errno in UNSUPPORTED_ERRNOS:
+                self.use_reflink = False
+                return False
+            raise
+
+    def copy_range_in_kernel(self, src_fd, dst_fd, start, end):
+        """
+        Copy a segment with copy_file_range. The kernel may share the
+        blocks instead of copying them (nfs, cifs, btrfs...).
+        @rtype: integer
+        @return: the offset where the copy stopped, start if it is not supported
+        """
+        src_offset = ctypes.c_longlong(start)
+        dst_offset = ctypes.c_longlong(start)
+        while src_offset.value < end:
+            count = min(end - src_offset.value, ARCHIPEL_CLONE_CHUNK_SIZE * 16)
+            copied = copy_file_range(src_fd, ctypes.byref(src_offset), dst_fd, ctypes.byref(dst_offset), count, 0)
+            if copied < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error in UNSUPPORTED_ERRNOS:
+                    self.use_copy_file_range = False
+                    break
+                raise OSError(error, os.strerror(error))
+            if copied == 0:
+                break
+            self.add_progress(copied)
+        return src_offset.value
+
+    def copy_range(self, src_fd, dst_fd, start, end):
+        """
+        Copy a segment by reading it. Zero filled chunks are skipped, so
+        they become holes in the destination file.
+        """
+        zero_chunk = "\0" * ARCHIPEL_CLONE_CHUNK_SIZE
+        offset = start
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        while offset < end:
+            chunk = os.read(src_fd, min(end - offset, ARCHIPEL_CLONE_CHUNK_SIZE))
+            if not chunk:
+                break
+            if not chunk == zero_chunk[:len(chunk)]:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                written = 0
+                while written < len(chunk):
+                    written += os.write(dst_fd, chunk[written:])
+            offset += len(chunk)
+            self.add_progress(len(chunk))
+
+    def copy_file(self, src, dst):
+        """
+        Clone one file with reflink, or copy its data segments.
+        @type src: string
+        @param src: the source file
+        @type dst: string
+        @param dst: the destination file
+        @rtype: string
+        @return: the used method
+        """
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                size = os.fstat(src_fd).st_size
+                if self.reflink(src_fd, dst_fd):
+                    self.add_progress(os.fstat(src_fd).st_blocks * 512)
+                    return "reflink"
+                method = "sparse copy"
+                for start, end in data_segments(src_fd, size):
+                    if self.use_copy_file_range:
+                        method = "copy_file_range"
+                        start = self.copy_range_in_kernel(src_fd, dst_fd, start, end)
+                    if start < end:
+                        self.copy_range(src_fd, dst_fd, start, end)
+                # keep the trailing hole
+                os.ftruncate(dst_fd, size)
+                return method
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+    def clone_file(self, name):
+        """
+        Clone one file of the source folder.
+        @type name: string
+        @param name: the name of the file
+        """
+        src = os.path.join(self.src_path, name)
+        dst = os.path.join(self.dst_path, name)
+        start_time = time.time()
+        if name in self.overlays:
+            self.create_overlay(src, dst, self.overlays[name])
+            self.add_progress(os.stat(src).st_blocks * 512)
+            method = "qcow2 overlay"
+        else:
+            method = self.copy_file(src, dst)
+            shutil.copymode(src, dst)
+        self.log.info("CLONING: %s cloned with %s in %.1fs" % (name, method, time.time() - start_time))
+
+    ### Running
+
+    def work(self):
+        """
+        Worker loop: clone files until the queue is empty.
+        """
+        while True:
+            try:
+                name = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.clone_file(name)
+            except Exception as ex:
+                self.log.error("CLONING: unable to clone %s: %s" % (name, str(ex)))
+                with self.lock:
+                    self.errors.append("%s: %s" % (name, str(ex)))
+
+    def run(self):
+        """
+        Clone all the files of the source folder, and wait for the end.
+        Sub folders are ignored.
+        """
+        files = []
+        for name in os.listdir(self.src_path):
+            path = os.path.join(self.src_path, name)
+            if not os.path.isfile(path):
+                self.log.warning("CLONING: %s is not a file, ignoring it" % path)
+                continue
+            allocated = os.stat(path).st_blocks * 512
+            files.append((allocated, name))
+            self.total_bytes += allocated
+        files.sort(reverse=True)
+        for allocated, name in files:
+            self.queue.put(name)
+
+        start_time = time.time()
+        workers = [Thread(target=self.work) for i in range(min(self.workers, len(files)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self.errors:
+            raise Exception("Unable to clone %s" % ", ".join(self.errors))
+        self.report(100)
+        self.log.info("CLONING: %d files (%d MiB of data) cloned in %.1fs" % (len(files), self.total_bytes / (1024 * 1024), time.time() - start_time))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# archipelDomainEvents.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNDomainEventQueue}, the queue between the libvirt event loop
+and the handling of the domain lifecycle events.
+
+Handling an event changes presences, performs hooks and pushes pubsub
+items, so it must not run on the libvirt event thread. Events are queued
+per domain and handled by a pool of workers: events of one domain are
+handled in order, by one worker at a time, while other domains are
+handled in parallel.
+
+An event waits for the coalescing window before being handled. Until
+then, a suspended event followed by a resumed one (or the opposite)
+cancel each other, and repeated suspended or resumed events are merged.
+"""
+
+import heapq
+import libvirt
+import time
+from threading import Condition, Thread
+
+
+ARCHIPEL_DOMAIN_EVENTS_WORKERS  = 4
+ARCHIPEL_DOMAIN_EVENTS_WINDOW   = 0.25
+
+
+def is_collapsible(event, detail):
+    """
+    Tell if an event only toggles the pause state of the domain.
+    Events caused by migrations are never collapsed.
+    @type event: integer
+    @param event: the libvirt event
+    @type detail: integer
+    @param detail: the detail of the event
+    @rtype: Boolean
+    @return: True if the event can be merged or canceled
+    """
+    if event == libvirt.VIR_DOMAIN_EVENT_SUSPENDED:
+        return not detail == libvirt.VIR_DOMAIN_EVENT_SUSPENDED_MIGRATED
+    if event == libvirt.VIR_DOMAIN_EVENT_RESUMED:
+        return not detail == libvirt.VIR_DOMAIN_EVENT_RESUMED_MIGRATED
+    return False
+
+
+class TNDomainEventQueue (object):
+    """
+    Per domain queues of libvirt lifecycle events, handled by a pool of
+    workers.
+    """
+
+    def __init__(self, handler, log, workers=ARCHIPEL_DOMAIN_EVENTS_WORKERS, window=ARCHIPEL_DOMAIN_EVENTS_WINDOW):
+        """
+        The contructor of the class.
+        @type handler: function
+        @param handler: called with (domain, event, detail) for each event
+        @type log: logging.Logger
+        @param log: the logger
+        @type workers: integer
+        @param workers: number of domains handled at the same time
+        @type window: float
+        @param window: number of seconds an event waits before being handled
+        """
+        self.handler = handler
+        self.log = log
+        self.number_of_workers = max(1, workers)
+        self.window = max(0, window)
+        self.condition = Condition()
+        self.pending = {}
+        self.pending_since = {}
+        self.scheduled = set()
+        self.running = set()
+        self.schedule = []
+        self.workers = []
+        self.stopped = False
+
+    def start(self):
+        """
+        Start the workers.
+        """
+        for i in range(self.number_of_workers):
+            worker = Thread(target=self.work, name="domainEventWorker%d" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """
+        Stop the workers once they have handled their current domain.
+        Pending events are dropped.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notifyAll()
+
+    def post(self, key, domain, event, detail):
+        """
+        Queue an event. This never blocks on the handling of events.
+        @type key: string
+        @param key: the uuid of the domain
+        @type domain: libvirt.virDomain
+        @param domain: the domain
+        @type event: integer
+        @param event: the libvirt event
+        @type detail: integer
+        @param detail: the detail of the event
+        """
+        with self.condition:
+            if not key in self.pending:
+                self.pending[key] = []
+                self.pending_since[key] = time.time()
+            events = self.pending[key]
+            if events and is_collapsible(event, detail) and is_collapsible(events[-1][1], events[-1][2]):
+                if events[-1][1] == event:
+                    events[-1] = (domain, event, detail)
+                else:
+                    events.pop()
+                    if not events:
+                        del self.pending[key]
+                        del self.pending_since[key]
+                        return
+            else:
+                events.append((domain, event, detail))
+            if not key in self.scheduled and not key in self.running:
+                self.schedule_key(key)
+
+    def schedule_key(self, key):
+        """
+        Schedule the handling of the pending events of a domain at the end
+        of the window. Must be called with the condition acquired.
+        @type key: string
+        @param key: the uuid of the domain
+        """
+        heapq.heappush(self.schedule, (self.pending_since[key] + self.window, key))
+        self.scheduled.add(key)
+        self.condition.notify()
+
+    def next_key(self):
+        """
+        Wait for a domain whose events are due and that is not handled
+        by another worker.
+        @rtype: tuple
+        @return: (uuid, list of events), or (None, None) if the queue is stopped
+        """
+        with self.condition:
+            while not self.stopped:
+                now = time.time()
+                if self.schedule and self.schedule[0][0] <= now:
+                    due, key = heapq.heappop(self.schedule)
+                    self.scheduled.discard(key)
+                    events = self.pending.pop(key, None)
+                    self.pending_since.pop(key, None)
+                    if not events:
+                        continue
+                    self.running.add(key)
+                    return key, events
+                if self.schedule:
+                    self.condition.wait(self.schedule[0][0] - now)
+                else:
+                    self.condition.wait()
+            return None, None
+
+    def work(self):
+        """
+        Worker loop: handle the events of one domain at a time.
+        """
+        while True:
+            key, events = self.next_key()
+            if key is None:
+                return
+            for domain, event, detail in events:
+                try:
+                    self.handler(domain, event, detail)
+                except Exception as ex:
+                    self.log.error("EVENTQUEUE: unable to handle event %d:%d of domain %s: %s" % (event, detail, key, str(ex)))
+            with self.condition:
+                self.running.discard(key)
+                if key in self.pending:
+                    self.schedule_key(key)
+
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+# archipelDomainStats.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNDomainStatsSampler}, that periodically reads the statistics
+of all the domains of the hypervisor, L{TNDomainStatsRing}, the history
+of the samples of one domain, and L{TNSamplingThread}, the thread running
+the periodic samplings of the hypervisor outside of its XMPP loop.
+
+When libvirt provides virConnectGetAllDomainStats (libvirt >= 1.2.8), all
+the domains are read with one call per tick. Otherwise the sampler falls
+back on one virDomainGetInfo per running domain, still from the same tick.
+"""
+
+import heapq
+import libvirt
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+
+
+ARCHIPEL_DOMAIN_STATS_INTERVAL      = 2.0
+ARCHIPEL_DOMAIN_STATS_HISTORY_SIZE  = 60
+
+# fields of a sample
+ARCHIPEL_DOMAIN_STATS_FIELDS        = ("date", "cputime", "memory", "block_rd_bytes", "block_wr_bytes", "net_rx_bytes", "net_tx_bytes")
+
+# counters of a network interface, ordered as virDomainInterfaceStats
+ARCHIPEL_DOMAIN_STATS_INTERFACE_KEYS = ("rx.bytes", "rx.pkts", "rx.errs", "rx.drop", "tx.bytes", "tx.pkts", "tx.errs", "tx.drop")
+
+
+class TNDomainStatsRing (object):
+    """
+    Fixed size history of the samples of one domain.
+    A sample is a tuple ordered as ARCHIPEL_DOMAIN_STATS_FIELDS.
+    """
+
+    def __init__(self, size=ARCHIPEL_DOMAIN_STATS_HISTORY_SIZE):
+        """
+        The contructor of the class.
+        @type size: integer
+        @param size: max number of samples kept
+        """
+        self.samples = deque(maxlen=size)
+
+    def add(self, sample):
+        """
+        Add a sample. The oldest one is dropped if the ring is full.
+        @type sample: tuple
+        @param sample: the sample
+        """
+        self.samples.append(sample)
+
+    def latest(self, count=1):
+        """
+        Return the most recent samples.
+        @type count: integer
+        @param count: max number of samples
+        @rtype: list
+        @return: list of dict, the most recent first
+        """
+        samples = list(self.samples)[-count:]
+        samples.reverse()
+        return [dict(zip(ARCHIPEL_DOMAIN_STATS_FIELDS, sample)) for sample in samples]
+
+    def cpu_usage(self, number_of_cpus):
+        """
+        Return the CPU usage in percent between the two last samples.
+        @type number_of_cpus: integer
+        @param number_of_cpus: the number of CPUs the usage is relative to
+        @rtype: float
+        @return: the usage, 0 if there is not enough samples
+        """
+        if len(self.samples) < 2 or not number_of_cpus:
+            return 0
+        last, previous = self.samples[-1], self.samples[-2]
+        duration = last[0] - previous[0]
+        if duration <= 0:
+            return 0
+        return max(0, 100 * (last[1] - previous[1]) / (duration * number_of_cpus * 1000000000))
+
+
+class TNDomainStatsSampler (object):
+    """
+    Read the statistics of all the virtual machines of the hypervisor at
+    each call to sample(), and keep them in one L{TNDomainStatsRing} per
+    virtual machine.
+    """
+
+    def __init__(self, hypervisor, history_size=ARCHIPEL_DOMAIN_STATS_HISTORY_SIZE):
+        """
+        The contructor of the class.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor
+        @type history_size: integer
+        @param history_size: number of samples kept per virtual machine
+        """
+        self.hypervisor = hypervisor
+        self.history_size = history_size
+        self.rings = {}
+        self.interfaces = {}
+        self.lock = Lock()
+        self.bulk_stats = hasattr(libvirt, "VIR_DOMAIN_STATS_CPU_TOTAL")
+
+    def read_all_domains_stats(self):
+        """
+        Read the statistics of all running domains with one libvirt call.
+        @rtype: tuple
+        @return: (uuid -> sample, uuid -> interface target -> counters ordered as ARCHIPEL_DOMAIN_STATS_INTERFACE_KEYS)
+        """
+        flags = libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK
+        now = time.time()
+        samples = {}
+        interfaces = {}
+        for domain, stats in self.hypervisor.libvirt_connection.getAllDomainStats(flags, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+            uuid = domain.UUIDString()
+            block_rd, block_wr, net_rx, net_tx = 0, 0, 0, 0
+            for i in range(stats.get("block.count", 0)):
+                block_rd += stats.get("block.%d.rd.bytes" % i, 0)
+                block_wr += stats.get("block.%d.wr.bytes" % i, 0)
+            interfaces[uuid] = {}
+            for i in range(stats.get("net.count", 0)):
+                net_rx += stats.get("net.%d.rx.bytes" % i, 0)
+                net_tx += stats.get("net.%d.tx.bytes" % i, 0)
+                if "net.%d.name" % i in stats:
+                    interfaces[uuid][stats["net.%d.name" % i]] = tuple([stats.get("net.%d.%s" % (i, key), 0) for key in ARCHIPEL_DOMAIN_STATS_INTERFACE_KEYS])
+            samples[uuid] = (now, stats.get("cpu.time", 0), stats.get("balloon.current", 0), block_rd, block_wr, net_rx, net_tx)
+        return samples, interfaces
+
+    def read_domains_info(self):
+        """
+        Read the statistics of the running virtual machines one by one.
+        Only CPU time and memory are available this way.
+        @rtype: tuple
+        @return: (uuid -> sample, empty dict of interfaces counters)
+        """
+        now = time.time()
+        samples = {}
+        for uuid, vm in self.hypervisor.virtualmachines.items():
+            if not vm.domain or vm.is_freeing or vm.is_migrating:
+                continue
+            try:
+                info = vm.domain.info()
+            except libvirt.libvirtError:
+                continue
+            if info[0] in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED, libvirt.VIR_DOMAIN_PAUSED):
+                samples[uuid] = (now, info[4], info[2], 0, 0, 0, 0)
+        return samples, {}
+
+    def sample(self):
+        """
+        Take one sample of every running virtual machine. Samples of
+        domains not managed by Archipel are ignored, and the history of
+        virtual machines that are not running anymore is dropped.
+        """
+        try:
+            if self.bulk_stats:
+                try:
+                    samples, interfaces = self.read_all_domains_stats()
+                except (AttributeError, libvirt.libvirtError) as ex:
+                    self.hypervisor.log.warning("STATS: bulk domain statistics are not available, reading domains one by one: %s" % str(ex))
+                    self.bulk_stats = False
+                    samples, interfaces = self.read_domains_info()
+            else:
+                samples, interfaces = self.read_domains_info()
+        except Exception as ex:
+            self.hypervisor.log.error("STATS: unable to sample domains statistics: %s" % str(ex))
+            return
+
+        with self.lock:
+            self.interfaces = interfaces
+            for uuid in self.rings.keys():
+                if uuid not in samples:
+                    del self.rings[uuid]
+            for uuid, sample in samples.iteritems():
+                if uuid not in self.hypervisor.virtualmachines:
+                    continue
+                if uuid not in self.rings:
+                    self.rings[uuid] = TNDomainStatsRing(self.history_size)
+                self.rings[uuid].add(sample)
+
+    def cpu_usage(self, uuid):
+        """
+        Return the CPU usage of the given virtual machine.
+        @type uuid: string
+        @param uuid: the uuid of the virtual machine
+        @rtype: float
+        @return: the usage in percent
+        """
+        with self.lock:
+            ring = self.rings.get(uuid)
+            if not ring:
+                return 0
+            return ring.cpu_usage(self.hypervisor.nodeinfo["nrCoreperSocket"])
+
+    def history(self, uuid, count=1):
+        """
+        Return the last samples of the given virtual machine.
+        @type uuid: string
+        @param uuid: the uuid of the virtual machine
+        @type count: integer
+        @param count: max number of samples
+        @rtype: list
+        @return: list of dict, the most recent first
+        """
+        with self.lock:
+            ring = self.rings.get(uuid)
+            if not ring:
+                return []
+            return ring.latest(count)
+
+    def interfaces_stats(self, uuid):
+        """
+        Return the counters of the network interfaces of the given virtual
+        machine read by the last sample. They are only sampled when bulk
+        statistics are available.
+        @type uuid: string
+        @param uuid: the uuid of the virtual machine
+        @rtype: dict
+        @return: interface target -> counters ordered as ARCHIPEL_DOMAIN_STATS_INTERFACE_KEYS, None if not sampled
+        """
+        with self.lock:
+            return self.interfaces.get(uuid)
+
+    def summary(self):
+        """
+        Return the sum of the last samples of all the virtual machines.
+        @rtype: dict
+        @return: number of sampled virtual machines, total CPU usage and total memory
+        """
+        with self.lock:
+            cpu, memory = 0, 0
+            for ring in self.rings.itervalues():
+                cpu += ring.cpu_usage(self.hypervisor.nodeinfo["nrCoreperSocket"])
+                memory += ring.samples[-1][2]
+            return {"running": len(self.rings), "cpuPrct": cpu, "memory": memory}
+
+
+class TNSamplingThread (Thread):
+    """
+    Run periodic samplings on one dedicated thread, so the libvirt calls
+    they make never delay the XMPP loop of the hypervisor. Samplings run
+    one after the other, each one rescheduled after its own interval.
+    """
+
+    def __init__(self, log):
+        """
+        The contructor of the class.
+        @type log: logging.Logger
+        @param log: the logger
+        """
+        Thread.__init__(self, name="samplingThread")
+        self.setDaemon(True)
+        self.log = log
+        self.condition = Condition()
+        self.schedule = []
+        self.stopped = False
+
+    def add_sampling(self, interval, callback):
+        """
+        Run the given callback every interval seconds.
+        @type interval: float
+        @param interval: the interval in seconds
+        @type callback: function
+        @param callback: the sampling method, called without argument
+        """
+        with self.condition:
+            heapq.heappush(self.schedule, (time.time() + interval, interval, callback))
+            self.condition.notify()
+
+    def stop(self):
+        """
+        Stop the thread once the current sampling is done.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def next_sampling(self):
+        """
+        Wait for the next due sampling.
+        @rtype: tuple
+        @return: (interval, callback), or (None, None) if the thread is stopped
+        """
+        with self.condition:
+            while not self.stopped:
+                now = time.time()
+                if self.schedule and self.schedule[0][0] <= now:
+                    due, interval, callback = heapq.heappop(self.schedule)
+                    return interval, callback
+                if self.schedule:
+                    self.condition.wait(self.schedule[0][0] - now)
+                else:
+                    self.condition.wait()
+            return None, None
+
+    def run(self):
+        """
+        Thread loop: run the samplings when they are due.
+        """
+        while True:
+            interval, callback = self.next_sampling()
+            if callback is None:
+                return
+            try:
+                callback()
+            except Exception as ex:
+                self.log.error("SAMPLING: unable to run %s: %s" % (callback.__name__, str(ex)))
+            with self.condition:
+                heapq.heappush(self.schedule, (time.time() + interval, interval, callback))
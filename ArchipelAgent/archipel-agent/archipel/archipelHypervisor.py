@@ -28,20 +28,30 @@ This provides the possibility to instanciate TNArchipelVirtualMachines
 """
 import datetime
 import libvirt
+import Queue
 import random
 import sqlite3
 import string
+import time
 import uuid as moduuid
-from threading import Thread
+from threading import Condition, Lock, Thread, Timer
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelPermissionCenter import TNArchipelPermissionStore
+from archipelcore.archipelPlugin import format_plugins_profile
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
+from archipelcore.archipelXMPPMultiplexer import TNXMPPMultiplexer
 from archipelcore.utils import build_error_iq, build_error_message
 from archipelcore import xmpp
 
+from archipelCloneEngine import ARCHIPEL_CLONE_MODE_COPY, ARCHIPEL_CLONE_MODES
+from archipelDomainEvents import ARCHIPEL_DOMAIN_EVENTS_WINDOW, ARCHIPEL_DOMAIN_EVENTS_WORKERS, TNDomainEventQueue
+from archipelDomainStats import ARCHIPEL_DOMAIN_STATS_HISTORY_SIZE, ARCHIPEL_DOMAIN_STATS_INTERVAL, TNDomainStatsSampler, TNSamplingThread
 from archipelLibvirtEntity import ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR
+from archipelMigrationScheduler import ARCHIPEL_MIGRATION_HISTORY_SIZE, ARCHIPEL_MIGRATION_MAX_CONCURRENT, ARCHIPEL_MIGRATION_MAX_PER_DESTINATION, \
+                                        ARCHIPEL_MIGRATION_SAMPLING_INTERVAL, TNMigrationScheduler, migration_options_from_node
 from archipelVirtualMachine import TNArchipelVirtualMachine
 import archipelLibvirtEntity
 
@@ -61,16 +71,38 @@ ARCHIPEL_ERROR_CODE_HYPERVISOR_UNMANAGE         = -9011
 ARCHIPEL_ERROR_CODE_HYPERVISOR_MIGRATION_INFO   = -9012
 ARCHIPEL_ERROR_CODE_HYPERVISOR_SET_ORG_INFO     = -9013
 ARCHIPEL_ERROR_CODE_HYPERVISOR_NODE_INFO        = -9014
+ARCHIPEL_ERROR_CODE_HYPERVISOR_BULK             = -9015
+ARCHIPEL_ERROR_CODE_HYPERVISOR_MIGRATIONS       = -9016
+ARCHIPEL_ERROR_CODE_HYPERVISOR_CANCEL_MIGRATION = -9017
 
 ARCHIPEL_VM_NAME_CHECK_INTERNAL                 = 1
 ARCHIPEL_VM_NAME_CHECK_ALL                      = 2
 
+# Timers (seconds)
+ARCHIPEL_LIBVIRT_CONNECTION_CHECK_INTERVAL      = 3.0
+ARCHIPEL_CENTRAL_AGENT_CHECK_INTERVAL           = 3.0
+
 # Namespace
 ARCHIPEL_NS_HYPERVISOR_CONTROL                  = "archipel:hypervisor:control"
 
 # XMPP shows
 ARCHIPEL_XMPP_SHOW_ONLINE                       = "Online"
 
+# Virtual machines wake up
+ARCHIPEL_WAKE_UP_CONCURRENCY                    = 16
+ARCHIPEL_WAKE_UP_JITTER                         = 0.5
+ARCHIPEL_WAKE_UP_TIMEOUT                        = 60
+
+ARCHIPEL_WAKE_UP_PRIORITY_RUNNING               = 0
+ARCHIPEL_WAKE_UP_PRIORITY_AUTOSTART             = 1
+ARCHIPEL_WAKE_UP_PRIORITY_OTHER                 = 2
+
+# Bulk operations
+ARCHIPEL_HYPERVISOR_BULK_ACTIONS                = ("alloc_many", "free_many", "clone_many", "migrate_many")
+ARCHIPEL_HYPERVISOR_BULK_WORKERS                = 4
+ARCHIPEL_HYPERVISOR_BULK_PUSH_SIZE              = 20
+ARCHIPEL_HYPERVISOR_BULK_DEFINE_TIMEOUT         = 1800
+
 
 class TNThreadedVirtualMachine (Thread):
     """
@@ -113,6 +145,398 @@ class TNThreadedVirtualMachine (Thread):
         self.xmppvm.loop()
 
 
+class TNMultiplexedVirtualMachine (object):
+    """
+    This class has the same interface than L{TNThreadedVirtualMachine}
+    but runs the L{TNArchipelVirtualMachine} main loop into the
+    hypervisor's L{TNXMPPMultiplexer} instead of a dedicated thread.
+    """
+
+    def __init__(self, jid, password, hypervisor, configuration, name, organizationInfo, multiplexer):
+        """
+        The contructor of the class.
+        @type jid: string
+        @param jid: the jid of the L{TNArchipelVirtualMachine}
+        @type password: string
+        @param password: the password associated to the JID
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor of the VM
+        @type name: string
+        @param name: the name of the VM
+        @type organizationInfo: Dict
+        @param organizationInfo: Dict containing locality, company name, company unit and owner
+        @type multiplexer: L{TNXMPPMultiplexer}
+        @param multiplexer: the multiplexer that will run the VM loop
+        """
+        self.jid = jid
+        self.password = password
+        self.multiplexer = multiplexer
+        self.xmppvm = TNArchipelVirtualMachine(self.jid, self.password, hypervisor, configuration, name, organizationInfo)
+
+    def get_instance(self):
+        """
+        This method returns the current L{TNArchipelVirtualMachine} instance.
+        @rtype: ArchipelVirtualMachine
+        @return: the L{ArchipelVirtualMachine} instance
+        """
+        return self.xmppvm
+
+    def start(self):
+        """
+        Give the L{TNArchipelVirtualMachine} to the multiplexer. It will be connected asynchronously.
+        """
+        self.multiplexer.add_entity(self.xmppvm)
+
+
+class TNVirtualMachineWakeUpScheduler (Thread):
+    """
+    This class starts the virtual machines entities of the hypervisor in the
+    background, with at most a given number of entities connecting to the
+    XMPP server at the same time. Running domains are started first, then
+    the autostarted ones, then the others.
+    """
+
+    def __init__(self, hypervisor, concurrency=ARCHIPEL_WAKE_UP_CONCURRENCY, jitter=ARCHIPEL_WAKE_UP_JITTER, timeout=ARCHIPEL_WAKE_UP_TIMEOUT, callback=None):
+        """
+        The contructor of the class.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor of the VMs
+        @type concurrency: integer
+        @param concurrency: max number of VMs authenticating at the same time. 0 means no limit
+        @type jitter: float
+        @param jitter: max random delay in seconds before starting each VM, once it has its slot
+        @type timeout: integer
+        @param timeout: number of seconds after which a VM that is not authenticated doesn't hold its slot anymore
+        @type callback: function
+        @param callback: called without argument once all VMs are authenticated (or timed out)
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.hypervisor = hypervisor
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.timeout = timeout
+        self.callback = callback
+        self.jobs = []
+        self.pending = {}
+        self.done = 0
+        self.condition = Condition()
+
+    def add(self, vm_thread):
+        """
+        Add a VM to start. The priority is given by the state of its libvirt domain.
+        @type vm_thread: L{TNThreadedVirtualMachine} or L{TNMultiplexedVirtualMachine}
+        @param vm_thread: the VM to start
+        """
+        priority = ARCHIPEL_WAKE_UP_PRIORITY_OTHER
+        try:
+            domain = self.hypervisor.libvirt_connection.lookupByUUIDString(vm_thread.get_instance().uuid)
+            if domain.isActive():
+                priority = ARCHIPEL_WAKE_UP_PRIORITY_RUNNING
+            elif domain.autostart():
+                priority = ARCHIPEL_WAKE_UP_PRIORITY_AUTOSTART
+        except libvirt.libvirtError:
+            pass
+        self.jobs.append((priority, len(self.jobs), vm_thread))
+
+    def on_vm_authenticated(self, origin=None, user_info=None, arguments=None):
+        """
+        Hook called when a started VM is authenticated. Frees its slot.
+        """
+        self.condition.acquire()
+        if user_info in self.pending:
+            del self.pending[user_info]
+            self.done += 1
+            self.condition.notify()
+        self.condition.release()
+
+    def expire_pending(self):
+        """
+        Free the slots of the VMs that are too long to authenticate.
+        Must be called with self.condition acquired.
+        """
+        now = time.time()
+        for key, started in self.pending.items():
+            if now - started > self.timeout:
+                self.hypervisor.log.warning("WAKEUP: virtual machine %s is not authenticated after %ss. Not waiting for it anymore." % (key, self.timeout))
+                del self.pending[key]
+                self.done += 1
+
+    def start_vm(self, vm_thread):
+        """
+        Start a VM that has been given a slot.
+        @type vm_thread: L{TNThreadedVirtualMachine} or L{TNMultiplexedVirtualMachine}
+        @param vm_thread: the VM to start
+        """
+        vm = vm_thread.get_instance()
+        try:
+            vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.on_vm_authenticated, user_info=vm.uuid, oneshot=True)
+            vm_thread.start()
+            self.hypervisor.perform_hooks("HOOK_HYPERVISOR_VM_WOKE_UP", vm)
+        except Exception as ex:
+            self.hypervisor.log.error("WAKEUP: unable to start virtual machine %s: %s" % (vm.uuid, str(ex)))
+            self.on_vm_authenticated(user_info=vm.uuid)
+
+    def report_progress(self):
+        """
+        Show the progression in the hypervisor presence.
+        """
+        self.hypervisor.update_presence(presence_msg="Waking up %d/%d" % (self.done, len(self.jobs)))
+
+    def run(self):
+        """
+        Overiddes super class method. Start the VMs by order of priority.
+        """
+        self.jobs.sort()
+        start_time = time.time()
+        self.hypervisor.log.info("WAKEUP: starting %d virtual machines, %s at a time" % (len(self.jobs), self.concurrency or "all"))
+        for position, (priority, index, vm_thread) in enumerate(self.jobs):
+            vm = vm_thread.get_instance()
+            self.condition.acquire()
+            while self.concurrency and len(self.pending) >= self.concurrency:
+                self.condition.wait(1)
+                self.expire_pending()
+            self.pending[vm.uuid] = time.time()
+            self.condition.release()
+
+            if self.jitter:
+                # the VM waits in its slot, the next ones are scheduled meanwhile
+                timer = Timer(random.uniform(0, self.jitter), self.start_vm, [vm_thread])
+                timer.setDaemon(True)
+                timer.start()
+            else:
+                self.start_vm(vm_thread)
+            if position % 10 == 0:
+                self.report_progress()
+
+        self.condition.acquire()
+        while self.pending:
+            self.condition.wait(1)
+            self.expire_pending()
+            self.report_progress()
+        self.condition.release()
+        self.hypervisor.log.info("WAKEUP: %d virtual machines started in %.1fs" % (len(self.jobs), time.time() - start_time))
+        if self.callback:
+            self.callback()
+
+
+class TNHypervisorBulkOperation (Thread):
+    """
+    This class runs one bulk action (alloc_many, free_many, clone_many or
+    migrate_many) on a list of items, with a bounded number of workers.
+    The result of each item is pushed on the hypervisor events node, by
+    groups of push_size results.
+    The virtual machines created by alloc_many (with a definition) and
+    clone_many are defined later by their own thread: their result is
+    recorded when they are defined, and the operation stays open until
+    then, or until define_timeout is over.
+    """
+
+    def __init__(self, hypervisor, action, requester, items, workers=ARCHIPEL_HYPERVISOR_BULK_WORKERS, push_size=ARCHIPEL_HYPERVISOR_BULK_PUSH_SIZE, define_timeout=ARCHIPEL_HYPERVISOR_BULK_DEFINE_TIMEOUT):
+        """
+        The contructor of the class.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor performing the action
+        @type action: string
+        @param action: one of ARCHIPEL_HYPERVISOR_BULK_ACTIONS
+        @type requester: xmpp.JID
+        @param requester: the JID of the requester
+        @type items: list
+        @param items: the list of xmpp.Node describing each target
+        @type workers: integer
+        @param workers: max number of items processed at the same time
+        @type push_size: integer
+        @param push_size: number of results sent in each push
+        @type define_timeout: integer
+        @param define_timeout: max number of seconds to wait for the definition of the created virtual machines
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.hypervisor = hypervisor
+        self.action = action
+        self.requester = requester
+        self.items = items
+        self.workers = max(1, min(workers, len(items)))
+        self.push_size = push_size
+        self.define_timeout = define_timeout
+        self.identifier = str(moduuid.uuid4())
+        self.queue = Queue.Queue()
+        self.lock = Lock()
+        self.results = []
+        self.unpushed_results = []
+        self.failures = 0
+        self.vm_uuids = set()
+        self.waiting_definitions = {}
+        self.deferred_indexes = set()
+        self.definitions = Condition()
+
+    def add_result(self, index, item, jid=None, error=None):
+        """
+        Record the result of an item, and push the pending results if there are enough.
+        """
+        attrs = {"index": index, "status": error and "error" or "success"}
+        if item.getAttr("jid"):
+            attrs["target"] = item.getAttr("jid")
+        if item.getAttr("name"):
+            attrs["name"] = item.getAttr("name")
+        if jid:
+            attrs["jid"] = jid
+        if error:
+            attrs["error"] = error
+        result = xmpp.Node("item", attrs=attrs)
+        self.lock.acquire()
+        self.results.append(result)
+        self.unpushed_results.append(result)
+        if error:
+            self.failures += 1
+        to_push = None
+        if len(self.unpushed_results) >= self.push_size:
+            to_push, self.unpushed_results = self.unpushed_results, []
+        self.lock.release()
+        if to_push:
+            self.push_results("bulk_progress", to_push)
+
+    def push_results(self, change, results):
+        """
+        Push the given results on the hypervisor events node.
+        """
+        batch = xmpp.Node("batch", attrs={"id": self.identifier, "action": self.action, "total": len(self.items),
+                                          "done": len(self.results), "failures": self.failures})
+        for result in results:
+            batch.addChild(node=result)
+        self.hypervisor.push_change("hypervisor", change, batch)
+
+    def has_vm(self, uuid):
+        """
+        @type uuid: string
+        @param uuid: the uuid of a virtual machine
+        @rtype: Boolean
+        @return: True if the virtual machine is created or freed by this operation
+        """
+        return uuid in self.vm_uuids
+
+    def track_vm(self, index, item, vm, will_define):
+        """
+        Called by L{TNArchipelHypervisor.perform_bulk_item} with the virtual machine
+        of an item, before its thread is started or before it is freed.
+        @type index: integer
+        @param index: the index of the item
+        @type item: xmpp.Node
+        @param item: the item
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine
+        @type will_define: Boolean
+        @param will_define: if True, the result of the item is recorded when the virtual machine is defined
+        """
+        self.vm_uuids.add(vm.uuid)
+        if not will_define:
+            return
+        # the thread of the virtual machine is not started yet, so the hooks cannot be performed before we wait for them
+        registrations = [vm.register_hook("HOOK_VM_DEFINE", method=self.did_define_vm, oneshot=True),
+                         vm.register_hook("HOOK_VM_DEFINE_FAILED", method=self.did_fail_to_define_vm, oneshot=True)]
+        with self.definitions:
+            self.deferred_indexes.add(index)
+            self.waiting_definitions[vm.uuid] = {"index": index, "item": item, "jid": str(vm.jid.getStripped()), "vm": vm, "registrations": registrations}
+
+    def did_define_vm(self, origin=None, user_info=None, arguments=None):
+        """
+        Hook called when a virtual machine created by the operation is defined.
+        @type origin: L{TNArchipelVirtualMachine}
+        @param origin: the virtual machine
+        """
+        self.stop_waiting(origin.uuid)
+
+    def did_fail_to_define_vm(self, origin=None, user_info=None, arguments=None):
+        """
+        Hook called when a virtual machine created by the operation could not be defined.
+        @type origin: L{TNArchipelVirtualMachine}
+        @param origin: the virtual machine
+        @type arguments: string
+        @param arguments: the error
+        """
+        self.stop_waiting(origin.uuid, arguments or "Unable to define the virtual machine")
+
+    def stop_waiting(self, uuid, error=None):
+        """
+        Record the result of an item that was waiting for its definition.
+        @type uuid: string
+        @param uuid: the uuid of the virtual machine
+        @type error: string
+        @param error: the error, if the virtual machine could not be defined
+        """
+        with self.definitions:
+            waiting = self.waiting_definitions.pop(uuid, None)
+            self.definitions.notifyAll()
+        if not waiting:
+            return
+        for registration in waiting["registrations"]:
+            waiting["vm"].unregister_hook_registration(registration)
+        if error:
+            self.hypervisor.log.error("BULK: %s of item %d failed: %s" % (self.action, waiting["index"], error))
+        self.add_result(waiting["index"], waiting["item"], jid=waiting["jid"], error=error)
+
+    def work(self):
+        """
+        Worker loop: process items until the queue is empty.
+        """
+        while True:
+            try:
+                index, item = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            def track_vm(vm, will_define, index=index, item=item):
+                self.track_vm(index, item, vm, will_define)
+
+            try:
+                jid = self.hypervisor.perform_bulk_item(self.action, self.requester, item, track_vm=track_vm)
+                with self.definitions:
+                    deferred = index in self.deferred_indexes
+                if not deferred:
+                    self.add_result(index, item, jid=jid)
+            except Exception as ex:
+                self.hypervisor.log.error("BULK: %s of item %d failed: %s" % (self.action, index, str(ex)))
+                with self.definitions:
+                    deferred = index in self.deferred_indexes
+                    waiting = [uuid for uuid, w in self.waiting_definitions.items() if w["index"] == index]
+                if waiting:
+                    self.stop_waiting(waiting[0], str(ex))
+                elif not deferred:
+                    self.add_result(index, item, error=str(ex))
+
+    def wait_for_definitions(self):
+        """
+        Wait until all the created virtual machines are defined, or until
+        define_timeout is over. The items still waiting then are failed.
+        """
+        deadline = time.time() + self.define_timeout
+        with self.definitions:
+            while self.waiting_definitions and time.time() < deadline:
+                self.definitions.wait(deadline - time.time())
+            remaining = self.waiting_definitions.keys()
+        for uuid in remaining:
+            self.stop_waiting(uuid, "Not defined after %d seconds" % self.define_timeout)
+
+    def run(self):
+        """
+        Overiddes super class method. Process all the items.
+        """
+        start_time = time.time()
+        for index, item in enumerate(self.items):
+            self.queue.put((index, item))
+        workers = [Thread(target=self.work) for i in range(self.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.wait_for_definitions()
+
+        self.push_results("bulk_done", self.unpushed_results)
+        self.unpushed_results = []
+        self.hypervisor.log.info("BULK: %s %s done in %.1fs: %d items, %d failures" % (self.action, self.identifier, time.time() - start_time, len(self.items), self.failures))
+        self.hypervisor.end_bulk_operation(self)
+
+
 class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLibvirtEntity, TNHookableEntity, TNAvatarControllableEntity, TNTaggableEntity):
     """
     This class represents a Hypervisor XMPP Capable. This is a XMPP client
@@ -137,6 +561,14 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         archipelLibvirtEntity.TNArchipelLibvirtEntity.__init__(self, configuration)
 
         self.virtualmachines = {}
+        self.virtualmachines_by_name = {}
+        self.virtualmachines_by_jid = {}
+        self.virtualmachines_lock = Lock()
+        self.reserved_vm_names = set()
+        self.libvirt_domains = None
+        self.libvirt_domains_by_name = {}
+        self.libvirt_domains_lock = Lock()
+        self.libvirt_domains_cacheable = False
         self.database_file = database_file
         self.xmppserveraddr = self.jid.getDomain()
         self.entity_type = "hypervisor"
@@ -146,6 +578,57 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.bad_chars_in_name = '(){}[]<>!@#$'
         self.check_for_central_agent = False
         self.already_wake_up = False
+        self.waking_up = False
+        self.vm_multiplexer = None
+        self.wake_up_concurrency = ARCHIPEL_WAKE_UP_CONCURRENCY
+        self.wake_up_jitter = ARCHIPEL_WAKE_UP_JITTER
+        self.wake_up_timeout = ARCHIPEL_WAKE_UP_TIMEOUT
+
+        if self.configuration.has_option("HYPERVISOR", "wake_up_concurrency"):
+            self.wake_up_concurrency = self.configuration.getint("HYPERVISOR", "wake_up_concurrency")
+        if self.configuration.has_option("HYPERVISOR", "wake_up_jitter"):
+            self.wake_up_jitter = self.configuration.getfloat("HYPERVISOR", "wake_up_jitter")
+        if self.configuration.has_option("HYPERVISOR", "wake_up_timeout"):
+            self.wake_up_timeout = self.configuration.getint("HYPERVISOR", "wake_up_timeout")
+
+        self.bulk_operations = {}
+        self.bulk_operations_lock = Lock()
+        self.bulk_workers = ARCHIPEL_HYPERVISOR_BULK_WORKERS
+        if self.configuration.has_option("HYPERVISOR", "bulk_workers"):
+            self.bulk_workers = self.configuration.getint("HYPERVISOR", "bulk_workers")
+        self.bulk_define_timeout = ARCHIPEL_HYPERVISOR_BULK_DEFINE_TIMEOUT
+        if self.configuration.has_option("HYPERVISOR", "bulk_define_timeout"):
+            self.bulk_define_timeout = self.configuration.getint("HYPERVISOR", "bulk_define_timeout")
+        self.database_lock = Lock()
+
+        domain_events_workers = ARCHIPEL_DOMAIN_EVENTS_WORKERS
+        domain_events_window = ARCHIPEL_DOMAIN_EVENTS_WINDOW
+        if self.configuration.has_option("HYPERVISOR", "domain_events_workers"):
+            domain_events_workers = self.configuration.getint("HYPERVISOR", "domain_events_workers")
+        if self.configuration.has_option("HYPERVISOR", "domain_events_window"):
+            domain_events_window = self.configuration.getfloat("HYPERVISOR", "domain_events_window")
+        self.domain_events = TNDomainEventQueue(self.dispatch_domain_event, self.log, workers=domain_events_workers, window=domain_events_window)
+        self.domain_events.start()
+
+        if self.configuration.has_option("VIRTUALMACHINE", "xmpp_multiplexing") and self.configuration.getboolean("VIRTUALMACHINE", "xmpp_multiplexing"):
+            multiplexing_workers = 4
+            multiplexing_processors = 4
+            if self.configuration.has_option("VIRTUALMACHINE", "xmpp_multiplexing_workers"):
+                multiplexing_workers = self.configuration.getint("VIRTUALMACHINE", "xmpp_multiplexing_workers")
+            if self.configuration.has_option("VIRTUALMACHINE", "xmpp_multiplexing_processors"):
+                multiplexing_processors = self.configuration.getint("VIRTUALMACHINE", "xmpp_multiplexing_processors")
+            self.vm_multiplexer = TNXMPPMultiplexer(number_of_workers=multiplexing_workers, number_of_processors=multiplexing_processors)
+            self.vm_multiplexer.start()
+            self.log.info("Virtual machines XMPP streams will be multiplexed using %d connection workers and %d processing threads" % (multiplexing_workers, multiplexing_processors))
+
+        self.vm_permission_store = None
+
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_shared_permissions_database_path"):
+            permissions_pool_size = 5
+            if self.configuration.has_option("VIRTUALMACHINE", "vm_shared_permissions_pool_size"):
+                permissions_pool_size = self.configuration.getint("VIRTUALMACHINE", "vm_shared_permissions_pool_size")
+            self.vm_permission_store = TNArchipelPermissionStore(self.configuration.get("VIRTUALMACHINE", "vm_shared_permissions_database_path"), pool_size=permissions_pool_size)
+            self.log.info("Virtual machines permissions are stored in shared database %s" % self.vm_permission_store.database_file)
 
         try:
             central_db_configured = self.configuration.getboolean("MODULES", "centraldb")
@@ -196,6 +679,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.create_hook("HOOK_HYPERVISOR_CLONE")
         self.create_hook("HOOK_HYPERVISOR_VM_WOKE_UP")
         self.create_hook("HOOK_HYPERVISOR_WOKE_UP")
+        self.create_hook("HOOK_HYPERVISOR_BULK_DONE")
 
         # vocabulary
         self.init_vocabulary()
@@ -207,14 +691,51 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         if self.is_hypervisor((archipelLibvirtEntity.ARCHIPEL_HYPERVISOR_TYPE_QEMU, archipelLibvirtEntity.ARCHIPEL_HYPERVISOR_TYPE_XEN)):
             try:
                 self.libvirt_event_callback_id = self.libvirt_connection.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.hypervisor_on_domain_event, None)
+                self.libvirt_domains_cacheable = True
             except libvirt.libvirtError:
                 self.log.error("We are sorry. But your hypervisor doesn't support libvirt virConnectDomainEventRegisterAny. And this really bad. I'm sooo sorry.")
+            for event_id in ("VIR_DOMAIN_EVENT_ID_DEVICE_ADDED", "VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED"):
+                if not hasattr(libvirt, event_id):
+                    continue
+                try:
+                    self.libvirt_connection.domainEventRegisterAny(None, getattr(libvirt, event_id), self.hypervisor_on_domain_device_event, None)
+                except libvirt.libvirtError as ex:
+                    self.log.warning("LIBVIRT: unable to register to %s: %s" % (event_id, str(ex)))
         else:
             self.log.warning("Your hypervisor doesn't support libvirt eventing. Using fake event loop.")
 
         self.capabilities = self.get_capabilities()
         self.nodeinfo = self.get_nodeinfo()
 
+        stats_interval = ARCHIPEL_DOMAIN_STATS_INTERVAL
+        stats_history_size = ARCHIPEL_DOMAIN_STATS_HISTORY_SIZE
+        if self.configuration.has_option("VIRTUALMACHINE", "stats_sampling_interval"):
+            stats_interval = self.configuration.getfloat("VIRTUALMACHINE", "stats_sampling_interval")
+        if self.configuration.has_option("VIRTUALMACHINE", "stats_history_size"):
+            stats_history_size = self.configuration.getint("VIRTUALMACHINE", "stats_history_size")
+        self.stats_sampler = TNDomainStatsSampler(self, history_size=stats_history_size)
+        self.sampling_thread = TNSamplingThread(self.log)
+        self.sampling_thread.add_sampling(stats_interval, self.stats_sampler.sample)
+        self.sampling_thread.start()
+
+        migration_max_concurrent = ARCHIPEL_MIGRATION_MAX_CONCURRENT
+        migration_max_per_destination = ARCHIPEL_MIGRATION_MAX_PER_DESTINATION
+        migration_history_size = ARCHIPEL_MIGRATION_HISTORY_SIZE
+        if self.configuration.has_option("HYPERVISOR", "migration_max_concurrent"):
+            migration_max_concurrent = self.configuration.getint("HYPERVISOR", "migration_max_concurrent")
+        if self.configuration.has_option("HYPERVISOR", "migration_max_per_destination"):
+            migration_max_per_destination = self.configuration.getint("HYPERVISOR", "migration_max_per_destination")
+        if self.configuration.has_option("HYPERVISOR", "migration_history_size"):
+            migration_history_size = self.configuration.getint("HYPERVISOR", "migration_history_size")
+        self.migration_default_options = {}
+        if self.configuration.has_option("HYPERVISOR", "migration_bandwidth"):
+            self.migration_default_options["bandwidth"] = self.configuration.getint("HYPERVISOR", "migration_bandwidth")
+        for option in ("compressed", "auto_converge"):
+            if self.configuration.has_option("HYPERVISOR", "migration_%s" % option):
+                self.migration_default_options[option] = self.configuration.getboolean("HYPERVISOR", "migration_%s" % option)
+        self.migration_scheduler = TNMigrationScheduler(self, max_concurrent=migration_max_concurrent, max_per_destination=migration_max_per_destination, history_size=migration_history_size)
+        self.sampling_thread.add_sampling(ARCHIPEL_MIGRATION_SAMPLING_INTERVAL, self.migration_scheduler.sample)
+
         # action on auth
         self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.manage_vcard_hook)
         if not self.get_plugin("centraldb"):
@@ -222,6 +743,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
 
         self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.update_presence)
 
+        # periodic work
+        self.add_timer(ARCHIPEL_LIBVIRT_CONNECTION_CHECK_INTERVAL, self.check_libvirt_connection)
+        if self.check_for_central_agent:
+            self.add_timer(ARCHIPEL_CENTRAL_AGENT_CHECK_INTERVAL, self.check_central_agent)
+
     # Overrides
 
     def set_custom_vcard_information(self, vCard):
@@ -289,8 +815,9 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @type parameters: object
         @param parameters: runtime arguments
         """
+        if self.waking_up or self.already_wake_up:
+            return
         self.manage_persistence(self.get_vms_from_local_db())
-        self.already_wake_up = True
 
     def register_handlers(self):
         """
@@ -370,6 +897,12 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.permission_center.create_permission("manage", "Authorizes users make Archipel able to manage external virtual machines", False)
         self.permission_center.create_permission("unmanage", "Authorizes users to make Archipel able to unmanage virtual machines", False)
         self.permission_center.create_permission("setorginfo", "Authorizes users to change VM Organization information of virtual machines", False)
+        self.permission_center.create_permission("alloc_many", "Authorizes users to allocate several virtual machines in one request", False)
+        self.permission_center.create_permission("free_many", "Authorizes users to free several virtual machines in one request", False)
+        self.permission_center.create_permission("clone_many", "Authorizes users to clone several virtual machines in one request", False)
+        self.permission_center.create_permission("migrate_many", "Authorizes users to migrate several virtual machines in one request", False)
+        self.permission_center.create_permission("migrations", "Authorizes users to see the running, queued and finished live migrations", False)
+        self.permission_center.create_permission("cancelmigration", "Authorizes users to cancel a queued live migration", False)
 
     def get_vms_from_local_db(self):
         """
@@ -379,6 +912,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.database = sqlite3.connect(self.database_file, check_same_thread=False)
         self.log.info("Populating database if not exists.")
         self.database.execute("create table if not exists virtualmachines (jid text, password text, creation_date date, comment text, name text)")
+        self.database.execute("create table if not exists overlays (uuid text primary key, parent_uuid text)")
         c = self.database.cursor()
         c.execute("select * from virtualmachines")
 
@@ -391,8 +925,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
     def manage_persistence(self, vms=[], existing_vms_entities=[]):
         """
         After getting the status of local vms from central db (were they exist
-        else where or not ?), we proceed to instanciate vms
+        else where or not ?), we proceed to instanciate vms. The entities are
+        then started in the background by a L{TNVirtualMachineWakeUpScheduler}
+        and HOOK_HYPERVISOR_WOKE_UP is performed once they are all started.
         """
+        self.waking_up = True
         if len(vms) > 0 or len(existing_vms_entities) > 0:
             self.update_presence(presence_msg="Initializing...")
 
@@ -401,6 +938,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         existing_vms_entities_uuids = []
         for vm in existing_vms_entities:
             existing_vms_entities_uuids.append(vm["uuid"])
+        scheduler = TNVirtualMachineWakeUpScheduler(self, self.wake_up_concurrency, self.wake_up_jitter, self.wake_up_timeout, callback=self.on_virtual_machines_woke_up)
         for vm in vms:
             string_jid = vm["string_jid"]
             jid = xmpp.JID(string_jid)
@@ -412,9 +950,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                 self.log.info("Creating vm entity for %s" % string_jid)
                 jid.setResource(self.jid.getNode().lower())
                 vm_thread = self.create_threaded_vm(jid, vm["password"], vm["name"], self.vcard_infos)
-                self.virtualmachines[vm_thread.jid.getNode()] = vm_thread.get_instance()
-                vm_thread.start()
-                self.perform_hooks("HOOK_HYPERVISOR_VM_WOKE_UP", vm_thread.get_instance())
+                self.register_vm_instance(vm_thread.jid.getNode(), vm_thread.get_instance())
+                scheduler.add(vm_thread)
             else:
                 self.log.warning("Vm entity %s already exist on another hypervisor, removing from local db and local libvirt." % string_jid)
                 c.execute("delete from virtualmachines where jid='%s'" % string_jid)
@@ -430,6 +967,15 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                         except libvirt.libvirtError:
                             self.log.warning("Libvirt gave error while trying to destroy the existing vm %s" % (vm))
 
+        scheduler.start()
+
+    def on_virtual_machines_woke_up(self):
+        """
+        Called by the L{TNVirtualMachineWakeUpScheduler} once all the virtual machines are started.
+        """
+        self.waking_up = False
+        self.already_wake_up = True
+        self.log.info("HYPERVISOR: plugins startup profile of the %d virtual machines:\n%s" % (len(self.virtualmachines), format_plugins_profile()))
         self.perform_hooks("HOOK_HYPERVISOR_WOKE_UP", self)
         self.update_presence()
 
@@ -444,11 +990,72 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @param name: the Name of the VM
         @type organizationInfo: Dict
         @param organizationInfo: Dict containing locality, company name, company unit and owner
-        @rtype: L{TNThreadedVirtualMachine}
-        @return: a L{TNThreadedVirtualMachine} instance of the virtual machine
+        @rtype: L{TNThreadedVirtualMachine} or L{TNMultiplexedVirtualMachine}
+        @return: a L{TNThreadedVirtualMachine} instance of the virtual machine, or a L{TNMultiplexedVirtualMachine} if multiplexing is enabled
         """
+        if self.vm_multiplexer:
+            return TNMultiplexedVirtualMachine(jid, password, self, self.configuration, name, organizationInfo, self.vm_multiplexer)
         return TNThreadedVirtualMachine(jid, password, self, self.configuration, name, organizationInfo)
 
+    # Virtual machines indexes
+
+    def register_vm_instance(self, uuid, vm):
+        """
+        Add the given virtual machine to self.virtualmachines and to the
+        name and JID indexes.
+        @type uuid: string
+        @param uuid: the uuid of the vm
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine
+        """
+        with self.virtualmachines_lock:
+            if uuid in self.virtualmachines:
+                self._remove_vm_from_name_index(self.virtualmachines[uuid], self.virtualmachines[uuid].name)
+            self.virtualmachines[uuid] = vm
+            self.virtualmachines_by_name.setdefault(vm.name.upper(), []).append(vm)
+            self.virtualmachines_by_jid[vm.jid.getStripped().lower()] = vm
+
+    def unregister_vm_instance(self, uuid):
+        """
+        Remove the virtual machine with the given uuid from self.virtualmachines
+        and from the name and JID indexes.
+        @type uuid: string
+        @param uuid: the uuid of the vm
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the removed virtual machine
+        """
+        with self.virtualmachines_lock:
+            vm = self.virtualmachines.pop(uuid)
+            self._remove_vm_from_name_index(vm, vm.name)
+            if self.virtualmachines_by_jid.get(vm.jid.getStripped().lower()) is vm:
+                del self.virtualmachines_by_jid[vm.jid.getStripped().lower()]
+        return vm
+
+    def reindex_vm_name(self, vm, old_name):
+        """
+        Update the name index after a virtual machine has been renamed.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the renamed virtual machine
+        @type old_name: string
+        @param old_name: the previous name of the vm
+        """
+        with self.virtualmachines_lock:
+            if not self.virtualmachines.get(vm.uuid) is vm:
+                return
+            self._remove_vm_from_name_index(vm, old_name)
+            self.virtualmachines_by_name.setdefault(vm.name.upper(), []).append(vm)
+
+    def _remove_vm_from_name_index(self, vm, name):
+        """
+        Remove the vm from the name index entry of the given name.
+        Must be called with self.virtualmachines_lock acquired.
+        """
+        vms = self.virtualmachines_by_name.get(name.upper(), [])
+        if vm in vms:
+            vms.remove(vm)
+        if not vms and name.upper() in self.virtualmachines_by_name:
+            del self.virtualmachines_by_name[name.upper()]
+
     def generate_name(self):
         """
         Get a random name from the names file.
@@ -459,11 +1066,39 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         current_name = None
         while search:
             current_name = self.generated_names[random.randint(0, self.number_of_names)].replace("\n", "")
-            if not self.get_vm_by_name(current_name):
+            if not self.get_vm_by_name(current_name) and not current_name.upper() in self.reserved_vm_names:
                 self.log.info("Generated name %s available. Using it." % current_name)
                 search = False
         return current_name
 
+    def reserve_vm_name(self, name, raise_error=True, name_check_level=ARCHIPEL_VM_NAME_CHECK_ALL):
+        """
+        Check that no virtual machine has the given name and reserve it, so
+        concurrent allocations cannot take it, until release_vm_name is called.
+        @type name: string
+        @param name: the name to reserve
+        @type raise_error: bool
+        @param raise_error: If set to True, raise an error instead of returning a boolean
+        @type name_check_level: int
+        @param name_check_level: Check all existing VM (including libvirt domain) or just internal VMs
+        @rtype: Boolean
+        @return: True if the name has been reserved
+        """
+        with self.virtualmachines_lock:
+            if self.libvirt_contains_domain_with_name(name, raise_error=raise_error, name_check_level=name_check_level):
+                return False
+            self.reserved_vm_names.add(name.upper())
+            return True
+
+    def release_vm_name(self, name):
+        """
+        Release a name reserved with reserve_vm_name.
+        @type name: string
+        @param name: the reserved name
+        """
+        with self.virtualmachines_lock:
+            self.reserved_vm_names.discard(name.upper())
+
     def get_vm_by_name(self, name):
         """
         Return the vm object by name.
@@ -472,10 +1107,10 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @rtype: L{TNArchipelVirtualMachine}
         @return: the virtual machine or None
         """
-        for uuid, vm in self.virtualmachines.iteritems():
-            if vm.name.upper() == name.upper():
-                return vm
-        return None
+        vms = self.virtualmachines_by_name.get(name.upper())
+        if not vms:
+            return None
+        return vms[0]
 
     def get_vm_by_uuid(self, uuid):
         """
@@ -489,6 +1124,18 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             return None
         return self.virtualmachines[uuid.lower()]
 
+    def get_vm_by_jid(self, jid):
+        """
+        Return the vm object by JID.
+        @type jid : xmpp.JID or string
+        @param jid: the JID of the vm, the resource is ignored
+        @rtype: L{TNArchipelVirtualMachine}
+        @return: the virtual machine or None
+        """
+        if isinstance(jid, xmpp.JID):
+            jid = jid.getStripped()
+        return self.virtualmachines_by_jid.get(jid.split("/")[0].lower())
+
     def get_vm_by_identifier(self, identifier):
         """
         Return the vm object by identifier. Identifier can be the UUID of the name.
@@ -531,6 +1178,114 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
 
         return domains
 
+    def get_all_libvirt_domains(self):
+        """
+        Returns a list of all domains of libvirt, running or only defined,
+        managed by Archipel or not. Used when libvirt has no listAllDomains.
+        """
+        domains = []
+        for domID in self.libvirt_connection.listDomainsID():
+            try:
+                domains.append(self.libvirt_connection.lookupByID(domID))
+            except Exception as ex:
+                self.log.warning("LIBVIRT: Could not find domain with ID %s. It may have been undefine just right now (%s)" % (domID, ex))
+        for name in self.libvirt_connection.listDefinedDomains():
+            try:
+                domains.append(self.libvirt_connection.lookupByName(name))
+            except Exception as ex:
+                self.log.warning("LIBVIRT: Coud not find domain with name %s. It may have been undefine just right now (%s)" % (name, ex))
+        return domains
+
+    def refresh_libvirt_domains(self):
+        """
+        Rebuild the cache of the libvirt domains with a full scan of libvirt.
+        The cache is then kept up to date by the lifecycle events.
+        Must be called with self.libvirt_domains_lock acquired.
+        """
+        domains = {}
+        if hasattr(self.libvirt_connection, "listAllDomains"):
+            for dom in self.libvirt_connection.listAllDomains(0):
+                domains[dom.UUIDString()] = {"name": dom.name(), "persistent": dom.isPersistent()}
+        else:
+            for dom in self.get_all_libvirt_domains():
+                try:
+                    domains[dom.UUIDString()] = {"name": dom.name(), "persistent": dom.isPersistent()}
+                except libvirt.libvirtError:
+                    # the domain has been undefined since it was listed
+                    continue
+        self.libvirt_domains = domains
+        self.libvirt_domains_by_name = {}
+        for uuid, info in domains.iteritems():
+            self.libvirt_domains_by_name[info["name"]] = uuid
+        self.log.debug("LIBVIRT: domains cache rebuilt with %d domains" % len(domains))
+
+    def invalidate_libvirt_domains(self):
+        """
+        Drop the cache of the libvirt domains. It will be rebuilt on next use.
+        """
+        with self.libvirt_domains_lock:
+            self.libvirt_domains = None
+            self.libvirt_domains_by_name = {}
+
+    def update_libvirt_domains(self, dom, event):
+        """
+        Update the cache of the libvirt domains according to a lifecycle event.
+        @type dom: virDomain
+        @param dom: the domain that triggered the event
+        @type event: integer
+        @param event: the libvirt lifecycle event
+        """
+        with self.libvirt_domains_lock:
+            if self.libvirt_domains is None:
+                return
+            uuid = dom.UUIDString()
+            info = self.libvirt_domains.get(uuid)
+            try:
+                if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                    if not dom.isActive():
+                        info = None
+                    elif info:
+                        info["persistent"] = False
+                elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+                    if info and not info["persistent"]:
+                        info = None
+                elif event in (libvirt.VIR_DOMAIN_EVENT_DEFINED, libvirt.VIR_DOMAIN_EVENT_STARTED) or not info:
+                    info = {"name": dom.name(), "persistent": dom.isPersistent()}
+            except libvirt.libvirtError:
+                # the domain doesn't exist anymore
+                info = None
+            old_info = self.libvirt_domains.get(uuid)
+            if old_info and self.libvirt_domains_by_name.get(old_info["name"]) == uuid:
+                del self.libvirt_domains_by_name[old_info["name"]]
+            if info:
+                self.libvirt_domains[uuid] = info
+                self.libvirt_domains_by_name[info["name"]] = uuid
+            elif uuid in self.libvirt_domains:
+                del self.libvirt_domains[uuid]
+
+    def get_unmanaged_domains(self, only_persistant=True):
+        """
+        Returns the libvirt domains that are not managed by Archipel. If
+        libvirt events are available, the answer comes from the domains cache,
+        otherwise libvirt is fully scanned.
+        @type only_persistant: Boolean
+        @param only_persistant: if True, ignore the transient domains
+        @rtype: list
+        @return: list of tuples (uuid, name)
+        """
+        if not self.libvirt_domains_cacheable:
+            return [(dom.UUIDString(), dom.name()) for dom in self.get_raw_libvirt_domains(only_persistant)]
+        with self.libvirt_domains_lock:
+            if self.libvirt_domains is None:
+                self.refresh_libvirt_domains()
+            domains = []
+            for uuid, info in self.libvirt_domains.iteritems():
+                if uuid in self.virtualmachines:
+                    continue
+                if info["persistent"] or not only_persistant:
+                    domains.append((uuid, info["name"]))
+            return domains
+
     def libvirt_contains_domain_with_name(self, name, raise_error=False, name_check_level=ARCHIPEL_VM_NAME_CHECK_ALL):
         """
         Check if there is already a domain with the same name,
@@ -544,7 +1299,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @rtype: Boolean
         @return: True if a domain has been found
         """
-        if self.get_vm_by_name(name):
+        if self.get_vm_by_name(name) or name.upper() in self.reserved_vm_names:
             if raise_error:
                 raise Exception("Archipel already manages a virtual machine named %s." % name)
             return True
@@ -552,19 +1307,74 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         if not name_check_level == ARCHIPEL_VM_NAME_CHECK_ALL:
             return False
 
-        unamanaged_doms = self.get_raw_libvirt_domains()
-        for dom in unamanaged_doms:
-            if dom.name() == name:
-                if raise_error:
-                    raise Exception("There is already a non managed virtual machine named %s declared in Libvirt." % name)
-                return True
-        return False
+        if self.libvirt_domains_cacheable:
+            with self.libvirt_domains_lock:
+                if self.libvirt_domains is None:
+                    self.refresh_libvirt_domains()
+                uuid = self.libvirt_domains_by_name.get(name)
+                found = uuid is not None and uuid not in self.virtualmachines and self.libvirt_domains[uuid]["persistent"]
+        else:
+            found = name in [dom.name() for dom in self.get_raw_libvirt_domains()]
+
+        if found and raise_error:
+            raise Exception("There is already a non managed virtual machine named %s declared in Libvirt." % name)
+        return found
 
     # LIBVIRT events Processing
 
+    def hypervisor_on_domain_device_event(self, conn, dom, device, opaque):
+        """
+        Triggered when a device is added to or removed from a domain.
+        Drop the cached description of the virtual machine.
+        """
+        try:
+            vm = self.get_vm_by_uuid(dom.UUIDString())
+            if vm:
+                vm.invalidate_domain_cache()
+        except Exception as ex:
+            self.log.error("EVENTVIRTUALMACHINE: Exception while handling device event: %s" % str(ex))
+
+    def libvirt_failure(self, failure):
+        """
+        Drop the domains cache, as events may have been lost, and update the
+        status of the entities.
+        @type failure: Bool
+        @param failure: true if libvirt connection failed and false if we've
+        recovered the connection
+        """
+        self.invalidate_libvirt_domains()
+        archipelLibvirtEntity.TNArchipelLibvirtEntity.libvirt_failure(self, failure)
+
     def hypervisor_on_domain_event(self, conn, dom, event, detail, opaque):
         """
-        Trigger when a domain trigger vbent. We care only about RESUMED and SHUTDOWNED from MIGRATED.
+        Trigger when a domain trigger vbent. This runs on the libvirt event
+        thread, so only the domains cache is updated here. The event is then
+        queued, and handled by L{dispatch_domain_event}.
+        """
+        try:
+            self.update_libvirt_domains(dom, event)
+        except Exception as ex:
+            self.log.warning("LIBVIRT: Unable to update the domains cache, invalidating it: %s" % str(ex))
+            self.invalidate_libvirt_domains()
+
+        try:
+            vm = self.get_vm_by_uuid(dom.UUIDString())
+            if vm:
+                vm.invalidate_domain_cache()
+            self.domain_events.post(dom.UUIDString(), dom, event, detail)
+        except Exception as ex:
+            self.log.error("EVENTVIRTUALMACHINE: Unable to queue event %d:%d: %s" % (event, detail, str(ex)))
+
+    def dispatch_domain_event(self, dom, event, detail):
+        """
+        Handle a queued domain event. We care only about RESUMED and SHUTDOWNED from MIGRATED.
+        Other events are transfered to the virtual machine.
+        @type dom: libvirt.virDomain
+        @param dom: the domain
+        @type event: integer
+        @param event: the libvirt event
+        @type detail: integer
+        @param detail: the detail of the event
         """
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED:
             try:
@@ -616,6 +1426,12 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             - unmanage
             - setorginfo
             - soft_alloc
+            - alloc_many
+            - free_many
+            - clone_many
+            - migrate_many
+            - migrations
+            - cancelmigration
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -654,6 +1470,12 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             reply = self.iq_set_organization_info(iq)
         elif action == "soft_alloc":
             reply = self.iq_soft_alloc(iq)
+        elif action in ARCHIPEL_HYPERVISOR_BULK_ACTIONS:
+            reply = self.iq_bulk(iq, action)
+        elif action == "migrations":
+            reply = self.iq_migrations(iq)
+        elif action == "cancelmigration":
+            reply = self.iq_cancel_migration(iq)
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
@@ -696,43 +1518,52 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         disallow_spaces_in_name = blank_spaces_disallowed_in_config or is_xen
         strip_unhandled_chars_in_name = is_xen
 
+        # the name is reserved until the VM is registered, so parallel
+        # allocations (alloc_many) cannot pick the same one
         if not requested_name:
-            name = self.generate_name()
+            name = None
+            while not name:
+                name = self.generate_name()
+                if disallow_spaces_in_name:
+                    name = name.replace(" ", "-")
+                if not self.reserve_vm_name(name, raise_error=False, name_check_level=ARCHIPEL_VM_NAME_CHECK_INTERNAL):
+                    name = None
         else:
             if disallow_spaces_in_name:
                 requested_name = requested_name.replace(" ", "-")
             if strip_unhandled_chars_in_name:
                 requested_name = filter(lambda c: c not in self.bad_chars_in_name, requested_name)
-            self.libvirt_contains_domain_with_name(requested_name, raise_error=True, name_check_level=name_check_level)
+            self.reserve_vm_name(requested_name, raise_error=True, name_check_level=name_check_level)
             name = requested_name
 
-        if disallow_spaces_in_name:
-            name = name.replace(" ", "-")
-
-        self.log.info("Starting xmpp threaded virtual machine.")
-        vm_thread = self.create_threaded_vm(vm_jid, vm_password, name, organization_info)
-        vm = vm_thread.get_instance()
-
-        if requester:
-            self.log.info("Adding the requesting controller %s to the VM's roster." % (str(requester)))
-            vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.add_jid_hook, user_info=xmpp.JID(requester), oneshot=True)
-            vm.permission_center.grant_permission_to_user("all", requester.getStripped())
-
-        if definition:
-            if not definition.getTag("uuid"):
-                definition.addChild("uuid")
-            if not definition.getTag("uuid").getData().lower() == vm_uuid.lower():
-                definition.getTag("uuid").setData(vm_uuid)
-            if not definition.getTag("name"):
-                definition.addChild("name")
-            if not definition.getTag("name").getData().lower() == name.lower():
-                definition.getTag("name").setData(name)
-            vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.define_hook, user_info=definition, oneshot=True)
+        try:
+            self.log.info("Starting xmpp threaded virtual machine.")
+            vm_thread = self.create_threaded_vm(vm_jid, vm_password, name, organization_info)
+            vm = vm_thread.get_instance()
 
-        self.log.info("Registering the new VM in hypervisor's database.")
-        self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(vm_jid.getStripped()), vm_password, datetime.datetime.now(), '', name))
-        self.database.commit()
-        self.virtualmachines[vm_uuid] = vm
+            if requester:
+                self.log.info("Adding the requesting controller %s to the VM's roster." % (str(requester)))
+                vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.add_jid_hook, user_info=xmpp.JID(requester), oneshot=True)
+                vm.permission_center.grant_permission_to_user("all", requester.getStripped())
+
+            if definition:
+                if not definition.getTag("uuid"):
+                    definition.addChild("uuid")
+                if not definition.getTag("uuid").getData().lower() == vm_uuid.lower():
+                    definition.getTag("uuid").setData(vm_uuid)
+                if not definition.getTag("name"):
+                    definition.addChild("name")
+                if not definition.getTag("name").getData().lower() == name.lower():
+                    definition.getTag("name").setData(name)
+                vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.define_hook, user_info=definition, oneshot=True)
+
+            self.log.info("Registering the new VM in hypervisor's database.")
+            with self.database_lock:
+                self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(vm_jid.getStripped()), vm_password, datetime.datetime.now(), '', name))
+                self.database.commit()
+            self.register_vm_instance(vm_uuid, vm)
+        finally:
+            self.release_vm_name(name)
 
         self.update_presence()
         self.log.info("XMPP Virtual Machine instance sucessfully initialized.")
@@ -761,9 +1592,10 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         vm_thread = self.create_threaded_vm(jid, password, name, organization_info)
         vm = vm_thread.get_instance()
         self.log.info("Registering the new VM in hypervisor's database.")
-        self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(jid.getStripped()), password, datetime.datetime.now(), '', name))
-        self.database.commit()
-        self.virtualmachines[uuid] = vm
+        with self.database_lock:
+            self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(jid.getStripped()), password, datetime.datetime.now(), '', name))
+            self.database.commit()
+        self.register_vm_instance(uuid, vm)
 
         self.update_presence()
         self.log.info("Migrated XMPP VM is ready.")
@@ -774,6 +1606,54 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         else:
             return vm_thread
 
+    def add_overlay_backing(self, uuid, parent_uuid):
+        """
+        Record that the disks of a virtual machine are qcow2 overlays backed
+        by the disks of another one.
+        @type uuid: string
+        @param uuid: the uuid of the overlay virtual machine
+        @type parent_uuid: string
+        @param parent_uuid: the uuid of the backing virtual machine
+        """
+        with self.database_lock:
+            self.database.execute("insert or replace into overlays values(?,?)", (uuid, parent_uuid))
+            self.database.commit()
+
+    def remove_overlay_backing(self, uuid):
+        """
+        Forget the overlay records of the given virtual machine, as an
+        overlay and as a backing.
+        @type uuid: string
+        @param uuid: the uuid of the virtual machine
+        """
+        with self.database_lock:
+            self.database.execute("delete from overlays where uuid=? or parent_uuid=?", (uuid, uuid))
+            self.database.commit()
+
+    def get_overlay_parent(self, uuid):
+        """
+        Return the virtual machine whose disks back the disks of the given one.
+        @type uuid: string
+        @param uuid: the uuid of the overlay virtual machine
+        @rtype: string
+        @return: the uuid of the backing virtual machine, or None
+        """
+        with self.database_lock:
+            row = self.database.execute("select parent_uuid from overlays where uuid=?", (uuid,)).fetchone()
+        return row and row[0] or None
+
+    def get_overlay_children(self, uuid):
+        """
+        Return the virtual machines whose disks are backed by the disks of
+        the given one.
+        @type uuid: string
+        @param uuid: the uuid of the backing virtual machine
+        @rtype: list
+        @return: the uuids of the overlay virtual machines
+        """
+        with self.database_lock:
+            return [row[0] for row in self.database.execute("select uuid from overlays where parent_uuid=?", (uuid,))]
+
     def free(self, jid):
         """
         Remove the XMPP container of VM with given jid.
@@ -783,8 +1663,9 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         uuid    = jid.getNode()
         vm      = self.virtualmachines[uuid]
 
-        if vm.is_migrating:
+        if vm.is_migrating and not self.migration_scheduler.cancel(uuid, "virtual machine freed"):
             raise Exception("Virtual machine is migrating. Can't free.")
+        vm.check_not_backing_overlays("free")
         if vm.domain and (vm.domain.info()[0] == 1 or vm.domain.info()[0] == 2 or vm.domain.info()[0] == 3):
             vm.domain.destroy()
         if vm.domain:
@@ -794,10 +1675,12 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         vm.terminate()
 
         self.log.info("Unregistering the VM from hypervisor's database.")
-        self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
-        self.database.commit()
+        with self.database_lock:
+            self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
+            self.database.commit()
+        self.remove_overlay_backing(uuid)
 
-        del self.virtualmachines[uuid]
+        self.unregister_vm_instance(uuid)
 
         self.log.info("Starting the vm removing procedure.")
         vm.inband_unregistration()
@@ -819,16 +1702,22 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             uuid = identifier
         vm = self.virtualmachines[uuid]
 
+        self.migration_scheduler.cancel(uuid, "virtual machine freed")
         vm.undefine_and_disconnect()
 
         try:
             self.log.info("Unregistering the VM from hypervisor's database.")
-            self.database.execute("delete from virtualmachines where jid='%s'" % vm.jid.getStripped())
-            self.database.commit()
+            with self.database_lock:
+                self.database.execute("delete from virtualmachines where jid='%s'" % vm.jid.getStripped())
+                self.database.commit()
         except Exception as ex:
             self.log.error("Unable to remove VM from database: %s" % str(ex))
         try:
-            del self.virtualmachines[uuid]
+            self.remove_overlay_backing(uuid)
+        except Exception as ex:
+            self.log.error("Unable to remove VM overlay records from database: %s" % str(ex))
+        try:
+            self.unregister_vm_instance(uuid)
         except Exception as ex:
             self.log.error("Unable to remove VM from internal list: %s" % str(ex))
 
@@ -836,14 +1725,28 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
 
         self.log.info("Virtual machine has been sucessfully soft freed.")
 
-    def clone(self, uuid, requester, wanted_name=None):
+    def clone(self, uuid, requester, wanted_name=None, mode=None, start_thread=True):
         """
         Clone a existing virtual machine.
         @type uuid: string
         @param uuid: the uuid of the VM to clone
         @type requester: xmpp.JID
         @param requester: JID of the requester
+        @type mode: string
+        @param mode: "copy" to copy the disks, "overlay" to create qcow2 overlays backed by them.
+        if None, VIRTUALMACHINE:clone_mode is used
+        @type start_thread: bool
+        @param start_thread: if True, start the thread of the clone immediately
+        @rtype: L{TNArchipelVirtualMachine} or L{TNThreadedVirtualMachine}
+        @return: L{TNArchipelVirtualMachine} if start_thread==True or L{TNThreadedVirtualMachine} if start_thread==False
         """
+        if not mode:
+            mode = ARCHIPEL_CLONE_MODE_COPY
+            if self.configuration.has_option("VIRTUALMACHINE", "clone_mode"):
+                mode = self.configuration.get("VIRTUALMACHINE", "clone_mode")
+        if not mode in ARCHIPEL_CLONE_MODES:
+            raise Exception("Unknown clone mode %s" % mode)
+
         vm = self.get_vm_by_uuid(uuid)
         definition = vm.definition
 
@@ -863,11 +1766,106 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         new_vm = new_vm_thread.get_instance()
         new_vm.register_hook("HOOK_VM_INITIALIZE",
                              method=new_vm.clone,
-                             user_info={"definition": definition, "path": vm.folder, "parentvm": vm},
+                             user_info={"definition": definition, "path": vm.folder, "parentvm": vm, "mode": mode},
                              oneshot=True)
-        new_vm_thread.start()
         self.perform_hooks("HOOK_HYPERVISOR_CLONE", new_vm)
         self.push_change("hypervisor", "clone")
+        if start_thread:
+            new_vm_thread.start()
+            return new_vm
+        else:
+            return new_vm_thread
+
+    def start_bulk_operation(self, operation):
+        """
+        Start the given bulk operation.
+        @type operation: L{TNHypervisorBulkOperation}
+        @param operation: the operation to start
+        """
+        with self.bulk_operations_lock:
+            self.bulk_operations[operation.identifier] = operation
+        self.log.info("BULK: starting %s %s on %d items with %d workers" % (operation.action, operation.identifier, len(operation.items), operation.workers))
+        operation.start()
+
+    def end_bulk_operation(self, operation):
+        """
+        Called by a L{TNHypervisorBulkOperation} when all its items have been processed.
+        @type operation: L{TNHypervisorBulkOperation}
+        @param operation: the finished operation
+        """
+        with self.bulk_operations_lock:
+            self.bulk_operations.pop(operation.identifier, None)
+        self.update_presence()
+        self.perform_hooks("HOOK_HYPERVISOR_BULK_DONE", operation)
+        self.shout("virtualmachine", "%s requested by %s is done: %d virtual machines, %d failures" % (operation.action, operation.requester, len(operation.items), operation.failures))
+
+    def has_bulk_operations(self):
+        """
+        @rtype: Boolean
+        @return: True if a bulk operation is running
+        """
+        return len(self.bulk_operations) > 0
+
+    def get_bulk_operation_of_vm(self, uuid):
+        """
+        Return the running bulk operation that creates or frees the given virtual machine.
+        @type uuid: string
+        @param uuid: the uuid of the virtual machine
+        @rtype: L{TNHypervisorBulkOperation}
+        @return: the operation, or None
+        """
+        with self.bulk_operations_lock:
+            for operation in self.bulk_operations.values():
+                if operation.has_vm(uuid):
+                    return operation
+        return None
+
+    def perform_bulk_item(self, action, requester, item, track_vm=None):
+        """
+        Perform the given bulk action on one item.
+        @type action: string
+        @param action: one of ARCHIPEL_HYPERVISOR_BULK_ACTIONS
+        @type requester: xmpp.JID
+        @param requester: the JID of the requester
+        @type item: xmpp.Node
+        @param item: the item describing the target
+        @type track_vm: function
+        @param track_vm: if not None, called with (vm, will_define) before the thread of a
+                         created virtual machine is started, or before a virtual machine is freed.
+                         will_define is True if the virtual machine will be defined later
+        @rtype: string
+        @return: the JID of the created virtual machine for alloc_many and clone_many, None otherwise
+        """
+        if action == "alloc_many":
+            vm_thread = self.alloc(requester, requested_name=item.getAttr("name"), start_thread=False,
+                                   organization_info=self.organization_info_from_node(item), definition=item.getTag("domain"))
+            vm = vm_thread.get_instance()
+            if track_vm:
+                track_vm(vm, item.getTag("domain") is not None)
+            vm_thread.start()
+            return str(vm.jid.getStripped())
+
+        vm = self.get_vm_by_jid(item.getAttr("jid") or "")
+        if not vm:
+            raise Exception("Virtual machine with JID %s is not managed by this hypervisor" % item.getAttr("jid"))
+        if action == "free_many":
+            if track_vm:
+                track_vm(vm, False)
+            self.free(vm.jid)
+        elif action == "clone_many":
+            new_vm_thread = self.clone(vm.uuid, requester, item.getAttr("name"), item.getAttr("mode"), start_thread=False)
+            new_vm = new_vm_thread.get_instance()
+            if track_vm:
+                track_vm(new_vm, True)
+            new_vm_thread.start()
+            return str(new_vm.jid.getStripped())
+        elif action == "migrate_many":
+            if not item.getAttr("hypervisorjid"):
+                raise Exception("No destination hypervisor given")
+            vm.migrate(xmpp.JID(item.getAttr("hypervisorjid")), migration_options_from_node(item, self.migration_default_options))
+        else:
+            raise Exception("Unknown bulk action %s" % action)
+        return None
 
     def get_capabilities(self):
         """
@@ -915,12 +1913,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         """
         try:
             command = iq.getTag("query").getTag("archipel")
-
-            organization_info = {}
-            for element in ("ORGNAME", "ORGUNIT", "LOCALITY", "USERID", "CATEGORIES"):
-                organization_info[element] = command.getAttr(element.lower())
-                if not organization_info[element]:
-                    organization_info[element] = self.vcard_infos[element]
+            organization_info = self.organization_info_from_node(command)
 
             xml_description = command.getTag("domain")
 
@@ -939,6 +1932,22 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_ALLOC)
         return reply
 
+    def organization_info_from_node(self, node):
+        """
+        Read the organization information given as attributes of the node.
+        Missing values are taken from the hypervisor's ones.
+        @type node: xmpp.Node
+        @param node: the node of the request
+        @rtype: dict
+        @return: the organization information
+        """
+        organization_info = {}
+        for element in ("ORGNAME", "ORGUNIT", "LOCALITY", "USERID", "CATEGORIES"):
+            organization_info[element] = node.getAttr(element.lower())
+            if not organization_info[element]:
+                organization_info[element] = self.vcard_infos[element]
+        return organization_info
+
     def message_alloc(self, msg):
         """
         Handle the allocation request message.
@@ -1056,7 +2065,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             vmuuid = vmjid.getNode()
             if iq.getTag("query").getTag("archipel").getAttr("name"):
                 wanted_name = iq.getTag("query").getTag("archipel").getAttr("name")
-            self.clone(vmuuid, iq.getFrom(), wanted_name)
+            self.clone(vmuuid, iq.getFrom(), wanted_name, iq.getTag("query").getTag("archipel").getAttr("mode"))
             self.shout("virtualmachine", "The Archipel Virtual Machine %s has been cloned by %s" % (vmuuid, iq.getFrom()))
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_CLONE)
@@ -1083,6 +2092,39 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         except Exception as ex:
             return build_error_message(self, ex, msg)
 
+    def iq_bulk(self, iq, action):
+        """
+        Start a bulk action on the items of the IQ. The reply contains the
+        identifier of the batch, and the results are pushed on the
+        hypervisor events node with the changes bulk_progress and bulk_done.
+        Items are:
+            - alloc_many: <item name="" orgname="" ...><domain/></item>
+            - free_many: <item jid=""/>
+            - clone_many: <item jid="" name=""/>
+            - migrate_many: <item jid="" hypervisorjid=""/>
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @type action: string
+        @param action: one of ARCHIPEL_HYPERVISOR_BULK_ACTIONS
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the identifier of the batch
+        """
+        try:
+            reply = iq.buildReply("result")
+            items = iq.getTag("query").getTag("archipel").getTags("item")
+            if not items:
+                raise Exception("No item given for %s" % action)
+            if action == "alloc_many":
+                names = [item.getAttr("name").upper() for item in items if item.getAttr("name")]
+                if len(names) != len(set(names)):
+                    raise Exception("The same name is requested several times")
+            operation = TNHypervisorBulkOperation(self, action, iq.getFrom(), items, workers=self.bulk_workers, define_timeout=self.bulk_define_timeout)
+            self.start_bulk_operation(operation)
+            reply.setQueryPayload([xmpp.Node("batch", attrs={"id": operation.identifier, "action": action, "total": len(items)})])
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_BULK)
+        return reply
+
     def iq_roster(self, iq):
         """
         Send the hypervisor roster content.
@@ -1099,10 +2141,9 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                 n.addData(vm.jid)
                 nodes.append(n)
 
-            unanaged_domains = self.get_raw_libvirt_domains(only_persistant=True)
-            for dom in unanaged_domains:
-                n = xmpp.Node("item", attrs={"managed": "False", "name": dom.name()})
-                n.addData("%s@%s" % (dom.UUIDString(), self.jid.getDomain()))
+            for uuid, name in self.get_unmanaged_domains(only_persistant=True):
+                n = xmpp.Node("item", attrs={"managed": "False", "name": name})
+                n.addData("%s@%s" % (uuid, self.jid.getDomain()))
                 nodes.append(n)
 
             reply.setQueryPayload(sorted(nodes, cmp=lambda x, y: cmp(x.getData(), y.getData())))
@@ -1211,6 +2252,40 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         except Exception as ex:
             return build_error_message(self, ex, msg)
 
+    def iq_migrations(self, iq):
+        """
+        Send the running, queued and last finished live migrations, with
+        their options and job statistics.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            reply = iq.buildReply("result")
+            reply.setQueryPayload([self.migration_scheduler.to_node(xmpp.Node("migrations"))])
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_MIGRATIONS)
+        return reply
+
+    def iq_cancel_migration(self, iq):
+        """
+        Cancel the queued live migration of a virtual machine.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            uuid = iq.getTag("query").getTag("archipel").getAttr("uuid")
+            if not self.migration_scheduler.cancel(uuid):
+                raise Exception("Virtual machine %s has no queued migration" % uuid)
+            reply = iq.buildReply("result")
+            self.push_change("hypervisor", "migrationcancelled")
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_CANCEL_MIGRATION)
+        return reply
+
     def iq_nodeinfo(self, iq):
         """
         Send the hypervisor node informations.
@@ -1285,9 +2360,10 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                 vm = self.virtualmachines[uuid]
                 vm.terminate(clean_files=False)
                 self.log.info("Unregistering the VM from hypervisor's database.")
-                self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
-                self.database.commit()
-                del self.virtualmachines[uuid]
+                with self.database_lock:
+                    self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
+                    self.database.commit()
+                self.unregister_vm_instance(uuid)
                 self.log.info("Starting the vm removing procedure.")
                 vm.inband_unregistration()
                 self.log.info("unmanage virtual machine with UUID: %s" % uuid)
@@ -1347,8 +2423,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HYPERVISOR_SET_ORG_INFO)
         return reply
 
-    def on_xmpp_loop_tick(self):
-        self.check_libvirt_connection()
+    def check_central_agent(self):
+        """
+        Timer checking if a central agent is present. If none is found
+        after the keepalive interval, wake up the VMs using the local database.
+        """
         if self.check_for_central_agent:
             if not self.last_keepalive_from_central_agent:
                 self.last_keepalive_from_central_agent = datetime.datetime.now()
@@ -1368,7 +2447,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                     self.update_presence(presence_msg=status)
                     return
 
-            if not self.already_wake_up:
+            if not self.already_wake_up and not self.waking_up:
                 self.log.error("HYPERVISOR: No Central agent found after %s seconds, starting vms based on local db info only." % self.get_plugin("centraldb").keepalive_interval)
                 self.wake_up_virtual_machines_hook()
 
@@ -1377,6 +2456,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         Called when Archipel exits gracefully (by init script or system shutdown)
         """
         self.log.info("Archipel is terminating.")
+        self.domain_events.stop()
+        self.sampling_thread.stop()
         if self.get_plugin("centraldb"):
             try:
                 self.get_plugin("centraldb").update_hypervisors([{"jid":str(self.jid), "last_seen":datetime.datetime.now(), "status":"Off"}])
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+#
+# archipelMigrationScheduler.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNMigrationScheduler}, that runs the live migrations of the
+virtual machines of the hypervisor, and L{TNMigrationJob}, one migration.
+
+Migrations are queued, and started in order as long as the hypervisor
+runs less than max_concurrent migrations and less than max_per_destination
+to the same destination hypervisor. A migration to a busy destination
+doesn't prevent the next ones to other destinations from starting, so
+evacuating a host uses all the links without overloading the source.
+A queued migration can be cancelled, and is when its virtual machine
+is destroyed, undefined or freed before it starts.
+
+The statistics of the running migrations are sampled by the hypervisor
+timer. They update the presence of the virtual machines, trigger the
+switch to post-copy, and the last samples are kept in the history of
+finished migrations.
+"""
+
+import libvirt
+import time
+from collections import deque
+from threading import Lock, Thread
+
+
+ARCHIPEL_MIGRATION_MAX_CONCURRENT       = 4
+ARCHIPEL_MIGRATION_MAX_PER_DESTINATION  = 2
+ARCHIPEL_MIGRATION_SAMPLING_INTERVAL    = 3.0
+ARCHIPEL_MIGRATION_HISTORY_SIZE         = 50
+
+# a post-copy migration switches to post-copy after this number of
+# memory passes, if it is not finished
+ARCHIPEL_MIGRATION_POSTCOPY_AFTER_ITERATION = 2
+
+ARCHIPEL_MIGRATION_BOOLEAN_OPTIONS      = ("compressed", "auto_converge", "postcopy")
+
+# libvirt flags of the boolean options
+ARCHIPEL_MIGRATION_OPTION_FLAGS         = {"compressed": "VIR_MIGRATE_COMPRESSED",
+                                           "auto_converge": "VIR_MIGRATE_AUTO_CONVERGE",
+                                           "postcopy": "VIR_MIGRATE_POSTCOPY"}
+
+# fields of the libvirt job statistics that are recorded
+ARCHIPEL_MIGRATION_STATS_FIELDS         = ("time_elapsed", "data_total", "data_processed", "data_remaining",
+                                           "memory_dirty_rate", "memory_iteration", "memory_bps", "downtime")
+
+
+def migration_options_from_node(node, defaults=None):
+    """
+    Read the migration options given as attributes of a node:
+    bandwidth (MiB/s), compressed, auto_converge and postcopy ("true" or "false").
+    @type node: xmpp.Node
+    @param node: the node
+    @type defaults: dict
+    @param defaults: the options used when the node doesn't give them
+    @rtype: dict
+    @return: the options
+    """
+    options = dict(defaults or {})
+    if node.getAttr("bandwidth"):
+        options["bandwidth"] = int(node.getAttr("bandwidth"))
+    for name in ARCHIPEL_MIGRATION_BOOLEAN_OPTIONS:
+        if node.getAttr(name):
+            options[name] = node.getAttr(name).lower() in ("true", "yes", "1")
+    return options
+
+def migration_flags(options):
+    """
+    Return the libvirt flags of a live migration with the given options.
+    @type options: dict
+    @param options: the migration options
+    @rtype: integer
+    @return: the flags
+    """
+    flags = libvirt.VIR_MIGRATE_PEER2PEER | libvirt.VIR_MIGRATE_PERSIST_DEST | libvirt.VIR_MIGRATE_LIVE
+    if hasattr(libvirt, "VIR_MIGRATE_UNSAFE"):
+        flags |= libvirt.VIR_MIGRATE_UNSAFE
+    for name, flag in ARCHIPEL_MIGRATION_OPTION_FLAGS.iteritems():
+        if not options.get(name):
+            continue
+        if not hasattr(libvirt, flag):
+            raise Exception("Migration option %s is not supported by this version of libvirt" % name)
+        flags |= getattr(libvirt, flag)
+    return flags
+
+
+class TNMigrationJob (object):
+    """
+    The live migration of one virtual machine.
+    """
+
+    def __init__(self, vm, destination_jid, uri, options=None):
+        """
+        The contructor of the class.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine to migrate
+        @type destination_jid: xmpp.JID
+        @param destination_jid: the JID of the destination hypervisor
+        @type uri: string
+        @param uri: the libvirt URI of the destination hypervisor
+        @type options: dict
+        @param options: the migration options
+        """
+        self.vm = vm
+        self.destination_jid = destination_jid
+        self.uri = uri
+        self.options = options or {}
+        self.state = "queued"
+        self.error = None
+        self.queued_date = time.time()
+        self.start_date = None
+        self.end_date = None
+        self.last_stats = {}
+        self.postcopy_started = False
+
+    def destination(self):
+        """
+        @rtype: string
+        @return: the bare JID of the destination hypervisor
+        """
+        return self.destination_jid.getStripped()
+
+    def progress(self):
+        """
+        @rtype: integer
+        @return: the progress in percent, according to the last statistics
+        """
+        total = self.last_stats.get("data_total", 0)
+        if not total:
+            return 0
+        if not self.last_stats.get("data_remaining", 0):
+            return 100
+        return min(99, int(100 - self.last_stats["data_remaining"] * 100.0 / total))
+
+    def read_stats(self, completed=False):
+        """
+        Read the job statistics of the domain.
+        @type completed: Boolean
+        @param completed: if True, read the statistics of the completed job
+        @rtype: dict
+        @return: the statistics, empty if they are not available
+        """
+        domain = self.vm.domain
+        try:
+            if completed:
+                if not hasattr(libvirt, "VIR_DOMAIN_JOB_STATS_COMPLETED"):
+                    return {}
+                stats = domain.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED)
+            elif hasattr(domain, "jobStats"):
+                stats = domain.jobStats()
+            else:
+                info = domain.jobInfo()
+                stats = {"time_elapsed": info[1], "data_total": info[3], "data_processed": info[4], "data_remaining": info[5]}
+        except (AttributeError, libvirt.libvirtError):
+            # the domain may have been freed at the end of the migration
+            return {}
+        return dict((field, stats[field]) for field in ARCHIPEL_MIGRATION_STATS_FIELDS if field in stats)
+
+    def to_node(self, node):
+        """
+        Write the job into the given node.
+        @type node: xmpp.Node
+        @param node: the node
+        @rtype: xmpp.Node
+        @return: the node
+        """
+        node.setAttr("uuid", self.vm.uuid)
+        node.setAttr("name", self.vm.name)
+        node.setAttr("destination", self.destination())
+        node.setAttr("state", self.state)
+        node.setAttr("progress", self.progress())
+        for name, value in self.options.iteritems():
+            if isinstance(value, bool):
+                value = value and "true" or "false"
+            node.setAttr(name, value)
+        if self.start_date:
+            node.setAttr("waited", "%.1f" % (self.start_date - self.queued_date))
+            node.setAttr("duration", "%.1f" % ((self.end_date or time.time()) - self.start_date))
+        if self.error:
+            node.setAttr("error", self.error)
+        if self.last_stats:
+            node.addChild("stats", attrs=self.last_stats)
+        return node
+
+
+class TNMigrationScheduler (object):
+    """
+    Queue of the live migrations of the hypervisor, with concurrency caps.
+    """
+
+    def __init__(self, hypervisor, max_concurrent=ARCHIPEL_MIGRATION_MAX_CONCURRENT, max_per_destination=ARCHIPEL_MIGRATION_MAX_PER_DESTINATION, history_size=ARCHIPEL_MIGRATION_HISTORY_SIZE):
+        """
+        The contructor of the class.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor
+        @type max_concurrent: integer
+        @param max_concurrent: max number of migrations running at the same time. 0 means no limit
+        @type max_per_destination: integer
+        @param max_per_destination: max number of migrations running to the same hypervisor. 0 means no limit
+        @type history_size: integer
+        @param history_size: number of finished migrations kept
+        """
+        self.hypervisor = hypervisor
+        self.max_concurrent = max_concurrent
+        self.max_per_destination = max_per_destination
+        self.queued = []
+        self.running = []
+        self.history = deque(maxlen=history_size)
+        self.lock = Lock()
+
+    def submit(self, job):
+        """
+        Queue a migration. It is started as soon as the caps allow it.
+        @type job: L{TNMigrationJob}
+        @param job: the migration
+        """
+        with self.lock:
+            self.queued.append(job)
+            running, queued = len(self.running), len(self.queued)
+        self.hypervisor.log.info("MIGRATION: %s to %s queued (%d running, %d queued)" % (job.vm.uuid, job.destination(), running, queued))
+        self.schedule()
+
+    def cancel(self, uuid, reason="cancelled"):
+        """
+        Cancel the queued migration of a virtual machine. A running
+        migration is not affected.
+        @type uuid: string
+        @param uuid: the UUID of the virtual machine
+        @type reason: string
+        @param reason: the reason recorded as error of the job
+        @rtype: L{TNMigrationJob}
+        @return: the cancelled migration, None if the virtual machine has no queued migration
+        """
+        with self.lock:
+            jobs = [job for job in self.queued if job.vm.uuid == uuid]
+            if not jobs:
+                return None
+            job = jobs[0]
+            self.queued.remove(job)
+            job.state = "cancelled"
+            job.error = reason
+            job.end_date = time.time()
+            self.history.append(job)
+        job.vm.is_migrating = False
+        self.hypervisor.log.info("MIGRATION: %s to %s cancelled: %s" % (uuid, job.destination(), reason))
+        try:
+            job.vm.change_presence(presence_show=job.vm.xmppstatusshow, presence_status="Migration cancelled")
+        except Exception as ex:
+            self.hypervisor.log.warning("MIGRATION: unable to update presence of %s: %s" % (uuid, str(ex)))
+        return job
+
+    def can_start(self, job):
+        """
+        Tell if a queued migration can start. Must be called with the lock acquired.
+        @type job: L{TNMigrationJob}
+        @param job: the migration
+        @rtype: Boolean
+        @return: True if the caps allow it
+        """
+        if self.max_concurrent and len(self.running) >= self.max_concurrent:
+            return False
+        if self.max_per_destination:
+            to_destination = len([running for running in self.running if running.destination() == job.destination()])
+            if to_destination >= self.max_per_destination:
+                return False
+        return True
+
+    def schedule(self):
+        """
+        Start the queued migrations allowed by the caps, in order.
+        """
+        started = []
+        with self.lock:
+            for job in self.queued[:]:
+                if not self.can_start(job):
+                    continue
+                self.queued.remove(job)
+                self.running.append(job)
+                job.state = "running"
+                job.start_date = time.time()
+                started.append(job)
+        for job in started:
+            thread = Thread(target=self.run_job, args=(job,), name="migration-%s" % job.vm.uuid)
+            thread.setDaemon(True)
+            thread.start()
+
+    def run_job(self, job):
+        """
+        Run one migration, then start the next ones.
+        @type job: L{TNMigrationJob}
+        @param job: the migration
+        """
+        try:
+            job.vm.migrate_running_step3(job)
+            job.state = "done"
+        except Exception as ex:
+            job.state = "failed"
+            job.error = str(ex)
+        if job.state == "done":
+            job.last_stats.update(job.read_stats(completed=True))
+        job.end_date = time.time()
+        with self.lock:
+            self.running.remove(job)
+            self.history.append(job)
+        self.hypervisor.log.info("MIGRATION: %s to %s %s after %.1fs (downtime %sms, %s bytes transferred, dirty rate %s pages/s)" % (job.vm.uuid, job.destination(), job.state,
+                                 job.end_date - job.start_date, job.last_stats.get("downtime", "?"), job.last_stats.get("data_processed", "?"), job.last_stats.get("memory_dirty_rate", "?")))
+        self.schedule()
+
+    def sample(self):
+        """
+        Read the statistics of the running migrations, update the presence
+        of the virtual machines and switch to post-copy when needed.
+        """
+        with self.lock:
+            running = self.running[:]
+        for job in running:
+            stats = job.read_stats()
+            if not stats or not job.state == "running":
+                continue
+            job.last_stats = stats
+            if job.options.get("postcopy") and not job.postcopy_started and stats.get("memory_iteration", 0) >= ARCHIPEL_MIGRATION_POSTCOPY_AFTER_ITERATION:
+                try:
+                    job.vm.domain.migrateStartPostCopy(0)
+                    job.postcopy_started = True
+                    self.hypervisor.log.info("MIGRATION: %s switched to post-copy" % job.vm.uuid)
+                except libvirt.libvirtError as ex:
+                    self.hypervisor.log.warning("MIGRATION: unable to switch %s to post-copy: %s" % (job.vm.uuid, str(ex)))
+            try:
+                job.vm.change_presence(presence_show=job.vm.xmppstatusshow, presence_status="Migrating - %d%%" % job.progress())
+            except Exception as ex:
+                self.hypervisor.log.warning("MIGRATION: unable to update presence of %s: %s" % (job.vm.uuid, str(ex)))
+
+    def to_node(self, node):
+        """
+        Write the running, queued and finished migrations into the given node.
+        @type node: xmpp.Node
+        @param node: the node
+        @rtype: xmpp.Node
+        @return: the node
+        """
+        with self.lock:
+            running = self.running[:]
+            queued = self.queued[:]
+            history = list(self.history)
+        node.setAttr("running", len(running))
+        node.setAttr("queued", len(queued))
+        node.setAttr("max_concurrent", self.max_concurrent)
+        node.setAttr("max_per_destination", self.max_per_destination)
+        for job in running + queued:
+            job.to_node(node.addChild("migration"))
+        history_node = node.addChild("history")
+        for job in reversed(history):
+            job.to_node(history_node.addChild("migration"))
+        return node
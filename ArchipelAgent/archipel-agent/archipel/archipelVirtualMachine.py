@@ -39,21 +39,24 @@ import os
 import shutil
 import thread
 import base64
+import copy
 import sys
 import traceback
-import time
-from threading import Timer
+from threading import Lock, Timer
 from StringIO import StringIO
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelPermissionCenter import TNArchipelSharedPermissionCenter
 from archipelcore.archipelRosterQueryableEntity import TNRosterQueryableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
 from archipelcore.utils import build_error_iq, build_error_message
 from archipelcore import xmpp
 
+from archipelCloneEngine import ARCHIPEL_CLONE_MODE_OVERLAY, ARCHIPEL_CLONE_WORKERS, TNCloneEngine
 from archipelLibvirtEntity import ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR, generate_mac_adress
+from archipelMigrationScheduler import TNMigrationJob, migration_flags, migration_options_from_node
 import archipelLibvirtEntity
 
 
@@ -123,9 +126,9 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.is_freeing = False
         self.inhibit_undefine_domain_event_counter = 0
         self.inhibit_define_domain_event_counter   = 0
-        self.cputime_samples = []
-        self.cputime_sampling_Interval = 2.0
-        self.cputime_sampling_timer(self.cputime_sampling_Interval)
+        self.domain_cache = {}
+        self.domain_cache_generation = 0
+        self.domain_cache_lock = Lock()
 
         if self.configuration.has_option("VIRTUALMACHINE", "vm_perm_path"):
             self.vm_perm_base_path = self.configuration.get("VIRTUALMACHINE", "vm_perm_path")
@@ -141,6 +144,13 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
 
         # start the permission center
         self.permission_db_file = "%s/%s" % (self.permfolder, self.configuration.get("VIRTUALMACHINE", "vm_permissions_database_path"))
+        permission_store = getattr(self.hypervisor, "vm_permission_store", None)
+        if permission_store:
+            if os.path.exists(self.permission_db_file) and not permission_store.has_entity(self.uuid):
+                imported = permission_store.import_database(self.uuid, self.permission_db_file)
+                self.log.info("Imported %d permissions, %d users and %d granted permissions from %s" % (imported + (self.permission_db_file,)))
+            self.permission_db_file = None
+            self.permission_center = TNArchipelSharedPermissionCenter(permission_store, self.uuid, root_admins=self.permission_center.root_admins)
         self.permission_center.start(database_file=self.permission_db_file)
         self.init_permissions()
 
@@ -153,6 +163,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.create_hook("HOOK_VM_RESUME")
         self.create_hook("HOOK_VM_UNDEFINE")
         self.create_hook("HOOK_VM_DEFINE")
+        self.create_hook("HOOK_VM_DEFINE_FAILED")
         self.create_hook("HOOK_VM_INITIALIZE")
         self.create_hook("HOOK_VM_TERMINATE")
         self.create_hook("HOOK_VM_FREE")
@@ -334,7 +345,9 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.hypervisor.libvirt_contains_domain_with_name(newname, raise_error=True)
 
         self.log.info("Renaming VM from %s to %s" % (self.name, newname))
+        old_name = self.name
         self.change_name(newname, publish)
+        self.hypervisor.reindex_vm_name(self, old_name)
 
         if self.domain:
             self.inhibit_undefine_domain_event_counter += 1
@@ -412,6 +425,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         then to the domain by looking the uuid used as JID Node.
         Exit on any error.
         """
+        self.invalidate_domain_cache()
         try:
             self.domain = self.hypervisor.libvirt_connection.lookupByUUIDString(self.uuid)
         except:
@@ -429,6 +443,91 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
 
         self.set_presence_according_to_libvirt_info()
 
+    # Domain cache
+
+    def invalidate_domain_cache(self):
+        """
+        Drop the cached descriptions, devices and autostart flag of the domain.
+        Called on define, undefine and on every libvirt event of the domain.
+        """
+        with self.domain_cache_lock:
+            self.domain_cache_generation += 1
+            self.domain_cache = {}
+
+    def get_domain_cache(self, key, compute):
+        """
+        Return the cached value for key, computing it if needed. A value
+        computed while the cache is invalidated is not stored.
+        @type key: object
+        @param key: the key of the value
+        @type compute: function
+        @param compute: function without argument returning the value
+        @return: the value
+        """
+        with self.domain_cache_lock:
+            generation = self.domain_cache_generation
+            if key in self.domain_cache:
+                return self.domain_cache[key]
+        value = compute()
+        with self.domain_cache_lock:
+            if generation == self.domain_cache_generation:
+                self.domain_cache[key] = value
+        return value
+
+    def get_domain_description(self, flags=0):
+        """
+        Return the parsed libvirt description of the domain. The returned
+        node is shared: use a copy before modifying it.
+        @type flags: integer
+        @param flags: the libvirt XMLDesc flags
+        @rtype: xmpp.Node
+        @return: the description
+        """
+        if not self.domain:
+            raise Exception("You need to first define the virtual machine")
+        domain = self.domain
+        return self.get_domain_cache(("description", flags), lambda: xmpp.simplexml.NodeBuilder(data=str(domain.XMLDesc(flags))).getDom())
+
+    def get_domain_devices(self):
+        """
+        Return the devices of the live description of the domain.
+        @rtype: dict
+        @return: dict with the keys:
+            - interfaces: list of dict (target, name, mac)
+            - disks: list of dict (target, path, device)
+            - graphics: list of dict (type, port)
+        """
+        def compute():
+            devices = {"interfaces": [], "disks": [], "graphics": []}
+            devices_node = self.get_domain_description().getTag("devices")
+            if not devices_node:
+                return devices
+            for nic in devices_node.getTags("interface"):
+                if not nic.getTag("target"):
+                    continue
+                target = nic.getTag("target").getAttr("dev")
+                name = target
+                if nic.getTag("alias"):
+                    name = nic.getTag("alias").getAttr("name")
+                mac = None
+                if nic.getTag("mac"):
+                    mac = nic.getTag("mac").getAttr("address")
+                devices["interfaces"].append({"target": target, "name": name, "mac": mac})
+            for disk in devices_node.getTags("disk"):
+                path = None
+                if disk.getTag("source"):
+                    source = disk.getTag("source")
+                    path = source.getAttr("file") or source.getAttr("dev") or source.getAttr("name")
+                target = None
+                if disk.getTag("target"):
+                    target = disk.getTag("target").getAttr("dev")
+                devices["disks"].append({"target": target, "path": path, "device": disk.getAttr("device")})
+            for graphics in devices_node.getTags("graphics"):
+                port = graphics.getAttr("port")
+                devices["graphics"].append({"type": graphics.getAttr("type"), "port": port and int(port) or -1})
+            return devices
+        return self.get_domain_cache("devices", compute)
+
     def on_domain_event(self, event, detail):
         """
         Called when a libvirt event is triggered.
@@ -440,10 +539,13 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         @param detail: the detail associated to the event
         """
         self.log.info("LIBVIRTEVENT: Libvirt event received: %d with detail %s" % (event, detail))
+        self.invalidate_domain_cache()
 
         if self.is_migrating:
-            self.log.info("LIBVIRTEVENT: Event received but virtual machine is migrating. Ignoring.")
-            return
+            stopped = (event == libvirt.VIR_DOMAIN_EVENT_STOPPED and not detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED)
+            if not (stopped or event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED) or not self.hypervisor.migration_scheduler.cancel(self.uuid, "domain stopped or undefined"):
+                self.log.info("LIBVIRTEVENT: Event received but virtual machine is migrating. Ignoring.")
+                return
 
         try:
             if event == libvirt.VIR_DOMAIN_EVENT_STARTED and not detail == libvirt.VIR_DOMAIN_EVENT_STARTED_MIGRATED:
@@ -515,7 +617,11 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         """
         Hook for defining on hook
         """
-        self.define(user_info)
+        try:
+            self.define(user_info)
+        except Exception as ex:
+            self.perform_hooks("HOOK_VM_DEFINE_FAILED", str(ex))
+            raise
 
     def control_create_hook(self, origin=None, user_info=None, arguments=None):
         """
@@ -523,33 +629,6 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         """
         self.create()
 
-    def _listen_migration_progress(self):
-        """
-        Will periodically update the VM XMPP status with the migration progress
-        """
-        try:
-            jobInfo = self.domain.jobInfo()
-            total = jobInfo[3]
-            remaining = jobInfo[5]
-            progress = 0
-
-            if (total == 0):
-                progress = 0
-            else:
-                if remaining == 0:
-                    progress = 100
-                else:
-                    progress = int(float(100) - float(remaining) * float(100.0) / float(total))
-                    if progress >= 100:
-                        progress = 99
-            if progress > 0:
-                self.change_presence(presence_show=self.xmppstatusshow, presence_status="Migrating - %d%%" % progress)
-
-            if self.is_migrating:
-                Timer(3, self._listen_migration_progress, []).start()
-        except Exception:
-            pass
-
     # Process IQ
 
     def __process_iq_archipel_control(self, conn, iq):
@@ -581,6 +660,8 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         if not self.hypervisor.libvirt_connection:
             self.log.info("Control action required but no libvirt connection.")
             raise xmpp.protocol.NodeProcessed
+        if self.is_migrating and action in ("destroy", "undefine"):
+            self.hypervisor.migration_scheduler.cancel(self.uuid, "virtual machine %s" % (action == "destroy" and "destroyed" or "undefined"))
         if self.is_migrating and (action not in ("info", "xmldesc", "networkinfo")):
             reply = build_error_iq(self, "Virtual machine is migrating. Can't perform this control operation.", iq, ARCHIPEL_ERROR_CODE_VM_MIGRATING)
             conn.send(reply)
@@ -663,6 +744,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         """
         if not self.domain:
             raise Exception("You need to first define the virtual machine")
+        self.check_not_backing_overlays("start")
         self.domain.create()
         self.log.info("Virtual machine created.")
         return str(self.domain.ID())
@@ -674,7 +756,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         if not self.domain:
             raise Exception("You need to first define the virtual machine")
         self.domain.shutdown()
-        if self.info()["state"] == libvirt.VIR_DOMAIN_RUNNING or self.info()["state"] == libvirt.VIR_DOMAIN_BLOCKED:
+        if self.domain.info()[0] in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED):
             self.change_presence(self.xmppstatusshow, ARCHIPEL_XMPP_SHOW_SHUTTINGDOWN)
         self.log.info("Virtual machine shut down.")
 
@@ -685,7 +767,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         if not self.domain:
             raise Exception("You need to first define the virtual machine")
 
-        if self.info()["state"] == libvirt.VIR_DOMAIN_SHUTOFF:
+        if self.domain.info()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
             self.log.warning("Virtual machine already off.")
             return
 
@@ -760,39 +842,26 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             return (data, size)
         return (None, (0, 0))
 
-    def cputime_sampling_timer(self, interval):
-        """
-        Create a threaded timer to take timestamp,cputime samples from actual domain
-        """
-        if self.domain and not self.is_freeing and not self.is_migrating:
-            try:
-                self.cputime_samples.insert(0, (time.time(), self.domain.info()[4]))
-                if len(self.cputime_samples) > 2:
-                    self.cputime_samples.pop()
-            except Exception as ex:
-                # @TODO: I'm sure there is a better way to do this.
-                # First, this thing should be only running when the VM is running
-                # instead of trying for nothing is the VM is not defined and running.
-                self.log.warning("It seems the VM is gone, certainly due to migration. Stopping cpu usage collector. (reason %s)" % ex)
-                return
-
-        if not self.is_migrating:
-            Timer(interval, self.cputime_sampling_timer, [interval]).start()
-
     def compute_cpu_usage(self):
         """
-        Return the vm CPU usage in percent between two samples
+        Return the vm CPU usage in percent between the two last samples
+        taken by the hypervisor's L{TNDomainStatsSampler}
         """
         try:
-            prtCPU = 100 * (self.cputime_samples[0][1] - self.cputime_samples[1][1]) / ((self.cputime_samples[0][0] - self.cputime_samples[1][0]) * self.hypervisor.get_nodeinfo()['nrCoreperSocket'] * 1000000000)
-        except:
-            prtCPU = 0
-
-        if prtCPU > 0:
-            return prtCPU
-        else:
+            return self.hypervisor.stats_sampler.cpu_usage(self.uuid)
+        except Exception:
             return 0
 
+    def stats_history(self, count=1):
+        """
+        Return the last statistics samples taken by the hypervisor's L{TNDomainStatsSampler}.
+        @type count: integer
+        @param count: max number of samples
+        @rtype: list
+        @return: list of dict, the most recent first
+        """
+        return self.hypervisor.stats_sampler.history(self.uuid, count)
+
     def info(self):
         """
         Return info of a domain.
@@ -808,7 +877,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             delta_memory = 0
 
         try:
-            autostart = self.domain.autostart()
+            autostart = self.get_domain_cache("autostart", self.domain.autostart)
         except:
             autostart = 0
 
@@ -823,25 +892,22 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
 
     def network_info(self):
         """
-        Get network statistics on the domain.
+        Get network statistics on the domain. The counters sampled by the
+        hypervisor's L{TNDomainStatsSampler} are used when available.
         """
         if not self.domain:
             raise Exception("You need to first define the virtual machine")
-        if not self.domain.info()[0] == libvirt.VIR_DOMAIN_RUNNING and not self.domain.info()[0] == libvirt.VIR_DOMAIN_BLOCKED:
+        if self.domain.info()[0] not in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED):
             raise Exception('Virtual machine must be running.')
 
-        desc = xmpp.simplexml.NodeBuilder(data=self.domain.XMLDesc(0)).getDom()
-        interfaces_nodes = desc.getTag("devices").getTags("interface")
+        sampled = self.hypervisor.stats_sampler.interfaces_stats(self.uuid) or {}
         netstats = []
-        for nic in interfaces_nodes:
-            target = nic.getTag("target").getAttr("dev")
-            try:
-                name = nic.getTag("alias").getAttr("name")
-            except:
-                name = target
-            stats = self.domain.interfaceStats(target)
+        for nic in self.get_domain_devices()["interfaces"]:
+            stats = sampled.get(nic["target"])
+            if not stats:
+                stats = self.domain.interfaceStats(nic["target"])
             netstats.append({
-                "name": name,
+                "name": nic["name"],
                 "rx_bytes": stats[0],
                 "rx_packets": stats[1],
                 "rx_errs": stats[2],
@@ -908,17 +974,16 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         if not self.domain:
             raise Exception("You need to first define the virtual machine")
         self.domain.setAutostart(flag)
+        self.invalidate_domain_cache()
 
     def xmldesc(self, mask_description=True):
         """
-        Get the XML description of the domain.
+        Get the XML description of the domain. The returned node is a deep
+        copy of the cached description, so callers can modify it.
         @rtype: xmpp.Node
         @return: the XML description
         """
-        if not self.domain:
-            raise Exception("You need to first define the virtual machine")
-        xmldesc = self.domain.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE)
-        descnode = xmpp.simplexml.NodeBuilder(data=xmldesc).getDom()
+        descnode = copy.deepcopy(self.get_domain_description(libvirt.VIR_DOMAIN_XML_SECURE))
         if mask_description and descnode.getTag("description"):
             descnode.delChild("description")
         return descnode
@@ -950,6 +1015,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             self.inhibit_define_domain_event_counter += 1
             self.log.debug("DEFINE: Value of define inhibit counter is now %s" % self.inhibit_define_domain_event_counter)
             self.hypervisor.libvirt_connection.defineXML(self.set_automatic_libvirt_description(xmldesc))
+            self.invalidate_domain_cache()
             self.definition = xmldesc
         except Exception as ex:
             self.inhibit_define_domain_event_counter -= 1
@@ -976,6 +1042,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             return
         self.domain.undefine()
         self.domain = None
+        self.invalidate_domain_cache()
         self.log.info("Virtual machine undefined.")
 
     def undefine_and_disconnect(self):
@@ -994,6 +1061,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             - definition : the xml object containing the libvirt definition
             - path : the vm path to clone (will clone * in it)
             - parentvm : the origin virtual machine object
+            - mode : "copy" (default) or "overlay" to create qcow2 overlays of the disks
         @type origin: TNArchipelEntity
         @param origin: the origin of the hook
         @type user_info: object
@@ -1019,19 +1087,65 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             if mac:
                 mac.setAttr("address", generate_mac_adress())
 
+        overlays = {}
+        if user_info.get("mode") == ARCHIPEL_CLONE_MODE_OVERLAY:
+            overlays = self.prepare_clone_overlays(newxml)
+            if overlays:
+                self.hypervisor.add_overlay_backing(self.uuid, parentuuid)
+                self.log.warning("CLONING: disks %s will be backed by the disks of %s, that cannot be started or freed while this clone exists" % (", ".join(overlays.keys()), parentuuid))
+
         self.log.debug("New XML description is now %s" % str(newxml))
         self.log.info("Starting to clone virtual machine %s from %s" % (self.uuid, parentuuid))
         self.change_presence(presence_show="dnd", presence_status="Cloning from %s" % parentname)
         parentvm.change_presence(presence_show="dnd", presence_status="Cloning to %s" % self.name)
         self.log.info("Starting threaded copy of base virtual repository from %s to %s" % (path, self.folder))
-        thread.start_new_thread(self.perform_threaded_cloning, (path, newxml, parentvm))
+        thread.start_new_thread(self.perform_threaded_cloning, (path, newxml, parentvm, overlays))
+
+    def check_not_backing_overlays(self, action):
+        """
+        Refuse an action modifying the disks of the virtual machine while
+        they are backing the qcow2 overlays of its clones.
+        @type action: string
+        @param action: the refused action, for the error message
+        @raise Exception: if the disks are backing overlays
+        """
+        overlay_children = self.hypervisor.get_overlay_children(self.uuid)
+        if overlay_children:
+            raise Exception("Virtual machine disks are backing the overlays of %s. Can't %s." % (", ".join(overlay_children), action))
 
-    def migrate(self, destination_jid):
+    def prepare_clone_overlays(self, newxml):
+        """
+        Turn the file disks of the clone description into qcow2 overlays.
+        Only the disks stored in the folder of the virtual machine are used.
+        @type newxml: xmpp.Node
+        @param newxml: the description of the clone, updated in place
+        @rtype: dict
+        @return: name of disk file -> format of the original disk
+        """
+        overlays = {}
+        for disk in newxml.getTag("devices").getTags("disk"):
+            source = disk.getTag("source")
+            if not disk.getAttr("device") in (None, "disk") or not source or not source.getAttr("file"):
+                continue
+            if not os.path.normpath(os.path.dirname(source.getAttr("file"))) == os.path.normpath(self.folder):
+                continue
+            driver = disk.getTag("driver")
+            if not driver:
+                driver = disk.addChild("driver", attrs={"name": "qemu"})
+            overlays[os.path.basename(source.getAttr("file"))] = driver.getAttr("type") or "raw"
+            driver.setAttr("type", "qcow2")
+        return overlays
+
+    def migrate(self, destination_jid, options=None):
         """
         Migrate a virtual machine from this host to another.
         This step check is virtual machine can be migrated.
         Then ask for the destination_jid hypervisor what is his
         libvirt uri.
+        @type destination_jid: xmpp.JID
+        @param destination_jid: the JID of the destination hypervisor
+        @type options: dict
+        @param options: options of a live migration (bandwidth, compressed, auto_converge, postcopy)
         """
         # Sanity checks
         if not self.hypervisor.is_hypervisor((archipelLibvirtEntity.ARCHIPEL_HYPERVISOR_TYPE_QEMU)):
@@ -1040,33 +1154,41 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             raise Exception('Virtual machine is already migrating.')
         if not self.definition:
             raise Exception('Virtual machine must be defined.')
-        if self.domain.info()[0] == libvirt.VIR_DOMAIN_BLOCKED:
+        state = self.domain.info()[0]
+        if state == libvirt.VIR_DOMAIN_BLOCKED:
             raise Exception('Virtual machine is blocked.')
         if self.hypervisor.jid.getStripped() == destination_jid.getStripped():
             raise Exception('Virtual machine is already running on %s' % destination_jid.getStripped())
+        overlay_parent = self.hypervisor.get_overlay_parent(self.uuid)
+        if overlay_parent:
+            raise Exception('Virtual machine disks are overlays backed by the disks of %s, that only exist on this hypervisor.' % overlay_parent)
+        self.check_not_backing_overlays("migrate")
 
-        if self.domain.info()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
+        if state == libvirt.VIR_DOMAIN_SHUTOFF:
             self.migrate_not_running_step1(destination_jid)
         else:
-            self.migrate_running_step1(destination_jid)
-        self._listen_migration_progress()
+            if options is None:
+                options = dict(self.hypervisor.migration_default_options)
+            # fail now if libvirt doesn't support the options
+            migration_flags(options)
+            self.migrate_running_step1(destination_jid, options)
 
-    def migrate_running_step1(self, destination_jid):
+    def migrate_running_step1(self, destination_jid, options):
         """
         This step asks for the destination_jid hypervisor what is his
         libvirt uri.
         """
 
         self.is_migrating = True
-        migration_destination_jid = destination_jid
 
-        iq = xmpp.Iq(typ="get", queryNS="archipel:hypervisor:control", to=migration_destination_jid)
+        iq = xmpp.Iq(typ="get", queryNS="archipel:hypervisor:control", to=destination_jid)
         iq.getTag("query").addChild(name="archipel", attrs={"action": "migrationinfo"})
-        self.xmppclient.SendAndCallForResponse(iq, self.migrate_running_step2)
+        self.xmppclient.SendAndCallForResponse(iq, self.migrate_running_step2, {"destination_jid": destination_jid, "options": options})
 
-    def migrate_running_step2(self, conn, resp):
+    def migrate_running_step2(self, conn, resp, destination_jid=None, options=None):
         """
-        Once received the remote hypervisor URI, start libvirt migration in a thread.
+        Once received the remote hypervisor URI, queue the libvirt migration
+        in the migration scheduler of the hypervisor.
         """
         try:
             remote_hypervisor_uri = resp.getTag("query").getTag("migration").getAttr("libvirt_uri")
@@ -1085,29 +1207,31 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         except Exception as ex:
             self.log.error("MIGRATION: unable to get remote libvirt URI: %s" % str(ex))
             self.is_migrating = False
+            self.change_presence(presence_show=self.xmppstatusshow, presence_status="Migration aborted")
+            return
 
-        self.change_presence(presence_show=self.xmppstatusshow, presence_status="Migrating - 0%")
-        thread.start_new_thread(self.migrate_running_step3, (remote_hypervisor_uri, ))
+        self.change_presence(presence_show=self.xmppstatusshow, presence_status="Migration queued")
+        self.hypervisor.migration_scheduler.submit(TNMigrationJob(self, destination_jid, remote_hypervisor_uri, options))
 
-    def migrate_running_step3(self, remote_hypervisor_uri):
+    def migrate_running_step3(self, job):
         """
-        Perform the migration.
+        Perform the migration. Called by the migration scheduler of the hypervisor.
+        @type job: L{TNMigrationJob}
+        @param job: the migration
         """
         # DO NOT UNDEFINE DOMAIN HERE. the hypervisor is in charge of this. If undefined here, can't free XMPP client
         try:
-            flags = libvirt.VIR_MIGRATE_PEER2PEER | libvirt.VIR_MIGRATE_PERSIST_DEST | libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_UNSAFE
-        except:
-            flags = libvirt.VIR_MIGRATE_PEER2PEER | libvirt.VIR_MIGRATE_PERSIST_DEST | libvirt.VIR_MIGRATE_LIVE
-        try:
-            self.log.info("MIGRATION: starting to migrate domain %s" % remote_hypervisor_uri)
-            self.domain.migrateToURI(remote_hypervisor_uri, flags, None, 0)
-            self.log.info("MIGRATION: migration to %s is a SUCCESS" % remote_hypervisor_uri)
+            self.log.info("MIGRATION: starting to migrate domain %s with options %s" % (job.uri, job.options))
+            self.change_presence(presence_show=self.xmppstatusshow, presence_status="Migrating - 0%")
+            self.domain.migrateToURI(job.uri, migration_flags(job.options), None, job.options.get("bandwidth", 0))
+            self.log.info("MIGRATION: migration to %s is a SUCCESS" % job.uri)
             self.perform_hooks("HOOK_VM_MIGRATED")
         except Exception as ex:
             self.is_migrating = False
             self.change_presence(presence_show=self.xmppstatusshow, presence_status="Can't migrate.")
-            self.shout("migration", "I can't migrate to %s because exception has been raised: %s" % (remote_hypervisor_uri, str(ex)))
-            self.log.error("Can't migrate to %s because of : %s" % (remote_hypervisor_uri, str(ex)))
+            self.shout("migration", "I can't migrate to %s because exception has been raised: %s" % (job.uri, str(ex)))
+            self.log.error("Can't migrate to %s because of : %s" % (job.uri, str(ex)))
+            raise
 
     def migrate_not_running_step1(self, destination_jid):
         """
@@ -1169,7 +1293,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
 
     # Other stuffs
 
-    def perform_threaded_cloning(self, src_path, newxml, parentvm):
+    def perform_threaded_cloning(self, src_path, newxml, parentvm, overlays=None):
         """
         Perform threaded copy of the virtual machine and then define it.
         @type src_path: string
@@ -1178,11 +1302,35 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         @param newxml: the origin XML description
         @type parentvm: TNArchipelVirtualMachine
         @param parentvm: the parent virtual machine object
+        @type overlays: dict
+        @param overlays: name of disk file -> format, for the disks cloned as qcow2 overlays
         """
-        for token in os.listdir(src_path):
-            self.log.debug("CLONING: copying item %s/%s to %s" % (src_path, token, self.folder))
-            shutil.copy("%s/%s" % (src_path, token), self.folder)
-        self.define(newxml)
+        def report_progress(percentage):
+            self.change_presence(presence_show="dnd", presence_status="Cloning from %s (%d%%)" % (parentvm.name, percentage))
+            parentvm.change_presence(presence_show="dnd", presence_status="Cloning to %s (%d%%)" % (self.name, percentage))
+
+        workers = ARCHIPEL_CLONE_WORKERS
+        if self.configuration.has_option("VIRTUALMACHINE", "clone_workers"):
+            workers = self.configuration.getint("VIRTUALMACHINE", "clone_workers")
+        qemu_img_bin = "qemu-img"
+        if self.configuration.has_option("STORAGE", "qemu_img_bin_path"):
+            qemu_img_bin = self.configuration.get("STORAGE", "qemu_img_bin_path")
+
+        engine = TNCloneEngine(src_path, self.folder, overlays=overlays, workers=workers, qemu_img_bin=qemu_img_bin, log=self.log, progress_callback=report_progress)
+        try:
+            engine.run()
+        except Exception as ex:
+            self.log.error("CLONING: unable to clone %s: %s" % (src_path, str(ex)))
+            self.change_presence("xa", ARCHIPEL_XMPP_SHOW_ERROR)
+            parentvm.change_presence("xa", ARCHIPEL_XMPP_SHOW_SHUTDOWN)
+            self.perform_hooks("HOOK_VM_DEFINE_FAILED", str(ex))
+            return
+        try:
+            self.define(newxml)
+        except Exception as ex:
+            self.log.error("CLONING: unable to define the clone: %s" % str(ex))
+            self.change_presence("xa", ARCHIPEL_XMPP_SHOW_ERROR)
+            self.perform_hooks("HOOK_VM_DEFINE_FAILED", str(ex))
         parentvm.change_presence("xa", ARCHIPEL_XMPP_SHOW_SHUTDOWN)
 
     def terminate(self, clean_files=True):
@@ -1196,7 +1344,10 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.perform_hooks("HOOK_VM_TERMINATE")
         self.permission_center.close_database()
         if clean_files:
-            os.unlink(self.permission_db_file)
+            if self.permission_db_file:
+                os.unlink(self.permission_db_file)
+            else:
+                self.permission_center.destroy()
             self.remove_folder()
 
     # XMPP Controls
@@ -1211,7 +1362,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         """
         try:
             hyp_jid = xmpp.JID(iq.getTag("query").getTag("archipel").getAttr("hypervisorjid"))
-            self.migrate(hyp_jid)
+            self.migrate(hyp_jid, migration_options_from_node(iq.getTag("query").getTag("archipel"), self.hypervisor.migration_default_options))
             reply = iq.buildReply("result")
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VM_MIGRATE)
@@ -1408,6 +1559,8 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
     def iq_info(self, iq):
         """
         Return an IQ containing the info of the domain using libvirt connection.
+        If the request has a history attribute, the info node also contains
+        up to this number of <stats/> samples, the most recent first.
         @type iq: xmpp.Protocol.Iq
         @param iq: the received IQ
         @rtype: xmpp.Protocol.Iq
@@ -1420,6 +1573,10 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             reply = iq.buildReply("result")
             infos = self.info()
             response = xmpp.Node(tag="info", attrs=infos)
+            history = iq.getTag("query").getTag("archipel").getAttr("history")
+            if history:
+                for sample in self.stats_history(int(history)):
+                    response.addChild("stats", attrs=sample)
             reply.setQueryPayload([response])
         except libvirt.libvirtError as ex:
             if ex.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
@@ -10,6 +10,7 @@ import os
 import libvirt
 import select
 import errno
+import heapq
 import time
 import threading
 
@@ -344,6 +345,268 @@ class virEventLoopPure:
         return ret;
 
 
+#
+# The same event loop, for hypervisors with many domains and streams.
+#
+# File handles are monitored with epoll() instead of poll(), and are
+# indexed both by ID and by file descriptor. Timers are indexed by ID
+# and their expiries are kept in a min-heap, so one iteration only
+# looks at the handles that are ready and at the timers that are due,
+# whatever the number of registered handles and timers.
+#
+# Updating or removing a timer does not touch the heap: the timer gets
+# a new generation, and heap entries of older generations are dropped
+# when they reach the top.
+#
+class virEventLoopEpoll(virEventLoopPure):
+    class virEventLoopEpollTimer(virEventLoopPure.virEventLoopPureTimer):
+        def __init__(self, timer, interval, cb, opaque):
+            virEventLoopPure.virEventLoopPureTimer.__init__(self, timer, interval, cb, opaque)
+            self.generation = 0
+
+
+    def __init__(self):
+        self.poll = select.epoll()
+        self.pipetrick = os.pipe()
+        self.pendingWakeup = False
+        self.runningPoll = False
+        self.nextHandleID = 1
+        self.nextTimerID = 1
+        self.handles = {}
+        self.handles_by_fd = {}
+        self.timers = {}
+        self.timers_heap = []
+        self.lock = threading.Lock()
+        self.quit = False
+
+        debug("Self pipe watch %d write %d" %(self.pipetrick[0], self.pipetrick[1]))
+        self.poll.register(self.pipetrick[0], select.EPOLLIN)
+
+
+    # Push the next expiry of the timer in the heap, invalidating
+    # the entries pushed before. Must be called with the lock held
+    def schedule_timer(self, t, now):
+        t.generation = t.generation + 1
+        interval = t.get_interval()
+        if interval < 0:
+            return
+        heapq.heappush(self.timers_heap, (now + interval, t.get_id(), t.generation))
+
+        # Drop the invalidated entries when they are the majority
+        if len(self.timers_heap) > 64 and len(self.timers_heap) > 2 * len(self.timers):
+            self.timers_heap = [e for e in self.timers_heap if e[1] in self.timers and self.timers[e[1]].generation == e[2]]
+            heapq.heapify(self.timers_heap)
+
+    # Drop the invalidated entries on top of the heap. Must be
+    # called with the lock held
+    def clean_timers_heap(self):
+        while self.timers_heap:
+            want, timerID, generation = self.timers_heap[0]
+            t = self.timers.get(timerID)
+            if t and t.generation == generation:
+                return
+            heapq.heappop(self.timers_heap)
+
+    # Calculate when the next timeout is due to occurr, returning
+    # the absolute timestamp for the next timeout, or 0 if there is
+    # no timeout due
+    def next_timeout(self):
+        with self.lock:
+            self.clean_timers_heap()
+            if not self.timers_heap:
+                return 0
+            return self.timers_heap[0][0]
+
+    # Return the timers due at 'now', with the same 20ms margin as
+    # virEventLoopPure, and schedule their next expiry
+    def due_timers(self, now):
+        due = []
+        with self.lock:
+            while self.timers_heap and self.timers_heap[0][0] <= now + 20:
+                want, timerID, generation = heapq.heappop(self.timers_heap)
+                t = self.timers.get(timerID)
+                if t and t.generation == generation:
+                    due.append(t)
+            # rescheduled once all are popped, so that a 0ms
+            # timer fires only once per iteration
+            for t in due:
+                t.set_last_fired(now)
+                self.schedule_timer(t, now)
+        return due
+
+    # Lookup a virEventLoopPureHandle object based on file descriptor
+    def get_handle_by_fd(self, fd):
+        return self.handles_by_fd.get(fd)
+
+    # Lookup a virEventLoopPureHandle object based on its event loop ID
+    def get_handle_by_id(self, handleID):
+        return self.handles.get(handleID)
+
+
+    # One single iteration, as virEventLoopPure.run_once(). Callbacks
+    # are dispatched without holding the lock, as they usually add,
+    # update or remove handles and timers
+    def run_once(self):
+        sleep = -1
+        self.runningPoll = True
+        try:
+            next = self.next_timeout()
+            debug("Next timeout due at %d" % next)
+            if next > 0:
+                now = int(time.time() * 1000)
+                if now >= next:
+                    sleep = 0
+                else:
+                    sleep = (next - now) / 1000.0
+
+            debug("Poll with a sleep of %d" % sleep)
+            events = self.poll.poll(sleep)
+
+            for (fd, revents) in events:
+                if fd == self.pipetrick[0]:
+                    self.pendingWakeup = False
+                    data = os.read(fd, 1)
+                    continue
+
+                h = self.get_handle_by_fd(fd)
+                if h:
+                    debug("Dispatch fd %d handle %d events %d" % (fd, h.get_id(), revents))
+                    h.dispatch(self.events_from_poll(revents))
+
+            now = int(time.time() * 1000)
+            for t in self.due_timers(now):
+                debug("Dispatch timer %d now %s" % (t.get_id(), str(now)))
+                t.dispatch()
+
+        except (IOError, OSError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+        finally:
+            self.runningPoll = False
+
+
+    # Registers a new file handle 'fd', monitoring  for 'events' (libvirt
+    # event constants), firing the callback  cb() when an event occurs.
+    # Returns a unique integer identier for this handle, that should be
+    # used to later update/remove it
+    def add_handle(self, fd, events, cb, opaque):
+        with self.lock:
+            handleID = self.nextHandleID + 1
+            self.nextHandleID = self.nextHandleID + 1
+
+            h = self.virEventLoopPureHandle(handleID, fd, events, cb, opaque)
+            if fd in self.handles_by_fd:
+                self.poll.modify(fd, self.events_to_poll(events))
+            else:
+                self.poll.register(fd, self.events_to_poll(events))
+            self.handles[handleID] = h
+            self.handles_by_fd[fd] = h
+        self.interrupt()
+
+        debug("Add handle %d fd %d events %d" % (handleID, fd, events))
+
+        return handleID
+
+    # Registers a new timer with periodic expiry at 'interval' ms,
+    # firing cb() each time the timer expires. If 'interval' is -1,
+    # then the timer is registered, but not enabled
+    # Returns a unique integer identier for this handle, that should be
+    # used to later update/remove it
+    def add_timer(self, interval, cb, opaque):
+        with self.lock:
+            timerID = self.nextTimerID + 1
+            self.nextTimerID = self.nextTimerID + 1
+
+            t = self.virEventLoopEpollTimer(timerID, interval, cb, opaque)
+            self.timers[timerID] = t
+            self.schedule_timer(t, int(time.time() * 1000))
+        self.interrupt()
+
+        debug("Add timer %d interval %d" % (timerID, interval))
+
+        return timerID
+
+    # Change the set of events to be monitored on the file handle.
+    # epoll() can update a file descriptor in place
+    def update_handle(self, handleID, events):
+        with self.lock:
+            h = self.handles.get(handleID)
+            if not h:
+                return
+            h.set_events(events)
+            self.poll.modify(h.get_fd(), self.events_to_poll(events))
+        self.interrupt()
+
+        debug("Update handle %d fd %d events %d" % (handleID, h.get_fd(), events))
+
+    # Change the periodic frequency of the timer. As for libvirt's
+    # own event loop, the next expiry is counted from now
+    def update_timer(self, timerID, interval):
+        with self.lock:
+            t = self.timers.get(timerID)
+            if not t:
+                return
+            t.set_interval(interval)
+            self.schedule_timer(t, int(time.time() * 1000))
+        self.interrupt()
+
+        debug("Update timer %d interval %d"  % (timerID, interval))
+
+    # Stop monitoring for events on the file handle
+    def remove_handle(self, handleID):
+        with self.lock:
+            h = self.handles.pop(handleID, None)
+            if not h:
+                return
+            if self.handles_by_fd.get(h.get_fd()) is h:
+                del self.handles_by_fd[h.get_fd()]
+                try:
+                    self.poll.unregister(h.get_fd())
+                except (IOError, OSError):
+                    # the file descriptor has already been closed,
+                    # and so removed from the epoll set
+                    pass
+        self.interrupt()
+
+        debug("Remove handle %d fd %d" % (handleID, h.get_fd()))
+
+    # Stop firing the periodic timer. Its entries in the heap are
+    # dropped when they reach the top
+    def remove_timer(self, timerID):
+        with self.lock:
+            if not self.timers.pop(timerID, None):
+                return
+        self.interrupt()
+
+        debug("Remove timer %d" % timerID)
+
+    # Convert from libvirt event constants, to epoll() events constants
+    def events_to_poll(self, events):
+        ret = 0
+        if events & libvirt.VIR_EVENT_HANDLE_READABLE:
+            ret |= select.EPOLLIN
+        if events & libvirt.VIR_EVENT_HANDLE_WRITABLE:
+            ret |= select.EPOLLOUT
+        if events & libvirt.VIR_EVENT_HANDLE_ERROR:
+            ret |= select.EPOLLERR
+        if events & libvirt.VIR_EVENT_HANDLE_HANGUP:
+            ret |= select.EPOLLHUP
+        return ret
+
+    # Convert from epoll() event constants, to libvirt events constants
+    def events_from_poll(self, events):
+        ret = 0
+        if events & select.EPOLLIN:
+            ret |= libvirt.VIR_EVENT_HANDLE_READABLE
+        if events & select.EPOLLOUT:
+            ret |= libvirt.VIR_EVENT_HANDLE_WRITABLE
+        if events & select.EPOLLERR:
+            ret |= libvirt.VIR_EVENT_HANDLE_ERROR
+        if events & select.EPOLLHUP:
+            ret |= libvirt.VIR_EVENT_HANDLE_HANGUP
+        return ret
+
+
 ###########################################################################
 # Now glue an instance of the general event loop into libvirt's event loop
 ###########################################################################
@@ -416,6 +679,14 @@ def virEventLoopPureStart():
     eventLoopThread.setDaemon(True)
     eventLoopThread.start()
 
+# Spawn a background thread running the epoll() based event loop,
+# or the poll() based one if epoll() is not available
+def virEventLoopEpollStart():
+    global eventLoop
+    if hasattr(select, "epoll"):
+        eventLoop = virEventLoopEpoll()
+    virEventLoopPureStart()
+
 def virEventLoopNativeStart():
     global eventLoopThread
     libvirt.virEventRegisterDefaultImpl()
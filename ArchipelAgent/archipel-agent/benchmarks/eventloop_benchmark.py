@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# eventloop_benchmark.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the poll() and epoll() python implementations of the libvirt
+event loop.
+
+For 100, 1000 and 4000 file handles and as many timers, measures the
+time needed to register them all, the time of one iteration of the loop
+with one ready handle and one due timer, the time needed to update them
+all, and the time needed to remove them all.
+
+The handles are pipes, so the limit of open files must allow twice the
+number of handles.
+
+usage: python eventloop_benchmark.py [number_of_iterations]
+"""
+
+import libvirt
+import os
+import resource
+import sys
+import time
+
+from archipel.libvirtEventLoop import virEventLoopEpoll, virEventLoopPure
+
+
+def handle_callback(handleID, fd, events, opaque):
+    pass
+
+def timer_callback(timerID, opaque):
+    opaque[0] += 1
+
+def raise_open_files_limit(count):
+    """
+    Raise the limit of open files if needed.
+    @type count: integer
+    @param count: number of handles
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = 2 * count + 64
+    if soft < needed:
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            raise Exception("%d handles need %d open files, the limit is %d" % (count, needed, hard))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+def run_loop(loop_class, count, iterations):
+    """
+    Measure one loop implementation.
+    @type loop_class: class
+    @param loop_class: virEventLoopPure or virEventLoopEpoll
+    @type count: integer
+    @param count: number of handles and timers
+    @type iterations: integer
+    @param iterations: number of iterations of the loop, the average is kept
+    @rtype: tuple
+    @return: durations of (add, iteration, update, remove) in ms
+    """
+    loop = loop_class()
+    pipes = [os.pipe() for i in range(count)]
+    fired = [0]
+
+    start = time.time()
+    handles = [loop.add_handle(r, libvirt.VIR_EVENT_HANDLE_READABLE, handle_callback, None) for r, w in pipes]
+    timers = [loop.add_timer(3600000, timer_callback, fired) for i in range(count - 1)]
+    timers.append(loop.add_timer(0, timer_callback, fired))
+    add_time = time.time() - start
+
+    # timers of virEventLoopPure fire once when added, and its first
+    # iteration does not time out, so a handle must be ready
+    os.write(pipes[-1][1], "x")
+    loop.run_once()
+    fired[0] = 0
+    start = time.time()
+    for i in range(iterations):
+        loop.run_once()
+    iteration_time = (time.time() - start) / iterations
+    if fired[0] < iterations:
+        raise Exception("%s: the due timer fired %d times in %d iterations" % (loop_class.__name__, fired[0], iterations))
+
+    start = time.time()
+    for handleID in handles:
+        loop.update_handle(handleID, libvirt.VIR_EVENT_HANDLE_READABLE | libvirt.VIR_EVENT_HANDLE_ERROR)
+    for timerID in timers[:-1]:
+        loop.update_timer(timerID, 7200000)
+    update_time = time.time() - start
+
+    start = time.time()
+    for handleID in handles:
+        loop.remove_handle(handleID)
+    for timerID in timers:
+        loop.remove_timer(timerID)
+    remove_time = time.time() - start
+
+    for r, w in pipes:
+        os.close(r)
+        os.close(w)
+    loop.poll = None
+    os.close(loop.pipetrick[0])
+    os.close(loop.pipetrick[1])
+    return add_time * 1000, iteration_time * 1000, update_time * 1000, remove_time * 1000
+
+def run(iterations):
+    """
+    Run the benchmark.
+    @type iterations: integer
+    @param iterations: number of iterations of the loop for each measure
+    """
+    print "%-8s %-10s %12s %14s %12s %12s" % ("handles", "loop", "add (ms)", "iteration (ms)", "update (ms)", "remove (ms)")
+    for count in (100, 1000, 4000):
+        raise_open_files_limit(count)
+        for name, loop_class in (("poll", virEventLoopPure), ("epoll", virEventLoopEpoll)):
+            add_time, iteration_time, update_time, remove_time = run_loop(loop_class, count, iterations)
+            print "%-8d %-10s %12.2f %14.3f %12.2f %12.2f" % (count, name, add_time, iteration_time, update_time, remove_time)
+
+
+if __name__ == "__main__":
+    iterations = 200
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    run(iterations)
@@ -106,6 +106,7 @@ setup(name='archipel-agent',
       scripts = [
         'install/bin/archipel-importvirtualmachine',
         'install/bin/archipel-updatedomain',
+        'install/bin/archipel-importpermissions',
         'install/bin/archipel-initinstall',
         'install/bin/archipel-commandsbytag',
         'install/bin/archipel-command',
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# test_cloneengine.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{TNCloneEngine}: sparse copies and qcow2 overlays.
+"""
+
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import unittest
+
+from archipel.archipelCloneEngine import TNCloneEngine, data_segments
+
+
+MiB = 1024 * 1024
+
+
+class FakeLog (object):
+
+    def __init__(self):
+        self.errors = []
+
+    def info(self, message):
+        pass
+
+    def warning(self, message):
+        pass
+
+    def error(self, message):
+        self.errors.append(message)
+
+
+def which(binary):
+    """
+    @rtype: string
+    @return: the path of the binary, or None if it is not in the PATH
+    """
+    for folder in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(folder, binary)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class TestTNCloneEngine (unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.src = os.path.join(self.folder, "src")
+        self.dst = os.path.join(self.folder, "dst")
+        os.mkdir(self.src)
+        os.mkdir(self.dst)
+        self.log = FakeLog()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_sparse(self, name, size, segments):
+        """
+        Write a file of the given size with data only in the given segments.
+        @type segments: list
+        @param segments: list of (offset, data)
+        """
+        path = os.path.join(self.src, name)
+        with open(path, "wb") as f:
+            f.truncate(size)
+            for offset, data in segments:
+                f.seek(offset)
+                f.write(data)
+        return path
+
+    def read(self, folder, name):
+        with open(os.path.join(folder, name), "rb") as f:
+            return f.read()
+
+    def allocated(self, folder, name):
+        return os.stat(os.path.join(folder, name)).st_blocks * 512
+
+    def clone(self, overlays=None, qemu_img_bin="qemu-img", in_kernel=True):
+        percentages = []
+        engine = TNCloneEngine(self.src, self.dst, overlays=overlays, qemu_img_bin=qemu_img_bin, log=self.log, progress_callback=percentages.append)
+        engine.use_reflink = False
+        engine.use_copy_file_range = engine.use_copy_file_range and in_kernel
+        engine.run()
+        return percentages
+
+    def test_data_segments(self):
+        path = self.write_sparse("disk", 64 * MiB, [(0, "a" * MiB), (32 * MiB, "b" * MiB)])
+        if self.allocated(self.src, "disk") >= 64 * MiB:
+            self.skipTest("the filesystem of %s does not keep holes" % self.folder)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            segments = data_segments(fd, 64 * MiB)
+        finally:
+            os.close(fd)
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[0][0], 0)
+        self.assertTrue(segments[1][0] <= 32 * MiB < segments[1][1])
+
+    def check_sparse_copy(self, in_kernel):
+        content = [(0, "a" * MiB), (40 * MiB, "b" * 100), (64 * MiB - 10, "c" * 10)]
+        self.write_sparse("disk", 64 * MiB, content)
+        self.write_sparse("empty", 16 * MiB, [])
+        self.write_sparse("zeros", 4 * MiB, [(0, "\0" * (4 * MiB))])
+        percentages = self.clone(in_kernel=in_kernel)
+        for name in ("disk", "empty", "zeros"):
+            self.assertEqual(self.read(self.dst, name), self.read(self.src, name))
+        self.assertEqual(percentages[-1], 100)
+        if self.allocated(self.src, "disk") < 64 * MiB:
+            self.assertTrue(self.allocated(self.dst, "disk") < 8 * MiB)
+            self.assertTrue(self.allocated(self.dst, "empty") < MiB)
+
+    def test_sparse_copy(self):
+        self.check_sparse_copy(in_kernel=False)
+        # zero filled blocks that are read are not written
+        self.assertEqual(self.allocated(self.dst, "zeros"), 0)
+
+    def test_sparse_copy_in_kernel(self):
+        self.check_sparse_copy(in_kernel=True)
+
+    def test_mode_is_kept_and_folders_ignored(self):
+        self.write_sparse("nvram", MiB, [(0, "x")])
+        os.chmod(os.path.join(self.src, "nvram"), 0640)
+        os.mkdir(os.path.join(self.src, "snapshots"))
+        self.clone()
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dst, "nvram")).st_mode), 0640)
+        self.assertEqual(sorted(os.listdir(self.dst)), ["nvram"])
+
+    def test_overlay_command(self):
+        # a fake qemu-img writing its arguments in the overlay
+        fake_qemu_img = os.path.join(self.folder, "qemu-img")
+        with open(fake_qemu_img, "w") as f:
+            f.write("#!/bin/sh\nfor last; do true; done\necho \"$@\" > \"$last\"\n")
+        os.chmod(fake_qemu_img, 0755)
+        self.write_sparse("disk.raw", MiB, [(0, "a")])
+        self.write_sparse("disk.qcow2", MiB, [(0, "b")])
+        self.clone(overlays={"disk.raw": "raw"}, qemu_img_bin=fake_qemu_img)
+        src = os.path.join(self.src, "disk.raw")
+        dst = os.path.join(self.dst, "disk.raw")
+        self.assertEqual(self.read(self.dst, "disk.raw").split(), ["create", "-f", "qcow2", "-b", src, "-F", "raw", dst])
+        self.assertEqual(self.read(self.dst, "disk.qcow2"), self.read(self.src, "disk.qcow2"))
+
+    def test_overlay_failure(self):
+        self.write_sparse("disk.raw", MiB, [(0, "a")])
+        self.assertRaises(Exception, self.clone, overlays={"disk.raw": "raw"}, qemu_img_bin="/bin/false")
+        self.assertEqual(len(self.log.errors), 1)
+
+    def test_overlay_with_qemu_img(self):
+        qemu_img = which("qemu-img")
+        if not qemu_img:
+            self.skipTest("qemu-img is not installed")
+        self.write_sparse("disk.raw", 16 * MiB, [(0, "a" * MiB)])
+        self.clone(overlays={"disk.raw": "raw"}, qemu_img_bin=qemu_img)
+        info = subprocess.Popen([qemu_img, "info", os.path.join(self.dst, "disk.raw")], stdout=subprocess.PIPE).communicate()[0]
+        self.assertTrue("file format: qcow2" in info)
+        self.assertTrue("backing file: %s" % os.path.join(self.src, "disk.raw") in info)
+        self.assertTrue(self.allocated(self.dst, "disk.raw") < MiB)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# test_domainevents.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{TNDomainEventQueue}: ordering, coalescing and per domain exclusion.
+"""
+
+import libvirt
+import unittest
+from threading import Event, Lock
+
+from archipel.archipelDomainEvents import TNDomainEventQueue
+
+
+STARTED     = (libvirt.VIR_DOMAIN_EVENT_STARTED, 0)
+STOPPED     = (libvirt.VIR_DOMAIN_EVENT_STOPPED, 0)
+SUSPENDED   = (libvirt.VIR_DOMAIN_EVENT_SUSPENDED, 0)
+RESUMED     = (libvirt.VIR_DOMAIN_EVENT_RESUMED, 0)
+MIGRATED    = (libvirt.VIR_DOMAIN_EVENT_SUSPENDED, libvirt.VIR_DOMAIN_EVENT_SUSPENDED_MIGRATED)
+
+
+class FakeLog (object):
+
+    def error(self, message):
+        pass
+
+
+class TestTNDomainEventQueueCoalescing (unittest.TestCase):
+    """
+    The workers are not started: the due events are read with next_key.
+    """
+
+    def setUp(self):
+        self.queue = TNDomainEventQueue(None, FakeLog(), window=0)
+
+    def post(self, key, *events):
+        for event, detail in events:
+            self.queue.post(key, key, event, detail)
+
+    def events_of(self, key):
+        due_key, events = self.queue.next_key()
+        self.assertEqual(due_key, key)
+        return [(event, detail) for domain, event, detail in events]
+
+    def test_order_is_kept(self):
+        self.post("a", STARTED, SUSPENDED, STOPPED)
+        self.assertEqual(self.events_of("a"), [STARTED, SUSPENDED, STOPPED])
+
+    def test_suspend_and_resume_cancel(self):
+        self.post("a", STARTED, SUSPENDED, RESUMED)
+        self.assertEqual(self.events_of("a"), [STARTED])
+
+    def test_repeated_events_are_merged(self):
+        self.post("a", SUSPENDED, SUSPENDED, SUSPENDED)
+        self.assertEqual(self.events_of("a"), [SUSPENDED])
+
+    def test_migration_events_are_kept(self):
+        self.post("a", MIGRATED, RESUMED)
+        self.assertEqual(self.events_of("a"), [MIGRATED, RESUMED])
+
+    def test_cancelled_domain_is_skipped(self):
+        self.post("a", SUSPENDED, RESUMED)
+        self.post("b", STOPPED)
+        self.assertEqual(self.events_of("b"), [STOPPED])
+
+    def test_domain_is_not_given_twice(self):
+        self.post("a", STARTED)
+        self.post("b", STARTED)
+        first = self.queue.next_key()[0]
+        self.post(first, STOPPED)
+        # the events received while the domain is handled wait for the end of its handling
+        self.assertNotEqual(self.queue.next_key()[0], first)
+        self.assertFalse(first in self.queue.scheduled)
+
+
+class TestTNDomainEventQueueWorkers (unittest.TestCase):
+
+    def setUp(self):
+        self.lock = Lock()
+        self.handled = []
+        self.done = Event()
+        self.release_a = Event()
+        self.queue = TNDomainEventQueue(self.handle, FakeLog(), workers=2, window=0)
+        self.queue.start()
+
+    def tearDown(self):
+        self.release_a.set()
+        self.queue.stop()
+
+    def handle(self, domain, event, detail):
+        if domain == "a" and event == STARTED[0]:
+            self.release_a.wait(5)
+        with self.lock:
+            self.handled.append((domain, event))
+            if len(self.handled) == 4:
+                self.done.set()
+
+    def test_domains_are_handled_in_parallel_and_in_order(self):
+        self.queue.post("a", "a", *STARTED)
+        self.queue.post("a", "a", *STOPPED)
+        self.queue.post("b", "b", *STARTED)
+        self.queue.post("b", "b", *STOPPED)
+        # "b" is not blocked by the handling of "a"
+        for i in range(500):
+            if len(self.handled) == 2:
+                break
+            self.done.wait(0.01)
+        self.assertEqual(self.handled, [("b", STARTED[0]), ("b", STOPPED[0])])
+        self.release_a.set()
+        self.done.wait(5)
+        self.assertEqual(self.handled[2:], [("a", STARTED[0]), ("a", STOPPED[0])])
+
+    def test_handler_errors_do_not_stop_the_domain(self):
+        def handle(domain, event, detail):
+            if event == STARTED[0]:
+                raise Exception("handler error")
+            self.handle(domain, event, detail)
+        self.queue.handler = handle
+        self.queue.post("c", "c", *STARTED)
+        self.queue.post("c", "c", *STOPPED)
+        self.queue.post("c", "c", *STARTED)
+        self.queue.post("c", "c", *STOPPED)
+        for i in range(500):
+            if len(self.handled) == 2:
+                break
+            self.done.wait(0.01)
+        self.assertEqual(self.handled, [("c", STOPPED[0]), ("c", STOPPED[0])])
+
+
+if __name__ == "__main__":
+    unittest.main()
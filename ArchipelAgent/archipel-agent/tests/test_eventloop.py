@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# test_eventloop.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{virEventLoopEpoll}: the heap of timers and the file handles.
+"""
+
+import libvirt
+import os
+import time
+import unittest
+
+from archipel.libvirtEventLoop import virEventLoopEpoll
+
+
+class TestVirEventLoopEpollTimers (unittest.TestCase):
+
+    def setUp(self):
+        self.loop = virEventLoopEpoll()
+        self.fired = []
+
+    def tearDown(self):
+        self.loop.poll.close()
+        os.close(self.loop.pipetrick[0])
+        os.close(self.loop.pipetrick[1])
+
+    def add_timer(self, interval, name):
+        return self.loop.add_timer(interval, lambda timer, opaque: self.fired.append(opaque), name)
+
+    def test_zero_timer_fires_once_per_iteration(self):
+        self.add_timer(0, "t")
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["t"])
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["t", "t"])
+
+    def test_disabled_timer(self):
+        timer = self.add_timer(-1, "t")
+        self.assertEqual(self.loop.next_timeout(), 0)
+        self.add_timer(1, "other")
+        time.sleep(0.03)
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["other"])
+        self.loop.update_timer(timer, 0)
+        self.loop.run_once()
+        self.assertTrue("t" in self.fired)
+
+    def test_due_timers_fire_in_deadline_order(self):
+        self.add_timer(100, "late")
+        self.add_timer(30, "early")
+        self.add_timer(60000, "never")
+        time.sleep(0.15)
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["early", "late"])
+
+    def test_next_timeout(self):
+        now = int(time.time() * 1000)
+        self.add_timer(5000, "a")
+        self.add_timer(1000, "b")
+        self.assertTrue(now + 1000 <= self.loop.next_timeout() < now + 1500)
+
+    def test_run_once_sleeps_until_the_next_timer(self):
+        self.add_timer(50, "t")
+        start = time.time()
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["t"])
+        self.assertTrue(time.time() - start >= 0.02)
+
+    def test_removed_timer(self):
+        timer = self.add_timer(0, "t")
+        self.loop.remove_timer(timer)
+        self.assertEqual(self.loop.next_timeout(), 0)
+        self.add_timer(0, "other")
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["other"])
+
+    def test_updated_timer_fires_once(self):
+        timer = self.add_timer(0, "t")
+        for i in range(10):
+            self.loop.update_timer(timer, 0)
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["t"])
+
+    def test_update_delays_the_timer(self):
+        timer = self.add_timer(0, "t")
+        self.loop.update_timer(timer, 60000)
+        self.add_timer(0, "other")
+        self.loop.run_once()
+        self.assertEqual(self.fired, ["other"])
+
+    def test_heap_is_compacted(self):
+        timers = [self.add_timer(60000, i) for i in range(10)]
+        for i in range(100):
+            for timer in timers:
+                self.loop.update_timer(timer, 60000)
+        self.assertTrue(len(self.loop.timers_heap) <= max(64, 2 * len(timers)) + 1)
+
+
+class TestVirEventLoopEpollHandles (unittest.TestCase):
+
+    def setUp(self):
+        self.loop = virEventLoopEpoll()
+        self.pipe = os.pipe()
+        self.dispatched = []
+
+    def tearDown(self):
+        self.loop.poll.close()
+        for fd in self.loop.pipetrick + self.pipe:
+            os.close(fd)
+
+    def dispatch(self, handle, fd, events, opaque):
+        self.dispatched.append((fd, events, opaque))
+        os.read(fd, 1)
+
+    def test_readable_handle(self):
+        handle = self.loop.add_handle(self.pipe[0], libvirt.VIR_EVENT_HANDLE_READABLE, self.dispatch, "p")
+        self.loop.add_timer(0, lambda timer, opaque: None, None)
+        self.loop.run_once()
+        self.assertEqual(self.dispatched, [])
+        os.write(self.pipe[1], "x")
+        self.loop.run_once()
+        self.assertEqual(self.dispatched, [(self.pipe[0], libvirt.VIR_EVENT_HANDLE_READABLE, "p")])
+        self.loop.remove_handle(handle)
+        os.write(self.pipe[1], "x")
+        self.loop.run_once()
+        self.assertEqual(len(self.dispatched), 1)
+
+    def test_update_handle(self):
+        handle = self.loop.add_handle(self.pipe[0], 0, self.dispatch, "p")
+        self.loop.add_timer(0, lambda timer, opaque: None, None)
+        os.write(self.pipe[1], "x")
+        self.loop.run_once()
+        self.assertEqual(self.dispatched, [])
+        self.loop.update_handle(handle, libvirt.VIR_EVENT_HANDLE_READABLE)
+        self.loop.run_once()
+        self.assertEqual(len(self.dispatched), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
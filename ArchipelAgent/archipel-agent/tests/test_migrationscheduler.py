@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# test_migrationscheduler.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{TNMigrationScheduler}: concurrency caps, cancellation and history.
+"""
+
+import time
+import unittest
+from threading import Event
+
+from archipelcore import xmpp
+from archipel.archipelMigrationScheduler import TNMigrationJob, TNMigrationScheduler, migration_options_from_node
+
+
+class FakeLog (object):
+
+    def info(self, message):
+        pass
+
+    def warning(self, message):
+        pass
+
+
+class FakeHypervisor (object):
+
+    def __init__(self):
+        self.log = FakeLog()
+
+
+class FakeDomain (object):
+
+    def jobStats(self, flags=0):
+        return {"data_total": 100, "data_remaining": 0, "downtime": 12, "type": 3}
+
+
+class FakeVirtualMachine (object):
+    """
+    Its migration lasts until finish() is called.
+    """
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.name = uuid
+        self.domain = FakeDomain()
+        self.xmppstatusshow = ""
+        self.is_migrating = True
+        self.presences = []
+        self.finished = Event()
+        self.error = None
+
+    def migrate_running_step3(self, job):
+        self.finished.wait(10)
+        if self.error:
+            raise Exception(self.error)
+
+    def change_presence(self, presence_show=None, presence_status=None):
+        self.presences.append(presence_status)
+
+    def finish(self, error=None):
+        self.error = error
+        self.finished.set()
+
+
+def wait_for(predicate, timeout=5):
+    """
+    Wait until the predicate is True.
+    """
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class TestTNMigrationScheduler (unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = TNMigrationScheduler(FakeHypervisor(), max_concurrent=2, max_per_destination=1, history_size=10)
+        self.vms = {}
+
+    def tearDown(self):
+        for vm in self.vms.values():
+            vm.finish()
+
+    def submit(self, uuid, destination):
+        self.vms[uuid] = FakeVirtualMachine(uuid)
+        job = TNMigrationJob(self.vms[uuid], xmpp.JID("%s/resource" % destination), "qemu+tcp://%s/system" % destination)
+        self.scheduler.submit(job)
+        return job
+
+    def running(self):
+        return sorted(job.vm.uuid for job in self.scheduler.running)
+
+    def queued(self):
+        return [job.vm.uuid for job in self.scheduler.queued]
+
+    def test_caps(self):
+        self.submit("a", "h1@x")
+        self.submit("b", "h1@x")
+        self.submit("c", "h2@x")
+        self.submit("d", "h3@x")
+        # "b" waits for "a" to free its destination, "d" for a free slot
+        self.assertEqual(self.running(), ["a", "c"])
+        self.assertEqual(self.queued(), ["b", "d"])
+        self.vms["a"].finish()
+        self.assertTrue(wait_for(lambda: self.running() == ["b", "c"]))
+        self.assertEqual(self.queued(), ["d"])
+        self.vms["c"].finish()
+        self.assertTrue(wait_for(lambda: self.running() == ["b", "d"]))
+
+    def test_no_limit(self):
+        self.scheduler.max_concurrent = 0
+        self.scheduler.max_per_destination = 0
+        for uuid in ("a", "b", "c"):
+            self.submit(uuid, "h1@x")
+        self.assertEqual(self.running(), ["a", "b", "c"])
+
+    def test_history(self):
+        job = self.submit("a", "h1@x")
+        failed_job = self.submit("b", "h2@x")
+        self.vms["a"].finish()
+        self.vms["b"].finish("connection refused")
+        self.assertTrue(wait_for(lambda: len(self.scheduler.history) == 2))
+        self.assertEqual(job.state, "done")
+        self.assertEqual(job.last_stats["downtime"], 12)
+        self.assertEqual(job.progress(), 100)
+        self.assertEqual(failed_job.state, "failed")
+        self.assertEqual(failed_job.error, "connection refused")
+
+    def test_cancel(self):
+        self.submit("a", "h1@x")
+        job = self.submit("b", "h1@x")
+        self.assertEqual(self.scheduler.cancel("a"), None)
+        self.assertTrue(self.scheduler.cancel("b", "virtual machine freed") is job)
+        self.assertEqual(job.state, "cancelled")
+        self.assertEqual(job.error, "virtual machine freed")
+        self.assertFalse(self.vms["b"].is_migrating)
+        self.assertEqual(self.queued(), [])
+        self.assertTrue(job in self.scheduler.history)
+        self.assertEqual(self.scheduler.cancel("b"), None)
+
+    def test_to_node(self):
+        self.submit("a", "h1@x")
+        self.submit("b", "h1@x")
+        node = self.scheduler.to_node(xmpp.Node("migrations"))
+        self.assertEqual(node.getAttr("running"), 1)
+        self.assertEqual(node.getAttr("queued"), 1)
+        self.assertEqual([migration.getAttr("state") for migration in node.getTags("migration")], ["running", "queued"])
+
+    def test_options_from_node(self):
+        node = xmpp.Node("item", attrs={"bandwidth": "100", "compressed": "true", "postcopy": "no"})
+        options = migration_options_from_node(node, {"auto_converge": True, "postcopy": True})
+        self.assertEqual(options, {"bandwidth": 100, "compressed": True, "auto_converge": True, "postcopy": False})
+
+
+if __name__ == "__main__":
+    unittest.main()
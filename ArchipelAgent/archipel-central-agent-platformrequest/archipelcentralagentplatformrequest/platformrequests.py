@@ -130,7 +130,7 @@ class TNPlatformRequests (TNArchipelPlugin):
         try:
             reply = iq.buildReply("result")
             limit = iq.getTag("query").getTag("archipel").getAttr("limit")
-            computed_items = self.computing_unit.score(self.entity.database, limit=limit)
+            computed_items = self.computing_unit.score(self.entity.database.readers, limit=limit)
             self.entity.log.debug("PLATFORMREQ: computed items : %s" % computed_items)
             for computed_item in computed_items:
                 reply.addChild("hypervisor", attrs=computed_item)
@@ -24,15 +24,19 @@ Contains L{TNArchipelCentralAgent}, the entities used for central agent.
 """
 
 import datetime
+import heapq
 import random
 import sqlite3
-from threading import Thread
-from Queue import Queue
+import time
+from threading import Thread, Lock
+from Queue import Queue, Empty
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
+from archipelcore import dbentries
+from archipelcore.dbquery import TNDBQuery, ARCHIPEL_DB_TABLE_COLUMNS
 from archipelcore.pubsub import TNPubSubNode
 from archipelcore.utils import build_error_iq
 from archipelcore import xmpp
@@ -40,49 +44,270 @@ from archipelcore import xmpp
 # this pubsub is subscribed by all hypervisors and carries the keepalive messages
 # for the central agent
 ARCHIPEL_KEEPALIVE_PUBSUB                = "/archipel/centralagentkeepalive"
+# pubsub#max_items of the keepalive node, as created by archipel-centralagentnode
+ARCHIPEL_KEEPALIVE_PUBSUB_MAX_ITEMS      = 100
 ARCHIPEL_NS_CENTRALAGENT                 = "archipel:centralagent"
 
 ARCHIPEL_ERROR_CODE_CENTRALAGENT         = 123
 
+# interval (seconds) used to check if we should become central agent
+ARCHIPEL_CENTRAL_AGENT_ROLE_CHECK_INTERVAL = 3.0
+
+# version of the central database schema, see migrate_database
+ARCHIPEL_CENTRAL_DB_SCHEMA_VERSION       = 3
+
+# max number of rows sent in one page of a paged read
+ARCHIPEL_CENTRAL_DB_MAX_PAGE_SIZE        = 500
+
+# max number of uuids given to one "in" filter. sqlite accepts at most 999 variables per statement
+ARCHIPEL_CENTRAL_DB_PAGE_SIZE            = 200
+
+# interval (seconds) between two writes of the hypervisors liveness and stats
+ARCHIPEL_CENTRAL_DB_HYPERVISORS_FLUSH_INTERVAL = 5.0
+
+ARCHIPEL_CENTRAL_DB_DATE_FORMAT          = "%Y-%m-%d %H:%M:%S.%f"
+
 # XMPP shows
 ARCHIPEL_XMPP_SHOW_ONLINE                       = "Online"
 
 
+class TNDBReaderPool(object):
+    """
+    A pool of read only connections to the central database. Reads are
+    run in the thread of the caller, in parallel with the writer thread
+    of L{TNDBController}, and see the last committed state of the database.
+    """
+    def __init__(self, db, log, size=4):
+        self.db = db
+        self.log = log
+        self.size = size
+        self.opened = 0
+        self.lock = Lock()
+        self.connections = Queue()
+
+    def acquire(self):
+        """
+        Get a connection from the pool, opening a new one if all are busy
+        and the pool is not full. A connection that cannot be opened does
+        not count in the pool.
+        @rtype: sqlite3.Connection
+        @return: a connection
+        """
+        self.lock.acquire()
+        try:
+            if self.connections.empty() and self.opened < self.size:
+                self.opened += 1
+                try:
+                    return sqlite3.connect(self.db, timeout=30, check_same_thread=False)
+                except:
+                    self.opened -= 1
+                    raise
+        finally:
+            self.lock.release()
+        return self.connections.get()
+
+    def execute(self, request, arg=None):
+        """
+        Run a read statement.
+        @type request: string
+        @param request: the sql statement
+        @type arg: tuple, list or dict
+        @param arg: the arguments of the statement
+        @rtype: list
+        @return: all the rows of the result
+        """
+        try:
+            conn = self.acquire()
+        except Exception as ex:
+            self.log.error("Unable to open a read connection to the database for sql read statement %s with %s (%s)" % (request, arg, ex))
+            return []
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(request, arg or tuple())
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+        except Exception as ex:
+            self.log.error("Error while executing sql read statement %s with %s (%s)" % (request, arg, ex))
+            return []
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
 class TNDBController(Thread):
     """
     This class reprensent the database controller. The main purpose is to handle
     better concurency read/write by setting up a Queue. This is a workaround to
     avoid sqlite3 to segfault from time to time.
+
+    Queued statements are grouped in batches: a batch is made of at most
+    batch_size requests or of the requests received during batch_latency
+    seconds, and is committed in a single transaction.
     """
-    def __init__(self, db, log):
+    def __init__(self, db, log, batch_size=500, batch_latency=0.05, journal_mode="wal", readers=4):
         super(TNDBController, self).__init__()
         self.db = db
+        self.log = log
         self.requets = Queue()
+        self.readers = TNDBReaderPool(db, log, readers)
         self.name = self.__class__.__name__
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.journal_mode = journal_mode
+        self.metrics_lock = Lock()
+        self.metrics = {"batches": 0, "statements": 0, "errors": 0, "commits": 0,
+                        "last_commit_latency": 0.0, "max_commit_latency": 0.0, "total_commit_latency": 0.0,
+                        "max_batch_size": 0}
         self.start()
-        self.log = log
+
+    def configure_connection(self, conn):
+        """
+        Set the pragmas of the connection.
+        @type conn: sqlite3.Connection
+        @param conn: the connection
+        """
+        if self.journal_mode:
+            mode = conn.execute("pragma journal_mode=%s" % self.journal_mode).fetchone()[0]
+            if mode.lower() != self.journal_mode.lower():
+                self.log.warning("CENTRALAGENT: unable to set journal mode to %s, using %s" % (self.journal_mode, mode))
+            if mode.lower() == "wal":
+                # in WAL mode, NORMAL is safe and avoids a fsync per commit
+                conn.execute("pragma synchronous=NORMAL")
+        conn.execute("pragma temp_store=MEMORY")
+
+    def next_batch(self):
+        """
+        Wait for a request and gather the following ones in a batch.
+        @rtype: list
+        @return: list of (request, args, results, many)
+        """
+        batch = [self.requets.get()]
+        deadline = time.time() + self.batch_latency
+        while len(batch) < self.batch_size and batch[-1][0] != '--close connection--':
+            remaining = deadline - time.time()
+            try:
+                if remaining <= 0:
+                    batch.append(self.requets.get_nowait())
+                else:
+                    batch.append(self.requets.get(True, remaining))
+            except Empty:
+                break
+        return batch
+
+    def commit(self, conn):
+        """
+        Commit the current transaction and update the metrics.
+        @type conn: sqlite3.Connection
+        @param conn: the connection
+        """
+        start = time.time()
+        conn.commit()
+        latency = time.time() - start
+        self.metrics_lock.acquire()
+        self.metrics["commits"] += 1
+        self.metrics["last_commit_latency"] = latency
+        self.metrics["total_commit_latency"] += latency
+        self.metrics["max_commit_latency"] = max(self.metrics["max_commit_latency"], latency)
+        self.metrics_lock.release()
 
     def run(self):
         conn = sqlite3.connect(self.db)
+        self.configure_connection(conn)
         cursor = conn.cursor()
-        while True:
-            request, arg, results = self.requets.get()
-            if request == '--close connection--':
-                break
-            try:
-                cursor.execute(request, arg)
-                conn.commit()
-            except Exception as ex:
-                self.log.error("Error while executing sql statement %s with %s (%s)" % (request, arg, ex))
-                continue
-            if results:
-                for record in cursor:
-                    results.put(record)
-                results.put('--no more results--')
+        running = True
+        while running:
+            batch = self.next_batch()
+            pending_writes = False
+            statements = 0
+            errors = 0
+            for request, arg, results, many in batch:
+                if request == '--close connection--':
+                    running = False
+                    break
+                if results is not None and pending_writes:
+                    # make sure the read sees committed data
+                    pending_writes = False
+                    try:
+                        self.commit(conn)
+                    except Exception as ex:
+                        self.log.error("Error while committing a batch of %d statements before a read (%s)" % (statements, ex))
+                        conn.rollback()
+                        errors += 1
+                        results.put('--no more results--')
+                        continue
+                try:
+                    if many:
+                        cursor.executemany(request, arg)
+                        statements += len(arg)
+                    else:
+                        cursor.execute(request, arg)
+                        statements += 1
+                except Exception as ex:
+                    self.log.error("Error while executing sql statement %s with %s (%s)" % (request, arg, ex))
+                    errors += 1
+                    if results is not None:
+                        results.put('--no more results--')
+                    continue
+                if results is not None:
+                    try:
+                        for record in cursor:
+                            results.put(record)
+                    except Exception as ex:
+                        self.log.error("Error while reading the results of sql statement %s with %s (%s)" % (request, arg, ex))
+                        errors += 1
+                    results.put('--no more results--')
+                else:
+                    pending_writes = True
+            if pending_writes:
+                try:
+                    self.commit(conn)
+                except Exception as ex:
+                    self.log.error("Error while committing a batch of %d statements (%s)" % (statements, ex))
+                    conn.rollback()
+                    errors += 1
+            self.metrics_lock.acquire()
+            self.metrics["batches"] += 1
+            self.metrics["statements"] += statements
+            self.metrics["errors"] += errors
+            self.metrics["max_batch_size"] = max(self.metrics["max_batch_size"], len(batch))
+            self.metrics_lock.release()
         conn.close()
 
     def execute(self, request, arg=None, results=None):
-        self.requets.put((request, arg or tuple(), results))
+        self.requets.put((request, arg or tuple(), results, False))
+
+    def executemany(self, request, args):
+        """
+        Queue the same statement for all given arguments. They will
+        be executed in the same transaction.
+        @type request: string
+        @param request: the sql statement
+        @type args: list
+        @param args: list of arguments
+        """
+        self.requets.put((request, list(args), None, True))
+
+    def read(self, request, arg=None):
+        """
+        Run a read statement using the reader pool, without waiting
+        for the queued writes. Use request() if the read must see the
+        writes queued before it.
+        @type request: string
+        @param request: the sql statement
+        @type arg: tuple, list or dict
+        @param arg: the arguments of the statement
+        @rtype: list
+        @return: all the rows of the result
+        """
+        return self.readers.execute(request, arg)
 
     def request(self, request, arg=None):
         results = Queue()
@@ -93,8 +318,212 @@ class TNDBController(Thread):
                 break
             yield record
 
+    def sync(self):
+        """
+        Wait until all the requests queued before this call are committed.
+        """
+        list(self.request("select 1"))
+
+    def get_metrics(self):
+        """
+        Return the metrics of the controller.
+        @rtype: dict
+        @return: queue depth, number of batches, statements, commits, errors and commit latencies (in seconds)
+        """
+        self.metrics_lock.acquire()
+        metrics = dict(self.metrics)
+        self.metrics_lock.release()
+        metrics["queue_depth"] = self.requets.qsize()
+        if metrics["commits"] > 0:
+            metrics["average_commit_latency"] = metrics["total_commit_latency"] / metrics["commits"]
+        else:
+            metrics["average_commit_latency"] = 0.0
+        del metrics["total_commit_latency"]
+        return metrics
+
     def close(self):
         self.execute('--close connection--')
+        self.readers.close()
+
+
+class TNHypervisorTable (object):
+    """
+    In memory copy of the hypervisors table. Keepalives and statistics only
+    update this table, and modified rows are written to the database by
+    flush(). Hypervisors are kept in a min-heap ordered on their last_seen
+    date, so finding the ones that timed out only looks at the oldest ones.
+    The heap may contain outdated items for a hypervisor, they are ignored
+    when popped.
+    """
+
+    def __init__(self):
+        """
+        The contructor of the class.
+        """
+        self.hypervisors    = {}
+        self.last_seen_heap = []
+        self.dirty          = set()
+        self.lock           = Lock()
+
+    def load(self, entries):
+        """
+        Fill the table with the rows read from the database.
+        @type entries: list
+        @param entries: list of dict, one per hypervisor
+        """
+        self.lock.acquire()
+        try:
+            self.hypervisors    = {}
+            self.last_seen_heap = []
+            self.dirty          = set()
+            for entry in entries:
+                hypervisor = dict(entry)
+                try:
+                    hypervisor["last_seen"] = date_to_timestamp(hypervisor["last_seen"])
+                except (TypeError, ValueError):
+                    hypervisor["last_seen"] = time.time()
+                self.hypervisors[hypervisor["jid"]] = hypervisor
+                self.last_seen_heap.append((hypervisor["last_seen"], hypervisor["jid"]))
+            heapq.heapify(self.last_seen_heap)
+        finally:
+            self.lock.release()
+
+    def register(self, entries):
+        """
+        Add hypervisors to the table. They are expected to be written
+        to the database by the caller.
+        @type entries: list
+        @param entries: list of dict, one per hypervisor
+        """
+        self.lock.acquire()
+        try:
+            for entry in entries:
+                hypervisor = {"stat1": 0, "stat2": 0, "stat3": 0}
+                hypervisor.update(entry)
+                hypervisor["jid"] = str(entry["jid"])
+                hypervisor["last_seen"] = time.time()
+                self.hypervisors[hypervisor["jid"]] = hypervisor
+                self.dirty.discard(hypervisor["jid"])
+                heapq.heappush(self.last_seen_heap, (hypervisor["last_seen"], hypervisor["jid"]))
+        finally:
+            self.lock.release()
+
+    def update(self, entries, seen=False):
+        """
+        Update some hypervisors. Unknown hypervisors are ignored, as
+        an update statement would do.
+        @type entries: list
+        @param entries: list of dict containing the jid and the values to change
+        @type seen: Boolean
+        @param seen: if True, the hypervisors have just been heard of
+        @rtype: list
+        @return: list of the jids of the hypervisors that came back online
+        """
+        back_online = []
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for entry in entries:
+                jid = str(entry["jid"])
+                hypervisor = self.hypervisors.get(jid, None)
+                if not hypervisor:
+                    continue
+                for key, value in entry.iteritems():
+                    if key in ARCHIPEL_DB_TABLE_COLUMNS["hypervisors"] and not key in ("jid", "last_seen"):
+                        hypervisor[key] = value
+                if seen:
+                    hypervisor["last_seen"] = now
+                    heapq.heappush(self.last_seen_heap, (now, jid))
+                    if hypervisor["status"] == "Unreachable":
+                        hypervisor["status"] = "Online"
+                        back_online.append(jid)
+                self.dirty.add(jid)
+        finally:
+            self.lock.release()
+        return back_online
+
+    def remove(self, jids):
+        """
+        Remove hypervisors from the table.
+        @type jids: list
+        @param jids: the jids of the hypervisors
+        """
+        self.lock.acquire()
+        try:
+            for jid in jids:
+                self.hypervisors.pop(str(jid), None)
+                self.dirty.discard(str(jid))
+        finally:
+            self.lock.release()
+
+    def expire(self, threshold):
+        """
+        Mark as unreachable the online hypervisors not seen since threshold seconds.
+        @type threshold: integer
+        @param threshold: the timeout in seconds
+        @rtype: list
+        @return: list of the jids of the hypervisors that timed out
+        """
+        timed_out = []
+        limit = time.time() - threshold
+        self.lock.acquire()
+        try:
+            while self.last_seen_heap and self.last_seen_heap[0][0] < limit:
+                last_seen, jid = heapq.heappop(self.last_seen_heap)
+                hypervisor = self.hypervisors.get(jid, None)
+                if not hypervisor or hypervisor["last_seen"] != last_seen:
+                    continue
+                if hypervisor["status"] == "Online":
+                    hypervisor["status"] = "Unreachable"
+                    self.dirty.add(jid)
+                    timed_out.append(jid)
+        finally:
+            self.lock.release()
+        return timed_out
+
+    def pop_dirty(self):
+        """
+        Return the rows modified since the last call.
+        @rtype: list
+        @return: list of dict, ready to be used with the update statement of the hypervisors
+        """
+        self.lock.acquire()
+        try:
+            rows = []
+            for jid in self.dirty:
+                hypervisor = self.hypervisors[jid]
+                rows.append({"jid": jid,
+                             "last_seen": timestamp_to_date(hypervisor["last_seen"]),
+                             "status": hypervisor["status"],
+                             "stat1": hypervisor["stat1"],
+                             "stat2": hypervisor["stat2"],
+                             "stat3": hypervisor["stat3"]})
+            self.dirty = set()
+            return rows
+        finally:
+            self.lock.release()
+
+
+def date_to_timestamp(date):
+    """
+    Convert a date stored in the central database to a timestamp.
+    @type date: string
+    @param date: the date
+    @rtype: float
+    @return: the timestamp
+    """
+    date = datetime.datetime.strptime(date, ARCHIPEL_CENTRAL_DB_DATE_FORMAT)
+    return time.mktime(date.timetuple()) + date.microsecond / 1000000.0
+
+def timestamp_to_date(timestamp):
+    """
+    Convert a timestamp to the date format of the central database.
+    @type timestamp: float
+    @param timestamp: the timestamp
+    @rtype: string
+    @return: the date
+    """
+    return datetime.datetime.fromtimestamp(timestamp).strftime(ARCHIPEL_CENTRAL_DB_DATE_FORMAT)
 
 
 class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarControllableEntity, TNTaggableEntity):
@@ -155,14 +584,35 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         self.xmpp_authenticated    = False
         self.is_central_agent      = False
         self.salt                  = random.random()
-        self.database              = TNDBController(self.configuration.get("CENTRALAGENT", "database"), self.log)
+        self.database              = TNDBController(self.configuration.get("CENTRALAGENT", "database"), self.log, **self.database_options())
+        self.compact_entries       = True
+        self.max_page_size         = ARCHIPEL_CENTRAL_DB_MAX_PAGE_SIZE
+        self.hypervisors_table     = TNHypervisorTable()
+        self.hypervisors_flush_interval = ARCHIPEL_CENTRAL_DB_HYPERVISORS_FLUSH_INTERVAL
+
+        if self.configuration.has_option("CENTRALAGENT", "compact_entries"):
+            self.compact_entries = self.configuration.getboolean("CENTRALAGENT", "compact_entries")
+
+        if self.configuration.has_option("CENTRALAGENT", "database_max_page_size"):
+            self.max_page_size = self.configuration.getint("CENTRALAGENT", "database_max_page_size")
+
+        if self.configuration.has_option("CENTRALAGENT", "hypervisors_flush_interval"):
+            self.hypervisors_flush_interval = self.configuration.getfloat("CENTRALAGENT", "hypervisors_flush_interval")
 
         # defining the structure of the keepalive pubsub event
         self.keepalive_event      = xmpp.Node("event",attrs={"type":"keepalive","jid":self.jid})
+        if self.compact_entries:
+            self.keepalive_event.setAttr("encodings", ",".join(dbentries.ARCHIPEL_ENTRIES_ENCODINGS))
         self.last_keepalive_heard = datetime.datetime.now()
         self.last_hyp_check       = datetime.datetime.now()
         self.required_stats_xml   = None
 
+        # periodic work
+        self.add_timer(ARCHIPEL_CENTRAL_AGENT_ROLE_CHECK_INTERVAL, self.check_central_agent_role)
+        self.add_timer(self.keepalive_interval, self.send_keepalive)
+        self.add_timer(self.hypervisor_check_interval, self.check_hyps_if_needed)
+        self.add_timer(self.hypervisors_flush_interval, self.flush_hypervisors)
+
         # module inits
         self.initialize_modules('archipel.plugin.core')
         self.initialize_modules('archipel.plugin.centralagent')
@@ -181,6 +631,23 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
 
     # Utilities
 
+    def database_options(self):
+        """
+        Read the options of the database controller from the configuration.
+        @rtype: dict
+        @return: keyword arguments for L{TNDBController}
+        """
+        options = {}
+        if self.configuration.has_option("CENTRALAGENT", "database_batch_size"):
+            options["batch_size"] = self.configuration.getint("CENTRALAGENT", "database_batch_size")
+        if self.configuration.has_option("CENTRALAGENT", "database_batch_latency"):
+            options["batch_latency"] = self.configuration.getfloat("CENTRALAGENT", "database_batch_latency") / 1000.0
+        if self.configuration.has_option("CENTRALAGENT", "database_journal_mode"):
+            options["journal_mode"] = self.configuration.get("CENTRALAGENT", "database_journal_mode")
+        if self.configuration.has_option("CENTRALAGENT", "database_readers"):
+            options["readers"] = self.configuration.getint("CENTRALAGENT", "database_readers")
+        return options
+
     def init_permissions(self):
         """
         Initialize the permissions.
@@ -215,6 +682,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             - update_hypervisors
             - unregister_hypervisors
             - unregister_vms
+            - database_metrics
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -242,6 +710,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply = self.iq_unregister_hypervisors(iq)
         elif action == "unregister_vms":
             reply = self.iq_unregister_vms(iq)
+        elif action == "database_metrics":
+            reply = self.iq_database_metrics(iq)
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
@@ -274,7 +744,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         # - force         : will always be central agent. centralized model when one hypervisor is always online.
         #                   Warning : be sure there is only 1 otherwise they will fight with each other.
         self.log.debug("CENTRALAGENT: Mode %s" % self.central_agent_mode)
-        self.central_keepalive_pubsub = TNPubSubNode(self.xmppclient, self.pubsubserver, ARCHIPEL_KEEPALIVE_PUBSUB)
+        self.central_keepalive_pubsub = TNPubSubNode(self.xmppclient, self.pubsubserver, ARCHIPEL_KEEPALIVE_PUBSUB, max_items=ARCHIPEL_KEEPALIVE_PUBSUB_MAX_ITEMS)
         self.central_keepalive_pubsub.recover()
         self.central_keepalive_pubsub.subscribe(self.jid, self.handle_central_keepalive_event)
         self.log.info("CENTRALAGENT: entity %s is now subscribed to events from node %s" % (self.jid, ARCHIPEL_KEEPALIVE_PUBSUB))
@@ -298,11 +768,13 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         initial_keepalive.setAttr("salt",self.salt)
         initial_keepalive.setAttr("keepalive_interval", self.keepalive_interval)
         initial_keepalive.setAttr("hypervisor_timeout_threshold", self.hypervisor_timeout_threshold)
+        if self.compact_entries:
+            initial_keepalive.setAttr("encodings", ",".join(dbentries.ARCHIPEL_ENTRIES_ENCODINGS))
 
         if self.required_stats_xml:
             initial_keepalive.addChild(node=self.required_stats_xml)
 
-        self.central_keepalive_pubsub.add_item(initial_keepalive)
+        self.central_keepalive_pubsub.publish(initial_keepalive, coalesce_key="keepalive")
         self.log.debug("CENTRALAGENT: initial keepalive sent")
         self.last_keepalive_sent = datetime.datetime.now()
         self.last_hyp_check      = datetime.datetime.now()
@@ -363,12 +835,12 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         try:
             read_event      = iq.getTag("query").getTag("archipel").getTag("event")
-            columns         = read_event.getAttr("columns")
-            where_statement = read_event.getAttr("where_statement")
             reply           = iq.buildReply("result")
-            entries         = self.read_hypervisors(columns, where_statement)
-            for entry in self.pack_entries(entries):
+            query           = self.query_from_event(read_event, "hypervisors")
+            entries, cursor = self.read_page(query, self.read_hypervisors)
+            for entry in self.pack_entries(entries, self.reply_encoding(iq)):
                 reply.addChild(node=entry)
+            self.add_page_to_reply(reply, query, cursor)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
@@ -381,12 +853,12 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         try:
             read_event      = iq.getTag("query").getTag("archipel").getTag("event")
-            columns         = read_event.getAttr("columns")
-            where_statement = read_event.getAttr("where_statement")
             reply           = iq.buildReply("result")
-            entries         = self.read_vms(columns, where_statement)
-            for entry in self.pack_entries(entries):
+            query           = self.query_from_event(read_event, "vms")
+            entries, cursor = self.read_page(query, self.read_vms)
+            for entry in self.pack_entries(entries, self.reply_encoding(iq)):
                 reply.addChild(node=entry)
+            self.add_page_to_reply(reply, query, cursor)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
@@ -404,7 +876,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             origin_hyp = iq.getFrom()
             reply      = iq.buildReply("result")
             entries    = self.get_existing_vms_instances(entries, origin_hyp)
-            for entry in self.pack_entries(entries):
+            for entry in self.pack_entries(entries, self.reply_encoding(iq)):
                 reply.addChild(node=entry)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
@@ -464,7 +936,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply   = iq.buildReply("result")
             entries = self.unpack_entries(iq)
             entries = self.update_vms_domain(entries)
-            for entry in self.pack_entries(entries):
+            for entry in self.pack_entries(entries, self.reply_encoding(iq)):
                 reply.addChild(node=entry)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
@@ -479,9 +951,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         try:
             reply   = iq.buildReply("result")
             entries = self.unpack_entries(iq)
-            for entry in entries:
-                entry['last_seen'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-            self.update_hypervisors(entries)
+            self.update_hypervisors(entries, seen=True)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
@@ -512,52 +982,139 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             in_entries  = self.unpack_entries(iq)
             out_entries = self.unregister_vms(in_entries)
             self.perform_hooks("HOOK_CENTRALAGENT_VM_UNREGISTERED", out_entries)
-            for entry in self.pack_entries(out_entries):
+            for entry in self.pack_entries(out_entries, self.reply_encoding(iq)):
                 reply.addChild(node=entry)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
 
-    def read_hypervisors(self, columns="*", where_statement=None):
+    def iq_database_metrics(self, iq):
+        """
+        Called when the central agent receives a database metrics request.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        """
+        try:
+            reply   = iq.buildReply("result")
+            metrics = xmpp.Node("metrics")
+            for key, value in self.database.get_metrics().iteritems():
+                metrics.addChild("item", attrs={"key": key, "value": value})
+            reply.setQueryPayload([metrics])
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
+        return reply
+
+    def query_from_event(self, read_event, table):
+        """
+        Build the query described by a read event.
+        @type read_event: xmpp.Node
+        @param read_event: the event node of the received IQ
+        @type table: string
+        @param table: the table to read
+        @rtype: L{TNDBQuery}
+        @return: the query
+        """
+        if read_event.getAttr("where_statement"):
+            raise Exception("Raw where_statement is not accepted anymore, please upgrade the centraldb plugin of %s" % read_event.getAttr("jid"))
+        return TNDBQuery.from_node(read_event, table=table)
+
+    def read(self, query):
+        """
+        Run a query on the central db.
+        @type query: L{TNDBQuery}
+        @param query: the query
+        @rtype: list
+        @return: list of dict column -> value
+        """
+        statement, params = query.to_sql()
+        return query.rows_to_entries(self.database.read(statement, params))
+
+    def read_page(self, query, read_method):
+        """
+        Run a query received from an entity. If the query is paged, its page
+        size is capped to max_page_size.
+        @type query: L{TNDBQuery}
+        @param query: the query
+        @type read_method: func
+        @param read_method: the method used to read the table
+        @rtype: tuple
+        @return: (list of entries, cursor of the next page or None)
+        """
+        if query.page_size:
+            query.page_size = min(query.page_size, self.max_page_size)
+        return query.split_page(read_method(query))
+
+    def add_page_to_reply(self, reply, query, cursor):
+        """
+        Tell the entity how to get the next page of a paged read.
+        Entities that do not know about pages just ignore this node.
+        @type reply: xmpp.Iq
+        @param reply: the reply
+        @type query: L{TNDBQuery}
+        @param query: the query that has been run
+        @type cursor: string
+        @param cursor: the cursor of the next page, or None if this is the last one
+        """
+        if not query.page_size:
+            return
+        page = reply.addChild("page", attrs={"size": query.page_size})
+        if cursor is not None:
+            page.setAttr("next", cursor)
+
+    def read_pages(self, query, page_size=None):
+        """
+        Iterate over the results of a query page by page, so the whole
+        result set is never held in memory.
+        @type query: L{TNDBQuery}
+        @param query: the query, without order or limit
+        @type page_size: integer
+        @param page_size: the number of rows per page. max_page_size if None
+        @rtype: generator
+        @return: generator of list of entries
+        """
+        query.page(page_size or self.max_page_size)
+        while True:
+            entries, cursor = query.split_page(self.read(query))
+            yield entries
+            if cursor is None:
+                break
+            query.cursor = cursor
+
+    def read_hypervisors(self, query=None):
         """
         Reads list of hypervisors in central db.
+        @type query: L{TNDBQuery}
+        @param query: the query on the hypervisors table. All hypervisors if None
         """
-        read_statement = "select %s from hypervisors" % columns
-        if where_statement:
-            read_statement += " where %s" % where_statement
-        rows = self.database.request(read_statement)
-        ret = []
-        for row in rows:
-            if columns == "*":
-                ret.append({"jid":row[0], "last_seen":row[1], "status":row[2]})
-            else:
-                res = {}
-                i = 0
-                for col in columns.split(","):
-                    res[col] = row[i]
-                    i += 1
-                ret.append(res)
-        return ret
+        return self.read(query or TNDBQuery("hypervisors"))
 
-    def read_vms(self, columns="*", where_statement=None):
+    def read_vms(self, query=None):
         """
         Read list of vms in central db.
+        @type query: L{TNDBQuery}
+        @param query: the query on the vms table. All vms if None
+        """
+        return self.read(query or TNDBQuery("vms"))
+
+    def read_vms_by_uuids(self, uuids, columns=None, conditions=()):
+        """
+        Read the vms with the given uuids, with one query per
+        ARCHIPEL_CENTRAL_DB_PAGE_SIZE uuids.
+        @type uuids: list
+        @param uuids: the uuids of the vms
+        @type columns: list
+        @param columns: the columns to return. All if None
+        @type conditions: list
+        @param conditions: names of predefined conditions the vms must match
+        @rtype: list
+        @return: the vms found
         """
-        read_statement = "select %s from vms" % columns
-        if where_statement:
-            read_statement += " where %s" % where_statement
-        rows = self.database.request(read_statement)
         ret = []
-        for row in rows:
-            if columns == "*":
-                ret.append({"uuid":row[0], "parker":row[1], "creation_date":row[2], "domain":row[3], "hypervisor":row[4], "name":row[5]})
-            else:
-                res = {}
-                i = 0
-                for col in columns.split(","):
-                    res[col] = row[i]
-                    i += 1
-                ret.append(res)
+        for i in range(0, len(uuids), ARCHIPEL_CENTRAL_DB_PAGE_SIZE):
+            query = TNDBQuery("vms", columns).where_in("uuid", uuids[i:i + ARCHIPEL_CENTRAL_DB_PAGE_SIZE])
+            for condition in conditions:
+                query.condition(condition)
+            ret.extend(self.read_vms(query))
         return ret
 
     def get_existing_vms_instances(self, entries, origin_hyp):
@@ -571,14 +1128,15 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         for entry in entries:
             uuids.append(entry["uuid"])
 
-        read_statement = "select vms.uuid from vms join hypervisors on hypervisors.jid=vms.hypervisor"
-        read_statement += " where vms.uuid in (%s)" % ','.join("?" * len(uuids))
-        read_statement += " and hypervisors.jid != '%s'" % origin_hyp
-        read_statement += " and hypervisors.status='Online'"
-
         self.log.debug("CENTRALAGENT: Check if vm uuids %s exist elsewhere " % uuids)
-        for row in self.database.request(read_statement, uuids):
-            ret.append({"uuid":row[0]})
+        for i in range(0, len(uuids), ARCHIPEL_CENTRAL_DB_PAGE_SIZE):
+            chunk = uuids[i:i + ARCHIPEL_CENTRAL_DB_PAGE_SIZE]
+            read_statement = "select vms.uuid from vms join hypervisors on hypervisors.jid=vms.hypervisor"
+            read_statement += " where vms.uuid in (%s)" % ','.join("?" * len(chunk))
+            read_statement += " and hypervisors.jid != ?"
+            read_statement += " and hypervisors.status='Online'"
+            for row in self.database.read(read_statement, chunk + [str(origin_hyp)]):
+                ret.append({"uuid":row[0]})
         self.log.debug("CENTRALAGENT: We found %s on %s vms existing on others hypervistors." % (len(ret), len(uuids)))
         return ret
 
@@ -588,18 +1146,12 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         are parked (have no hypervisor, or have a hypervisor which is not online)
         """
         uuids = []
-        ret = []
 
         for entry in entries:
             uuids.append(entry["uuid"])
 
-        read_statement = "select uuid, domain from vms"
-        read_statement += " where uuid in (%s)" % ','.join("?" * len(uuids))
-        read_statement += " and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online'))"
-
         self.log.debug("CENTRALDB: Get parked vms from database")
-        for row in self.database.request(read_statement, uuids):
-            ret.append({"uuid":row[0], "domain":row[1]})
+        ret = self.read_vms_by_uuids(uuids, ["uuid", "domain"], ["parked"])
         self.log.debug("CENTRALDB: We found %s parked vms" % len(ret))
         return ret
 
@@ -610,8 +1162,9 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @param entries: list of hypervisors
         """
         for entry in entries:
-            entry['last_seen'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            entry['last_seen'] = datetime.datetime.now().strftime(ARCHIPEL_CENTRAL_DB_DATE_FORMAT)
         self.db_commit("insert into hypervisors values(:jid, :last_seen, :status, :stat1, :stat2, :stat3)", entries)
+        self.hypervisors_table.register(entries)
 
     def register_vms(self,entries):
         """
@@ -619,7 +1172,9 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type entries: List
         @param entries: list of vms
         """
-        self.db_commit("insert into vms values(:uuid, :parker, :creation_date, :domain, :hypervisor, :name)",entries)
+        for entry in entries:
+            entry["jid"] = self.vm_jid_from_domain(entry.get("domain"))
+        self.db_commit("insert into vms (uuid, parker, creation_date, domain, hypervisor, name, jid) values(:uuid, :parker, :creation_date, :domain, :hypervisor, :name, :jid)", entries)
 
     def update_vms(self,entries):
         """
@@ -627,6 +1182,9 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type entries: List
         @param entries: list of vms
         """
+        if "domain" in entries[0]:
+            for entry in entries:
+                entry["jid"] = self.vm_jid_from_domain(entry.get("domain"))
         update_snipplets = []
         for key,val in entries[0].iteritems():
             if key != "uuid":
@@ -698,18 +1256,33 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             self.db_commit(command, entries_to_commit)
         return results
 
-    def update_hypervisors(self,entries):
+    def update_hypervisors(self, entries, seen=False):
         """
-        Update a list of hypervisors in central db.
+        Update a list of hypervisors. Only the in memory table is changed,
+        and it is written to the central db by flush_hypervisors, right
+        away if a status changed.
         @type entries: List
-        @param entries: list of vms
+        @param entries: list of hypervisors
+        @type seen: Boolean
+        @param seen: True if the entries come from the hypervisors themselves
         """
-        update_snipplets = []
-        for key, val in entries[0].iteritems():
-            if key != "jid":
-                update_snipplets.append("%s=:%s" % (key, key))
-        command = "update hypervisors set %s where jid=:jid" % (", ".join(update_snipplets))
-        self.db_commit(command, entries)
+        if not self.is_central_agent:
+            raise Exception("CENTRALAGENT: we are not central agent")
+        back_online = self.hypervisors_table.update(entries, seen)
+        for jid in back_online:
+            self.log.info("CENTRALAGENT: Hypervisor %s is back up Online" % jid)
+        if back_online or [entry for entry in entries if "status" in entry]:
+            self.flush_hypervisors()
+
+    def flush_hypervisors(self):
+        """
+        Write the hypervisors changed since the last flush to the central db.
+        """
+        if not self.is_central_agent:
+            return
+        rows = self.hypervisors_table.pop_dirty()
+        if rows:
+            self.database.executemany("update hypervisors set last_seen=:last_seen, status=:status, stat1=:stat1, stat2=:stat2, stat3=:stat3 where jid=:jid", rows)
 
     def unregister_hypervisors(self,entries):
         """
@@ -717,7 +1290,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type entries: List
         @param entries: list of hypervisors
         """
-        self.db_commit("delete from hypervisors where jid=:jid, last_seen=:last_seen, status=:status",entries)
+        self.db_commit("delete from hypervisors where jid=:jid", entries)
+        self.hypervisors_table.remove([entry["jid"] for entry in entries])
 
     def unregister_vms(self, entries):
         """
@@ -729,18 +1303,14 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         uuids = []
         for entry in entries:
             uuids.append(entry["uuid"])
-        where_statement = "uuid = '"
-        where_statement += "' or uuid='".join(uuids)
-        where_statement += "'"
 
         # list of vms which have been found in central db, including uuid and jid
-        cleaned_entries = self.read_vms("uuid,domain", where_statement)
+        cleaned_entries = self.read_vms_by_uuids(uuids, ["uuid", "jid"])
         for i in range(len(cleaned_entries)):
-            domain_xml = cleaned_entries[i]["domain"]
-            if domain_xml != "None":
-                domain = xmpp.simplexml.NodeBuilder(data=cleaned_entries[i]["domain"]).getDom()
-                cleaned_entries[i]["jid"] = xmpp.JID(domain.getTag("description").getData().split("::::")[0])
-                del(cleaned_entries[i]["domain"])
+            if cleaned_entries[i]["jid"]:
+                cleaned_entries[i]["jid"] = xmpp.JID(cleaned_entries[i]["jid"])
+            else:
+                del(cleaned_entries[i]["jid"])
 
         self.db_commit("delete from vms where uuid=:uuid",cleaned_entries)
         return cleaned_entries
@@ -751,36 +1321,37 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type iq: xmpp.Iq
         @param event: received Iq
         """
-        central_database_event = iq.getTag("query").getTag("archipel").getTag("event")
-        entries = []
-        for entry in central_database_event.getChildren():
-            entry_dict = {}
-            for entry_val in entry.getChildren():
-                entry_dict[entry_val.getAttr("key")] = entry_val.getAttr("value")
-            entries.append(entry_dict)
-        return entries
+        return dbentries.unpack_entries(iq.getTag("query").getTag("archipel").getTag("event"))
 
-    def pack_entries(self, entries):
+    def pack_entries(self, entries, encoding=dbentries.ARCHIPEL_ENTRIES_ENCODING_XML):
         """
         Pack the list of entries to send to remote entity.
-        @rtype: list
-        @return: list of xmpp nodes, one per entry
         @type entries: list
         @param entries: list of dict entities
+        @type encoding: string
+        @param encoding: the encoding to use
+        @rtype: list
+        @return: list of xmpp nodes
         """
-        packed_entries = []
-        for entry in entries:
-            entryTag = xmpp.Node(tag="entry")
-            for key,value in entry.iteritems():
-                entryTag.addChild("item",attrs={"key":key,"value":value})
-            packed_entries.append(entryTag)
-        return packed_entries
+        return dbentries.pack_entries(entries, encoding)
+
+    def reply_encoding(self, iq):
+        """
+        Return the encoding to use to answer the given IQ, according
+        to the encodings accepted by the sender.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        @rtype: string
+        @return: the encoding
+        """
+        if not self.compact_entries:
+            return dbentries.ARCHIPEL_ENTRIES_ENCODING_XML
+        return dbentries.negotiate_encoding(iq.getTag("query").getTag("archipel").getTag("event").getAttr("accept_encoding"))
 
     def db_commit(self, command, entries):
         if self.is_central_agent:
             self.log.debug("CENTRALAGENT: commit '%s' with entries %s" % (command, entries))
-            for entry in entries:
-                self.database.execute(command, entry)
+            self.database.executemany(command, entries)
         else:
             raise Exception("CENTRALAGENT: we are not central agent")
 
@@ -789,23 +1360,11 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         Check that hypervisors are alive.
         """
         self.log.debug("CENTRALAGENT: Checking hypervisors state")
-        now                  = datetime.datetime.now()
-        rows                 = self.database.request("select jid,last_seen,status from hypervisors;")
-        hypervisor_to_update = []
-
-        for row in rows:
-            jid, last_seen, status = row
-            last_seen_date = datetime.datetime.strptime(last_seen, "%Y-%m-%d %H:%M:%S.%f")
-            if (now - last_seen_date).total_seconds() > self.hypervisor_timeout_threshold and status == "Online":
-                self.log.warning("CENTRALAGENT: Hypervisor %s timed out" % jid)
-                hypervisor_to_update.append({"jid": jid, "status": "Unreachable"})
-            elif (now - last_seen_date).total_seconds() <= self.hypervisor_timeout_threshold and status == "Unreachable":
-                self.log.info("CENTRALAGENT: Hypervisor %s is back up Online" % jid)
-                hypervisor_to_update.append({"jid": jid, "status": "Online"})
-
-        if hypervisor_to_update:
-            self.update_hypervisors(hypervisor_to_update)
-
+        timed_out = self.hypervisors_table.expire(self.hypervisor_timeout_threshold)
+        for jid in timed_out:
+            self.log.warning("CENTRALAGENT: Hypervisor %s timed out" % jid)
+        if timed_out:
+            self.flush_hypervisors()
         self.last_hyp_check = datetime.datetime.now()
 
     # Database Management
@@ -814,45 +1373,119 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         Create, Update and / or recover the parking database
         """
-        self.database.execute("create table if not exists vms (uuid text unique on conflict replace, parker string, creation_date date, domain string, hypervisor string, name string)")
-        self.database.execute("create table if not exists hypervisors (jid text unique on conflict replace, last_seen date, status string, stat1 int, stat2 int, stat3 int)")
-        self.updatedb()
+        self.migrate_database()
         self.database.execute("update vms set hypervisor='None';")
+        self.database.sync()
+        self.hypervisors_table.load(self.read_hypervisors())
 
-    def updatedb(self):
+    def migrate_database(self):
         """
-        Check if we need to alter table and fill it with proper value
+        Bring the database schema to ARCHIPEL_CENTRAL_DB_SCHEMA_VERSION. The
+        version of the schema is stored in the sqlite user_version pragma.
+        Databases created before the versioning have version 0, and all
+        migrations are written so they can be applied on them.
         """
-        need_update = True
-        for item in self.database.request("pragma table_info('vms')"):
-            if item[1] == 'name':
-                need_update = False
+        version = list(self.database.request("pragma user_version"))[0][0]
+        if version >= ARCHIPEL_CENTRAL_DB_SCHEMA_VERSION:
+            return
+        for target in range(version + 1, ARCHIPEL_CENTRAL_DB_SCHEMA_VERSION + 1):
+            self.log.info("CENTRALAGENT: migrating database schema to version %d" % target)
+            getattr(self, "migrate_database_to_%d" % target)()
+            self.database.execute("pragma user_version=%d" % target)
 
-        if need_update:
-            self.log.info("Migrating database to new schema")
-            self.database.execute("alter table vms add column 'name' 'string'")
-            # Populate this new value
-            for row in self.database.request('select * from vms'):
-                if row[3] != 'None':
-                    xml = xmpp.simplexml.NodeBuilder(row[3]).getDom()
-                    name = xml.getTag("name").getData()
-                else:
-                    name = row[0]
-                self.database.execute("update vms set name='%s' where uuid =='%s'" % (name, row[0]))
+    def migrate_database_to_1(self):
+        """
+        Initial schema.
+        """
+        self.database.execute("create table if not exists vms (uuid text unique on conflict replace, parker string, creation_date date, domain string, hypervisor string)")
+        self.database.execute("create table if not exists hypervisors (jid text unique on conflict replace, last_seen date, status string, stat1 int, stat2 int, stat3 int)")
 
-    # Event loop
+    def migrate_database_to_2(self):
+        """
+        Add the name of the vms.
+        """
+        if self.table_has_column("vms", "name"):
+            return
+        self.database.execute("alter table vms add column 'name' 'string'")
+        names = []
+        for row in self.database.request("select uuid, domain from vms"):
+            if row[1] != 'None':
+                xml = xmpp.simplexml.NodeBuilder(row[1]).getDom()
+                name = xml.getTag("name").getData()
+            else:
+                name = row[0]
+            names.append({"uuid": row[0], "name": name})
+        if names:
+            self.database.executemany("update vms set name=:name where uuid=:uuid", names)
+
+    def migrate_database_to_3(self):
+        """
+        Add the jid of the vms, extracted from the domain description,
+        and the indexes used by parking and placement queries.
+        """
+        if not self.table_has_column("vms", "jid"):
+            self.database.execute("alter table vms add column 'jid' 'string'")
+            jids = []
+            for row in self.database.request("select uuid, domain from vms"):
+                jids.append({"uuid": row[0], "jid": self.vm_jid_from_domain(row[1])})
+            if jids:
+                self.database.executemany("update vms set jid=:jid where uuid=:uuid", jids)
+        self.database.execute("create index if not exists vms_hypervisor on vms (hypervisor)")
+        self.database.execute("create index if not exists vms_jid on vms (jid)")
+        self.database.execute("create index if not exists hypervisors_status on hypervisors (status)")
+
+    def table_has_column(self, table, column):
+        """
+        Check if the given table has the given column.
+        @type table: string
+        @param table: the name of the table
+        @type column: string
+        @param column: the name of the column
+        @rtype: Boolean
+        @return: True if the column exists
+        """
+        for item in self.database.request("pragma table_info('%s')" % table):
+            if item[1] == column:
+                return True
+        return False
+
+    def vm_jid_from_domain(self, domain):
+        """
+        Extract the jid of a vm from its domain description.
+        @type domain: string
+        @param domain: the libvirt domain XML, or 'None'
+        @rtype: string
+        @return: the bare jid of the vm, or None
+        """
+        if not domain or domain == "None":
+            return None
+        try:
+            xml = xmpp.simplexml.NodeBuilder(data=domain).getDom()
+            return str(xmpp.JID(xml.getTag("description").getData().split("::::")[0]).getStripped())
+        except Exception as ex:
+            self.log.warning("CENTRALAGENT: unable to extract jid from domain: %s" % str(ex))
+            return None
 
-    def on_xmpp_loop_tick(self):
+    # Timers
 
-        if self.xmpp_authenticated:
+    def check_central_agent_role(self):
+        """
+        In auto mode, become the central agent if we are not.
+        """
+        if self.xmpp_authenticated and not self.is_central_agent and self.central_agent_mode == "auto":
+            self.become_central_agent()
 
-            if not self.is_central_agent and self.central_agent_mode == "auto":
-                self.become_central_agent()
-            elif self.is_central_agent:
-                if (datetime.datetime.now() - self.last_keepalive_sent).total_seconds() >= self.keepalive_interval:
-                    self.central_keepalive_pubsub.add_item(self.keepalive_event_with_date())
-                    self.last_keepalive_sent = datetime.datetime.now()
+    def send_keepalive(self):
+        """
+        Publish the keepalive event if we are the central agent.
+        """
+        if self.xmpp_authenticated and self.is_central_agent:
+            self.central_keepalive_pubsub.publish(self.keepalive_event_with_date(), coalesce_key="keepalive")
+            self.last_keepalive_sent = datetime.datetime.now()
 
-                if self.ping_hypervisors:
-                    if (datetime.datetime.now() - self.last_hyp_check).total_seconds() >= self.hypervisor_check_interval:
-                        self.check_hyps()
+    def check_hyps_if_needed(self):
+        """
+        Check the hypervisors if we are the central agent and if ping_hypervisors is set.
+        """
+        if self.xmpp_authenticated and self.is_central_agent and self.ping_hypervisors:
+            self.check_hyps()
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# entries_benchmark.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the xml and json+zlib encodings of the central agent entries.
+
+For 10, 100 and 1000 register_vms entries (each one carrying a libvirt
+domain description), measures the size of the serialized stanza, the
+time needed to pack the entries and serialize the stanza, and the time
+needed to parse the stanza and unpack the entries.
+
+usage: python entries_benchmark.py [number_of_runs]
+"""
+
+import sys
+import time
+import uuid
+
+from archipelcore import xmpp
+from archipelcore.dbentries import ARCHIPEL_ENTRIES_ENCODINGS, pack_entries, unpack_entries
+
+
+DOMAIN_TEMPLATE = """<domain type="kvm">
+  <name>%(name)s</name>
+  <uuid>%(uuid)s</uuid>
+  <description>%(uuid)s@archipel.local::::password</description>
+  <memory>1048576</memory>
+  <currentMemory>1048576</currentMemory>
+  <vcpu>2</vcpu>
+  <os><type arch="x86_64" machine="pc">hvm</type><boot dev="hd"/></os>
+  <features><acpi/><apic/><pae/></features>
+  <clock offset="utc"/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>destroy</on_crash>
+  <devices>
+    <emulator>/usr/bin/kvm</emulator>
+    <disk type="file" device="disk">
+      <driver name="qemu" type="qcow2" cache="none"/>
+      <source file="/vm/drives/%(uuid)s/disk0.qcow2"/>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+    <interface type="bridge">
+      <mac address="52:54:00:12:34:56"/>
+      <source bridge="br0"/>
+      <model type="virtio"/>
+    </interface>
+    <input type="tablet" bus="usb"/>
+    <graphics type="vnc" port="-1" autoport="yes" listen="0.0.0.0"/>
+  </devices>
+</domain>"""
+
+
+def build_entries(count):
+    """
+    Build a list of register_vms entries.
+    @type count: integer
+    @param count: number of entries
+    @rtype: list
+    @return: the entries
+    """
+    entries = []
+    for i in range(count):
+        vm_uuid = str(uuid.uuid4())
+        domain = xmpp.simplexml.NodeBuilder(data=DOMAIN_TEMPLATE % {"name": "vm-%d" % i, "uuid": vm_uuid}).getDom()
+        entries.append({"uuid": vm_uuid, "parker": None, "creation_date": None, "domain": domain,
+                        "hypervisor": "hypervisor@archipel.local/hypervisor", "name": "vm-%d" % i})
+    return entries
+
+def build_stanza(entries, encoding):
+    """
+    Pack the entries in a register_vms IQ and serialize it.
+    @rtype: string
+    @return: the serialized IQ
+    """
+    event = xmpp.Node(tag="event", attrs={"jid": "hypervisor@archipel.local/hypervisor"})
+    for node in pack_entries(entries, encoding):
+        event.addChild(node=node)
+    iq = xmpp.Iq(typ="set", queryNS="archipel:centralagent", to="centralagent@archipel.local/central")
+    iq.getTag("query").addChild(name="archipel", attrs={"action": "register_vms"})
+    iq.getTag("query").getTag("archipel").addChild(node=event)
+    return str(iq)
+
+def read_stanza(data):
+    """
+    Parse a serialized IQ and unpack its entries.
+    @rtype: list
+    @return: the entries
+    """
+    iq = xmpp.Iq(node=xmpp.simplexml.NodeBuilder(data=data).getDom())
+    return unpack_entries(iq.getTag("query").getTag("archipel").getTag("event"))
+
+def best_time(runs, function, *args):
+    """
+    Return the best duration of the given number of calls to function.
+    """
+    best = None
+    for i in range(runs):
+        start = time.time()
+        function(*args)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def run(runs):
+    """
+    Run the benchmark.
+    @type runs: integer
+    @param runs: number of runs of each measure, the best one is kept
+    """
+    print "%-8s %-10s %12s %12s %12s" % ("entries", "encoding", "size (KiB)", "pack (ms)", "unpack (ms)")
+    for count in (10, 100, 1000):
+        entries = build_entries(count)
+        for encoding in reversed(ARCHIPEL_ENTRIES_ENCODINGS):
+            data = build_stanza(entries, encoding)
+            if len(read_stanza(data)) != count:
+                raise Exception("%s encoding lost entries" % encoding)
+            pack_time = best_time(runs, build_stanza, entries, encoding)
+            unpack_time = best_time(runs, read_stanza, data)
+            print "%-8d %-10s %12.1f %12.2f %12.2f" % (count, encoding, len(data) / 1024.0, pack_time * 1000, unpack_time * 1000)
+
+
+if __name__ == "__main__":
+    runs = 5
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+    run(runs)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# test_dbreaderpool.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{TNDBReaderPool}, the read only connections to the central database.
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from threading import Thread
+
+from archipelcentral.archipelCentralAgent import TNDBReaderPool
+
+
+class FakeLog (object):
+    """
+    Keeps the logged errors.
+    """
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+
+class TestTNDBReaderPool (unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = os.path.join(self.folder, "central.db")
+        conn = sqlite3.connect(self.db)
+        conn.execute("create table hypervisors (jid text primary key, status text)")
+        conn.execute("insert into hypervisors values ('h1@x', 'Online')")
+        conn.commit()
+        conn.close()
+        self.log = FakeLog()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_read(self):
+        pool = TNDBReaderPool(self.db, self.log, size=2)
+        rows = pool.execute("select jid, status from hypervisors where status=?", ("Online",))
+        self.assertEqual(rows, [("h1@x", "Online")])
+        pool.close()
+
+    def test_connections_are_reused(self):
+        pool = TNDBReaderPool(self.db, self.log, size=2)
+        for i in range(5):
+            pool.execute("select * from hypervisors")
+        self.assertEqual(pool.opened, 1)
+        self.assertEqual(pool.connections.qsize(), 1)
+        pool.close()
+        self.assertTrue(pool.connections.empty())
+
+    def test_size_is_a_cap(self):
+        pool = TNDBReaderPool(self.db, self.log, size=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual(pool.opened, 2)
+        acquired = []
+        waiter = Thread(target=lambda: acquired.append(pool.acquire()))
+        waiter.start()
+        waiter.join(0.2)
+        # the pool is full, the third reader waits for a connection
+        self.assertTrue(waiter.isAlive())
+        pool.connections.put(first)
+        waiter.join(5)
+        self.assertEqual(acquired, [first])
+        self.assertEqual(pool.opened, 2)
+        pool.connections.put(first)
+        pool.connections.put(second)
+        pool.close()
+
+    def test_read_error(self):
+        pool = TNDBReaderPool(self.db, self.log, size=1)
+        self.assertEqual(pool.execute("select * from unknown"), [])
+        self.assertEqual(len(self.log.errors), 1)
+        # the connection went back to the pool
+        self.assertEqual(pool.execute("select jid from hypervisors"), [("h1@x",)])
+        pool.close()
+
+    def test_connection_that_cannot_be_opened(self):
+        pool = TNDBReaderPool(os.path.join(self.folder, "missing", "central.db"), self.log, size=1)
+        self.assertEqual(pool.execute("select * from hypervisors"), [])
+        self.assertEqual(pool.execute("select * from hypervisors"), [])
+        self.assertEqual(pool.opened, 0)
+        self.assertEqual(len(self.log.errors), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,17 +26,21 @@ This provides basic XMPP features, like connecting, auth...
 """
 
 import datetime
+import heapq
+import os
+import select
 import socket
 import sys
 import time
 import traceback
 import xmpp
-from pkg_resources import iter_entry_points,load_entry_point
+from threading import Lock
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelFileTransferCapableEntity import TNFileTransferCapableEntity
-from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelHookableEntity import TNHookableEntity, configure_hook_worker_pool
 from archipelcore.archipelPermissionCenter import TNArchipelPermissionCenter
+from archipelcore.archipelPlugin import TNArchipelLazyPlugin, get_plugin_factories, record_plugin_profile, resident_memory
 from archipelcore.archipelRosterQueryableEntity import TNRosterQueryableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
 from archipelcore.utils import TNArchipelLogger, build_error_iq, get_default_gateway_interface
@@ -67,6 +71,12 @@ ARCHIPEL_XMPP_LOOP_ON                       = 1
 ARCHIPEL_XMPP_LOOP_RESTART                  = 2
 ARCHIPEL_XMPP_LOOP_REMOVE_USER              = 3
 
+# maximum time the main loop waits for an event before looking at its status again
+ARCHIPEL_XMPP_LOOP_MAX_WAIT                 = 30.0
+
+# interval used to call on_xmpp_loop_tick of entities still overriding it
+ARCHIPEL_XMPP_LOOP_LEGACY_TICK_INTERVAL     = 3.0
+
 
 ARCHIPEL_MESSAGING_HELP_MESSAGE = """
 You can communicate with me using text commands, just like if you were chatting with your friends. \
@@ -117,6 +127,12 @@ class TNArchipelEntity (object):
         self.auto_reconnect         = auto_reconnect
         self.messages_registrar     = []
         self.isAuth                 = False
+        self.timers                 = []
+        self.timers_sequence        = 0
+        self.timers_lock            = Lock()
+        self.fd_callbacks           = {}
+        self.loop_waker             = None
+        self.loop_wakeup_pipe       = None
         self.loop_status            = ARCHIPEL_XMPP_LOOP_OFF
         self.pubsubserver           = self.configuration.get("GLOBAL", "xmpp_pubsub_server")
         self.log                    = TNArchipelLogger(self)
@@ -125,13 +141,20 @@ class TNArchipelEntity (object):
         self.pubSubNodeAdmins       = None
         self.entity_type            = "not-defined"
         self.plugins                = []
+        self.plugins_profile        = []
+        self.lazy_plugins           = True
         self.is_unregistering       = False
         self.use_avatar             = self.configuration.getboolean("GLOBAL", "use_avatar")
         self.permission_db_file     = "permissions.sqlite3"
         self.permission_admin_names = dict(map(lambda x: ("STATIC_%s" % x, x), self.configuration.get("GLOBAL", "archipel_root_admins").split()))
         self.permission_center      = TNArchipelPermissionCenter(root_admins=self.permission_admin_names)
 
+        if self.configuration.has_option("GLOBAL", "lazy_plugins"):
+            self.lazy_plugins = self.configuration.getboolean("GLOBAL", "lazy_plugins")
+
         if isinstance(self, TNHookableEntity):
+            if self.configuration.has_option("GLOBAL", "hooks_async_workers"):
+                configure_hook_worker_pool(self.configuration.getint("GLOBAL", "hooks_async_workers"))
             TNHookableEntity.__init__(self, self.log)
         if isinstance(self, TNAvatarControllableEntity):
             TNAvatarControllableEntity.__init__(self, configuration, self.permission_center, self.xmppclient, self.log)
@@ -155,6 +178,10 @@ class TNArchipelEntity (object):
             ## recover/create pubsub after connection
             self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", self.recover_pubsubs)
 
+        # entities that still override on_xmpp_loop_tick get it called periodically
+        if self.__class__.on_xmpp_loop_tick.im_func is not TNArchipelEntity.on_xmpp_loop_tick.im_func:
+            self.add_timer(ARCHIPEL_XMPP_LOOP_LEGACY_TICK_INTERVAL, self.on_xmpp_loop_tick)
+
         self.log.info("jid defined as %s" % (str(self.jid)))
 
         ip_conf = self.configuration.get("GLOBAL", "machine_ip")
@@ -171,7 +198,8 @@ class TNArchipelEntity (object):
 
     def initialize_modules(self, group):
         """
-        This will initialize all plugins.
+        This will initialize all plugins. Plugins declaring lazy-namespaces or
+        lazy-hooks in their plugin_info are instantiated on first use.
         @type group: string
         @param group: the name of the entry point group to load
         """
@@ -180,10 +208,13 @@ class TNArchipelEntity (object):
         if not loading_module_policy in ('restrictive', 'permissive'):
            self.log.error("PLUGIN: loading_module_policy in configuration must be set to 'restrictive' or 'permissive'. Consider this as a major failure.")
            return
-        for factory_method in iter_entry_points(group=group, name="factory"):
+        group_start = time.time()
+        for factory_method, plugin_infos, factory, error in get_plugin_factories(group):
+            if error:
+                self.log.error("PLUGIN: unable to load plugin %s: %s" % (str(factory_method), error))
+                continue
             try:
-                plugin_infos = load_entry_point(factory_method.dist, group="archipel.plugin", name="version")()
-                for plugin_info in plugin_infos[2]:
+                for plugin_info in plugin_infos:
                     if loading_module_policy == "restrictive":
                         if not self.configuration.has_option("MODULES", plugin_info["identifier"]):
                             self.log.info("PLUGIN: plugin %s has not been loaded as it is not defined in configuration and loading mode is restrictive." % plugin_info["identifier"])
@@ -206,20 +237,29 @@ class TNArchipelEntity (object):
                                 excluded_plugins.append(plugin_info["identifier"])
                                 self.log.error("PLUGIN: plugin %s needs configuration option with name %s" % (plugin_info["identifier"], needed_token))
                                 self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
-                    method = factory_method.load()
-                    for plugin in method(self.configuration, self, group):
+                    if self.lazy_plugins and (plugin_info.get("lazy-namespaces") or plugin_info.get("lazy-hooks")):
+                        self.plugins.append({"info": plugin_info, "plugin": TNArchipelLazyPlugin(self.configuration, self, group, plugin_info, factory)})
+                        self.log.info("PLUGIN: plugin %s will be loaded on first use" % plugin_info["identifier"])
+                        continue
+                    memory = resident_memory()
+                    start = time.time()
+                    for plugin in factory(self.configuration, self, group):
                         if (plugin["info"]["identifier"] == plugin_info["identifier"]):
                             self.plugins.append(plugin)
-                            self.log.info("PLUGIN: loaded plugin %s " % plugin_info["identifier"])
+                            profile = record_plugin_profile(group, plugin_info["identifier"], time.time() - start, resident_memory() - memory)
+                            self.plugins_profile.append(profile)
+                            self.log.info("PLUGIN: loaded plugin %s in %.1fms" % (plugin_info["identifier"], profile["duration"] * 1000))
             except Exception as ex:
                 self.log.error("PLUGIN: unable to load plugin %s: %s" % (str(factory_method), str(ex)))
                 t, v, tr = sys.exc_info()
                 self.log.debug("\n".join(traceback.format_exception(t,v,tr)))
+        self.log.info("PLUGIN: plugins of group %s initialized in %.1fms" % (group, (time.time() - group_start) * 1000))
         self.perform_hooks("HOOK_ARCHIPELENTITY_PLUGIN_ALL_LOADED")
 
     def get_plugin(self, identifier):
         """
-        Return the plugin object with given identifier.
+        Return the plugin object with given identifier. A plugin
+        not loaded yet is loaded.
         @type identifier: string
         @param identifier: the identifier of the plugin
         @rtype: object
@@ -227,6 +267,8 @@ class TNArchipelEntity (object):
         """
         for plugin in self.plugins:
             if plugin["info"]["identifier"] == identifier:
+                if isinstance(plugin["plugin"], TNArchipelLazyPlugin):
+                    return plugin["plugin"].load()
                 return plugin["plugin"]
         return None
 
@@ -272,6 +314,8 @@ class TNArchipelEntity (object):
         Overrides this to add custom permissions.
         """
         self.log.info("initializing permissions of %s" % self.jid)
+        if isinstance(self, TNHookableEntity):
+            TNHookableEntity.init_permissions(self)
         if isinstance(self, TNTaggableEntity):
             TNTaggableEntity.init_permissions(self)
         if isinstance(self, TNAvatarControllableEntity):
@@ -287,6 +331,7 @@ class TNArchipelEntity (object):
         self.permission_center.create_permission("permission_list", "Authorizes users to list existing", False)
         self.permission_center.create_permission("permission_set", "Authorizes users to set all permissions", False)
         self.permission_center.create_permission("permission_setown", "Authorizes users to set only own permissions", False)
+        self.permission_center.create_permission("permission_cachestats", "Authorizes users to get the statistics of the permission cache", False)
         self.permission_center.create_permission("subscription_add", "Authorizes users add others in entity roster", False)
         self.permission_center.create_permission("subscription_remove", "Authorizes users remove others in entity roster", False)
         self.log.info("permissions of %s initialized" % self.jid)
@@ -481,6 +526,8 @@ class TNArchipelEntity (object):
         This method have to be overloaded in order to register handler for
         XMPP events.
         """
+        if isinstance(self, TNHookableEntity):
+            TNHookableEntity.register_handlers(self)
         if isinstance(self, TNTaggableEntity):
             TNTaggableEntity.register_handlers(self)
         if isinstance(self, TNAvatarControllableEntity):
@@ -504,6 +551,8 @@ class TNArchipelEntity (object):
         """
         Unregister all XMPP handlers.
         """
+        if isinstance(self, TNHookableEntity):
+            TNHookableEntity.unregister_handlers(self)
         if isinstance(self, TNTaggableEntity):
             TNTaggableEntity.unregister_handlers(self)
         if isinstance(self, TNAvatarControllableEntity):
@@ -691,7 +740,13 @@ class TNArchipelEntity (object):
         push = xmpp.Node(tag="push", attrs={"date": datetime.datetime.now(), "xmlns": ns, "change": change})
         for content_node in content_nodes:
             push.addChild(node=content_node)
-        self.pubSubNodeEvent.add_item(push)
+        # a push without content only tells clients to refresh, so a queued
+        # identical push that has not been sent yet can be replaced by this one
+        coalesce_key = None
+        if not content_nodes:
+            coalesce_key = (ns, change)
+        if not self.pubSubNodeEvent.publish(push, coalesce_key=coalesce_key):
+            self.log.warning("PUSH : event publish queue is congested: %s" % str(self.pubSubNodeEvent.get_publish_queue().get_statistics()))
 
     def shout(self, subject, message):
         """
@@ -1116,6 +1171,7 @@ class TNArchipelEntity (object):
             - list
             - set
             - setown
+            - cachestats
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -1135,6 +1191,8 @@ class TNArchipelEntity (object):
             reply = self.iq_get_permission(iq, onlyown=False)
         elif action == "getown":
             reply = self.iq_get_permission(iq, onlyown=True)
+        elif action == "cachestats":
+            reply = self.iq_permission_cache_statistics(iq)
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
@@ -1234,12 +1292,203 @@ class TNArchipelEntity (object):
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_LIST_PERMISSIONS)
         return reply
 
+    def iq_permission_cache_statistics(self, iq):
+        """
+        Return the statistics of the permission decision cache.
+        @type iq: xmpp.Node
+        @param iq: the original request IQ
+        """
+        try:
+            reply = iq.buildReply("result")
+            statistics = xmpp.Node("statistics")
+            for key, value in self.permission_center.get_cache_statistics().iteritems():
+                statistics.addChild("item", attrs={"key": key, "value": value})
+            reply.setQueryPayload([statistics])
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_LIST_PERMISSIONS)
+        return reply
+
+    ### Loop status
+
+    def get_loop_status(self):
+        """
+        @rtype: integer
+        @return: the current ARCHIPEL_XMPP_LOOP_* status
+        """
+        return self._loop_status
+
+    def set_loop_status(self, status):
+        """
+        Set the loop status and wake up the loop so it is taken into account immediately.
+        @type status: integer
+        @param status: the new ARCHIPEL_XMPP_LOOP_* status
+        """
+        self._loop_status = status
+        self.wake_up_loop()
+
+    loop_status = property(get_loop_status, set_loop_status)
+
+    def wake_up_loop(self):
+        """
+        Interrupt the wait of the loop running this entity.
+        """
+        if self.loop_waker:
+            self.loop_waker()
+        elif self.loop_wakeup_pipe:
+            try:
+                os.write(self.loop_wakeup_pipe[1], "x")
+            except OSError:
+                pass
+
+
+    ### Timers and file descriptors
+
+    def add_timer(self, interval, callback, repeat=True):
+        """
+        Register a timer. Timers are run by the loop of the entity
+        only when it is connected.
+        @type interval: float
+        @param interval: the number of seconds before firing
+        @type callback: function
+        @param callback: the method to call, without argument
+        @type repeat: Boolean
+        @param repeat: if False, the timer is fired only once
+        @rtype: dict
+        @return: the timer, to be given to remove_timer
+        """
+        timer = {"interval": interval, "callback": callback, "repeat": repeat, "cancelled": False}
+        self.timers_lock.acquire()
+        self.timers_sequence += 1
+        heapq.heappush(self.timers, (time.time() + interval, self.timers_sequence, timer))
+        self.timers_lock.release()
+        self.wake_up_loop()
+        return timer
+
+    def remove_timer(self, timer):
+        """
+        Cancel a timer.
+        @type timer: dict
+        @param timer: the timer returned by add_timer
+        """
+        timer["cancelled"] = True
+
+    def register_fd_callback(self, fd, callback):
+        """
+        Register a callback called by the loop when fd is readable.
+        @type fd: integer
+        @param fd: the file descriptor to watch
+        @type callback: function
+        @param callback: the method to call, with the fd as argument
+        """
+        self.fd_callbacks[fd] = callback
+        self.wake_up_loop()
+
+    def unregister_fd_callback(self, fd):
+        """
+        Stop watching the given fd.
+        @type fd: integer
+        @param fd: the file descriptor
+        """
+        if fd in self.fd_callbacks:
+            del self.fd_callbacks[fd]
+
+    def run_due_timers(self):
+        """
+        Fire all the timers that have expired.
+        @rtype: float
+        @return: number of seconds before the next timer, or None if there is no timer
+        """
+        now = time.time()
+        due = []
+        self.timers_lock.acquire()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            deadline, sequence, timer = heapq.heappop(self.timers)
+            if timer["cancelled"]:
+                continue
+            due.append(timer)
+            if timer["repeat"]:
+                self.timers_sequence += 1
+                heapq.heappush(self.timers, (max(deadline + timer["interval"], now), self.timers_sequence, timer))
+        self.timers_lock.release()
+
+        for timer in due:
+            if timer["cancelled"]:
+                continue
+            try:
+                timer["callback"]()
+            except Exception as ex:
+                self.log.error("LOOP: error while running timer %s: %s" % (timer["callback"], str(ex)))
+                t, v, tr = sys.exc_info()
+                self.log.debug("TRACEBACK: %s" % "\n".join(traceback.format_exception(t, v, tr)))
+
+        return self.next_timer_timeout()
+
+    def next_timer_timeout(self):
+        """
+        Drop the cancelled timers at the head of the queue, without firing anything.
+        @rtype: float
+        @return: number of seconds before the next timer (0 if it is due), or None if there is no timer
+        """
+        self.timers_lock.acquire()
+        while len(self.timers) > 0 and self.timers[0][2]["cancelled"]:
+            heapq.heappop(self.timers)
+        next_timeout = None
+        if len(self.timers) > 0:
+            next_timeout = max(0, self.timers[0][0] - time.time())
+        self.timers_lock.release()
+        return next_timeout
+
+    def xmpp_stream_fileno(self):
+        """
+        @rtype: integer
+        @return: the file descriptor of the XMPP stream
+        """
+        return self.xmppclient.Connection._sock.fileno()
+
+    def xmpp_stream_has_buffered_data(self):
+        """
+        @rtype: Boolean
+        @return: True if the TLS layer holds decrypted data that select() will not report
+        """
+        ssl_object = getattr(self.xmppclient.Connection, "_sslObj", None)
+        if ssl_object and hasattr(ssl_object, "pending"):
+            return ssl_object.pending() > 0
+        return False
+
+    def process_events(self):
+        """
+        Fire expired timers and wait for the next event: data on the
+        XMPP stream, a registered fd, a timer or a wake up.
+        """
+        timeout = self.run_due_timers()
+        if timeout is None or timeout > ARCHIPEL_XMPP_LOOP_MAX_WAIT:
+            timeout = ARCHIPEL_XMPP_LOOP_MAX_WAIT
+
+        buffered = self.xmpp_stream_has_buffered_data()
+        if buffered:
+            timeout = 0
+
+        stream_fd = self.xmpp_stream_fileno()
+        watched = [stream_fd, self.loop_wakeup_pipe[0]] + self.fd_callbacks.keys()
+        ready = select.select(watched, [], [], timeout)[0]
+
+        if self.loop_wakeup_pipe[0] in ready:
+            os.read(self.loop_wakeup_pipe[0], 4096)
+        for fd in ready:
+            if fd in self.fd_callbacks:
+                self.fd_callbacks[fd](fd)
+        if buffered or stream_fd in ready:
+            self.xmppclient.Process(0)
+
+
     ### Loop
 
     def loop(self):
         """
         This is the main loop of the client.
         """
+        if not self.loop_wakeup_pipe:
+            self.loop_wakeup_pipe = os.pipe()
         while not self.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
             try:
                 if self.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
@@ -1247,9 +1496,7 @@ class TNArchipelEntity (object):
                     return
                 if self.loop_status == ARCHIPEL_XMPP_LOOP_ON:
                     if self.xmppclient.isConnected():
-                        if hasattr(self, "on_xmpp_loop_tick"):
-                            self.on_xmpp_loop_tick()
-                        self.xmppclient.Process(3)
+                        self.process_events()
                 elif self.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
                     if self.xmppclient.isConnected():
                         self.xmppclient.disconnect()
@@ -1257,25 +1504,36 @@ class TNArchipelEntity (object):
                     self.connect()
 
             except Exception as ex:
-                if str(ex).upper().find('USER REMOVED') > -1:
-                    self.log.info("LOOP EXCEPTION: Account has been removed from server.")
-                    self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
-                else:
-                    if  str(ex).upper().find('SYSTEM-SHUTDOWN') > -1:
-                        self.log.warning("LOOP EXCEPTION: The XMPP server has been shut down. Waiting 5 second for reconnection")
-                    else:
-                        self.log.error("LOOP EXCEPTION : Disconnected from server. Trying to reconnect in 5 seconds.")
-                        t, v, tr = sys.exc_info()
-                        self.log.error("TRACEBACK: %s" % "\n".join(traceback.format_exception(t, v, tr)))
-                    self.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+                self.handle_xmpp_loop_exception(ex)
+                if self.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
                     time.sleep(5.0)
 
         if self.xmppclient.isConnected():
             self.xmppclient.disconnect()
 
+    def handle_xmpp_loop_exception(self, ex):
+        """
+        Update the loop status according to an exception raised
+        while processing the XMPP stream. This is used by the loop
+        and by L{TNXMPPMultiplexer} when the entity is multiplexed.
+        @type ex: Exception
+        @param ex: the raised exception
+        """
+        if str(ex).upper().find('USER REMOVED') > -1:
+            self.log.info("LOOP EXCEPTION: Account has been removed from server.")
+            self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+        else:
+            if  str(ex).upper().find('SYSTEM-SHUTDOWN') > -1:
+                self.log.warning("LOOP EXCEPTION: The XMPP server has been shut down. Waiting 5 second for reconnection")
+            else:
+                self.log.error("LOOP EXCEPTION : Disconnected from server. Trying to reconnect in 5 seconds.")
+                t, v, tr = sys.exc_info()
+                self.log.error("TRACEBACK: %s" % "\n".join(traceback.format_exception(t, v, tr)))
+            self.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+
     def on_xmpp_loop_tick(self):
         """
-        override it in subclass if you want to do something
-        in each executiong of run loop
+        Deprecated: use add_timer instead. If overridden in a subclass,
+        it is called every ARCHIPEL_XMPP_LOOP_LEGACY_TICK_INTERVAL seconds.
         """
         pass
@@ -19,8 +19,142 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import sys
+import time
 import traceback
+from collections import deque
+from threading import Thread, Lock
+from Queue import Queue
+
+from archipelcore.utils import build_error_iq
+from archipelcore import xmpp
+
+
+ARCHIPEL_NS_HOOKS                   = "archipel:hooks"
+ARCHIPEL_ERROR_CODE_HOOKS_TIMINGS   = -10
+
+# methods with a lower priority are performed first
+ARCHIPEL_HOOK_PRIORITY_DEFAULT      = 50
+
+# default number of threads performing the asynchronous hook methods
+ARCHIPEL_HOOK_ASYNC_WORKERS         = 4
+
+# number of durations kept per hook method to compute percentiles
+ARCHIPEL_HOOK_TIMING_SAMPLES        = 256
+
+
+class TNHookWorkerPool (object):
+    """
+    Bounded pool of threads performing the asynchronous hook methods
+    of all the entities of the process.
+    """
+
+    def __init__(self, size):
+        """
+        The contructor of the class.
+        @type size: integer
+        @param size: the number of threads
+        """
+        self.jobs = Queue()
+        self.workers = []
+        for i in range(max(1, size)):
+            worker = Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, entity, hookname, info, arguments):
+        """
+        Queue a hook method.
+        """
+        self.jobs.put((entity, hookname, info, arguments))
+
+    def work(self):
+        """
+        Perform the queued hook methods.
+        """
+        while True:
+            entity, hookname, info, arguments = self.jobs.get()
+            entity.perform_hook_method(hookname, info, arguments)
+
+hook_worker_pool_size = ARCHIPEL_HOOK_ASYNC_WORKERS
+hook_worker_pool = None
+hook_worker_pool_lock = Lock()
+
+def configure_hook_worker_pool(size):
+    """
+    Set the number of threads of the hook worker pool. Must be called before the first asynchronous hook.
+    @type size: integer
+    @param size: the number of threads
+    """
+    global hook_worker_pool_size
+    hook_worker_pool_size = size
+
+def get_hook_worker_pool():
+    """
+    @rtype: L{TNHookWorkerPool}
+    @return: the pool shared by all entities, created on first use
+    """
+    global hook_worker_pool
+    if not hook_worker_pool:
+        hook_worker_pool_lock.acquire()
+        try:
+            if not hook_worker_pool:
+                hook_worker_pool = TNHookWorkerPool(hook_worker_pool_size)
+        finally:
+            hook_worker_pool_lock.release()
+    return hook_worker_pool
+
+
+class TNHookTiming (object):
+    """
+    Durations of a hook method.
+    """
+
+    def __init__(self):
+        """
+        The contructor of the class.
+        """
+        self.calls   = 0
+        self.errors  = 0
+        self.total   = 0.0
+        self.max     = 0.0
+        self.samples = deque(maxlen=ARCHIPEL_HOOK_TIMING_SAMPLES)
+        self.lock    = Lock()
+
+    def add(self, duration, error=False):
+        """
+        Record a call.
+        @type duration: float
+        @param duration: the duration in seconds
+        @type error: Boolean
+        @param error: True if the method raised an exception
+        """
+        self.lock.acquire()
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.samples.append(duration)
+        self.lock.release()
+
+    def to_dict(self):
+        """
+        @rtype: dict
+        @return: the number of calls and errors, the total, average and max durations
+                 and the 50th, 95th and 99th percentiles of the last durations
+        """
+        self.lock.acquire()
+        samples = sorted(self.samples)
+        ret = {"calls": self.calls, "errors": self.errors, "total": self.total, "max": self.max,
+               "average": self.calls and self.total / self.calls or 0.0}
+        self.lock.release()
+        for percentile in (50, 95, 99):
+            ret["p%d" % percentile] = samples and samples[min(len(samples) - 1, len(samples) * percentile / 100)] or 0.0
+        return ret
 
 
 class TNHookableEntity (object):
@@ -34,8 +168,42 @@ class TNHookableEntity (object):
         @type log: TNArchipelLog
         @param log: the logger of the entity
         """
-        self.hooks  = {}
-        self.log    = log
+        self.hooks          = {}
+        self.hooks_garbage  = {}
+        self.hooks_sequence = 0
+        self.hooks_lock     = Lock()
+        self.hooks_timings  = {}
+        self.log            = log
+
+    ### subclass must implement this
+
+    def check_acp(conn, iq):
+        """
+        Function that verify if the ACP is valid.
+        @type conn: xmpp.Dispatcher
+        @param conn: the connection
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the IQ to check
+        @raise Exception: Exception if not implemented
+        """
+        raise Exception("Subclass of TNHookableEntity must implement check_acp.")
+
+    def check_perm(self, conn, stanza, action_name, error_code=-1, prefix=""):
+        """
+        function that verify if the permissions are granted
+        @type conn: xmpp.Dispatcher
+        @param conn: the connection
+        @type stanza: xmpp.Node
+        @param stanza: the stanza containing the action
+        @type action_name: string
+        @param action_name: the action to check
+        @type error_code: int
+        @param error_code: the error code to return
+        @type prefix: string
+        @param prefix: the prefix of the action
+        @raise Exception: Exception if not implemented
+        """
+        raise Exception("Subclass of TNHookableEntity must implement check_perm.")
 
     # Hooks management
 
@@ -45,8 +213,11 @@ class TNHookableEntity (object):
         @type hookname: string
         @param hookname: the name of the new hook
         """
+        self.hooks_lock.acquire()
         self.hooks[hookname] = []
-        self.log.info("HOOK: creating hook with name %s" % hookname)
+        self.hooks_garbage[hookname] = 0
+        self.hooks_lock.release()
+        self.log.debug("HOOK: creating hook with name %s" % hookname)
         return True
 
     def remove_hook(self, hookname):
@@ -58,15 +229,20 @@ class TNHookableEntity (object):
         @rtype: boolean
         @return: True in case of success
         """
-        if hookname not in self.hooks:
-            return False
-        for hook in self.hooks[hookname]:
-            self.hooks[hookname].remove(hook)
-        del self.hooks[hookname]
+        self.hooks_lock.acquire()
+        try:
+            if hookname not in self.hooks:
+                return False
+            for priority, registration_id, info in self.hooks[hookname]:
+                info["active"] = False
+            del self.hooks[hookname]
+            del self.hooks_garbage[hookname]
+        finally:
+            self.hooks_lock.release()
         self.log.info("HOOK: removing hook with name %s" % hookname)
         return True
 
-    def register_hook(self, hookname, method, user_info=None, oneshot=False):
+    def register_hook(self, hookname, method, user_info=None, oneshot=False, priority=ARCHIPEL_HOOK_PRIORITY_DEFAULT, asynchronous=False):
         """
         Register a method that will be triggered by a hook. The methood must use
         the following prototype: method(origin, user_info, arguments).
@@ -78,12 +254,42 @@ class TNHookableEntity (object):
         @param user_info: user info you want to pass to the method when it'll be peformed
         @type oneshot: boolean
         @param oneshot: if True, the method will be unregistered after first performing
+        @type priority: integer
+        @param priority: methods with lower priority are performed first. Methods with the
+                         same priority are performed in registration order
+        @type asynchronous: boolean
+        @param asynchronous: if True, the method is performed by the hook worker pool and
+                             perform_hooks does not wait for it. Use it for methods that
+                             may block and whose result is not needed by the caller
+        @rtype: dict
+        @return: the registration, that can be given to unregister_hook_registration
         """
         # If the hook is not existing, we create it.
         if hookname not in self.hooks:
             self.create_hook(hookname)
-        self.hooks[hookname].append({"method": method, "oneshot": oneshot, "user_info": user_info})
-        self.log.info("HOOK: registering hook method %s for hook name %s (oneshot: %s)" % (method.__name__, hookname, str(oneshot)))
+        self.hooks_lock.acquire()
+        self.hooks_sequence += 1
+        info = {"method": method, "oneshot": oneshot, "user_info": user_info, "priority": priority,
+                "asynchronous": asynchronous, "active": True, "hookname": hookname}
+        bisect.insort(self.hooks[hookname], (priority, self.hooks_sequence, info))
+        self.hooks_lock.release()
+        self.log.debug("HOOK: registering hook method %s for hook name %s (oneshot: %s, priority: %d, asynchronous: %s)" % (method.__name__, hookname, str(oneshot), priority, str(asynchronous)))
+        return info
+
+    def unregister_hook_registration(self, info):
+        """
+        Unregister a method using the registration returned by register_hook.
+        The registration is only flagged, and it is removed from the
+        list during the next perform_hooks, so this costs O(1).
+        @type info: dict
+        @param info: the registration
+        """
+        self.hooks_lock.acquire()
+        if info["active"]:
+            info["active"] = False
+            if info["hookname"] in self.hooks_garbage:
+                self.hooks_garbage[info["hookname"]] += 1
+        self.hooks_lock.release()
 
     def unregister_hook(self, hookname, method):
         """
@@ -97,41 +303,175 @@ class TNHookableEntity (object):
         """
         if hookname not in self.hooks:
             return False
-        for hook in self.hooks[hookname]:
-            if hook["method"] == method:
-                self.hooks[hookname].remove(hook)
+        for priority, registration_id, info in self.hooks[hookname]:
+            if info["active"] and info["method"] == method:
+                self.unregister_hook_registration(info)
                 break
         self.log.info("HOOK: unregistering hook method %s for hook name %s" % (method.__name__, hookname))
         return True
 
     def perform_hooks(self, hookname, arguments=None):
         """
-        Perform all registered methods for the given hook.
+        Perform all registered methods for the given hook, by order of priority.
+        Asynchronous methods are queued to the hook worker pool.
         @type hookname: string
         @param hookname: the name of the hook
         @type arguments: object
         @param arguments: random object that will be given to the registered methods as "argument" kargs
         """
-        self.log.info("HOOK: going to run methods for hook %s" % hookname)
-        hook_to_remove = []
-        if hookname not in self.hooks:
-            self.log.warning("No hook with name %s found" % hookname)
-            return
-        for info in self.hooks[hookname]:
-            m           = info["method"]
-            oneshot     = info["oneshot"]
-            user_info   = info["user_info"]
-            try:
-                self.log.debug("HOOK: performing method %s registered in hook with name %s and user_info: %s (oneshot: %s)" % (m.__name__, hookname, str(user_info), str(oneshot)))
-                m(self, user_info, arguments)
-                if oneshot:
-                    self.log.info("HOOK: this hook was oneshot. Registering for deletion.")
-                    hook_to_remove.append(m)
-            except Exception as ex:
-                    self.log.error("HOOK: error when performing method %s for hookname %s: %s" % (m.__name__, hookname, str(ex)))
-                    t, v, tr = sys.exc_info()
-                    self.log.debug("\n".join(traceback.format_exception(t,v,tr)))
-
-        for hook_method in hook_to_remove:
-            self.log.info("HOOK: removing registred hook for deletion %s" % (hook_method.__name__))
-            self.unregister_hook(hookname, hook_method)
+        self.hooks_lock.acquire()
+        try:
+            if hookname not in self.hooks:
+                self.log.warning("No hook with name %s found" % hookname)
+                return
+            if self.hooks_garbage[hookname] > 0:
+                self.hooks[hookname] = [registration for registration in self.hooks[hookname] if registration[2]["active"]]
+                self.hooks_garbage[hookname] = 0
+            # methods registered by the performed ones must not be performed now
+            registrations = list(self.hooks[hookname])
+        finally:
+            self.hooks_lock.release()
+
+        self.log.debug("HOOK: going to run %d methods for hook %s" % (len(registrations), hookname))
+        self.perform_hook_registrations(hookname, registrations, arguments)
+
+    def perform_hook_registrations(self, hookname, registrations, arguments):
+        """
+        Perform the given registered methods of a hook.
+        @type hookname: string
+        @param hookname: the name of the hook
+        @type registrations: list
+        @param registrations: list of (priority, id, registration), as stored in self.hooks
+        @type arguments: object
+        @param arguments: the arguments given to perform_hooks
+        """
+        for priority, registration_id, info in registrations:
+            if not info["active"]:
+                continue
+            if info["asynchronous"]:
+                if info["oneshot"]:
+                    self.unregister_hook_registration(info)
+                get_hook_worker_pool().submit(self, hookname, info, arguments)
+            elif self.perform_hook_method(hookname, info, arguments) and info["oneshot"]:
+                self.log.debug("HOOK: removing oneshot method %s from hook %s" % (info["method"].__name__, hookname))
+                self.unregister_hook_registration(info)
+
+    def perform_hook_method(self, hookname, info, arguments):
+        """
+        Perform one registered method and record its duration.
+        @type hookname: string
+        @param hookname: the name of the hook
+        @type info: dict
+        @param info: the registration
+        @type arguments: object
+        @param arguments: the arguments given to perform_hooks
+        @rtype: Boolean
+        @return: True if the method succeeded
+        """
+        m = info["method"]
+        error = False
+        start = time.time()
+        try:
+            m(self, info["user_info"], arguments)
+        except Exception as ex:
+            error = True
+            self.log.error("HOOK: error when performing method %s for hookname %s: %s" % (m.__name__, hookname, str(ex)))
+            t, v, tr = sys.exc_info()
+            self.log.debug("\n".join(traceback.format_exception(t,v,tr)))
+        self.hook_timing(hookname, m).add(time.time() - start, error)
+        return not error
+
+    # Timings
+
+    def hook_timing(self, hookname, method):
+        """
+        Return the timing of a hook method, created if needed.
+        @type hookname: string
+        @param hookname: the name of the hook
+        @type method: function
+        @param method: the method
+        @rtype: L{TNHookTiming}
+        @return: the timing
+        """
+        if hasattr(method, "im_self") and method.im_self is not None:
+            method_name = "%s.%s" % (method.im_self.__class__.__name__, method.__name__)
+        else:
+            method_name = method.__name__
+        key = (hookname, method_name)
+        timing = self.hooks_timings.get(key, None)
+        if not timing:
+            timing = self.hooks_timings.setdefault(key, TNHookTiming())
+        return timing
+
+    def get_hooks_timings(self):
+        """
+        Return the timings of all hook methods that have been performed, the slowest first.
+        @rtype: list
+        @return: list of dict containing hook, method and the values of L{TNHookTiming}.to_dict
+        """
+        timings = []
+        for (hookname, method_name), timing in self.hooks_timings.items():
+            values = timing.to_dict()
+            values["hook"] = hookname
+            values["method"] = method_name
+            timings.append(values)
+        timings.sort(key=lambda values: values["total"], reverse=True)
+        return timings
+
+    # XMPP
+
+    def init_permissions(self):
+        """
+        Initialize the hooks permissions.
+        """
+        self.permission_center.create_permission("hooks_timings", "Authorizes users to get the timings of the hooks", False)
+
+    def register_handlers(self):
+        """
+        Initialize the handlers for hooks.
+        """
+        self.xmppclient.RegisterHandler('iq', self.process_hooks_iq, ns=ARCHIPEL_NS_HOOKS)
+
+    def unregister_handlers(self):
+        """
+        Unregister the handlers for hooks.
+        """
+        self.xmppclient.UnregisterHandler('iq', self.process_hooks_iq, ns=ARCHIPEL_NS_HOOKS)
+
+    def process_hooks_iq(self, conn, iq):
+        """
+        This method is invoked when a ARCHIPEL_NS_HOOKS IQ is received.
+        It understands IQ of type:
+            - timings
+        @type conn: xmpp.Dispatcher
+        @param conn: ths instance of the current connection that send the stanza
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        """
+        action = self.check_acp(conn, iq)
+        self.check_perm(conn, iq, action, -1, prefix="hooks_")
+        if action == "timings":
+            reply = self.iq_hooks_timings(iq)
+            conn.send(reply)
+            raise xmpp.protocol.NodeProcessed
+
+    def iq_hooks_timings(self, iq):
+        """
+        Return the timings of the hook methods. Durations are in milliseconds.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: the reply
+        """
+        try:
+            reply = iq.buildReply("result")
+            nodes = []
+            for values in self.get_hooks_timings():
+                attrs = {"hook": values["hook"], "method": values["method"], "calls": values["calls"], "errors": values["errors"]}
+                for key in ("total", "average", "max", "p50", "p95", "p99"):
+                    attrs[key] = "%.3f" % (values[key] * 1000)
+                nodes.append(xmpp.Node("timing", attrs=attrs))
+            reply.setQueryPayload(nodes)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HOOKS_TIMINGS)
+        return reply
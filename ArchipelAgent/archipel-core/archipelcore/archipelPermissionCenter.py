@@ -20,11 +20,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, create_engine
+from threading import Lock
+
+import sqlite3
+
+from sqlalchemy import Table, Column, Integer, String, ForeignKey, MetaData, create_engine, select, and_, literal, union_all
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, backref
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool
 
 Base = declarative_base()
 
@@ -63,6 +68,28 @@ class TNArchipelPermission (Base):
         return "<TNArchipelPermission('%s', '%s', '%s')>" % (self.name, self.description, self.defaultValue)
 
 
+# tables of the permission store shared by several entities
+shared_metadata = MetaData()
+
+entities_permissions = Table('entities_permissions', shared_metadata,
+    Column('entity', String, primary_key=True),
+    Column('name', String, primary_key=True),
+    Column('description', String),
+    Column('defaultValue', Integer)
+)
+
+entities_users = Table('entities_users', shared_metadata,
+    Column('entity', String, primary_key=True),
+    Column('name', String, primary_key=True)
+)
+
+entities_users_have_permissions = Table('entities_users_have_permissions', shared_metadata,
+    Column('entity', String, primary_key=True),
+    Column('user', String, primary_key=True),
+    Column('permission', String, primary_key=True)
+)
+
+
 class TNArchipelPermissionCenter:
 
     def __init__(self, database_file=None, root_admins={}):
@@ -79,6 +106,13 @@ class TNArchipelPermissionCenter:
         self.metadata = None
         self.session = None
 
+        # decision cache: user name -> permission name -> Boolean
+        self.decisions = {}
+        self.decisions_lock = Lock()
+        self.decisions_generation = 0
+        self.decisions_hits = 0
+        self.decisions_misses = 0
+
     def start(self, database_file=None, root_admins={}):
         """
         Start the connection and be ready to use permissions
@@ -93,6 +127,7 @@ class TNArchipelPermissionCenter:
         self.metadata = Base.metadata
         self.metadata.create_all(self.engine)
         self.session = sessionmaker(bind=self.engine)
+        self.preload_decisions()
 
     def create_session(self):
         """
@@ -110,6 +145,7 @@ class TNArchipelPermissionCenter:
         @type new_account: String
         @param new_account: the JID of the new admin account
         """
+        # admins are checked before the decision cache, no need to invalidate it
         if not new_account in self.root_admins.values():
             self.root_admins[key] = new_account
 
@@ -150,6 +186,7 @@ class TNArchipelPermissionCenter:
             p = TNArchipelPermission(name, description, default_permission)
             session.add(p)
             session.commit()
+            self.invalidate_decisions()
             if not currentsession: session.close()
             return True
         except IntegrityError:
@@ -186,6 +223,7 @@ class TNArchipelPermissionCenter:
             p = self.get_permission(name, currentsession=session)
             session.delete(p)
             session.commit()
+            self.invalidate_decisions()
             if not currentsession: session.close()
             return True
         except NoResultFound:
@@ -219,6 +257,7 @@ class TNArchipelPermissionCenter:
             u = TNArchipelUser(name)
             session.add(u)
             session.commit()
+            self.invalidate_decisions(name)
             if not currentsession: session.close()
             return u
         except IntegrityError:
@@ -255,6 +294,7 @@ class TNArchipelPermissionCenter:
             u = session.query(TNArchipelUser).filter(TNArchipelUser.name == name).one()
             session.delete(u)
             session.commit()
+            self.invalidate_decisions(name)
             if not currentsession: session.close()
             return True
         except NoResultFound:
@@ -279,6 +319,7 @@ class TNArchipelPermissionCenter:
         if not (p in u.permissions):
             u.permissions.append(p)
             session.commit()
+        self.invalidate_decisions(user_name)
         if not currentsession: session.close()
         return True
 
@@ -302,6 +343,7 @@ class TNArchipelPermissionCenter:
             return True
         u.permissions.remove(p)
         session.commit()
+        self.invalidate_decisions(user_name)
         if not currentsession: session.close()
         return True
 
@@ -349,7 +391,8 @@ class TNArchipelPermissionCenter:
 
     def check_permission(self, user_name, permission_name):
         """
-        Check if given user has given permission.
+        Check if given user has given permission. Decisions are cached until
+        the permissions of the user change.
         @type user_name: string
         @param user_name: the name of the user
         @type permission_name: string
@@ -357,21 +400,73 @@ class TNArchipelPermissionCenter:
         @rtype: Boolean
         @return: True in case of success
         """
-        permObject = self.get_permission(permission_name)
         if user_name in self.root_admins.values():
             return True
-        if self.user_has_permission(user_name, "all"):
-            return True
-        if not self.get_user(user_name):
-            if permObject and permObject.defaultValue == 1:
-                return True
-            else:
-                return False
-        if not permObject:
-            return False
-        if self.user_has_permission(user_name, permission_name):
+        decision = self.decisions.get(user_name, {}).get(permission_name, None)
+        if decision is not None:
+            self.decisions_hits += 1
+            return decision
+        self.decisions_misses += 1
+        generation = self.decisions_generation
+        user_permissions, default_value = self.read_decision_inputs(user_name, permission_name)
+        decision = self.decide(user_permissions, permission_name, default_value)
+        self.store_decision(generation, user_name, permission_name, decision)
+        return decision
+
+    def read_decision_inputs(self, user_name, permission_name):
+        """
+        Read what is needed to decide if a user has a permission, in one session.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @rtype: tuple
+        @return: (names of the permissions of the user or None if the user is unknown,
+                  default value of the permission or None if the permission does not exist)
+        """
+        session = self.create_session()
+        try:
+            permission = session.query(TNArchipelPermission).filter(TNArchipelPermission.name == permission_name).first()
+            user = session.query(TNArchipelUser).filter(TNArchipelUser.name == user_name).first()
+            return user and [p.name for p in user.permissions], permission and permission.defaultValue
+        finally:
+            session.close()
+
+    def read_all_decision_inputs(self):
+        """
+        Read the permissions of all users and the default values of all permissions.
+        @rtype: tuple
+        @return: (dict user name -> list of permission names, dict permission name -> default value)
+        """
+        session = self.create_session()
+        try:
+            users = {}
+            for user in session.query(TNArchipelUser).all():
+                users[user.name] = [p.name for p in user.permissions]
+            defaults = {}
+            for permission in session.query(TNArchipelPermission).all():
+                defaults[permission.name] = permission.defaultValue
+            return users, defaults
+        finally:
+            session.close()
+
+    def decide(self, user_permissions, permission_name, default_value):
+        """
+        Take a permission decision.
+        @type user_permissions: list
+        @param user_permissions: the names of the permissions of the user, None if the user is unknown
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @type default_value: integer
+        @param default_value: the default value of the permission, None if the permission does not exist
+        @rtype: Boolean
+        @return: True if granted
+        """
+        if user_permissions is None:
+            return default_value == 1
+        if "all" in user_permissions:
             return True
-        return False
+        return permission_name in user_permissions
 
     def check_permissions(self, user_name, permissions):
         """
@@ -388,6 +483,65 @@ class TNArchipelPermissionCenter:
                 return False
         return True
 
+    ### Decision cache
+
+    def store_decision(self, generation, user_name, permission_name, decision):
+        """
+        Store a decision, unless the cache has been invalidated since it has been computed.
+        """
+        self.decisions_lock.acquire()
+        try:
+            if generation == self.decisions_generation:
+                self.decisions.setdefault(user_name, {})[permission_name] = decision
+        finally:
+            self.decisions_lock.release()
+
+    def invalidate_decisions(self, user_name=None):
+        """
+        Forget the cached decisions.
+        @type user_name: string
+        @param user_name: forget only the decisions of this user. All if None
+        """
+        self.decisions_lock.acquire()
+        try:
+            self.decisions_generation += 1
+            if user_name is None:
+                self.decisions = {}
+            else:
+                self.decisions.pop(user_name, None)
+        finally:
+            self.decisions_lock.release()
+
+    def preload_decisions(self):
+        """
+        Fill the decision cache for all known users and permissions.
+        """
+        generation = self.decisions_generation
+        decisions = {}
+        users, defaults = self.read_all_decision_inputs()
+        for user_name, user_permissions in users.iteritems():
+            decisions[user_name] = {}
+            for permission_name, default_value in defaults.iteritems():
+                decisions[user_name][permission_name] = self.decide(user_permissions, permission_name, default_value)
+        self.decisions_lock.acquire()
+        try:
+            if generation == self.decisions_generation:
+                self.decisions = decisions
+        finally:
+            self.decisions_lock.release()
+
+    def get_cache_statistics(self):
+        """
+        Return the statistics of the decision cache.
+        @rtype: dict
+        @return: number of hits, misses, hit rate and cached decisions
+        """
+        total = self.decisions_hits + self.decisions_misses
+        return {"hits": self.decisions_hits,
+                "misses": self.decisions_misses,
+                "hit_rate": total and float(self.decisions_hits) / total or 0.0,
+                "entries": sum([len(decisions) for decisions in self.decisions.values()])}
+
     def close_database(self):
         """
         Close the db connection.
@@ -395,4 +549,495 @@ class TNArchipelPermissionCenter:
         self.session.close_all()
         self.engine.dispose()
         del self.session
-        del self.engine
\ No newline at end of file
+        del self.engine
+
+class TNArchipelPermissionStore:
+    """
+    A permission database shared by several entities, the hypervisor virtual
+    machines for instance. All rows are keyed by the entity they belong to, and
+    all entities use the same engine and the same bounded pool of connections.
+    """
+
+    def __init__(self, database_file, pool_size=5):
+        """
+        Initialize the store.
+        @type database_file: string
+        @param database_file: the path to the db file
+        @type pool_size: integer
+        @param pool_size: the max number of connections opened on the database
+        """
+        self.database_file = database_file
+        self.engine = create_engine('sqlite:///%s' % database_file, poolclass=QueuePool, pool_size=pool_size, max_overflow=0, connect_args={"check_same_thread": False})
+        shared_metadata.create_all(self.engine)
+
+    def read(self, statement):
+        """
+        Run a select statement.
+        @rtype: list
+        @return: the rows
+        """
+        conn = self.engine.connect()
+        try:
+            return conn.execute(statement).fetchall()
+        finally:
+            conn.close()
+
+    def write(self, *statements):
+        """
+        Run statements in one transaction.
+        @rtype: integer
+        @return: the number of rows changed by the last statement
+        """
+        conn = self.engine.connect()
+        try:
+            transaction = conn.begin()
+            try:
+                for statement in statements:
+                    result = conn.execute(statement)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            return result.rowcount
+        finally:
+            conn.close()
+
+    ### Permissions
+
+    def create_permission(self, entity, name, description, default_value):
+        """
+        Create a permission of the entity.
+        @rtype: Boolean
+        @return: True in case of success, False if it already exists
+        """
+        try:
+            self.write(entities_permissions.insert().values(entity=entity, name=name, description=description, defaultValue=int(default_value)))
+            return True
+        except IntegrityError:
+            return False
+
+    def get_permissions(self, entity, name=None):
+        """
+        Return the permissions of the entity, or only the one with the given name.
+        @rtype: list
+        @return: list of L{TNArchipelPermission}
+        """
+        statement = select([entities_permissions]).where(entities_permissions.c.entity == entity)
+        if name:
+            statement = statement.where(entities_permissions.c.name == name)
+        return [TNArchipelPermission(row["name"], row["description"], row["defaultValue"]) for row in self.read(statement)]
+
+    def delete_permission(self, entity, name):
+        """
+        Delete a permission of the entity.
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        return self.write(entities_users_have_permissions.delete().where(and_(entities_users_have_permissions.c.entity == entity, entities_users_have_permissions.c.permission == name)),
+                          entities_permissions.delete().where(and_(entities_permissions.c.entity == entity, entities_permissions.c.name == name))) > 0
+
+    ### Users
+
+    def create_user(self, entity, name):
+        """
+        Create a user of the entity.
+        @rtype: Boolean
+        @return: True in case of success, False if it already exists
+        """
+        try:
+            self.write(entities_users.insert().values(entity=entity, name=name))
+            return True
+        except IntegrityError:
+            return False
+
+    def has_user(self, entity, name):
+        """
+        @rtype: Boolean
+        @return: True if the user exists for the entity
+        """
+        return len(self.read(select([entities_users.c.name]).where(and_(entities_users.c.entity == entity, entities_users.c.name == name)))) > 0
+
+    def delete_user(self, entity, name):
+        """
+        Delete a user of the entity and its granted permissions.
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        return self.write(entities_users_have_permissions.delete().where(and_(entities_users_have_permissions.c.entity == entity, entities_users_have_permissions.c.user == name)),
+                          entities_users.delete().where(and_(entities_users.c.entity == entity, entities_users.c.name == name))) > 0
+
+    def grant(self, entity, permission_name, user_name):
+        """
+        Grant a permission to a user of the entity. The user is created if needed.
+        @rtype: Boolean
+        @return: True in case of success, False if the permission does not exist
+        """
+        if not self.get_permissions(entity, permission_name):
+            return False
+        self.write(entities_users.insert().prefix_with("OR IGNORE").values(entity=entity, name=user_name),
+                   entities_users_have_permissions.insert().prefix_with("OR IGNORE").values(entity=entity, user=user_name, permission=permission_name))
+        return True
+
+    def revoke(self, entity, permission_name, user_name):
+        """
+        Revoke a permission to a user of the entity.
+        @rtype: Boolean
+        @return: True
+        """
+        self.write(entities_users_have_permissions.delete().where(and_(entities_users_have_permissions.c.entity == entity,
+                                                                       entities_users_have_permissions.c.user == user_name,
+                                                                       entities_users_have_permissions.c.permission == permission_name)))
+        return True
+
+    def get_user_permissions(self, entity, user_name):
+        """
+        Return the permissions granted to a user of the entity.
+        @rtype: list
+        @return: list of L{TNArchipelPermission}
+        """
+        statement = select([entities_permissions]).where(and_(entities_permissions.c.entity == entity,
+                                                              entities_users_have_permissions.c.entity == entity,
+                                                              entities_users_have_permissions.c.user == user_name,
+                                                              entities_users_have_permissions.c.permission == entities_permissions.c.name))
+        return [TNArchipelPermission(row["name"], row["description"], row["defaultValue"]) for row in self.read(statement)]
+
+    def get_users_permissions(self, entity):
+        """
+        @rtype: dict
+        @return: user name -> list of permission names, for all users of the entity
+        """
+        users = {}
+        for row in self.read(select([entities_users.c.name]).where(entities_users.c.entity == entity)):
+            users[row["name"]] = []
+        for row in self.read(select([entities_users_have_permissions]).where(entities_users_have_permissions.c.entity == entity)):
+            users.setdefault(row["user"], []).append(row["permission"])
+        return users
+
+    def get_decision_inputs(self, entity, user_name, permission_name):
+        """
+        Read, with one query, if the user exists, the permissions granted
+        to it and the default value of the given permission.
+        @type entity: string
+        @param entity: the entity
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @rtype: tuple
+        @return: (names of the permissions of the user or None if the user is unknown,
+                  default value of the permission or None if the permission does not exist)
+        """
+        statement = union_all(select([literal("user").label("kind"), entities_users.c.name.label("value")]).where(and_(entities_users.c.entity == entity,
+                                                                                                                    entities_users.c.name == user_name)),
+                              select([literal("permission"), entities_users_have_permissions.c.permission]).where(and_(entities_users_have_permissions.c.entity == entity,
+                                                                                                                       entities_users_have_permissions.c.user == user_name)),
+                              select([literal("default"), entities_permissions.c.defaultValue]).where(and_(entities_permissions.c.entity == entity,
+                                                                                                           entities_permissions.c.name == permission_name)))
+        user_exists = False
+        user_permissions = []
+        default_value = None
+        for kind, value in self.read(statement):
+            if kind == "user":
+                user_exists = True
+            elif kind == "permission":
+                user_permissions.append(value)
+            elif value is not None:
+                default_value = int(value)
+        if not user_exists:
+            user_permissions = None
+        return user_permissions, default_value
+
+    ### Entities
+
+    def has_entity(self, entity):
+        """
+        @rtype: Boolean
+        @return: True if the store contains something for the entity
+        """
+        return len(self.read(select([entities_permissions.c.name]).where(entities_permissions.c.entity == entity).limit(1))) > 0 \
+            or len(self.read(select([entities_users.c.name]).where(entities_users.c.entity == entity).limit(1))) > 0
+
+    def delete_entity(self, entity):
+        """
+        Remove everything related to the entity.
+        """
+        self.write(entities_users_have_permissions.delete().where(entities_users_have_permissions.c.entity == entity),
+                   entities_users.delete().where(entities_users.c.entity == entity),
+                   entities_permissions.delete().where(entities_permissions.c.entity == entity))
+
+    def import_database(self, entity, database_file):
+        """
+        Import the content of a permission database of a L{TNArchipelPermissionCenter}.
+        Rows already in the store are kept.
+        @type entity: string
+        @param entity: the entity owning the database
+        @type database_file: string
+        @param database_file: the path to the db file
+        @rtype: tuple
+        @return: number of imported (permissions, users, granted permissions)
+        """
+        db = sqlite3.connect(database_file)
+        try:
+            permissions = [{"entity": entity, "name": row[0], "description": row[1], "defaultValue": row[2]} for row in db.execute("select name, description, defaultValue from permissions")]
+            users = [{"entity": entity, "name": row[0]} for row in db.execute("select name from users")]
+            grants = [{"entity": entity, "user": row[0], "permission": row[1]} for row in db.execute("select user, permission from users_have_permissions")]
+        finally:
+            db.close()
+        conn = self.engine.connect()
+        try:
+            transaction = conn.begin()
+            try:
+                for table, rows in ((entities_permissions, permissions), (entities_users, users), (entities_users_have_permissions, grants)):
+                    if rows:
+                        conn.execute(table.insert().prefix_with("OR IGNORE"), rows)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            conn.close()
+        return len(permissions), len(users), len(grants)
+
+    def close(self):
+        """
+        Close all the connections.
+        """
+        self.engine.dispose()
+
+
+class TNArchipelSharedPermissionCenter (TNArchipelPermissionCenter):
+    """
+    A permission center storing its data in a L{TNArchipelPermissionStore}
+    shared with other entities.
+    """
+
+    def __init__(self, store, entity, root_admins={}):
+        """
+        Initialize the permission center.
+        @type store: L{TNArchipelPermissionStore}
+        @param store: the shared store
+        @type entity: string
+        @param entity: the key of the entity in the store
+        @type root_admins: array
+        @param root_admins: the root users JID
+        """
+        TNArchipelPermissionCenter.__init__(self, database_file=store.database_file, root_admins=root_admins)
+        self.store = store
+        self.entity = entity
+
+    def start(self, database_file=None, root_admins={}):
+        """
+        Be ready to use permissions. The store is already opened.
+        """
+        if len(root_admins) > 0:
+            self.root_admins = root_admins
+        self.preload_decisions()
+
+    def create_session(self):
+        """
+        The shared permission center does not use SQLAlchemy sessions.
+        @raise Exception: always
+        """
+        raise Exception("The shared permission center does not use sessions")
+
+    ### Permission management
+
+    def create_permission(self, name, description="", default_permission=False, currentsession=None):
+        """
+        Create a new permission of the entity in the store.
+        @type name: string
+        @param name: the name of the permission
+        @type description: string
+        @param description: the description of the permission
+        @type default_permission: Boolean
+        @param default_permission: the default value of permission if not set
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if not self.store.create_permission(self.entity, name, description, default_permission):
+            return False
+        self.invalidate_decisions()
+        return True
+
+    def get_permission(self, name, currentsession=None):
+        """
+        Get the permission of the entity by name.
+        @type name: string
+        @param name: the name of the permission
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: L{TNArchipelPermission}
+        @return: the L{TNArchipelPermission} object or None
+        """
+        permissions = self.store.get_permissions(self.entity, name)
+        return permissions and permissions[0] or None
+
+    def delete_permission(self, name, currentsession=None):
+        """
+        Delete the permission of the entity by name.
+        @type name: string
+        @param name: the name of the permission
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if not self.store.delete_permission(self.entity, name):
+            return False
+        self.invalidate_decisions()
+        return True
+
+    def get_permissions(self, currentsession=None):
+        """
+        Return all permissions of the entity.
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: list
+        @return: list of L{TNArchipelPermission}
+        """
+        return self.store.get_permissions(self.entity)
+
+    ### Users management
+
+    def create_user(self, name, currentsession=None):
+        """
+        Create a new user of the entity.
+        @type name: string
+        @param name: the name of the user
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: L{TNArchipelUser}
+        @return: the new user, None if it already exists
+        """
+        if not self.store.create_user(self.entity, name):
+            return None
+        self.invalidate_decisions(name)
+        return TNArchipelUser(name)
+
+    def get_user(self, name, currentsession=None):
+        """
+        Get the user of the entity by name.
+        @type name: string
+        @param name: the name of the user
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: L{TNArchipelUser}
+        @return: the L{TNArchipelUser} object or None
+        """
+        if not self.store.has_user(self.entity, name):
+            return None
+        return TNArchipelUser(name)
+
+    def delete_user(self, name, currentsession=None):
+        """
+        Delete the user of the entity by name.
+        @type name: string
+        @param name: the name of the user
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if not self.store.delete_user(self.entity, name):
+            return False
+        self.invalidate_decisions(name)
+        return True
+
+    def grant_permission_to_user(self, permission_name, user_name, currentsession=None):
+        """
+        Grant given permission to given user. The user is created if needed.
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @type user_name: string
+        @param user_name: the name of the user
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: Boolean
+        @return: True in case of success, False if the permission does not exist
+        """
+        ret = self.store.grant(self.entity, permission_name, user_name)
+        self.invalidate_decisions(user_name)
+        return ret
+
+    def revoke_permission_to_user(self, permission_name, user_name, currentsession=None):
+        """
+        Revoke given permission to given user.
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @type user_name: string
+        @param user_name: the name of the user
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        ret = self.store.revoke(self.entity, permission_name, user_name)
+        self.invalidate_decisions(user_name)
+        return ret
+
+    def user_has_permission(self, user_name, permission_name, currentsession=None):
+        """
+        Check if user has been granted the permission. Default values are not used.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: Boolean
+        @return: True if the permission is granted to the user
+        """
+        return permission_name in [p.name for p in self.store.get_user_permissions(self.entity, user_name)]
+
+    def get_user_permissions(self, user_name, currentsession=None):
+        """
+        Get permissions of user.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type currentsession: None
+        @param currentsession: ignored
+        @rtype: list of L{TNArchipelPermission}
+        @return: the list L{TNArchipelPermission} of user
+        """
+        return self.store.get_user_permissions(self.entity, user_name)
+
+    ### User permissions verification
+
+    def read_decision_inputs(self, user_name, permission_name):
+        """
+        Read what is needed to decide if a user has a permission, with one query to the store.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permission_name: string
+        @param permission_name: the name of the permission
+        @rtype: tuple
+        @return: (names of the permissions of the user or None if the user is unknown,
+                  default value of the permission or None if the permission does not exist)
+        """
+        return self.store.get_decision_inputs(self.entity, user_name, permission_name)
+
+    def read_all_decision_inputs(self):
+        """
+        Read the permissions of all users and the default values of all permissions of the entity.
+        @rtype: tuple
+        @return: (dict user name -> list of permission names, dict permission name -> default value)
+        """
+        defaults = {}
+        for permission in self.store.get_permissions(self.entity):
+            defaults[permission.name] = permission.defaultValue
+        return self.store.get_users_permissions(self.entity), defaults
+
+    def close_database(self):
+        """
+        Forget the cached decisions. The store stays opened for the other entities.
+        """
+        self.invalidate_decisions()
+
+    def destroy(self):
+        """
+        Remove all the permissions of the entity from the store.
+        """
+        self.store.delete_entity(self.entity)
+        self.invalidate_decisions()
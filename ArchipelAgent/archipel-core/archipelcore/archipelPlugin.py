@@ -19,6 +19,114 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import resource
+import time
+import xmpp
+from threading import Lock
+from pkg_resources import iter_entry_points, load_entry_point
+
+from archipelcore.utils import ARCHIPEL_NS_GENERIC_ERROR
+
+
+# factories of the installed plugins, by entry point group
+plugin_factories = {}
+plugin_factories_lock = Lock()
+
+# startup cost of the plugins, by (entry point group, identifier)
+plugins_profile = {}
+plugins_profile_lock = Lock()
+
+
+def get_plugin_factories(group):
+    """
+    Return the plugins installed for the given entry point group. Entry points
+    are resolved only once per process.
+    @type group: string
+    @param group: the entry point group
+    @rtype: list
+    @return: list of tuples (entry point, list of plugin info, factory, error message or None)
+    """
+    plugin_factories_lock.acquire()
+    try:
+        if not group in plugin_factories:
+            factories = []
+            for factory_method in iter_entry_points(group=group, name="factory"):
+                try:
+                    plugin_infos = load_entry_point(factory_method.dist, group="archipel.plugin", name="version")()
+                    factories.append((factory_method, plugin_infos[2], factory_method.load(), None))
+                except Exception as ex:
+                    factories.append((factory_method, [], None, str(ex)))
+            plugin_factories[group] = factories
+        return plugin_factories[group]
+    finally:
+        plugin_factories_lock.release()
+
+def resident_memory():
+    """
+    @rtype: integer
+    @return: the resident memory of the process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except Exception:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def record_plugin_profile(group, identifier, duration, memory, lazy=False):
+    """
+    Add the cost of one plugin instantiation to the process profile.
+    @type group: string
+    @param group: the entry point group
+    @type identifier: string
+    @param identifier: the plugin identifier
+    @type duration: float
+    @param duration: the instantiation time in seconds
+    @type memory: integer
+    @param memory: the resident memory growth in bytes
+    @type lazy: Boolean
+    @param lazy: True if the plugin has been instantiated on first use
+    @rtype: dict
+    @return: the entry for the entity profile
+    """
+    plugins_profile_lock.acquire()
+    try:
+        profile = plugins_profile.setdefault((group, identifier), {"group": group, "identifier": identifier, "instances": 0,
+                                                                  "lazy_instances": 0, "duration": 0.0, "memory": 0})
+        profile["instances"] += 1
+        if lazy:
+            profile["lazy_instances"] += 1
+        profile["duration"] += duration
+        profile["memory"] += memory
+    finally:
+        plugins_profile_lock.release()
+    return {"group": group, "identifier": identifier, "duration": duration, "memory": memory, "lazy": lazy}
+
+def get_plugins_profile():
+    """
+    @rtype: list
+    @return: the cost of the plugins for all the entities of the process, the most expensive first
+    """
+    plugins_profile_lock.acquire()
+    try:
+        profiles = [dict(profile) for profile in plugins_profile.values()]
+    finally:
+        plugins_profile_lock.release()
+    profiles.sort(key=lambda profile: profile["duration"], reverse=True)
+    return profiles
+
+def format_plugins_profile():
+    """
+    @rtype: string
+    @return: a readable report of L{get_plugins_profile}
+    """
+    lines = ["%-45s %10s %8s %12s %12s" % ("plugin", "instances", "lazy", "time (ms)", "memory (KiB)")]
+    for profile in get_plugins_profile():
+        lines.append("%-45s %10d %8d %12.1f %12d" % ("%s/%s" % (profile["group"], profile["identifier"]), profile["instances"],
+                                                     profile["lazy_instances"], profile["duration"] * 1000, profile["memory"] / 1024))
+    return "\n".join(lines)
+
+
+
 
 class TNArchipelPlugin:
 
@@ -50,6 +158,19 @@ class TNArchipelPlugin:
         """
         pass
 
+    def process_iq(self, conn, iq):
+        """
+        Handle an IQ received in one of the lazy-namespaces of the plugin.
+        A lazy plugin gives it the IQ that made it load, as the handlers the
+        plugin registers while the IQ is dispatched are not called for it.
+        @type conn: xmpp.Dispatcher
+        @param conn: ths instance of the current connection that send the stanza
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @raise Exception: Exception if the plugin declares lazy-namespaces and does not implement it
+        """
+        raise Exception("plugins declaring lazy-namespaces must implement 'process_iq'")
+
     @classmethod
     def plugin_info(self, group):
         """
@@ -63,6 +184,156 @@ class TNArchipelPlugin:
                     "identifier"                : plugin_identifier,
                     "configuration-section"     : plugin_configuration_section,
                     "configuration-tokens"      : plugin_configuration_tokens }
+        A plugin that only reacts to its IQ namespaces and to some hooks can
+        also return the following keys, so it is instantiated on first use
+        (see L{TNArchipelLazyPlugin}). Its IQs must then be handled by process_iq:
+                    "lazy-namespaces"           : ["namespace of the IQs handled"],
+                    "lazy-hooks"                : ["hooks the plugin registers in its constructor"],
+                    "lazy-permissions"          : [("name", "description", default value)]
         @raise Exception: Exception if not implemented
         """
-        raise Exception("plugins objects must implement 'plugin_info'")
\ No newline at end of file
+        raise Exception("plugins objects must implement 'plugin_info'")
+
+class TNArchipelLazyPlugin (object):
+    """
+    Stands for a plugin declaring lazy-namespaces or lazy-hooks in its
+    plugin_info. The plugin is instantiated on the first IQ received in one
+    of its namespaces, on the first perform of one of its hooks, or when
+    it is asked with get_plugin. Its permissions are created up front.
+    If the plugin fails to load, the error is kept and given back to the
+    next uses without trying again.
+    """
+
+    def __init__(self, configuration, entity, entry_point_group, plugin_info, factory):
+        """
+        Initialize the placeholder.
+        @type configuration: Configuration object
+        @param configuration: the configuration
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity that owns the plugin
+        @type entry_point_group: string
+        @param entry_point_group: the group name of plugin entry_point
+        @type plugin_info: dict
+        @param plugin_info: the plugin_info of the plugin
+        @type factory: function
+        @param factory: the plugin factory
+        """
+        self.configuration              = configuration
+        self.entity                     = entity
+        self.plugin_entry_point_group   = entry_point_group
+        self.plugin_info                = plugin_info
+        self.factory                    = factory
+        self.plugin                     = None
+        self.load_error                 = None
+        self.handlers_registered        = False
+        self.hook_registrations         = []
+        self.lock                       = Lock()
+
+        for name, description, default in plugin_info.get("lazy-permissions", []):
+            self.entity.permission_center.create_permission(name, description, default)
+        for hookname in plugin_info.get("lazy-hooks", []):
+            self.hook_registrations.append(self.entity.register_hook(hookname, method=self.perform_plugin_hook, user_info=hookname))
+
+    def load(self):
+        """
+        Instantiate the plugin if needed.
+        @rtype: L{TNArchipelPlugin}
+        @return: the plugin
+        """
+        self.lock.acquire()
+        try:
+            if self.plugin:
+                return self.plugin
+            if self.load_error:
+                raise Exception(self.load_error)
+            identifier = self.plugin_info["identifier"]
+            memory = resident_memory()
+            start = time.time()
+            try:
+                for plugin in self.factory(self.configuration, self.entity, self.plugin_entry_point_group):
+                    if plugin["info"]["identifier"] == identifier:
+                        self.plugin = plugin["plugin"]
+                if not self.plugin:
+                    raise Exception("Factory of plugin %s did not return it" % identifier)
+            except Exception as ex:
+                self.plugin = None
+                self.load_error = "Unable to load plugin %s: %s" % (identifier, str(ex))
+                self.entity.log.error("PLUGIN: %s" % self.load_error)
+                raise Exception(self.load_error)
+            profile = record_plugin_profile(self.plugin_entry_point_group, identifier, time.time() - start, resident_memory() - memory, lazy=True)
+            self.entity.plugins_profile.append(profile)
+            for registration in self.hook_registrations:
+                self.entity.unregister_hook_registration(registration)
+            if self.handlers_registered:
+                for namespace in self.plugin_info.get("lazy-namespaces", []):
+                    self.entity.xmppclient.UnregisterHandler('iq', self.process_iq, ns=namespace)
+                self.plugin.register_handlers()
+            self.entity.log.info("PLUGIN: loaded plugin %s on first use in %.1fms" % (identifier, profile["duration"] * 1000))
+            return self.plugin
+        finally:
+            self.lock.release()
+
+    def register_handlers(self):
+        """
+        Register a handler for the namespaces of the plugin, or the plugin handlers if it is loaded.
+        """
+        self.handlers_registered = True
+        if self.plugin:
+            return self.plugin.register_handlers()
+        for namespace in self.plugin_info.get("lazy-namespaces", []):
+            self.entity.xmppclient.RegisterHandler('iq', self.process_iq, ns=namespace)
+
+    def unregister_handlers(self):
+        """
+        Unregister the handlers.
+        """
+        self.handlers_registered = False
+        if self.plugin:
+            return self.plugin.unregister_handlers()
+        for namespace in self.plugin_info.get("lazy-namespaces", []):
+            self.entity.xmppclient.UnregisterHandler('iq', self.process_iq, ns=namespace)
+
+    def process_iq(self, conn, iq):
+        """
+        Load the plugin and give it the IQ. The dispatcher does not call
+        the handlers registered while it dispatches, so the IQ is given
+        to L{TNArchipelPlugin.process_iq} of the plugin.
+        @type conn: xmpp.Dispatcher
+        @param conn: ths instance of the current connection that send the stanza
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        """
+        try:
+            plugin = self.load()
+        except Exception:
+            conn.send(self.build_load_error_iq(iq))
+            raise xmpp.protocol.NodeProcessed
+        plugin.process_iq(conn, iq)
+
+    def build_load_error_iq(self, iq):
+        """
+        Build the error answered to the IQ when the plugin could not be
+        loaded. The error has been logged when the load failed.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: the error IQ
+        """
+        reply = iq.buildReply("error")
+        reply.setQueryPayload(iq.getQueryPayload())
+        error = xmpp.Node("error", attrs={"code": -1, "type": "cancel"})
+        error.addChild(name=ARCHIPEL_NS_GENERIC_ERROR.replace(":", "-"), namespace=ARCHIPEL_NS_GENERIC_ERROR)
+        error.addChild(name="text", payload=self.load_error)
+        reply.addChild(node=error)
+        return reply
+
+    def perform_plugin_hook(self, origin, hookname, arguments):
+        """
+        Load the plugin and perform the methods it registered for the hook.
+        Nothing is performed if the plugin could not be loaded.
+        """
+        if self.load_error:
+            return
+        plugin = self.load()
+        registrations = [registration for registration in self.entity.hooks.get(hookname, []) if getattr(registration[2]["method"], "im_self", None) is plugin]
+        self.entity.perform_hook_registrations(hookname, registrations, arguments)
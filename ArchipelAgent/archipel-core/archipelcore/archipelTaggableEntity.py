@@ -93,11 +93,18 @@ class TNTaggableEntity (object):
         Get the global tag pubsub node.
         Arguments here are used to be HOOK compliant see register_hook of L{TNHookableEntity}
         """
-        # getting the tags pubsub node
+        # getting the tags pubsub node. The items are shared by all the entities of the process:
+        # they are retrieved by the first entity to connect and kept current by the notifications
+        # received by one of them. Notifications may have been missed while this entity was
+        # disconnected, so the items are retrieved again when it reconnects
         tagsNodeName = "/archipel/tags"
-        self.pubSubNodeTags = TNPubSubNode(self.xmppclient, self.pubsubserver, tagsNodeName)
+        if self.pubSubNodeTags:
+            self.pubSubNodeTags.store.invalidate()
+        self.pubSubNodeTags = TNPubSubNode(self.xmppclient, self.pubsubserver, tagsNodeName, index_attribute="jid", shared=True)
         if not self.pubSubNodeTags.recover(wait=True):
             Exception("The pubsub node /archipel/tags must have been created. You can use archipel-tagnode tool to create it.")
+        else:
+            self.pubSubNodeTags.subscribe_shared(self.jid, run_on_loop=lambda callback: self.add_timer(0, callback, repeat=False))
 
     def init_permissions(self):
         """
@@ -116,6 +123,8 @@ class TNTaggableEntity (object):
         Unregister the handlers for tags.
         """
         self.xmppclient.UnregisterHandler('iq', self.process_tags_iq, ns=ARCHIPEL_NS_TAGS)
+        if self.pubSubNodeTags:
+            self.pubSubNodeTags.release_shared(self.jid)
 
     ### Tags
 
@@ -138,30 +147,18 @@ class TNTaggableEntity (object):
 
     def set_tags(self, tags):
         """
-        Set the tags of the current entity.
+        Set the tags of the current entity. The existing tag item of the entity
+        is replaced by publishing the new one with the same id. New tag items
+        use the JID of the entity as id.
         @type tags: string
         @param tags: the string containing tags separated by ';;'
         """
-        current_id = None
-        for item in self.pubSubNodeTags.get_items():
-            if item.getTag("tag") and item.getTag("tag").getAttr("jid") == self.jid.getStripped():
+        current_id = self.jid.getStripped()
+        for item in self.pubSubNodeTags.get_items_by(self.jid.getStripped()):
+            if item.getTag("tag"):
                 current_id = item.getAttr("id")
-        if current_id:
-            self.pubSubNodeTags.remove_item(current_id, callback=self.did_clean_old_tags, user_info=tags)
-        else:
-            tagNode = xmpp.Node(tag="tag", attrs={"jid": self.jid.getStripped(), "tags": tags})
-            self.pubSubNodeTags.add_item(tagNode)
-
-    def did_clean_old_tags(self, resp, user_info):
-        """
-        Callback called when old tags has been removed if any.
-        @raise Exception: Exception if not implemented
-        """
-        if resp.getType() == "result":
-            tagNode = xmpp.Node(tag="tag", attrs={"jid": self.jid.getStripped(), "tags": user_info})
-            self.pubSubNodeTags.add_item(tagNode)
-        else:
-            raise Exception("Tags unable to set tags. answer is: " + str(resp))
+        tagNode = xmpp.Node(tag="tag", attrs={"jid": self.jid.getStripped(), "tags": tags})
+        self.pubSubNodeTags.publish(tagNode, item_id=current_id)
 
     def iq_set_tags(self, iq):
         """
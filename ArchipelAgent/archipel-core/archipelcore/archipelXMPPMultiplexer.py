@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+#
+# archipelXMPPMultiplexer.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNXMPPMultiplexer, a single thread that watches the XMPP streams
+of a large number of L{TNArchipelEntity} at once.
+
+Instead of one thread and one loop per entity, all sockets (and the fd
+registered with register_fd_callback) are watched with one epoll set (or
+a poll set when epoll is not available) by the dispatcher thread, so the
+number of watched fds is not limited by FD_SETSIZE. A fd is registered
+in the set when its entity becomes idle and unregistered when it is
+processed or removed. It does nothing else: the entities with ready
+data or due timers are handed to a pool of processing threads, which
+run the timers, the fd callbacks and the XMPP stream of the entity. An
+entity is processed by one thread at a time, and its fds are not watched
+while it is processed. Blocking operations (connection, authentication,
+reconnection and unregistration) have their own pool of worker threads,
+so they never delay the processing of the other entities.
+"""
+
+import errno
+import os
+import select
+import sys
+import time
+import traceback
+from Queue import Queue
+from threading import Thread, Lock
+
+from archipelcore.archipelEntity import ARCHIPEL_XMPP_LOOP_OFF, ARCHIPEL_XMPP_LOOP_RESTART, \
+                                        ARCHIPEL_XMPP_LOOP_REMOVE_USER, ARCHIPEL_XMPP_LOOP_MAX_WAIT
+from archipelcore.utils import log
+
+
+# POLLIN, POLLPRI, POLLERR and POLLHUP have the same values as their EPOLL counterparts
+POLL_READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+
+class TNXMPPMultiplexerWorker (Thread):
+    """
+    Performs the jobs of the multiplexed entities: blocking XMPP
+    operations, or processing of the ready entities.
+    """
+
+    def __init__(self, multiplexer, jobs):
+        """
+        The contructor of the class.
+        @type multiplexer: L{TNXMPPMultiplexer}
+        @param multiplexer: the multiplexer owning this worker
+        @type jobs: Queue.Queue
+        @param jobs: the queue of jobs to perform
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.multiplexer = multiplexer
+        self.jobs = jobs
+
+    def process(self, entity, ready_fds, stream_ready):
+        """
+        Run the due timers, the fd callbacks and the XMPP stream of a ready entity.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @type ready_fds: list
+        @param ready_fds: the registered fds that are readable
+        @type stream_ready: Boolean
+        @param stream_ready: True if the XMPP stream has data to read
+        """
+        entity.run_due_timers()
+        for fd in ready_fds:
+            callback = entity.fd_callbacks.get(fd, None)
+            if not callback:
+                continue
+            try:
+                callback(fd)
+            except Exception as ex:
+                entity.log.error("MULTIPLEXER: error in fd callback: %s" % str(ex))
+        if stream_ready:
+            entity.xmppclient.Process(0)
+
+    def run(self):
+        """
+        Process the jobs until a None job is received.
+        """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            action, entity, arguments = job
+            try:
+                if action == "process":
+                    self.process(entity, *arguments)
+                elif action == "connect":
+                    entity.connect()
+                elif action == "reconnect":
+                    if entity.xmppclient and entity.xmppclient.isConnected():
+                        entity.xmppclient.disconnect()
+                    time.sleep(1.0)
+                    entity.connect()
+                elif action == "unregister":
+                    entity.process_inband_unregistration()
+                elif action == "disconnect":
+                    if entity.xmppclient and entity.xmppclient.isConnected():
+                        entity.xmppclient.disconnect()
+            except Exception as ex:
+                entity.handle_xmpp_loop_exception(ex)
+            self.multiplexer.job_done(entity)
+
+
+class TNXMPPMultiplexer (Thread):
+    """
+    This class watches the XMPP streams of several entities in one thread.
+    """
+
+    def __init__(self, number_of_workers=4, number_of_processors=4):
+        """
+        The contructor of the class.
+        @type number_of_workers: integer
+        @param number_of_workers: number of threads used to connect entities
+        @type number_of_processors: integer
+        @param number_of_processors: number of threads used to process the ready entities
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.entities           = {}
+        self.busy_entities      = {}
+        self.lock               = Lock()
+        self.jobs               = Queue()
+        self.ready_entities     = Queue()
+        self.running            = False
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.registered         = {}
+        if hasattr(select, "epoll"):
+            self.poller         = select.epoll()
+            self.poll_unit      = 1
+        else:
+            self.poller         = select.poll()
+            self.poll_unit      = 1000
+        self.poller.register(self.wakeup_read, select.POLLIN)
+        self.workers            = []
+        for i in range(max(1, number_of_workers)):
+            self.workers.append(TNXMPPMultiplexerWorker(self, self.jobs))
+        for i in range(max(1, number_of_processors)):
+            self.workers.append(TNXMPPMultiplexerWorker(self, self.ready_entities))
+
+
+    ### Entities management
+
+    def add_entity(self, entity):
+        """
+        Connect the given entity and add it to the dispatching loop.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to manage
+        """
+        key = str(entity.jid)
+        entity.loop_waker = self.wake_up
+        self.lock.acquire()
+        self.entities[key] = entity
+        self.busy_entities[key] = True
+        self.lock.release()
+        self.jobs.put(("connect", entity, None))
+
+    def remove_entity(self, entity):
+        """
+        Remove the given entity from the dispatching loop. This does not disconnect it.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity to remove
+        """
+        key = str(entity.jid)
+        self.lock.acquire()
+        if key in self.entities:
+            del self.entities[key]
+        if key in self.busy_entities:
+            del self.busy_entities[key]
+        self.lock.release()
+
+    def get_entity(self, jid):
+        """
+        Return the managed entity with given JID.
+        @type jid: xmpp.JID or string
+        @param jid: the JID of the entity
+        @rtype: L{TNArchipelEntity}
+        @return: the entity, or None
+        """
+        return self.entities.get(str(jid), None)
+
+    def entities_count(self):
+        """
+        @rtype: integer
+        @return: the number of managed entities
+        """
+        return len(self.entities)
+
+    def _submit(self, key, action, entity):
+        """
+        Give a blocking operation to the workers. The entity is
+        not dispatched until the operation is done.
+        """
+        self.busy_entities[key] = True
+        self.jobs.put((action, entity, None))
+
+    def job_done(self, entity):
+        """
+        Called by the workers when the job of an entity is over.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        self.lock.acquire()
+        self.busy_entities.pop(str(entity.jid), None)
+        self.lock.release()
+        self.wake_up()
+
+    def wake_up(self):
+        """
+        Interrupt the current poll so the entities list is read again.
+        """
+        try:
+            os.write(self.wakeup_write, "x")
+        except OSError:
+            pass
+
+
+    ### Loop
+
+    def stop(self):
+        """
+        Stop the dispatcher and the workers.
+        """
+        self.running = False
+        for worker in self.workers:
+            worker.jobs.put(None)
+        self.wake_up()
+
+    def _prepare(self):
+        """
+        Manage entities states and build the map of fd to watch. Nothing
+        is run here: the entities with due timers or buffered data are
+        returned to be processed.
+        @rtype: tuple
+        @return: (dict fileno -> (entity, True if fd of the XMPP stream), list of (entity, has buffered data) to process now, timeout)
+        """
+        watched = {}
+        due = []
+        timeout = ARCHIPEL_XMPP_LOOP_MAX_WAIT
+        self.lock.acquire()
+        try:
+            for key, entity in self.entities.items():
+                if key in self.busy_entities:
+                    continue
+
+                if entity.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
+                    del self.entities[key]
+                    self.jobs.put(("disconnect", entity, None))
+                    continue
+                if entity.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
+                    del self.entities[key]
+                    self.jobs.put(("unregister", entity, None))
+                    continue
+                if entity.loop_status == ARCHIPEL_XMPP_LOOP_RESTART or not entity.xmppclient or not entity.xmppclient.isConnected():
+                    self._submit(key, "reconnect", entity)
+                    continue
+                try:
+                    next_timer = entity.next_timer_timeout()
+                    buffered = entity.xmpp_stream_has_buffered_data()
+                    watched[entity.xmpp_stream_fileno()] = (entity, True)
+                    for fd in entity.fd_callbacks.keys():
+                        watched[fd] = (entity, False)
+                    if next_timer == 0 or buffered:
+                        due.append((entity, buffered))
+                    elif next_timer is not None and next_timer < timeout:
+                        timeout = next_timer
+                except Exception as ex:
+                    entity.handle_xmpp_loop_exception(ex)
+        finally:
+            self.lock.release()
+        if len(due) > 0:
+            timeout = 0
+        return watched, due, timeout
+
+    def _dispatch(self, entities):
+        """
+        Give the ready entities to the processing threads. An entity is
+        not watched nor dispatched again until it has been processed.
+        @type entities: dict
+        @param entities: entity -> (list of ready fds, True if the XMPP stream is ready)
+        """
+        self.lock.acquire()
+        try:
+            for entity, (ready_fds, stream_ready) in entities.items():
+                key = str(entity.jid)
+                if not key in self.entities or key in self.busy_entities:
+                    continue
+                self.busy_entities[key] = True
+                self.ready_entities.put(("process", entity, (ready_fds, stream_ready)))
+        finally:
+            self.lock.release()
+
+    def _register(self, fileno, owner):
+        """
+        Add a fd to the poll set.
+        @type fileno: integer
+        @param fileno: the fd
+        @type owner: tuple
+        @param owner: (entity, True if fd of the XMPP stream)
+        @rtype: Boolean
+        @return: False if the fd is not valid anymore
+        """
+        try:
+            self.poller.register(fileno, POLL_READ_EVENTS)
+        except (IOError, OSError, ValueError):
+            return False
+        self.registered[fileno] = owner
+        return True
+
+    def _unregister(self, fileno):
+        """
+        Remove a fd from the poll set.
+        @type fileno: integer
+        @param fileno: the fd
+        """
+        self.registered.pop(fileno, None)
+        try:
+            self.poller.unregister(fileno)
+        except (IOError, OSError, KeyError, ValueError):
+            # closed fds have already been removed from the epoll set
+            pass
+
+    def _watch(self, watched):
+        """
+        Update the poll set so it contains exactly the given fds.
+        @type watched: dict
+        @param watched: the dict fileno -> (entity, is stream) returned by _prepare
+        @rtype: dict
+        @return: fileno -> (entity, is stream), for the fds that could not be registered
+        """
+        for fileno, owner in self.registered.items():
+            if not watched.get(fileno) == owner:
+                self._unregister(fileno)
+        invalid = {}
+        for fileno, owner in watched.iteritems():
+            if not fileno in self.registered and not self._register(fileno, owner):
+                invalid[fileno] = owner
+        return invalid
+
+    def _poll(self, timeout):
+        """
+        Wait for events on the poll set.
+        @type timeout: float
+        @param timeout: max number of seconds to wait
+        @rtype: list
+        @return: list of (fileno, events)
+        """
+        try:
+            return self.poller.poll(timeout * self.poll_unit)
+        except (IOError, OSError, select.error) as ex:
+            if ex.args and ex.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def _restart_closed_sockets(self, invalid):
+        """
+        Restart the entities whose socket is not valid anymore, and forget
+        their other invalid fds.
+        @type invalid: dict
+        @param invalid: the dict fileno -> (entity, is stream) of the invalid fds
+        """
+        for fileno, (entity, is_stream) in invalid.items():
+            self._unregister(fileno)
+            if not is_stream:
+                entity.log.warning("MULTIPLEXER: fd %d is not valid anymore. Unregistering it." % fileno)
+                entity.unregister_fd_callback(fileno)
+            else:
+                entity.log.warning("MULTIPLEXER: XMPP socket has been closed. Restarting.")
+                entity.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+
+    def run(self):
+        """
+        Overiddes super class method. Watch the streams and dispatch the ready entities.
+        """
+        self.running = True
+        for worker in self.workers:
+            worker.start()
+        while self.running:
+            try:
+                watched, due, timeout = self._prepare()
+                invalid = self._watch(watched)
+                if invalid:
+                    # a fd has been closed since the entity registered it
+                    self._restart_closed_sockets(invalid)
+                    continue
+                targets = {}
+                for entity, buffered in due:
+                    targets[entity] = ([], buffered)
+                for fileno, events in self._poll(timeout):
+                    if fileno == self.wakeup_read:
+                        os.read(self.wakeup_read, 4096)
+                        continue
+                    if not fileno in self.registered:
+                        continue
+                    entity, is_stream = self.registered[fileno]
+                    if events & select.POLLNVAL:
+                        invalid[fileno] = (entity, is_stream)
+                        continue
+                    ready_fds, stream_ready = targets.get(entity, ([], False))
+                    if is_stream:
+                        stream_ready = True
+                    else:
+                        ready_fds.append(fileno)
+                    targets[entity] = (ready_fds, stream_ready)
+                if invalid:
+                    self._restart_closed_sockets(invalid)
+                self._dispatch(targets)
+            except Exception as ex:
+                t, v, tr = sys.exc_info()
+                log.error("MULTIPLEXER: unexpected error in dispatch loop: %s" % "\n".join(traceback.format_exception(t, v, tr)))
+                time.sleep(1.0)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# dbentries.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Encoding of the lists of database entries exchanged with the central agent.
+
+Two encodings exist:
+    - xml: the historical one. Each entry is a <entry/> node containing one
+      <item key="" value=""/> node per field.
+    - json+zlib: the whole list is serialized in JSON, compressed with zlib and
+      sent base64 encoded as the data of a single <entries encoding="json+zlib"/>
+      node. Building and parsing it does not depend on the number of fields,
+      and libvirt XML descriptions are not escaped as attribute values anymore.
+
+The central agent advertises the encodings it understands in its keepalive.
+The entities use the compact encoding only if it has been advertised, and ask
+for compact replies with the accept_encoding attribute of their event. In any
+other case, the xml encoding is used, so old and new peers can talk together.
+"""
+
+import base64
+import json
+import zlib
+
+from archipelcore import xmpp
+
+
+ARCHIPEL_ENTRIES_ENCODING_XML       = "xml"
+ARCHIPEL_ENTRIES_ENCODING_COMPACT   = "json+zlib"
+
+# supported encodings, by order of preference
+ARCHIPEL_ENTRIES_ENCODINGS          = [ARCHIPEL_ENTRIES_ENCODING_COMPACT, ARCHIPEL_ENTRIES_ENCODING_XML]
+
+ARCHIPEL_ENTRIES_COMPRESSION_LEVEL  = 6
+
+
+def negotiate_encoding(advertised):
+    """
+    Return the preferred encoding among the ones advertised by the remote entity.
+    @type advertised: string
+    @param advertised: comma separated list of encodings, or None
+    @rtype: string
+    @return: the encoding to use
+    """
+    if not advertised:
+        return ARCHIPEL_ENTRIES_ENCODING_XML
+    remote_encodings = [encoding.strip() for encoding in advertised.split(",")]
+    for encoding in ARCHIPEL_ENTRIES_ENCODINGS:
+        if encoding in remote_encodings:
+            return encoding
+    return ARCHIPEL_ENTRIES_ENCODING_XML
+
+def entry_value(value):
+    """
+    Convert a value the same way it would be written as a XML attribute, so
+    both encodings give the same entries once unpacked.
+    @type value: object
+    @param value: the value to convert
+    @rtype: unicode
+    @return: the converted value
+    """
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return unicode(value)
+
+def pack_entries(entries, encoding=ARCHIPEL_ENTRIES_ENCODING_XML):
+    """
+    Pack a list of entries.
+    @type entries: list
+    @param entries: list of dict
+    @type encoding: string
+    @param encoding: one of ARCHIPEL_ENTRIES_ENCODINGS
+    @rtype: list
+    @return: list of xmpp.Node to add to the event or to the reply
+    """
+    if encoding == ARCHIPEL_ENTRIES_ENCODING_COMPACT:
+        converted = []
+        for entry in entries:
+            converted_entry = {}
+            for key, value in entry.iteritems():
+                converted_entry[key] = entry_value(value)
+            converted.append(converted_entry)
+        payload = zlib.compress(json.dumps(converted, separators=(",", ":")), ARCHIPEL_ENTRIES_COMPRESSION_LEVEL)
+        node = xmpp.Node(tag="entries", attrs={"encoding": encoding, "count": len(converted)})
+        node.setData(base64.b64encode(payload))
+        return [node]
+
+    packed_entries = []
+    for entry in entries:
+        entryTag = xmpp.Node(tag="entry")
+        for key, value in entry.iteritems():
+            entryTag.addChild("item", attrs={"key": key, "value": value})
+        packed_entries.append(entryTag)
+    return packed_entries
+
+def unpack_entries(node):
+    """
+    Unpack the list of entries contained in the given node, whatever the encoding.
+    @type node: xmpp.Node
+    @param node: the node containing the packed entries (the event or the reply)
+    @rtype: list
+    @return: list of dict
+    """
+    entries = []
+    if not node:
+        return entries
+
+    for child in node.getChildren():
+        if child.getName() == "entries":
+            encoding = child.getAttr("encoding")
+            if encoding != ARCHIPEL_ENTRIES_ENCODING_COMPACT:
+                raise Exception("Unknown entries encoding %s" % encoding)
+            entries.extend(json.loads(zlib.decompress(base64.b64decode(child.getData()))))
+        elif child.getName() == "entry":
+            entry_dict = {}
+            for entry_val in child.getChildren():
+                if entry_val.getAttr("key"):
+                    entry_dict[entry_val.getAttr("key")] = entry_val.getAttr("value")
+            if entry_dict != {}:
+                entries.append(entry_dict)
+    return entries
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+#
+# dbquery.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNDBQuery, a description of a read on the central database.
+
+A query is built by the entities asking the central agent for data,
+sent over XMPP, and turned by the central agent into a parameterized
+SQL statement. Table names, columns, operators and conditions are
+checked against the lists below, and values are always given to sqlite
+as parameters, so nothing received from XMPP ends in the SQL text.
+"""
+
+
+# columns of the central database tables, in their storage order
+ARCHIPEL_DB_TABLE_COLUMNS = {
+    "vms": ["uuid", "parker", "creation_date", "domain", "hypervisor", "name", "jid"],
+    "hypervisors": ["jid", "last_seen", "status", "stat1", "stat2", "stat3"]
+}
+
+# unique column of each table, used as cursor for paged reads
+ARCHIPEL_DB_TABLE_KEYS = {
+    "vms": "uuid",
+    "hypervisors": "jid"
+}
+
+ARCHIPEL_DB_OPERATORS = ["=", "!=", "<", "<=", ">", ">=", "like", "not like", "in", "not in", "is null", "is not null"]
+
+# predefined conditions that cannot be expressed with simple filters
+ARCHIPEL_DB_CONDITIONS = {
+    "vms": {
+        "parked": "(hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online'))",
+        "defined": "domain != 'None'"
+    },
+    "hypervisors": {
+        "online": "status='Online'"
+    }
+}
+
+
+class TNDBQuery (object):
+    """
+    A select on one table of the central database.
+    """
+
+    def __init__(self, table, columns=None):
+        """
+        The contructor of the class.
+        @type table: string
+        @param table: the table to read ("vms" or "hypervisors")
+        @type columns: list
+        @param columns: the columns to return. All if None
+        """
+        self.table      = table
+        self.columns    = columns
+        self.filters    = []
+        self.conditions = []
+        self.order_by   = None
+        self.descending = False
+        self.limit      = None
+        self.offset     = None
+        self.page_size  = None
+        self.cursor     = None
+
+    ### Building
+
+    def where(self, column, operator, value=None):
+        """
+        Add a filter. Filters are combined with "and".
+        @type column: string
+        @param column: the column to filter on
+        @type operator: string
+        @param operator: one of ARCHIPEL_DB_OPERATORS
+        @type value: string or list
+        @param value: the value, a list for "in" and "not in", None for "is null" and "is not null"
+        @rtype: L{TNDBQuery}
+        @return: the query itself
+        """
+        self.filters.append((column, operator.strip().lower(), value))
+        return self
+
+    def where_in(self, column, values):
+        """
+        Shortcut to add a "in" filter.
+        @type column: string
+        @param column: the column to filter on
+        @type values: list
+        @param values: the accepted values
+        @rtype: L{TNDBQuery}
+        @return: the query itself
+        """
+        return self.where(column, "in", list(values))
+
+    def condition(self, name):
+        """
+        Add a predefined condition from ARCHIPEL_DB_CONDITIONS.
+        @type name: string
+        @param name: the name of the condition
+        @rtype: L{TNDBQuery}
+        @return: the query itself
+        """
+        self.conditions.append(name)
+        return self
+
+    def order(self, column, descending=False):
+        """
+        Set the order of the results.
+        @type column: string
+        @param column: the column to order on
+        @type descending: Boolean
+        @param descending: if True, use descending order
+        @rtype: L{TNDBQuery}
+        @return: the query itself
+        """
+        self.order_by = column
+        self.descending = descending
+        return self
+
+    def slice(self, limit, offset=None):
+        """
+        Limit the number of results.
+        @type limit: integer
+        @param limit: max number of rows
+        @type offset: integer
+        @param offset: number of rows to skip
+        @rtype: L{TNDBQuery}
+        @return: the query itself
+        """
+        self.limit = limit
+        self.offset = offset
+        return self
+
+    def page(self, page_size, cursor=None):
+        """
+        Read the results by pages of page_size rows, ordered by the key of
+        the table. The cursor is the key of the last row of the previous page.
+        A paged query cannot have its own order or limit.
+        @type page_size: integer
+        @param page_size: max number of rows per page
+        @type cursor: string
+        @param cursor: the cursor returned with the previous page, None for the first one
+        @rtype: L{TNDBQuery}
+        @return: the query itself
+        """
+        self.page_size = page_size
+        self.cursor = cursor
+        return self
+
+    def is_pageable(self):
+        """
+        @rtype: Boolean
+        @return: True if the query can be read by pages
+        """
+        return self.limit is None and self.order_by in (None, ARCHIPEL_DB_TABLE_KEYS.get(self.table))
+
+    def split_page(self, entries):
+        """
+        Split the entries read with a paged query.
+        @type entries: list
+        @param entries: the entries returned by the statement of a paged query
+        @rtype: tuple
+        @return: (entries of the page, cursor of the next page or None if this is the last one)
+        """
+        if not self.page_size or len(entries) <= self.page_size:
+            return entries, None
+        entries = entries[:self.page_size]
+        return entries, entries[-1][ARCHIPEL_DB_TABLE_KEYS[self.table]]
+
+    ### SQL
+
+    def selected_columns(self):
+        """
+        @rtype: list
+        @return: the checked list of columns returned by the query
+        """
+        if not self.table in ARCHIPEL_DB_TABLE_COLUMNS:
+            raise Exception("Unknown table %s" % self.table)
+        if not self.columns:
+            return ARCHIPEL_DB_TABLE_COLUMNS[self.table]
+        for column in self.columns:
+            self.check_column(column)
+        if self.page_size and not ARCHIPEL_DB_TABLE_KEYS[self.table] in self.columns:
+            return self.columns + [ARCHIPEL_DB_TABLE_KEYS[self.table]]
+        return self.columns
+
+    def check_column(self, column):
+        """
+        Raise an exception if the column is not part of the table.
+        @type column: string
+        @param column: the column name
+        """
+        if not column in ARCHIPEL_DB_TABLE_COLUMNS[self.table]:
+            raise Exception("Unknown column %s in table %s" % (column, self.table))
+
+    def to_sql(self):
+        """
+        Build the parameterized statement.
+        @rtype: tuple
+        @return: (statement, list of parameters)
+        """
+        columns = self.selected_columns()
+        clauses = []
+        params = []
+        for column, operator, value in self.filters:
+            self.check_column(column)
+            if not operator in ARCHIPEL_DB_OPERATORS:
+                raise Exception("Unknown operator %s" % operator)
+            if operator in ("in", "not in"):
+                if len(value) == 0:
+                    clauses.append(operator == "in" and "0" or "1")
+                    continue
+                clauses.append("%s %s (%s)" % (column, operator, ",".join("?" * len(value))))
+                params.extend(value)
+            elif operator in ("is null", "is not null"):
+                clauses.append("%s %s" % (column, operator))
+            else:
+                clauses.append("%s %s ?" % (column, operator))
+                params.append(value)
+        for name in self.conditions:
+            if not name in ARCHIPEL_DB_CONDITIONS.get(self.table, {}):
+                raise Exception("Unknown condition %s for table %s" % (name, self.table))
+            clauses.append(ARCHIPEL_DB_CONDITIONS[self.table][name])
+        order_by, descending = self.order_by, self.descending
+        if self.page_size:
+            if not self.is_pageable():
+                raise Exception("A paged query cannot have its own order or limit")
+            order_by, descending = ARCHIPEL_DB_TABLE_KEYS[self.table], False
+            if self.cursor is not None:
+                clauses.append("%s > ?" % ARCHIPEL_DB_TABLE_KEYS[self.table])
+                params.append(self.cursor)
+
+        statement = "select %s from %s" % (", ".join(columns), self.table)
+        if clauses:
+            statement += " where %s" % " and ".join(clauses)
+        if order_by:
+            self.check_column(order_by)
+            statement += " order by %s%s" % (order_by, descending and " desc" or "")
+        if self.page_size:
+            # one more row tells if there is a next page
+            statement += " limit ?"
+            params.append(int(self.page_size) + 1)
+        elif self.limit is not None:
+            statement += " limit ?"
+            params.append(int(self.limit))
+            if self.offset is not None:
+                statement += " offset ?"
+                params.append(int(self.offset))
+        return statement, params
+
+    def rows_to_entries(self, rows):
+        """
+        Turn the rows returned by the statement into a list of dict.
+        @type rows: list
+        @param rows: the rows
+        @rtype: list
+        @return: list of dict column -> value
+        """
+        columns = self.selected_columns()
+        entries = []
+        for row in rows:
+            entries.append(dict(zip(columns, row)))
+        return entries
+
+    ### XMPP
+
+    def to_node(self, node):
+        """
+        Write the query into the given node.
+        @type node: xmpp.Node
+        @param node: the event node sent to the central agent
+        @rtype: xmpp.Node
+        @return: the node
+        """
+        node.setAttr("table", self.table)
+        if self.columns:
+            node.setAttr("columns", ",".join(self.columns))
+        if self.order_by:
+            node.setAttr("order_by", self.order_by)
+            node.setAttr("descending", self.descending and "true" or "false")
+        if self.limit is not None:
+            node.setAttr("limit", self.limit)
+        if self.offset is not None:
+            node.setAttr("offset", self.offset)
+        if self.page_size:
+            node.setAttr("page_size", self.page_size)
+        if self.cursor is not None:
+            node.setAttr("cursor", self.cursor)
+        for column, operator, value in self.filters:
+            filter_node = node.addChild("filter", attrs={"column": column, "operator": operator})
+            if isinstance(value, (list, tuple)):
+                for item in value:
+                    filter_node.addChild("value", attrs={"value": item})
+            elif value is not None:
+                filter_node.setAttr("value", value)
+        for name in self.conditions:
+            node.addChild("condition", attrs={"name": name})
+        return node
+
+    @classmethod
+    def from_node(cls, node, table=None):
+        """
+        Read a query sent with to_node.
+        @type node: xmpp.Node
+        @param node: the received event node
+        @type table: string
+        @param table: if given, the table is forced to this value
+        @rtype: L{TNDBQuery}
+        @return: the query
+        """
+        columns = None
+        if node.getAttr("columns") and node.getAttr("columns") != "*":
+            columns = [column.strip() for column in node.getAttr("columns").split(",")]
+        query = cls(table or node.getAttr("table"), columns)
+        for filter_node in node.getTags("filter"):
+            operator = (filter_node.getAttr("operator") or "").strip().lower()
+            if operator in ("in", "not in"):
+                value = [value_node.getAttr("value") for value_node in filter_node.getTags("value")]
+            else:
+                value = filter_node.getAttr("value")
+            query.where(filter_node.getAttr("column"), operator, value)
+        for condition_node in node.getTags("condition"):
+            query.condition(condition_node.getAttr("name"))
+        if node.getAttr("order_by"):
+            query.order(node.getAttr("order_by"), node.getAttr("descending") == "true")
+        if node.getAttr("limit"):
+            query.slice(int(node.getAttr("limit")), node.getAttr("offset") and int(node.getAttr("offset")) or None)
+        if node.getAttr("page_size"):
+            query.page(int(node.getAttr("page_size")), node.getAttr("cursor"))
+        return query
@@ -19,11 +19,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import types
 import xmpp
 
+from collections import OrderedDict
+from threading import Lock
 from uuid import uuid1 as uuid
 
+from archipelcore.utils import log
+
 XMPP_PUBSUB_VAR_TITLE                                       = "pubsub#title"
 XMPP_PUBSUB_VAR_DELIVER_NOTIFICATION                        = "pubsub#deliver_notifications"
 XMPP_PUBSUB_VAR_DELIVER_PAYLOADS                            = "pubsub#deliver_payloads"
@@ -63,10 +68,415 @@ XMPP_PUBSUB_AFFILIATION_MEMBER                             = "member"
 XMPP_PUBSUB_AFFILIATION_NONE                               = "none"
 XMPP_PUBSUB_AFFILIATION_OUTCAST                            = "outcast"
 
+# max number of publish/retract IQs of a publish queue waiting for their answer
+XMPP_PUBSUB_PUBLISH_MAX_IN_FLIGHT                          = 8
+# number of queued publications above which a publish queue reports backpressure
+XMPP_PUBSUB_PUBLISH_HIGH_WATERMARK                         = 256
+# number of seconds after which an unanswered publish/retract IQ stops counting as in flight
+XMPP_PUBSUB_PUBLISH_TIMEOUT                                = 30
+
+
+class TNPubSubItemStore (object):
+    """
+    In memory copy of the items of a pubsub node, indexed by item id and
+    optionally by an attribute of the item payload (for instance "jid").
+    It is filled by a full retrieval of the node, then kept current with
+    the publications and retractions of the entity and with the pubsub
+    event notifications.
+    """
+
+    def __init__(self, index_attribute=None, max_items=None):
+        """
+        Initialize the TNPubSubItemStore.
+        @type index_attribute: string
+        @param index_attribute: if not None, the attribute of the payload to index items on
+        @type max_items: integer
+        @param max_items: if not None, the oldest items are dropped above this number, like the server does
+        """
+        self.index_attribute    = index_attribute
+        self.max_items          = max_items
+        self.items              = OrderedDict()
+        self.index              = {}
+        self.synchronized       = False
+        self.subscribers        = OrderedDict()
+        self.subscriber_jid     = None
+        self.lock               = Lock()
+
+    def item_key(self, item_id):
+        """
+        Item ids are compared without case.
+        """
+        return item_id and item_id.lower()
+
+    def index_value(self, item):
+        """
+        Return the value of the indexed attribute of the item payload.
+        @type item: xmpp.Node
+        @param item: the pubsub item
+        @rtype: string
+        @return: the value, or None
+        """
+        if not self.index_attribute:
+            return None
+        for payload in item.getChildren():
+            if payload.getAttr(self.index_attribute):
+                return payload.getAttr(self.index_attribute)
+        return None
+
+    def reset(self, items):
+        """
+        Replace the content of the store with the result of a full retrieval.
+        @type items: list
+        @param items: list of pubsub items
+        """
+        self.lock.acquire()
+        try:
+            self.items = OrderedDict()
+            self.index = {}
+            for item in items:
+                self._put(item)
+            self.synchronized = True
+        finally:
+            self.lock.release()
+
+    def invalidate(self):
+        """
+        Mark the store as out of date. The next recover will retrieve the whole node.
+        """
+        self.synchronized = False
+
+    def put(self, item):
+        """
+        Add or replace an item.
+        @type item: xmpp.Node
+        @param item: the pubsub item
+        """
+        self.lock.acquire()
+        try:
+            self._put(item)
+        finally:
+            self.lock.release()
+
+    def _put(self, item):
+        key = self.item_key(item.getAttr("id"))
+        if key in self.items:
+            self._remove(key)
+        self.items[key] = item
+        value = self.index_value(item)
+        if value is not None:
+            self.index.setdefault(value, []).append(key)
+        while self.max_items and len(self.items) > self.max_items:
+            self._remove(self.items.iterkeys().next())
+
+    def remove(self, item_id):
+        """
+        Remove an item.
+        @type item_id: string
+        @param item_id: the item id
+        @rtype: Boolean
+        @return: True if the item was in the store
+        """
+        self.lock.acquire()
+        try:
+            return self._remove(self.item_key(item_id))
+        finally:
+            self.lock.release()
+
+    def _remove(self, key):
+        item = self.items.pop(key, None)
+        if item is None:
+            return False
+        value = self.index_value(item)
+        if value in self.index:
+            self.index[value].remove(key)
+            if not self.index[value]:
+                del self.index[value]
+        return True
+
+    def get(self, item_id):
+        """
+        @type item_id: string
+        @param item_id: the item id
+        @rtype: xmpp.Node
+        @return: the item, or None
+        """
+        return self.items.get(self.item_key(item_id), None)
+
+    def get_all(self):
+        """
+        @rtype: list
+        @return: all items, in publication order
+        """
+        self.lock.acquire()
+        try:
+            return self.items.values()
+        finally:
+            self.lock.release()
+
+    def get_by_index(self, value):
+        """
+        @type value: string
+        @param value: the value of the indexed attribute
+        @rtype: list
+        @return: the items having this value, in publication order
+        """
+        self.lock.acquire()
+        try:
+            return [self.items[key] for key in self.index.get(value, [])]
+        finally:
+            self.lock.release()
+
+    def apply_event(self, event_items):
+        """
+        Apply the content of a pubsub event notification.
+        @type event_items: xmpp.Node
+        @param event_items: the <items/> node of the event
+        @rtype: list
+        @return: the ids of the published items that came without payload and must be retrieved
+        """
+        missing_ids = []
+        for child in event_items.getChildren():
+            if child.getName() == "item":
+                if child.getChildren():
+                    self.put(child)
+                else:
+                    missing_ids.append(child.getAttr("id"))
+            elif child.getName() == "retract":
+                self.remove(child.getAttr("id"))
+        return missing_ids
+
+# stores shared by all the entities of the process, by (pubsub server, node name)
+shared_item_stores = {}
+shared_item_stores_lock = Lock()
+
+def get_shared_item_store(pubsubserver, nodename, index_attribute=None, max_items=None):
+    """
+    Return the item store of the node shared by all the entities of the process.
+    @type pubsubserver: string
+    @param pubsubserver: the JID of the pubsub server
+    @type nodename: string
+    @param nodename: the name of the pubsub node
+    @rtype: L{TNPubSubItemStore}
+    @return: the store
+    """
+    shared_item_stores_lock.acquire()
+    try:
+        key = (str(pubsubserver), nodename)
+        if not key in shared_item_stores:
+            shared_item_stores[key] = TNPubSubItemStore(index_attribute, max_items)
+        return shared_item_stores[key]
+    finally:
+        shared_item_stores_lock.release()
+
+
+class TNPubSubPublishQueue (object):
+    """
+    Queue of the publications and retractions of an entity on a pubsub node.
+    Requests are pipelined: up to max_in_flight IQs are sent without waiting
+    for the answers, and the next ones are sent as answers arrive.
+    Queued requests about the same item id, or with the same coalesce key,
+    are merged so only the last one is sent.
+    A request that is not answered within timeout seconds (for instance
+    because the connection was lost) fails and frees its slot. Expired
+    requests are detected when the queue is flushed.
+    """
+
+    def __init__(self, node, max_in_flight=XMPP_PUBSUB_PUBLISH_MAX_IN_FLIGHT, high_watermark=XMPP_PUBSUB_PUBLISH_HIGH_WATERMARK, timeout=XMPP_PUBSUB_PUBLISH_TIMEOUT):
+        """
+        Initialize the TNPubSubPublishQueue.
+        @type node: L{TNPubSubNode}
+        @param node: the pubsub node
+        @type max_in_flight: integer
+        @param max_in_flight: max number of IQs waiting for their answer
+        @type high_watermark: integer
+        @param high_watermark: number of queued requests above which the queue reports backpressure
+        @type timeout: integer
+        @param timeout: number of seconds after which an unanswered request fails
+        """
+        self.node           = node
+        self.max_in_flight  = max_in_flight
+        self.high_watermark = high_watermark
+        self.timeout        = timeout
+        self.pending        = OrderedDict()
+        self.in_flight      = {}
+        self.sequence       = 0
+        self.sent           = 0
+        self.coalesced      = 0
+        self.expired        = 0
+        self.failed         = 0
+        self.lock           = Lock()
+
+    def publish(self, itemcontentnode, item_id=None, coalesce_key=None, callback=None):
+        """
+        Queue the publication of an item.
+        @type itemcontentnode: xmpp.Node
+        @param itemcontentnode: the node to publish
+        @type item_id: string
+        @param item_id: if not None, the id of the item. A queued request about the same item is replaced
+        @type coalesce_key: object
+        @param coalesce_key: if not None, a queued publication with the same key is replaced
+        @type callback: function
+        @param callback: if not None, callback(resp) is called when the publication is answered or fails
+        @rtype: Boolean
+        @return: False if the queue is above its high watermark
+        """
+        if item_id:
+            key = ("item", item_id)
+        elif coalesce_key is not None:
+            key = ("coalesce", coalesce_key)
+        else:
+            key = None
+        return self.enqueue(key, ("publish", itemcontentnode, item_id), callback)
+
+    def retract(self, item_id, callback=None):
+        """
+        Queue the retraction of an item. A queued publication of the same item is dropped.
+        @type item_id: string
+        @param item_id: the id of the item
+        @type callback: function
+        @param callback: if not None, callback(resp) is called when the retraction is answered or fails
+        @rtype: Boolean
+        @return: False if the queue is above its high watermark
+        """
+        return self.enqueue(("item", item_id), ("retract", None, item_id), callback)
+
+    def enqueue(self, key, request, callback):
+        """
+        Add or merge a request and send what can be sent.
+        """
+        self.lock.acquire()
+        try:
+            if key is None:
+                self.sequence += 1
+                key = ("unique", self.sequence)
+            callbacks = []
+            if key in self.pending:
+                callbacks = self.pending.pop(key)[1]
+                self.coalesced += 1
+            if callback:
+                callbacks.append(callback)
+            self.pending[key] = (request, callbacks)
+            accepted = len(self.pending) <= self.high_watermark
+        finally:
+            self.lock.release()
+        self.flush()
+        return accepted
+
+    def is_congested(self):
+        """
+        @rtype: Boolean
+        @return: True if the queue is above its high watermark
+        """
+        return len(self.pending) > self.high_watermark
+
+    def get_statistics(self):
+        """
+        @rtype: dict
+        @return: the number of pending, in flight, sent, coalesced, expired and failed requests
+        """
+        return {"pending": len(self.pending), "in_flight": len(self.in_flight), "sent": self.sent,
+                "coalesced": self.coalesced, "expired": self.expired, "failed": self.failed}
+
+    def error_response(self, condition):
+        """
+        Build the error given to the callbacks of a request that was not answered.
+        @type condition: string
+        @param condition: the XMPP error condition
+        @rtype: xmpp.Protocol.Iq
+        @return: an IQ of type error
+        """
+        resp = xmpp.Iq(typ="error", frm=self.node.pubsubserver)
+        resp.setError(condition)
+        return resp
+
+    def expire(self):
+        """
+        Fail the requests in flight for more than timeout seconds.
+        @rtype: list
+        @return: the callbacks of the expired requests
+        """
+        expired_callbacks = []
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for token, (deadline, callbacks) in self.in_flight.items():
+                if deadline <= now:
+                    del self.in_flight[token]
+                    self.expired += 1
+                    expired_callbacks.extend(callbacks)
+        finally:
+            self.lock.release()
+        return expired_callbacks
+
+    def flush(self):
+        """
+        Fail the expired requests, then send the queued ones, up to max_in_flight.
+        """
+        expired_callbacks = self.expire()
+        if expired_callbacks:
+            log.warning("PUBSUB: publication requests on %s were not answered in %ds" % (self.node.nodename, self.timeout))
+            self.run_callbacks(expired_callbacks, self.error_response(xmpp.ERR_REMOTE_SERVER_TIMEOUT))
+        while True:
+            self.lock.acquire()
+            try:
+                if len(self.in_flight) >= self.max_in_flight or not self.pending:
+                    return
+                key, (request, callbacks) = self.pending.popitem(last=False)
+                self.sequence += 1
+                token = self.sequence
+                self.in_flight[token] = (time.time() + self.timeout, callbacks)
+                self.sent += 1
+            finally:
+                self.lock.release()
+            self.send(token, request, callbacks)
+
+    def run_callbacks(self, callbacks, resp):
+        """
+        Give the answer of a request to its callbacks.
+        """
+        for callback in callbacks:
+            try:
+                callback(resp)
+            except Exception as ex:
+                log.error("PUBSUB: error in publication callback on %s: %s" % (self.node.nodename, str(ex)))
+
+    def send(self, token, request, callbacks):
+        """
+        Send one request. If it cannot be sent, its callbacks are called
+        with an error and the next requests are still sent.
+        """
+        action, itemcontentnode, item_id = request
+
+        def _did_send(resp, user_info=None):
+            self.lock.acquire()
+            try:
+                # a request that expired has already been answered
+                answered = self.in_flight.pop(token, None) is not None
+            finally:
+                self.lock.release()
+            if answered:
+                self.run_callbacks(callbacks, resp)
+            self.flush()
+
+        try:
+            if action == "publish":
+                self.node.add_item(itemcontentnode, callback=_did_send, item_id=item_id)
+            else:
+                self.node.remove_item(item_id, callback=_did_send)
+        except Exception as ex:
+            log.error("PUBSUB: unable to %s item on %s: %s" % (action, self.node.nodename, str(ex)))
+            self.lock.acquire()
+            try:
+                self.in_flight.pop(token, None)
+                self.failed += 1
+            finally:
+                self.lock.release()
+            self.run_callbacks(callbacks, self.error_response(xmpp.ERR_ITEM_NOT_FOUND))
+
 
 class TNPubSubNode:
 
-    def __init__(self, xmppclient, pubsubserver, nodename):
+    def __init__(self, xmppclient, pubsubserver, nodename, index_attribute=None, max_items=None, shared=False):
         """
         Initialize the TNPubSubNode.
         @type xmppclient: xmpp.Dispatcher
@@ -75,28 +485,47 @@ class TNPubSubNode:
         @param xmppclient: the string containing the JID of the pubsub server
         @type nodename: string
         @param nodename: the name of the pubsub node
+        @type index_attribute: string
+        @param index_attribute: if not None, items are also indexed on this attribute of their payload (see get_items_by)
+        @type max_items: integer
+        @param max_items: the pubsub#max_items of the node, if the local copy must be bounded the same way
+        @type shared: Boolean
+        @param shared: if True, the items are shared with the other TNPubSubNode of the process
+                       using the same node, and retrieved only once
         """
         self.xmppclient     = xmppclient
         self.pubsubserver   = pubsubserver
         self.nodename       = nodename
         self.recovered      = False
-        self.content        = None
         self.affiliations   = {}
         self.subscriptions  = []
+        self.publish_queue  = None
+        self.subscriber_callback = None
+        self.subscriber_jid = None
+        self.run_on_loop    = None
+        if shared:
+            self.store = get_shared_item_store(pubsubserver, nodename, index_attribute, max_items)
+        else:
+            self.store = TNPubSubItemStore(index_attribute, max_items)
 
 
     ### Node management
 
-    def recover(self, wait=False):
+    def recover(self, wait=False, force=False):
         """
         Get the current pubsub node and wait for response. If not already recovered, ask to server.
+        The items are not retrieved again if the store is up to date, unless force is True.
         @type wait: Boolean
         @param wait: if True, recovering will be blockant (IE, execution interrupted until recovering)
+        @type force: Boolean
+        @param force: if True, always retrieve all the items
         @rtype: Boolean
         @return: True in case of success
         """
+        if self.store.synchronized and not force:
+            self.recovered = True
+            return True
         try:
-            self.retrieve_items(wait=wait)
             return self.retrieve_items(wait=wait)
         except Exception as ex:
             return False
@@ -116,7 +545,7 @@ class TNPubSubNode:
         def _did_retrieve_items(conn, resp, callback=None):
             ret = False
             if resp.getType() == "result":
-                self.content = resp.getTag("pubsub").getTag("items").getTags("item")
+                self.store.reset(resp.getTag("pubsub").getTag("items").getTags("item"))
                 self.recovered = True
                 ret = True
             if callback:
@@ -130,6 +559,31 @@ class TNPubSubNode:
             self.xmppclient.SendAndCallForResponse(iq, func=_did_retrieve_items, args={"callback": callback})
             return True
 
+    def retrieve_items_by_id(self, item_ids, callback=None):
+        """
+        Retrieve only the given items and add them to the store.
+        @type item_ids: list
+        @param item_ids: the ids of the items
+        @type callback: function
+        @param callback: if not None, callback will be called with the response
+        """
+        iq           = xmpp.Iq(typ="get", to=self.pubsubserver)
+        iq_pubsub    = iq.addChild(name='pubsub', namespace="http://jabber.org/protocol/pubsub")
+        iq_items     = iq_pubsub.addChild(name="items", attrs={"node": self.nodename})
+        for item_id in item_ids:
+            iq_items.addChild(name="item", attrs={"id": item_id})
+
+        def _did_retrieve_items_by_id(conn, resp, callback=None):
+            if resp.getType() == "result":
+                for item in resp.getTag("pubsub").getTag("items").getTags("item"):
+                    self.store.put(item)
+            else:
+                self.store.invalidate()
+            if callback:
+                callback(resp)
+
+        self.xmppclient.SendAndCallForResponse(iq, func=_did_retrieve_items_by_id, args={"callback": callback})
+
     def create(self, callback=None, wait=False):
         """
         Create node on server if not exists.
@@ -176,6 +630,9 @@ class TNPubSubNode:
         def _did_delete(conn, resp, callback):
             ret = False
             if resp.getType() == "result":
+                self.store.reset([])
+                self.store.invalidate()
+                self.recovered = False
                 ret = True
             if callback:
                 callback(resp)
@@ -237,7 +694,7 @@ class TNPubSubNode:
         @rtype: list
         @return: list of pubsub's xmpp.Nonde
         """
-        return self.content
+        return self.store.get_all()
 
     def get_item(self, item_id):
         """
@@ -245,12 +702,20 @@ class TNPubSubNode:
         @type item_id: string
         @param item_id: the pubsub node id
         """
-        for n in self.content:
-            if n.getAttr("id").lower() == item_id.lower():
-                return n
-        return None
+        return self.store.get(item_id)
+
+    def get_items_by(self, value):
+        """
+        Return the items whose payload has the given value for the
+        index attribute given to the constructor.
+        @type value: string
+        @param value: the value of the index attribute
+        @rtype: list
+        @return: list of pubsub's xmpp.Node
+        """
+        return self.store.get_by_index(value)
 
-    def add_item(self, itemcontentnode, callback=None, wait=False):
+    def add_item(self, itemcontentnode, callback=None, wait=False, item_id=None):
         """
         Add a leaf item xmpp.node to the node and will trigger callback if any
         on server answer.
@@ -258,6 +723,8 @@ class TNPubSubNode:
         @param itemcontentnode: the node to publish on the pubsub
         @type callback: function
         @param callback: if not None, callback will be called after publication
+        @type item_id: string
+        @param item_id: if not None, the id of the item. An existing item with this id is replaced
         """
         if not self.recovered:
             raise Exception("PUBSUB: can't add item. Node %s doesn't exists." % self.nodename)
@@ -265,13 +732,13 @@ class TNPubSubNode:
         pubsub      = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
         publish     = pubsub.addChild("publish", attrs={"node": self.nodename})
         item        = publish.addChild("item")
-        item.setAttr("id", str(uuid()))
+        item.setAttr("id", item_id or str(uuid()))
         item.addChild(node=itemcontentnode)
 
         def _did_publish_item(conn, resp, callback, item):
             ret = False
             if resp.getType() == "result" and resp.getTag("pubsub").getTag("publish").getTag("item").getAttr("id") == item.getAttr("id"):
-                self.content.append(item)
+                self.store.put(item)
                 ret = True
             if callback:
                 return callback(resp)
@@ -300,15 +767,15 @@ class TNPubSubNode:
         retract = pubsub.addChild("retract", attrs={"node": self.nodename})
         item = retract.addChild("item", attrs={"id": item_id})
 
-        for item in self.content:
-            if item.getAttr("id") == item_id:
-                self.content.remove(item)
-                break
+        self.store.remove(item_id)
 
         def _did_remove_item(conn, resp, callback, user_info):
             ret = False
             if resp.getType() == "result":
                 ret = True
+            else:
+                # the server does not have the same items as us
+                self.store.invalidate()
             if callback:
                 return callback(resp, user_info)
             return ret
@@ -321,6 +788,33 @@ class TNPubSubNode:
 
 
 
+    def get_publish_queue(self):
+        """
+        Return the publish queue of the node, created on first use.
+        @rtype: L{TNPubSubPublishQueue}
+        @return: the queue
+        """
+        if not self.publish_queue:
+            self.publish_queue = TNPubSubPublishQueue(self)
+        return self.publish_queue
+
+    def publish(self, itemcontentnode, item_id=None, coalesce_key=None, callback=None):
+        """
+        Queue the publication of an item. See L{TNPubSubPublishQueue.publish}.
+        @rtype: Boolean
+        @return: False if the queue is above its high watermark
+        """
+        return self.get_publish_queue().publish(itemcontentnode, item_id, coalesce_key, callback)
+
+    def retract(self, item_id, callback=None):
+        """
+        Queue the retraction of an item. See L{TNPubSubPublishQueue.retract}.
+        @rtype: Boolean
+        @return: False if the queue is above its high watermark
+        """
+        return self.get_publish_queue().retract(item_id, callback)
+
+
     ## Subscription management
 
     def retrieve_subscriptions(self, callback=None, wait=False):
@@ -380,6 +874,9 @@ class TNPubSubNode:
         def _did_subscribe(conn, resp, callback):
             ret = False
             if resp.getType() == "result":
+                subscription = resp.getTag("pubsub") and resp.getTag("pubsub").getTag("subscription")
+                if subscription and subscription.getAttr("subid"):
+                    self.subscriptions.append(subscription.getAttr("subid"))
                 self.xmppclient.RegisterHandler('message', self._on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
                 ret = True
             return ret
@@ -394,17 +891,118 @@ class TNPubSubNode:
 
         self.xmppclient.send(iq)
 
+    def subscribe_shared(self, jid, run_on_loop=None):
+        """
+        Make the shared store of the node receive the event notifications.
+        Only one TNPubSubNode of the process subscribes, the others are kept
+        as candidates and one of them takes over when it is released.
+        @type jid: xmpp.Protocol.JID
+        @param jid: the JID of the entity owning this TNPubSubNode
+        @type run_on_loop: function
+        @param run_on_loop: called with a function to run it on the loop of the entity owning
+                            this TNPubSubNode. If None, the take over runs on the releasing thread
+        """
+        subscribe = False
+        self.run_on_loop = run_on_loop
+        self.store.lock.acquire()
+        try:
+            self.store.subscribers[jid.getStripped()] = self
+            if self.store.subscriber_jid in (None, jid.getStripped()):
+                self.store.subscriber_jid = jid.getStripped()
+                subscribe = True
+        finally:
+            self.store.lock.release()
+        if subscribe:
+            self.subscribe(jid, wait=True)
+
+    def release_shared(self, jid):
+        """
+        Stop receiving the event notifications for the shared store. If this
+        TNPubSubNode was the subscriber, its subscription is removed and the
+        next candidate subscribes and retrieves the items on its own loop,
+        as events may have been missed meanwhile.
+        @type jid: xmpp.Protocol.JID
+        @param jid: the JID of the entity owning this TNPubSubNode
+        """
+        successor = None
+        self.store.lock.acquire()
+        try:
+            if not self.store.subscribers.get(jid.getStripped()) is self:
+                return
+            del self.store.subscribers[jid.getStripped()]
+            if not self.store.subscriber_jid == jid.getStripped():
+                return
+            self.store.subscriber_jid = None
+            if self.store.subscribers:
+                successor_jid, successor = self.store.subscribers.items()[0]
+                self.store.subscriber_jid = successor_jid
+        finally:
+            self.store.lock.release()
+        self.xmppclient.UnregisterHandler('message', self._on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
+        try:
+            for subid in self.subscriptions or [None]:
+                self.unsubscribe(jid, subid)
+        except Exception as ex:
+            log.warning("PUBSUB: unable to unsubscribe %s from %s: %s" % (jid.getStripped(), self.nodename, str(ex)))
+        self.subscriptions = []
+        self.subscriber_callback = None
+        self.subscriber_jid = None
+        self.store.invalidate()
+        if successor:
+            # the successor uses its own connection: never wait on it from the releasing thread
+            if successor.run_on_loop:
+                successor.run_on_loop(lambda: successor.take_over_shared(xmpp.JID(successor_jid)))
+            else:
+                successor.take_over_shared(xmpp.JID(successor_jid))
+
+    def take_over_shared(self, jid):
+        """
+        Become the subscriber of the shared store, after the previous one
+        has been released. Nothing is done if this TNPubSubNode has been
+        released meanwhile.
+        @type jid: xmpp.Protocol.JID
+        @param jid: the JID of the entity owning this TNPubSubNode
+        """
+        self.store.lock.acquire()
+        try:
+            if not self.store.subscriber_jid == jid.getStripped() or not self.store.subscribers.get(jid.getStripped()) is self:
+                return
+        finally:
+            self.store.lock.release()
+        try:
+            self.subscribe(jid, wait=True)
+            self.retrieve_items()
+        except Exception as ex:
+            log.error("PUBSUB: %s is unable to take over the subscription to %s: %s" % (jid.getStripped(), self.nodename, str(ex)))
+
     def _on_pubsub_event(self, conn, event):
         """
-        Trigger the callback for events.
+        Update the items with the event and trigger the callback, if any.
+        The whole node is retrieved only if the items are not up to date.
         """
+        purge = event.getTag("event").getTag("purge")
+        if purge and purge.getAttr("node") == self.nodename:
+            self.store.reset([])
+            return
+        items = event.getTag("event").getTag("items")
+        if not items or items.getAttr("node") != self.nodename:
+            return
+        if not self.subscriber_jid or event.getTo().getStripped() != self.subscriber_jid.getStripped():
+            return
+
         def on_retrieve(resp):
-            if resp.getType() == "result":
-                node = event.getTag("event").getTag("items").getAttr("node")
-                if node == self.nodename and self.subscriber_callback and event.getTo().getStripped() == self.subscriber_jid.getStripped():
-                    self.subscriber_callback(event)
+            if resp.getType() == "result" and self.subscriber_callback:
+                self.subscriber_callback(event)
 
-        self.retrieve_items(callback=on_retrieve)
+        if not self.store.synchronized:
+            self.retrieve_items(callback=on_retrieve)
+            return
+        missing_ids = self.store.apply_event(items)
+        if missing_ids:
+            self.retrieve_items_by_id(missing_ids, callback=on_retrieve)
+            return
+        if self.subscriber_callback:
+            self.subscriber_callback(event)
 
     def unsubscribe(self, jid, subID, callback=None, wait=False):
         """
@@ -425,7 +1023,10 @@ class TNPubSubNode:
 
         iq = xmpp.Iq(typ="set", to=self.pubsubserver)
         pubsub = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
-        pubsub.addChild("unsubscribe", attrs={"node": self.nodename, "jid": jid.getStripped(), "subid": subID})
+        attrs = {"node": self.nodename, "jid": jid.getStripped()}
+        if subID:
+            attrs["subid"] = subID
+        pubsub.addChild("unsubscribe", attrs=attrs)
 
         if wait:
             resp = self.xmppclient.SendAndWaitForResponse(iq)
@@ -29,7 +29,6 @@ import ConfigParser
 import socket
 import struct
 import fcntl
-import inspect
 import glob
 import logging
 import logging.handlers
@@ -48,6 +47,11 @@ ARCHIPEL_LOG_INFO                               = 1
 ARCHIPEL_LOG_WARNING                            = 2
 ARCHIPEL_LOG_ERROR                              = 3
 
+ARCHIPEL_LOG_PYTHON_LEVELS                      = {ARCHIPEL_LOG_DEBUG: logging.DEBUG,
+                                                   ARCHIPEL_LOG_INFO: logging.INFO,
+                                                   ARCHIPEL_LOG_WARNING: logging.WARNING,
+                                                   ARCHIPEL_LOG_ERROR: logging.ERROR}
+
 
 log = logging.getLogger('archipel')
 
@@ -61,37 +65,42 @@ class TNArchipelLogger:
         self.xmppclient = xmppconn
         self.entity     = entity
         self.pubSubNode = pubsubnode
-
-    def __log(self, level, msg):
-        log = logging.getLogger('archipel')
-        msg = "\033[33m%s.%s (%s)\033[0m::%s" % (self.entity.__class__.__name__, inspect.stack()[2][3],  self.entity.jid, msg)
+        self.classname  = entity.__class__.__name__
+
+    def __log(self, level, msg, args):
+        """
+        Send the message to the archipel logger. The level is checked
+        before anything is computed, and msg is only formatted with
+        args by the logging module if the record is really emitted.
+        """
         if level < ARCHIPEL_LOG_LEVEL:
             return
-        elif level == ARCHIPEL_LOG_DEBUG:
-            log.debug(msg)
-        elif level == ARCHIPEL_LOG_INFO:
-            log.info(msg)
-        elif level == ARCHIPEL_LOG_WARNING:
-            log.warning(msg)
-        elif level == ARCHIPEL_LOG_ERROR:
-            log.error(msg)
+        python_level = ARCHIPEL_LOG_PYTHON_LEVELS[level]
+        if not log.isEnabledFor(python_level):
+            return
+        # frame 0 is __log, 1 is debug/info/..., 2 is the caller
+        caller = sys._getframe(2).f_code.co_name
+        if args:
+            log.log(python_level, "\033[33m%s.%s (%s)\033[0m::%s" % (self.classname, caller, self.entity.jid, msg), *args)
+        else:
+            log.log(python_level, "\033[33m%s.%s (%s)\033[0m::%s", self.classname, caller, self.entity.jid, msg)
 
         # if self.xmppclient and self.pubSubNode:
         #     log = xmpp.Node(tag="log", attrs={"date": datetime.datetime.now(), "level": str(level)})
         #     log.setData(msg)
         #     self.pubSubNode.add_item(log)
 
-    def debug(self, msg):
-        self.__log(ARCHIPEL_LOG_DEBUG, msg)
+    def debug(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_DEBUG, msg, args)
 
-    def info(self, msg):
-        self.__log(ARCHIPEL_LOG_INFO, msg)
+    def info(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_INFO, msg, args)
 
-    def warning(self, msg):
-        self.__log(ARCHIPEL_LOG_WARNING, msg)
+    def warning(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_WARNING, msg, args)
 
-    def error(self, msg):
-        self.__log(ARCHIPEL_LOG_ERROR, msg)
+    def error(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_ERROR, msg, args)
 
 
 class ColorFormatter (logging.Formatter):
@@ -166,7 +175,7 @@ def init_log(conf):
 
 
 def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
-    caller = inspect.stack()[1][3]
+    caller = sys._getframe(1).f_code.co_name
     log.error("%s.%s: exception raised is: '%s' triggered by stanza :\n%s" % (originclass, caller, ex, str(iq)))
     t, v, tr = sys.exc_info()
     log.debug("\n".join(traceback.format_exception(t,v,tr)))
@@ -187,7 +196,7 @@ def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
 
 
 def build_error_message(originclass, ex, msg):
-    caller = inspect.stack()[3][3]
+    caller = sys._getframe(3).f_code.co_name
     log.error("%s: exception raised is: '%s' triggered by message:\n %s" % (caller, str(ex), str(msg)))
     return str(ex)
 
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# logger_benchmark.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of L{TNArchipelLogger}: measures the cost of one call
+when the message is filtered out by the logging level and when it is
+really emitted (to /dev/null).
+
+usage: python logger_benchmark.py [number_of_calls]
+"""
+
+import logging
+import os
+import sys
+import timeit
+
+from archipelcore import utils
+
+
+class FakeEntity (object):
+    """
+    Minimal entity as seen by the logger.
+    """
+    jid = "benchmark@archipel.local/bench"
+
+
+def run(number):
+    """
+    Run the benchmark.
+    @type number: integer
+    @param number: number of calls for each measure
+    """
+    logger = utils.TNArchipelLogger(FakeEntity())
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(utils.ColorFormatter("%(levelname)s::%(asctime)s::%(message)s"))
+    utils.log.addHandler(handler)
+    utils.log.propagate = False
+
+    def log_static():
+        logger.debug("this is a message")
+
+    def log_interpolated():
+        logger.debug("this is a message with %s and %d", "argument", 42)
+
+    def log_preformatted():
+        logger.debug("this is a message with %s and %d" % ("argument", 42))
+
+    cases = (("static", log_static), ("lazy args", log_interpolated), ("pre-formatted", log_preformatted))
+    for level_name, level in (("filtered", logging.INFO), ("emitted", logging.DEBUG)):
+        utils.log.setLevel(level)
+        for case_name, case in cases:
+            duration = min(timeit.repeat(case, number=number, repeat=3))
+            print "%-10s %-15s %8.3f us/call" % (level_name, case_name, duration * 1000000.0 / number)
+
+
+if __name__ == "__main__":
+    number = 100000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    run(number)
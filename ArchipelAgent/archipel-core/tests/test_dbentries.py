@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# test_dbentries.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of the encodings of the database entries exchanged with the central agent.
+"""
+
+import unittest
+
+from archipelcore import xmpp
+from archipelcore.dbentries import ARCHIPEL_ENTRIES_ENCODING_COMPACT, ARCHIPEL_ENTRIES_ENCODING_XML, \
+    negotiate_encoding, pack_entries, unpack_entries
+
+
+ENTRIES = [{"uuid": "a", "name": u"caf\xe9", "domain": "<domain type='kvm'><name>a</name></domain>", "creation_date": 12},
+           {"uuid": "b", "name": "web", "domain": "None", "creation_date": None}]
+
+
+class TestEntriesEncoding (unittest.TestCase):
+
+    def received(self, encoding):
+        """
+        Pack the entries in an event, and unpack them from the received stanza.
+        """
+        event = xmpp.Node("event")
+        for node in pack_entries(ENTRIES, encoding):
+            event.addChild(node=node)
+        return unpack_entries(xmpp.simplexml.XML2Node(unicode(event).encode("utf-8")))
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding(None), ARCHIPEL_ENTRIES_ENCODING_XML)
+        self.assertEqual(negotiate_encoding("xml"), ARCHIPEL_ENTRIES_ENCODING_XML)
+        self.assertEqual(negotiate_encoding("gzip, json+zlib"), ARCHIPEL_ENTRIES_ENCODING_COMPACT)
+        self.assertEqual(negotiate_encoding("gzip"), ARCHIPEL_ENTRIES_ENCODING_XML)
+
+    def test_compact_is_a_single_node(self):
+        nodes = pack_entries(ENTRIES, ARCHIPEL_ENTRIES_ENCODING_COMPACT)
+        self.assertEqual(len(nodes), 1)
+        self.assertEqual(nodes[0].getAttr("count"), 2)
+
+    def test_both_encodings_give_the_same_entries(self):
+        xml_entries = self.received(ARCHIPEL_ENTRIES_ENCODING_XML)
+        compact_entries = self.received(ARCHIPEL_ENTRIES_ENCODING_COMPACT)
+        self.assertEqual(xml_entries, compact_entries)
+        self.assertEqual(compact_entries[0]["name"], u"caf\xe9")
+        self.assertEqual(compact_entries[0]["creation_date"], u"12")
+        self.assertEqual(compact_entries[1]["creation_date"], u"None")
+        self.assertEqual(compact_entries[0]["domain"], ENTRIES[0]["domain"])
+
+    def received_empty(self, encoding):
+        event = xmpp.Node("event")
+        for node in pack_entries([], encoding):
+            event.addChild(node=node)
+        return unpack_entries(event)
+
+    def test_empty(self):
+        self.assertEqual(unpack_entries(None), [])
+        self.assertEqual(self.received_empty(ARCHIPEL_ENTRIES_ENCODING_COMPACT), [])
+        self.assertEqual(self.received_empty(ARCHIPEL_ENTRIES_ENCODING_XML), [])
+
+    def test_unknown_encoding(self):
+        event = xmpp.Node("event")
+        event.addChild("entries", attrs={"encoding": "gzip"})
+        self.assertRaises(Exception, unpack_entries, event)
+
+
+if __name__ == "__main__":
+    unittest.main()
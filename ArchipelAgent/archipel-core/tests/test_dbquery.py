@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# test_dbquery.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{TNDBQuery}: SQL generation, paging and XMPP round trip.
+"""
+
+import unittest
+
+from archipelcore import xmpp
+from archipelcore.dbquery import TNDBQuery
+
+
+class TestTNDBQuerySQL (unittest.TestCase):
+
+    def test_select_all_columns(self):
+        statement, params = TNDBQuery("hypervisors").to_sql()
+        self.assertEqual(statement, "select jid, last_seen, status, stat1, stat2, stat3 from hypervisors")
+        self.assertEqual(params, [])
+
+    def test_filters_are_parameterized(self):
+        query = TNDBQuery("vms", ["uuid", "name"]).where("name", "LIKE", "web%").where("hypervisor", "is null")
+        statement, params = query.to_sql()
+        self.assertEqual(statement, "select uuid, name from vms where name like ? and hypervisor is null")
+        self.assertEqual(params, ["web%"])
+
+    def test_in_filter(self):
+        statement, params = TNDBQuery("vms", ["uuid"]).where_in("uuid", ["a", "b"]).to_sql()
+        self.assertEqual(statement, "select uuid from vms where uuid in (?,?)")
+        self.assertEqual(params, ["a", "b"])
+
+    def test_empty_in_filter(self):
+        statement, params = TNDBQuery("vms", ["uuid"]).where_in("uuid", []).where("uuid", "not in", []).to_sql()
+        self.assertEqual(statement, "select uuid from vms where 0 and 1")
+        self.assertEqual(params, [])
+
+    def test_condition_order_and_slice(self):
+        query = TNDBQuery("vms", ["uuid"]).condition("parked").order("name", descending=True).slice(10, 20)
+        statement, params = query.to_sql()
+        self.assertTrue(statement.startswith("select uuid from vms where (hypervisor='None'"))
+        self.assertTrue(statement.endswith(" order by name desc limit ? offset ?"))
+        self.assertEqual(params, [10, 20])
+
+    def test_unknown_names_are_refused(self):
+        self.assertRaises(Exception, TNDBQuery("users").to_sql)
+        self.assertRaises(Exception, TNDBQuery("vms", ["password"]).to_sql)
+        self.assertRaises(Exception, TNDBQuery("vms").where("password", "=", "x").to_sql)
+        self.assertRaises(Exception, TNDBQuery("vms").where("uuid", "; drop", "x").to_sql)
+        self.assertRaises(Exception, TNDBQuery("vms").condition("online").to_sql)
+        self.assertRaises(Exception, TNDBQuery("vms").order("password").to_sql)
+
+
+class TestTNDBQueryPaging (unittest.TestCase):
+
+    def test_first_page(self):
+        query = TNDBQuery("vms", ["name"]).page(2)
+        statement, params = query.to_sql()
+        self.assertEqual(statement, "select name, uuid from vms order by uuid limit ?")
+        self.assertEqual(params, [3])
+
+    def test_next_page(self):
+        statement, params = TNDBQuery("vms", ["uuid"]).where("name", "=", "web").page(2, "b").to_sql()
+        self.assertEqual(statement, "select uuid from vms where name = ? and uuid > ? order by uuid limit ?")
+        self.assertEqual(params, ["web", "b", 3])
+
+    def test_split_page(self):
+        query = TNDBQuery("vms", ["uuid"]).page(2)
+        entries = [{"uuid": "a"}, {"uuid": "b"}, {"uuid": "c"}]
+        self.assertEqual(query.split_page(entries), ([{"uuid": "a"}, {"uuid": "b"}], "b"))
+        self.assertEqual(query.split_page(entries[:2]), (entries[:2], None))
+
+    def test_not_pageable(self):
+        self.assertFalse(TNDBQuery("vms").order("name").is_pageable())
+        self.assertFalse(TNDBQuery("vms").slice(1).is_pageable())
+        self.assertTrue(TNDBQuery("vms").order("uuid").is_pageable())
+        self.assertRaises(Exception, TNDBQuery("vms").order("name").page(10).to_sql)
+
+    def test_rows_to_entries(self):
+        query = TNDBQuery("hypervisors", ["jid", "status"])
+        self.assertEqual(query.rows_to_entries([("h1@x", "Online")]), [{"jid": "h1@x", "status": "Online"}])
+
+
+class TestTNDBQueryXMPP (unittest.TestCase):
+
+    def round_trip(self, query):
+        node = query.to_node(xmpp.Node("event"))
+        return TNDBQuery.from_node(xmpp.simplexml.XML2Node(str(node)))
+
+    def test_round_trip(self):
+        query = TNDBQuery("vms", ["uuid", "name"]).where_in("uuid", ["a", "b"]).where("name", "!=", "x")
+        query.condition("defined").order("name", descending=True).slice(5, 10)
+        received = self.round_trip(query)
+        self.assertEqual(received.to_sql(), query.to_sql())
+
+    def test_round_trip_page(self):
+        query = TNDBQuery("hypervisors").condition("online").page(50, "h1@x")
+        self.assertEqual(self.round_trip(query).to_sql(), query.to_sql())
+
+    def test_operator_case_and_spaces(self):
+        node = xmpp.Node("event", attrs={"table": "vms", "columns": "uuid"})
+        filter_node = node.addChild("filter", attrs={"column": "uuid", "operator": " NOT IN "})
+        filter_node.addChild("value", attrs={"value": "a"})
+        filter_node.addChild("value", attrs={"value": "b"})
+        statement, params = TNDBQuery.from_node(node).to_sql()
+        self.assertEqual(statement, "select uuid from vms where uuid not in (?,?)")
+        self.assertEqual(params, ["a", "b"])
+
+    def test_forced_table(self):
+        node = TNDBQuery("hypervisors").to_node(xmpp.Node("event"))
+        self.assertEqual(TNDBQuery.from_node(node, table="vms").table, "vms")
+
+
+if __name__ == "__main__":
+    unittest.main()
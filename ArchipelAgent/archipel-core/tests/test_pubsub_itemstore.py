@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# test_pubsub_itemstore.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{TNPubSubItemStore}, the in memory copy of the items of a pubsub node.
+"""
+
+import unittest
+
+from archipelcore import xmpp
+from archipelcore.pubsub import TNPubSubItemStore, get_shared_item_store
+
+
+def build_item(item_id, jid=None):
+    """
+    Build a pubsub item with a <tag/> payload.
+    @type item_id: string
+    @param item_id: the id of the item
+    @type jid: string
+    @param jid: if not None, the jid attribute of the payload
+    @rtype: xmpp.Node
+    @return: the item
+    """
+    item = xmpp.Node("item", attrs={"id": item_id})
+    payload = item.addChild("tag")
+    if jid:
+        payload.setAttr("jid", jid)
+    return item
+
+
+class TestTNPubSubItemStore (unittest.TestCase):
+
+    def setUp(self):
+        self.store = TNPubSubItemStore(index_attribute="jid")
+
+    def test_reset(self):
+        self.assertFalse(self.store.synchronized)
+        self.store.reset([build_item("1", "a@x"), build_item("2", "b@x")])
+        self.assertTrue(self.store.synchronized)
+        self.assertEqual([item.getAttr("id") for item in self.store.get_all()], ["1", "2"])
+        self.store.invalidate()
+        self.assertFalse(self.store.synchronized)
+
+    def test_ids_are_compared_without_case(self):
+        self.store.put(build_item("AbC", "a@x"))
+        self.assertEqual(self.store.get("abc").getAttr("id"), "AbC")
+        self.assertTrue(self.store.remove("ABC"))
+        self.assertFalse(self.store.remove("abc"))
+        self.assertEqual(self.store.get("abc"), None)
+
+    def test_index(self):
+        self.store.put(build_item("1", "a@x"))
+        self.store.put(build_item("2", "a@x"))
+        self.store.put(build_item("3", "b@x"))
+        self.store.put(build_item("4"))
+        self.assertEqual([item.getAttr("id") for item in self.store.get_by_index("a@x")], ["1", "2"])
+        self.store.remove("1")
+        self.assertEqual([item.getAttr("id") for item in self.store.get_by_index("a@x")], ["2"])
+        self.store.remove("2")
+        self.assertEqual(self.store.get_by_index("a@x"), [])
+        self.assertFalse("a@x" in self.store.index)
+
+    def test_replace_updates_index_and_order(self):
+        self.store.put(build_item("1", "a@x"))
+        self.store.put(build_item("2", "b@x"))
+        self.store.put(build_item("1", "c@x"))
+        self.assertEqual(self.store.get_by_index("a@x"), [])
+        self.assertEqual([item.getAttr("id") for item in self.store.get_by_index("c@x")], ["1"])
+        self.assertEqual([item.getAttr("id") for item in self.store.get_all()], ["2", "1"])
+
+    def test_max_items_drops_the_oldest(self):
+        store = TNPubSubItemStore(index_attribute="jid", max_items=2)
+        for item_id in ("1", "2", "3"):
+            store.put(build_item(item_id, "a@x"))
+        self.assertEqual([item.getAttr("id") for item in store.get_all()], ["2", "3"])
+        self.assertEqual([item.getAttr("id") for item in store.get_by_index("a@x")], ["2", "3"])
+
+    def test_apply_event(self):
+        self.store.reset([build_item("1", "a@x")])
+        event_items = xmpp.Node("items")
+        event_items.addChild(node=build_item("2", "b@x"))
+        event_items.addChild("item", attrs={"id": "3"})
+        event_items.addChild("retract", attrs={"id": "1"})
+        missing_ids = self.store.apply_event(event_items)
+        self.assertEqual(missing_ids, ["3"])
+        self.assertEqual([item.getAttr("id") for item in self.store.get_all()], ["2"])
+
+    def test_shared_store(self):
+        store = get_shared_item_store("pubsub.x", "/archipel/tags", "jid")
+        self.assertTrue(get_shared_item_store(xmpp.JID("pubsub.x"), "/archipel/tags") is store)
+        self.assertFalse(get_shared_item_store("pubsub.x", "/archipel/other") is store)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# test_pubsub_publishqueue.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests of L{TNPubSubPublishQueue}: pipelining, coalescing, backpressure and expiry.
+"""
+
+import unittest
+
+from archipelcore import xmpp
+from archipelcore.pubsub import TNPubSubPublishQueue
+
+
+class FakePubSubNode (object):
+    """
+    Records the publications and retractions instead of sending them.
+    The answers are given with answer().
+    """
+
+    def __init__(self):
+        self.pubsubserver   = "pubsub.x"
+        self.nodename       = "/archipel/test"
+        self.requests       = []
+        self.fail           = False
+
+    def add_item(self, itemcontentnode, callback=None, item_id=None):
+        if self.fail:
+            raise Exception("not connected")
+        self.requests.append(("publish", item_id or itemcontentnode.getName(), callback))
+
+    def remove_item(self, item_id, callback=None):
+        self.requests.append(("retract", item_id, callback))
+
+    def sent(self):
+        return [(action, target) for action, target, callback in self.requests]
+
+    def answer(self, index, typ="result"):
+        self.requests[index][2](xmpp.Iq(typ=typ))
+
+
+class TestTNPubSubPublishQueue (unittest.TestCase):
+
+    def setUp(self):
+        self.node = FakePubSubNode()
+        self.answers = []
+
+    def callback(self, name):
+        return lambda resp: self.answers.append((name, resp.getType()))
+
+    def test_pipelining(self):
+        queue = TNPubSubPublishQueue(self.node, max_in_flight=2)
+        for name in ("a", "b", "c"):
+            queue.publish(xmpp.Node(name), callback=self.callback(name))
+        self.assertEqual(self.node.sent(), [("publish", "a"), ("publish", "b")])
+        self.node.answer(0)
+        self.assertEqual(self.node.sent(), [("publish", "a"), ("publish", "b"), ("publish", "c")])
+        self.assertEqual(self.answers, [("a", "result")])
+        self.assertEqual(queue.get_statistics()["in_flight"], 2)
+        self.assertEqual(queue.get_statistics()["sent"], 3)
+
+    def test_coalescing(self):
+        queue = TNPubSubPublishQueue(self.node, max_in_flight=1)
+        queue.publish(xmpp.Node("first"))
+        queue.publish(xmpp.Node("v1"), item_id="vm", callback=self.callback("v1"))
+        queue.publish(xmpp.Node("s1"), coalesce_key="stats")
+        queue.publish(xmpp.Node("v2"), item_id="vm", callback=self.callback("v2"))
+        queue.publish(xmpp.Node("s2"), coalesce_key="stats")
+        self.assertEqual(queue.get_statistics()["pending"], 2)
+        self.assertEqual(queue.get_statistics()["coalesced"], 2)
+        self.node.answer(0)
+        self.node.answer(1)
+        self.node.answer(2)
+        self.assertEqual(self.node.sent(), [("publish", "first"), ("publish", "vm"), ("publish", "s2")])
+        self.assertEqual(self.answers, [("v1", "result"), ("v2", "result")])
+
+    def test_retract_replaces_queued_publication(self):
+        queue = TNPubSubPublishQueue(self.node, max_in_flight=1)
+        queue.publish(xmpp.Node("first"))
+        queue.publish(xmpp.Node("v1"), item_id="vm")
+        queue.retract("vm")
+        self.node.answer(0)
+        self.assertEqual(self.node.sent(), [("publish", "first"), ("retract", "vm")])
+
+    def test_backpressure(self):
+        queue = TNPubSubPublishQueue(self.node, max_in_flight=1, high_watermark=1)
+        self.assertTrue(queue.publish(xmpp.Node("a")))
+        self.assertTrue(queue.publish(xmpp.Node("b")))
+        self.assertFalse(queue.publish(xmpp.Node("c")))
+        self.assertTrue(queue.is_congested())
+        self.node.answer(0)
+        self.assertFalse(queue.is_congested())
+
+    def test_expiry(self):
+        queue = TNPubSubPublishQueue(self.node, max_in_flight=1, timeout=0)
+        queue.publish(xmpp.Node("a"), callback=self.callback("a"))
+        self.assertEqual(self.answers, [])
+        # the flush of the next publication fails the expired one and frees its slot
+        queue.publish(xmpp.Node("b"), callback=self.callback("b"))
+        self.assertEqual(self.answers, [("a", "error")])
+        self.assertEqual(self.node.sent(), [("publish", "a"), ("publish", "b")])
+        self.assertEqual(queue.get_statistics()["expired"], 1)
+        # the late answer of an expired request is ignored
+        self.node.answer(0)
+        self.assertEqual([answer for answer in self.answers if answer[0] == "a"], [("a", "error")])
+
+    def test_send_failure(self):
+        queue = TNPubSubPublishQueue(self.node, max_in_flight=1)
+        self.node.fail = True
+        queue.publish(xmpp.Node("a"), callback=self.callback("a"))
+        self.node.fail = False
+        queue.publish(xmpp.Node("b"), callback=self.callback("b"))
+        self.assertEqual(self.answers, [("a", "error")])
+        self.assertEqual(self.node.sent(), [("publish", "b")])
+        self.assertEqual(queue.get_statistics()["failed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()